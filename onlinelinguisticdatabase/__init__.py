@@ -16,5 +16,5 @@
 
 """
 
-__version__ = '2.0.0'
+__version__ = '2.1.0'
 
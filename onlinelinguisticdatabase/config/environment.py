@@ -19,15 +19,18 @@
 
 """
 
-import os, re
+import os
 
 from mako.lookup import TemplateLookup
 from pylons.configuration import PylonsConfig
 from pylons.error import handle_mako_error
-from sqlalchemy import engine_from_config
+from paste.deploy.converters import aslist
 import onlinelinguisticdatabase.lib.app_globals as app_globals
 import onlinelinguisticdatabase.lib.helpers
 from onlinelinguisticdatabase.lib.foma_worker import start_foma_worker
+from onlinelinguisticdatabase.lib.resize import start_derivative_workers
+from onlinelinguisticdatabase.lib.backupwriter import start_backup_flusher
+from onlinelinguisticdatabase.lib.dbengine import get_engine
 from onlinelinguisticdatabase.config.routing import make_map
 from onlinelinguisticdatabase.model import init_model
 import logging
@@ -39,9 +42,10 @@ def load_environment(global_conf, app_conf):
     
     .. note::
     
-        This is where the ``regexp`` operator for SQLite is defined and where
-        the ``PRAGMA`` command is issued to make SQLite LIKE queries
-        case-sensitive.
+        This is where the database engines are created.  The ``regexp``
+        operator for SQLite, the ``PRAGMA`` command that makes SQLite LIKE
+        queries case-sensitive and the connection pool options are in
+        ``lib/dbengine.py``.
 
     """
     config = PylonsConfig()
@@ -72,67 +76,27 @@ def load_environment(global_conf, app_conf):
         input_encoding='utf-8', default_filters=['escape'],
         imports=['from webhelpers.html import escape'])
 
-    engine = engine_from_config(config, 'sqlalchemy.')
-
     # CONFIGURATION OPTIONS HERE (note: all config options will override
     # any Pylons config options)
 
-    # Patch the SQLAlchemy database engine if SQLite is the RDBMS.  Add a REGEXP
-    # function and make LIKE searches case-sensitive.
-    RDBMSName = config['sqlalchemy.url'].split(':')[0]
-    app_globals.RDBMSName = RDBMSName
-    if RDBMSName == 'sqlite':
-        # Try to use the event API of SQLA>=0.7; otherwise use a PoolListener a l SQLA ca. 0.5.8
-        try:
-            from sqlalchemy import event
-            from sqlalchemy.engine import Engine
-            @event.listens_for(Engine, 'connect')
-            def sqlite_patches(dbapi_connection, connection_record):
-                # Define a regexp function for SQLite,
-                def regexp(expr, item):
-                    """This is the Python re-based regexp function that we provide
-                    for SQLite.  Note that searches will be case-sensitive by
-                    default.  Such behaviour is assured in MySQL by inserting
-                    COLLATE expressions into the query (cf. in SQLAQueryBuilder.py).
-                    """
-                    patt = re.compile(expr)
-                    try:
-                        return item and patt.search(item) is not None
-                    # This will make regexp searches work on int, date & datetime fields.
-                    except TypeError:
-                        return item and patt.search(str(item)) is not None
-                dbapi_connection.create_function('regexp', 2, regexp)
-                # Make LIKE searches case-sensitive in SQLite.
-                cursor = dbapi_connection.cursor()
-                cursor.execute("PRAGMA case_sensitive_like=ON")
-                cursor.close()
-        except ImportError:
-            from sqlalchemy.interfaces import PoolListener
-            class SQLiteSetup(PoolListener):
-                """A PoolListener used to provide the SQLite dbapi with a regexp function.
-                """
-                def connect(self, conn, conn_record):
-                    conn.create_function('regexp', 2, self.regexp)
-
-                def regexp(self, expr, item):
-                    """This is the Python re-based regexp function that we provide for SQLite.
-                    Note that searches will be case-sensitive by default, which may not be
-                    the default for the MySQL regexp, depending on the collation."""
-                    patt = re.compile(expr)
-                    try:
-                        return item and patt.search(item) is not None
-                    # This will make regexp searches work on int, date & datetime fields.
-                    # I think this is desirable ...
-                    except TypeError:
-                        return item and patt.search(str(item)) is not None
-            engine = engine_from_config(
-                config, 'sqlalchemy.', listeners=[SQLiteSetup()])
-            # Make LIKE searches case sensitive in SQLite
-            engine.execute('PRAGMA case_sensitive_like=ON')
-
-    init_model(engine)
+    # Create the database engines, cf. lib/dbengine.py.  If SQLite is the RDBMS,
+    # the engines add a REGEXP function and make LIKE searches case-sensitive.
+    # The read replicas get the same engine options as the primary database.
+    engine = get_engine(config)
+    app_globals.RDBMSName = config['sqlalchemy.url'].split(':')[0]
+    replica_engines = [get_engine(config, replica_url) for replica_url in
+                       aslist(config.get('replica_urls'), ',', True)]
+
+    init_model(engine, replica_engines)
 
     # start foma worker -- used for long-running tasks like FST compilation
     foma_worker = start_foma_worker()
 
+    # start derivative workers -- used for creating reduced copies of image and audio files
+    start_derivative_workers(config)
+
+    # start the backup flusher -- used to write backups outside of requests if
+    # the defer_backups option is set
+    start_backup_flusher(config)
+
     return config
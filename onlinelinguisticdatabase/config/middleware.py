@@ -27,6 +27,8 @@ from pylons.middleware import ErrorHandler, StatusCodeRedirect
 from pylons.wsgiapp import PylonsApp
 from routes.middleware import RoutesMiddleware
 from onlinelinguisticdatabase.config.environment import load_environment
+from onlinelinguisticdatabase.lib.profiling import ProfilingMiddleware
+import onlinelinguisticdatabase.lib.helpers as h
 import logging
 import pprint
 
@@ -158,6 +160,16 @@ def make_app(global_conf, full_stack=False, static_files=True, **app_conf):
     # nasty text/html content types and converts them to application/json!
     app = HTML2JSONContentType(app)
 
+    # Record the wall time, SQL, subprocess and JSON serialization costs of
+    # each request and serve them at /metrics, cf. lib/profiling.py.
+    if asbool(config.get('profile_requests', 0)):
+        sample_rate = float(config.get('profile_sample_rate', 0))
+        profile_dir = None
+        if sample_rate:
+            profile_dir = h.get_OLD_directory_path('profiles', config=config)
+            h.make_directory_safely(profile_dir)
+        app = ProfilingMiddleware(app, sample_rate, profile_dir)
+
     if asbool(full_stack):
         # Handle Python exceptions
         app = ErrorHandler(app, global_conf, **config['pylons.errorware'])
@@ -90,6 +90,14 @@ def make_map(config):
                 action='writetofile', conditions=dict(method='PUT'))
     map.connect('/corpora/new_search', controller='corpora', action='new_search')
 
+    map.connect('/files/uploads', controller='files', action='create_upload',
+                conditions=dict(method='POST'))
+    map.connect('/files/uploads/{id}', controller='files', action='show_upload',
+                conditions=dict(method='GET'))
+    map.connect('/files/uploads/{id}', controller='files', action='upload_chunk',
+                conditions=dict(method='PUT'))
+    map.connect('/files/uploads/{id}/finalize', controller='files', action='finalize_upload',
+                conditions=dict(method='POST'))
     map.connect('/files/{id}/serve', controller='files', action='serve')
     map.connect('/files/{id}/serve_reduced', controller='files', action='serve_reduced')
 
@@ -102,6 +110,12 @@ def make_map(config):
     map.connect('/login/logout', controller='login', action='logout')
     map.connect('/login/email_reset_password', controller='login', action='email_reset_password')
 
+    # The request metrics are only served if request profiling is enabled, cf.
+    # lib/profiling.py.
+    map.connect('/metrics', controller='metrics', action='delete',
+                conditions=dict(method='DELETE'))
+    map.connect('/metrics', controller='metrics', action='index')
+
     map.connect('/morphemelanguagemodels/{id}/compute_perplexity', controller='morphemelanguagemodels',
                 action='compute_perplexity', conditions=dict(method='PUT'))
     map.connect('/morphemelanguagemodels/{id}/generate', controller='morphemelanguagemodels',
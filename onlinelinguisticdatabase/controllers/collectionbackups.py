@@ -74,7 +74,8 @@ class CollectionbackupsController(BaseController):
             python_search_params = json.loads(json_search_params)
             SQLAQuery = self.query_builder.get_SQLA_query(python_search_params.get('query'))
             query = h.filter_restricted_models('CollectionBackup', SQLAQuery)
-            return h.add_pagination(query, python_search_params.get('paginator'))
+            return h.restore_backups(
+                h.add_pagination(query, python_search_params.get('paginator')))
         except h.JSONDecodeError:
             response.status_int = 400
             return h.JSONDecodeErrorResponse
@@ -114,7 +115,7 @@ class CollectionbackupsController(BaseController):
             query = Session.query(CollectionBackup)
             query = h.add_order_by(query, dict(request.GET), self.query_builder)
             query = h.filter_restricted_models(u'CollectionBackup', query)
-            return h.add_pagination(query, dict(request.GET))
+            return h.restore_backups(h.add_pagination(query, dict(request.GET)))
         except Invalid, e:
             response.status_int = 400
             return {'errors': e.unpack_errors()}
@@ -152,10 +153,9 @@ class CollectionbackupsController(BaseController):
         """
         collection_backup = Session.query(CollectionBackup).get(id)
         if collection_backup:
-            unrestricted_users = h.get_unrestricted_users()
-            user = session['user']
-            if h.user_is_authorized_to_access_model(user, collection_backup, unrestricted_users):
-                return collection_backup
+            user = h.get_principal()
+            if h.user_is_authorized_to_access_model(user, collection_backup):
+                return h.restore_backups([collection_backup])[0]
             else:
                 response.status_int = 403
                 return h.unauthorized_msg
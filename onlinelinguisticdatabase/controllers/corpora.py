@@ -21,21 +21,22 @@
 
 import logging
 import os
-import codecs
+from array import array
 from uuid import uuid4
 from shutil import rmtree
 import simplejson as json
-from paste.fileapp import FileApp
 from pylons import request, response, session, config
 from pylons.controllers.util import forward
 from formencode.validators import Invalid
 from onlinelinguisticdatabase.lib.base import BaseController
+from onlinelinguisticdatabase.lib.backupwriter import BackupWriter
 from onlinelinguisticdatabase.lib.schemata import CorpusSchema, CorpusFormatSchema
 import onlinelinguisticdatabase.lib.helpers as h
 from onlinelinguisticdatabase.lib.SQLAQueryBuilder import SQLAQueryBuilder, OLDSearchParseError
 from onlinelinguisticdatabase.model.meta import Session
 from onlinelinguisticdatabase.model import Corpus, CorpusBackup, CorpusFile, Form
-from subprocess import call, Popen
+from onlinelinguisticdatabase.lib.foma_worker import foma_worker_q
+from onlinelinguisticdatabase.lib import treebank
 
 log = logging.getLogger(__name__)
 
@@ -133,7 +134,7 @@ class CorporaController(BaseController):
                 return {'errors': e.unpack_errors()}
             except Exception, e:
                 log.warn("%s's filter expression (%s) raised an unexpected exception: %s." % (
-                    h.get_user_full_name(session['user']), request.body, e))
+                    h.get_user_full_name(h.get_principal()), request.body, e))
                 response.status_int = 400
                 return {'error': u'The specified search parameters generated an invalid database query'}
         else:
@@ -373,11 +374,28 @@ class CorporaController(BaseController):
             is a list of dictionaries representing previous versions of the
             corpus.
 
+            If the ``page`` and ``items_per_page`` query string parameters are
+            supplied, ``previous_versions`` contains only the requested page
+            of previous versions (most recent first) and the dictionary has a
+            ``paginator`` key whose value includes the total ``count``.
+
         """
-        corpus, previous_versions = h.get_model_and_previous_versions('Corpus', id)
-        if corpus or previous_versions:
-            return {'corpus': corpus,
-                    'previous_versions': previous_versions}
+        try:
+            corpus, previous_versions = h.get_model_and_previous_versions(
+                'Corpus', id, dict(request.GET))
+        except Invalid, e:
+            response.status_int = 400
+            return {'errors': e.unpack_errors()}
+        paginator = None
+        if isinstance(previous_versions, dict):
+            paginator = previous_versions['paginator']
+            previous_versions = previous_versions['items']
+        if corpus or previous_versions or (paginator and paginator['count']):
+            result = {'corpus': corpus,
+                      'previous_versions': previous_versions}
+            if paginator:
+                result['paginator'] = paginator
+            return result
         else:
             response.status_int = 404
             return {'error': 'No corpora or corpus backups match %s' % id}
@@ -394,6 +412,12 @@ class CorporaController(BaseController):
         :param str id: the ``id`` value of the corpus.
         :returns: the modified corpus model (or a JSON error message).
 
+        .. note::
+
+            The file is written asynchronously by a worker thread.  The
+            ``write_status`` and ``forms_written`` values of the corpus file
+            report the progress of the write.
+
         """
         #corpus = h.eagerload_corpus(Session.query(Corpus), eagerload_forms=True).get(id)
         corpus = Session.query(Corpus).get(id)
@@ -430,8 +454,8 @@ class CorporaController(BaseController):
                 corpus_file = filter(lambda cf: cf.id == int(file_id), corpus.files)[0]
                 corpus_file_path = os.path.join(get_corpus_dir_path(corpus),
                                               '%s.gz' % corpus_file.filename)
-                if authorized_to_access_corpus_file(session['user'], corpus_file):
-                    return forward(FileApp(corpus_file_path, content_type='application/x-gzip'))
+                if authorized_to_access_corpus_file(h.get_principal(), corpus_file):
+                    return forward(h.FileServer(corpus_file_path, content_type='application/x-gzip'))
                 else:
                     response.status_int = 403
                     return json.dumps(h.unauthorized_msg)
@@ -456,27 +480,28 @@ class CorporaController(BaseController):
         :param str id: the ``id`` value of the corpus.
         :returns: an array of forms as JSON objects
 
+        .. note::
+
+            Patterns are evaluated by the in-process engine in
+            ``lib/treebank.py``, which supports a subset of the TGrep2 pattern
+            language.  Other patterns are passed to the TGrep2 executable, if
+            it is installed.
+
         """
-        if not h.command_line_program_installed('tgrep2'):
-            response.status_int = 400
-            return {'error': 'TGrep2 is not installed.'}
         corpus = Session.query(Corpus).get(id)
         if corpus:
             try:
                 treebank_corpus_file_object = filter(lambda cf: cf.format == u'treebank',
                         corpus.files)[0]
                 corpus_dir_path = get_corpus_dir_path(corpus)
-                tgrep2_corpus_file_path = os.path.join(corpus_dir_path,
-                        '%s.t2c' % treebank_corpus_file_object.filename)
+                treebank_corpus_file_path = os.path.join(corpus_dir_path,
+                        treebank_corpus_file_object.filename)
             except Exception:
                 response.status_int = 400
                 return {'error': 'Corpus %d has not been written to file as a treebank.'}
-            if not os.path.exists(tgrep2_corpus_file_path):
+            if not os.path.exists(treebank_corpus_file_path):
                 response.status_int = 400
                 return {'error': 'Corpus %d has not been written to file as a treebank.'}
-            #if not authorized_to_access_corpus_file(session['user'], treebank_corpus_file_object):
-            #    response.status_int = 403
-            #    return h.unauthorized_msg
             try:
                 request_params = json.loads(unicode(request.body, request.charset))
                 try:
@@ -486,27 +511,11 @@ class CorporaController(BaseController):
                     response.status_int = 400
                     return {'errors': {'tgrep2pattern':
                         'A tgrep2pattern attribute must be supplied and must have a unicode/string value'}}
-                tmp_path = os.path.join(corpus_dir_path, '%s%s.txt' % (session['user'].username, h.generate_salt()))
-                with open(os.devnull, "w") as fnull:
-                    with open(tmp_path, 'w') as stdout:
-                        # The -wu option causes TGrep2 to print only the root symbol of each matching tree
-                        process = Popen(['tgrep2', '-c', tgrep2_corpus_file_path, '-wu', tgrep2pattern],
-                            stdout=stdout, stderr=fnull)
-                        process.communicate()
-                match_ids = filter(None, map(get_form_ids_from_tgrep2_output_line, open(tmp_path, 'r')))
-                os.remove(tmp_path)
-                if match_ids:
-                    query = h.eagerload_form(Session.query(Form)).filter(Form.id.in_(match_ids))
-                    query = h.filter_restricted_models('Form', query)
-                    query = h.add_order_by(query, request_params.get('order_by'), self.query_builder)
-                    result = h.add_pagination(query, request_params.get('paginator'))
-                elif request_params.get('paginator'):
-                    paginator = request_params['paginator']
-                    paginator['count'] = 0
-                    result = {'paginator': paginator, 'items': []}
-                else:
-                    result = []
-                return result
+                match_ids = treebank.search(treebank_corpus_file_object,
+                                            treebank_corpus_file_path, tgrep2pattern)
+                return get_tgrep2_search_results(match_ids,
+                    request_params.get('paginator'), request_params.get('order_by'),
+                    self.query_builder)
             except h.JSONDecodeError:
                 response.status_int = 400
                 return h.JSONDecodeErrorResponse
@@ -539,133 +548,110 @@ class CorporaController(BaseController):
             response.status_int = 404
             return {'error': 'There is no corpus with id %s' % id}
 
-def get_form_ids_from_tgrep2_output_line(line):
-    try:
-        return int(line.split('-')[1])
-    except Exception:
-        return None
+def get_tgrep2_search_results(match_ids, paginator, order_by, query_builder):
+    """Return the forms with ids in ``match_ids``, paginated and ordered as requested.
+
+    Unless the user is unrestricted, the ids of the forms that the user is not
+    authorized to access are first removed from ``match_ids`` (cf.
+    ``h.get_authorized_ids``).  If no ordering is requested, pagination is then
+    performed on the (sorted) list of match ids so that only the forms on the
+    requested page are retrieved and no COUNT query is issued.
+
+    :param match_ids: a sorted ``array`` of form ids, as returned by ``treebank.search``.
+    :param dict paginator: the paginator from the request, or ``None``.
+    :param dict order_by: the order by parameters from the request, or ``None``.
+    :param query_builder: a SQLAQueryBuilder for forms.
+    :returns: a list of forms or a dict with 'paginator' and 'items' keys.
+
+    """
+    user = h.get_principal()
+    if match_ids and not h.user_is_unrestricted(user):
+        authorized = h.get_authorized_ids(user, 'Form', match_ids)
+        match_ids = array('l', [id for id in match_ids if authorized.get(id)])
+    if not match_ids:
+        if paginator:
+            paginator['count'] = 0
+            return {'paginator': paginator, 'items': []}
+        return []
+    query = h.eagerload_form(Session.query(Form))
+    if not order_by:
+        if (paginator and paginator.get('page') is not None and
+            paginator.get('items_per_page') is not None):
+            paginator = h.PaginatorSchema.to_python(paginator)
+            paginator['count'] = len(match_ids)
+            start, end = h.get_start_and_end_from_paginator(paginator)
+            page_ids = match_ids[start:end]
+            items = []
+            if page_ids:
+                items = query.filter(Form.id.in_(page_ids)).order_by(Form.id.asc()).all()
+            if paginator.get('minimal'):
+                items = h.minimal(items)
+            return {'paginator': paginator, 'items': items}
+    query = query.filter(Form.id.in_(match_ids))
+    if paginator is not None:
+        paginator['count'] = len(match_ids)
+    query = h.add_order_by(query, order_by, query_builder)
+    return h.add_pagination(query, paginator)
 
 def authorized_to_access_corpus_file(user, corpus_file):
     """Return True if user is authorized to access the corpus file."""
     if corpus_file.restricted and user.role != u'administrator' and \
-    user not in h.get_unrestricted_users():
+    user.id not in h.get_unrestricted_user_ids():
         return False
     return True
 
 def write_to_file(corpus, format_):
-    """Write the corpus to file in the specified format.
+    """Queue the writing of the corpus to file in the specified format.
 
-    Write the corpus to a binary file, create or update a corpus file model and
-    associate it to the corpus model (if necessary).
+    Create or update the corpus file model of ``corpus`` that corresponds to
+    ``format_``, mark it as queued and have the worker thread write the file.
 
     :param corpus: a corpus model.
     :param str format_: the format of the file to be written.
-    :returns: the corpus modified appropriately (assuming success)
-    :side effects: may write (a) file(s) to disk and update/create a corpus file model.
+    :returns: the corpus modified appropriately.
+    :side effects: creates/updates a corpus file model and queues a job that
+        writes (a) file(s) to disk.
 
     .. note::
 
-        It may be desirable/necessary to perform the corpus file writing
-        asynchronously using a dedicated corpus-file-worker.
+        The response is returned before the file is written.  Clients should
+        poll ``GET /corpora/id`` until the ``write_attempt`` value of the
+        relevant corpus file is unchanged and its ``write_status`` is
+        ``u'complete'`` (or ``u'failed'``).
 
     """
-
-    error_msg = lambda msg: {'error': u'Unable to write corpus %d to file with format "%s". (%s)' % (
-                corpus.id, format_, msg)}
-
-    def update_corpus_file(corpus, filename, modifier, datetime_modified, restricted):
-        """Update the corpus file model of ``corpus`` that matches ``filename``."""
-        corpus_file = [cf for cf in corpus.files if cf.filename == filename][0]
-        corpus_file.restricted = restricted
-        corpus_file.modifier = modifier
-        corpus_file.datetime_modified = corpus.datetime_modified = now
-
-    def generate_new_corpus_file(corpus, filename, format_, creator, datetime_created, restricted):
-        """Create a corpus file model with ``filename`` and append it to ``corpus.files``."""
+    corpus_file_path = get_corpus_file_path(corpus, format_)
+    corpus_filename = os.path.split(corpus_file_path)[1]
+    now = h.now()
+    user = h.get_user()
+    try:
+        corpus_file = [cf for cf in corpus.files if cf.filename == corpus_filename][0]
+    except IndexError:
         corpus_file = CorpusFile()
-        corpus_file.restricted = restricted
+        corpus_file.restricted = False
         corpus.files.append(corpus_file)
-        corpus_file.filename = filename
+        corpus_file.filename = corpus_filename
         corpus_file.format = format_
-        corpus_file.creator = corpus_file.modifier = creator
-        corpus_file.datetime_created = corpus_file.datetime_modified = datetime_created
-        corpus.datetime_modified = datetime_created
-
-    def destroy_file(file_path):
-        try:
-            rmtree(file_path)
-        except Exception:
-            pass
-
-    corpus_file_path = get_corpus_file_path(corpus, format_)
-    update = os.path.exists(corpus_file_path) # If True, we are upating
-    restricted = False
-
-    # Create the corpus file on the filesystem
-    try:
-        writer = h.corpus_formats[format_]['writer']
-        if corpus.form_search:   # ``form_search`` value negates any content.
-            with codecs.open(corpus_file_path, 'w', 'utf8') as f:
-                for form in corpus.forms:
-                    if not restricted and "restricted" in [t.name for t in form.tags]:
-                        restricted = True
-                    f.write(writer(form))
-        else:
-            form_references = corpus.get_form_references(corpus.content)
-            forms = dict([(f.id, f) for f in corpus.forms])
-            with codecs.open(corpus_file_path, 'w', 'utf8') as f:
-                for id in form_references:
-                    form = forms[id]
-                    if not restricted and "restricted" in [t.name for t in form.tags]:
-                        restricted = True
-                    f.write(writer(form))
-        gzipped_corpus_file_path = h.compress_file(corpus_file_path)
-        create_tgrep2_corpus_file(gzipped_corpus_file_path, format_)
-    except Exception, e:
-        destroy_file(corpus_file_path)
-        response.status_int = 400
-        return error_msg(e)
-
-    # Update/create the corpus_file object
-    try:
-        now = h.now()
-        session['user'] = Session.merge(session['user'])
-        user = session['user']
-        corpus_filename = os.path.split(corpus_file_path)[1]
-        if update:
-            try:
-                update_corpus_file(corpus, corpus_filename, user, now, restricted)
-            except Exception:
-                generate_new_corpus_file(corpus, corpus_filename, format_, user,
-                                      now, restricted)
-        else:
-            generate_new_corpus_file(corpus, corpus_filename, format_, user, now,
-                                  restricted)
-    except Exception, e:
-        destroy_file(corpus_file_path)
-        response.status_int = 400
-        return error_msg(e)
+        corpus_file.creator = user
+        corpus_file.datetime_created = now
+    corpus_file.modifier = user
+    corpus_file.datetime_modified = corpus.datetime_modified = now
+    corpus_file.write_attempt = unicode(uuid4())
+    corpus_file.write_status = u'queued'
+    corpus_file.write_message = None
+    corpus_file.forms_written = 0
     Session.commit()
+    foma_worker_q.put({
+        'id': h.generate_salt(),
+        'func': 'write_corpus_file',
+        'args': {
+            'corpus_file_id': corpus_file.id,
+            'file_path': corpus_file_path,
+            'user_id': user.id
+        }
+    })
     return corpus
 
-def create_tgrep2_corpus_file(gzipped_corpus_file_path, format_):
-    """Use TGrep2 to create a .t2c corpus file from the gzipped file of phrase-structure trees.
-
-    :param str gzipped_corpus_file_path: absolute path to the gzipped corpus file.
-    :param str format_: the format in which the corpus has just been written to disk.
-    :returns: the absolute path to the .t2c file or ``False``.
-
-    """
-    if format_ == u'treebank' and h.command_line_program_installed('tgrep2'):
-
-        out_path = '%s.t2c' % os.path.splitext(gzipped_corpus_file_path)[0]
-        with open(os.devnull, "w") as fnull:
-            call(['tgrep2', '-p', gzipped_corpus_file_path, out_path], stdout=fnull, stderr=fnull)
-        if os.path.exists(out_path):
-            return out_path
-        return False
-    return False
-
 ################################################################################
 # Backup corpus
 ################################################################################
@@ -677,9 +663,7 @@ def backup_corpus(corpus_dict):
     :returns: ``None``
 
     """
-    corpus_backup = CorpusBackup()
-    corpus_backup.vivify(corpus_dict)
-    Session.add(corpus_backup)
+    BackupWriter().add(CorpusBackup, corpus_dict).flush()
 
 
 ################################################################################
@@ -711,7 +695,7 @@ def create_new_corpus(data):
     corpus.form_search = data['form_search']
     corpus.forms = data['forms']
     corpus.tags = data['tags']
-    corpus.enterer = corpus.modifier = session['user']
+    corpus.enterer = corpus.modifier = h.get_user()
     corpus.datetime_modified = corpus.datetime_entered = h.now()
     return corpus
 
@@ -741,8 +725,7 @@ def update_corpus(corpus, data):
         changed = True
 
     if changed:
-        session['user'] = Session.merge(session['user'])
-        corpus.modifier = session['user']
+        corpus.modifier = h.get_user()
         corpus.datetime_modified = h.now()
         return corpus
     return changed
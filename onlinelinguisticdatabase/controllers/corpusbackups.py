@@ -73,7 +73,8 @@ class CorpusbackupsController(BaseController):
             json_search_params = unicode(request.body, request.charset)
             python_search_params = json.loads(json_search_params)
             query = self.query_builder.get_SQLA_query(python_search_params.get('query'))
-            return h.add_pagination(query, python_search_params.get('paginator'))
+            return h.restore_backups(
+                h.add_pagination(query, python_search_params.get('paginator')))
         except h.JSONDecodeError:
             response.status_int = 400
             return h.JSONDecodeErrorResponse
@@ -112,7 +113,7 @@ class CorpusbackupsController(BaseController):
         try:
             query = Session.query(CorpusBackup)
             query = h.add_order_by(query, dict(request.GET), self.query_builder)
-            return h.add_pagination(query, dict(request.GET))
+            return h.restore_backups(h.add_pagination(query, dict(request.GET)))
         except Invalid, e:
             response.status_int = 400
             return {'errors': e.unpack_errors()}
@@ -150,10 +151,9 @@ class CorpusbackupsController(BaseController):
         """
         corpus_backup = Session.query(CorpusBackup).get(id)
         if corpus_backup:
-            unrestricted_users = h.get_unrestricted_users()
-            user = session['user']
-            if h.user_is_authorized_to_access_model(user, corpus_backup, unrestricted_users):
-                return corpus_backup
+            user = h.get_principal()
+            if h.user_is_authorized_to_access_model(user, corpus_backup):
+                return h.restore_backups([corpus_backup])[0]
             else:
                 response.status_int = 403
                 return h.unauthorized_msg
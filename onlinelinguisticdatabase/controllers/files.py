@@ -21,11 +21,13 @@
 
 import logging
 import datetime
-import os, shutil
+import os
+import threading
 import simplejson as json
+from hashlib import sha256
+from uuid import uuid4
 from string import letters, digits
 from random import sample
-from paste.fileapp import FileApp
 from pylons import request, response, session, config
 from pylons.controllers.util import forward
 from formencode.validators import Invalid
@@ -33,12 +35,13 @@ from sqlalchemy.orm import subqueryload
 from onlinelinguisticdatabase.lib.base import BaseController
 from onlinelinguisticdatabase.lib.schemata import FileCreateWithBase64EncodedFiledataSchema, \
     FileCreateWithFiledataSchema, FileSubintervalReferencingSchema, \
-    FileExternallyHostedSchema, FileUpdateSchema
+    FileExternallyHostedSchema, FileUpdateSchema, FileUploadSchema
 import onlinelinguisticdatabase.lib.helpers as h
 from onlinelinguisticdatabase.lib.SQLAQueryBuilder import SQLAQueryBuilder, OLDSearchParseError
 from onlinelinguisticdatabase.model.meta import Session
 from onlinelinguisticdatabase.model import File
-from onlinelinguisticdatabase.lib.resize import save_reduced_copy
+from onlinelinguisticdatabase.lib.resize import queue_reduced_copy, lossy_retry_after, get_checksum
+from onlinelinguisticdatabase.lib.blobstore import write_blob, store_blob, release_blob
 
 log = logging.getLogger(__name__)
 
@@ -178,9 +181,9 @@ class FilesController(BaseController):
                     file = create_subinterval_referencing_file(values)
             else:
                 file = create_plain_file()
-            file.lossy_filename = save_reduced_copy(file, config)
             Session.add(file)
             Session.commit()
+            queue_reduced_copy(file, config)
             return file
         except h.JSONDecodeError:
             response.status_int = 400
@@ -226,9 +229,8 @@ class FilesController(BaseController):
         """
         file = h.eagerload_file(Session.query(File)).get(int(id))
         if file:
-            unrestricted_users = h.get_unrestricted_users()
-            user = session['user']
-            if h.user_is_authorized_to_access_model(user, file, unrestricted_users):
+            user = h.get_principal()
+            if h.user_is_authorized_to_access_model(user, file):
                 try:
                     if getattr(file, 'parent_file', None):
                         file = update_subinterval_referencing_file(file)
@@ -276,8 +278,9 @@ class FilesController(BaseController):
         """
         file = h.eagerload_file(Session.query(File)).get(id)
         if file:
-            if session['user'].role == u'administrator' or \
-            file.enterer is session['user']:
+            principal = h.get_principal()
+            if principal.role == u'administrator' or \
+            file.enterer_id == principal.id:
                 delete_file(file)
                 return file
             else:
@@ -300,9 +303,8 @@ class FilesController(BaseController):
         """
         file = h.eagerload_file(Session.query(File)).get(id)
         if file:
-            unrestricted_users = h.get_unrestricted_users()
-            user = session['user']
-            if h.user_is_authorized_to_access_model(user, file, unrestricted_users):
+            user = h.get_principal()
+            if h.user_is_authorized_to_access_model(user, file):
                 return file
             else:
                 response.status_int = 403
@@ -341,8 +343,7 @@ class FilesController(BaseController):
         response.content_type = 'application/json'
         file = h.eagerload_file(Session.query(File)).get(id)
         if file:
-            unrestricted_users = h.get_unrestricted_users()
-            if h.user_is_authorized_to_access_model(session['user'], file, unrestricted_users):
+            if h.user_is_authorized_to_access_model(h.get_principal(), file):
                 return {'data': get_new_edit_file_data(request.GET), 'file': file}
             else:
                 response.status_int = 403
@@ -369,9 +370,168 @@ class FilesController(BaseController):
         :param str id: the ``id`` value of the file whose reduced-size file data
             are requested.
 
+        .. note::
+
+            Reduced-size copies are created in the background after file
+            creation.  Until the copy is ready, the response has status 202 and
+            a ``Retry-After`` header.
+
         """
         return serve_file(id, True)
 
+    @h.jsonify
+    @h.restrict('POST')
+    @h.authenticate
+    @h.authorize(['administrator', 'contributor'])
+    def create_upload(self):
+        """Initiate a chunked upload of file data.
+
+        :URL: ``POST /files/uploads``
+        :request body: JSON object with a ``filename`` attribute and an
+            optional ``size`` attribute (the total number of bytes to be uploaded).
+        :returns: a JSON object representing the upload, i.e., with ``id``,
+            ``filename``, ``size`` and ``offset`` attributes.
+
+        .. note::
+
+            A chunked upload is an alternative to the multipart/form-data and
+            Base64 methods of file creation that never holds more than a chunk
+            of the file data in memory.  The file data are sent in one or more
+            ``PUT /files/uploads/id?offset=n`` requests whose bodies are the
+            raw bytes starting at offset ``n``.  An interrupted upload can be
+            resumed by requesting ``GET /files/uploads/id`` and continuing from
+            the ``offset`` returned.  Finally, ``POST /files/uploads/id/finalize``
+            (with the file's metadata as JSON) creates the file resource.
+
+        """
+        try:
+            values = json.loads(unicode(request.body, request.charset))
+            data = FileUploadSchema().to_python(values)
+            return create_upload(data)
+        except h.JSONDecodeError:
+            response.status_int = 400
+            return h.JSONDecodeErrorResponse
+        except Invalid, e:
+            response.status_int = 400
+            return {'errors': e.unpack_errors()}
+
+    @h.jsonify
+    @h.restrict('GET')
+    @h.authenticate
+    @h.authorize(['administrator', 'contributor'])
+    def show_upload(self, id):
+        """Return the upload with ``id``, including the offset at which to resume it.
+
+        :URL: ``GET /files/uploads/id``
+        :param str id: the ``id`` value of the upload.
+
+        """
+        upload = get_upload(id)
+        if not upload:
+            response.status_int = 404
+            return {'error': 'There is no upload with id %s' % id}
+        if upload['user_id'] != h.get_principal().id:
+            response.status_int = 403
+            return h.unauthorized_msg
+        return upload
+
+    @h.jsonify
+    @h.restrict('PUT')
+    @h.authenticate
+    @h.authorize(['administrator', 'contributor'])
+    def upload_chunk(self, id):
+        """Append a chunk of file data to the upload with ``id``.
+
+        :URL: ``PUT /files/uploads/id?offset=n``
+        :request body: the raw bytes of the file data starting at offset ``n``.
+        :param str id: the ``id`` value of the upload.
+        :returns: the upload, with its new ``offset``.
+
+        If ``n`` is not the upload's current offset, the response has status
+        409 and the current offset is returned so that the client can resume
+        from there.
+
+        """
+        upload = get_upload(id)
+        if not upload:
+            response.status_int = 404
+            return {'error': 'There is no upload with id %s' % id}
+        if upload['user_id'] != h.get_principal().id:
+            response.status_int = 403
+            return h.unauthorized_msg
+        try:
+            offset = int(request.GET.get('offset'))
+        except (TypeError, ValueError):
+            response.status_int = 400
+            return {'errors': {'offset': u'An integer offset must be supplied.'}}
+        lock = get_upload_lock(id)
+        if not lock.acquire(False):
+            response.status_int = 409
+            return {'error': u'Another chunk of upload %s is being written.' % id,
+                    'offset': upload['offset']}
+        try:
+            if offset != upload['offset']:
+                response.status_int = 409
+                return {'error': u'The offset of upload %s is %d, not %d.' % (
+                        id, upload['offset'], offset), 'offset': upload['offset']}
+            length = request.content_length or 0
+            if upload['size'] is not None and offset + length > upload['size']:
+                response.status_int = 400
+                return {'error': u'The chunk would make upload %s larger than its declared size of %d bytes.' % (
+                        id, upload['size'])}
+            return write_upload_chunk(upload, request.body_file_raw, length)
+        finally:
+            lock.release()
+
+    @h.jsonify
+    @h.restrict('POST')
+    @h.authenticate
+    @h.authorize(['administrator', 'contributor'])
+    def finalize_upload(self, id):
+        """Create a file resource from the completed upload with ``id``.
+
+        :URL: ``POST /files/uploads/id/finalize``
+        :request body: JSON object with the (optional) metadata of the new file,
+            i.e., the attributes accepted by ``POST /files`` minus the file data.
+        :param str id: the ``id`` value of the upload.
+        :returns: the newly created file.
+
+        """
+        upload = get_upload(id)
+        if not upload:
+            response.status_int = 404
+            return {'error': 'There is no upload with id %s' % id}
+        if upload['user_id'] != h.get_principal().id:
+            response.status_int = 403
+            return h.unauthorized_msg
+        if upload['size'] is not None and upload['offset'] != upload['size']:
+            response.status_int = 400
+            return {'error': u'Upload %s is incomplete: %d of %d bytes have been received.' % (
+                    id, upload['offset'], upload['size'])}
+        lock = get_upload_lock(id)
+        if not lock.acquire(False):
+            response.status_int = 409
+            return {'error': u'Another chunk of upload %s is being written.' % id,
+                    'offset': upload['offset']}
+        try:
+            values = {}
+            if request.body:
+                values = json.loads(unicode(request.body, request.charset))
+            file = create_file_from_upload(upload, values)
+            Session.add(file)
+            Session.commit()
+            remove_upload(upload, keep_data=True)
+            queue_reduced_copy(file, config)
+            return file
+        except h.JSONDecodeError:
+            response.status_int = 400
+            return h.JSONDecodeErrorResponse
+        except Invalid, e:
+            response.status_int = 400
+            return {'errors': e.unpack_errors()}
+        finally:
+            lock.release()
+
 
 def serve_file(id, reduced=False):
     """Serve the content (binary data) of a file.
@@ -387,21 +547,25 @@ def serve_file(id, reduced=False):
         response.status_int = 400
         return json.dumps({'error': u'The content of file %s is stored elsewhere at %s' % (id, file.url)})
     if file:
+        if not h.user_is_authorized_to_access_file(h.get_principal(), file):
+            response.status_int = 403
+            return json.dumps(h.unauthorized_msg)
         files_dir = h.get_OLD_directory_path('files', config=config)
+        etag = None
         if reduced:
             filename = getattr(file, 'lossy_filename', None)
+            if file.lossy_status in (u'queued', u'processing'):
+                response.status_int = 202
+                response.headers['Retry-After'] = str(lossy_retry_after)
+                return json.dumps({'message': u'The size-reduced copy of file %s is being created' % id})
             if not filename:
                 response.status_int = 404
                 return json.dumps({'error': u'There is no size-reduced copy of file %s' % id})
             file_path = os.path.join(files_dir, 'reduced_files', filename)
         else:
             file_path = os.path.join(files_dir, file.filename)
-        unrestricted_users = h.get_unrestricted_users()
-        if h.user_is_authorized_to_access_model(session['user'], file, unrestricted_users):
-            return forward(FileApp(file_path))
-        else:
-            response.status_int = 403
-            return json.dumps(h.unauthorized_msg)
+            etag = file.checksum
+        return forward(h.FileServer(file_path, etag=etag))
     else:
         response.status_int = 404
         return json.dumps({'error': 'There is no file with id %s' % id})
@@ -450,10 +614,10 @@ def add_standard_metadata(file, data):
     file.datetime_modified = now
     # Because of SQLAlchemy's uniqueness constraints, we may need to set the
     # enterer to the elicitor.
-    if data['elicitor'] and (data['elicitor'].id == session['user'].id):
+    if data['elicitor'] and (data['elicitor'].id == h.get_principal().id):
         file.enterer = data['elicitor']
     else:
-        file.enterer = session['user']
+        file.enterer = h.get_user()
     return file
 
 def restrict_file_by_forms(file):
@@ -488,7 +652,7 @@ def create_base64_file(data):
     schema = FileCreateWithBase64EncodedFiledataSchema()
     state = h.State()
     state.full_dict = data
-    state.user = session['user']
+    state.user = h.get_principal()
     data = schema.to_python(data, state)
 
     file = File()
@@ -497,17 +661,18 @@ def create_base64_file(data):
 
     file = add_standard_metadata(file, data)
 
-    # Write the file to disk (making sure it's unique and thereby potentially)
-    # modifying file.filename; and calculate file.size.
+    # Write the file to the blob store and link it under a unique filename
+    # (thereby potentially modifying file.filename); calculate file.size.
     file_data = data['base64_encoded_file']     # base64-decoded during validation
     files_path = h.get_OLD_directory_path('files', config=config)
     file_path = os.path.join(files_path, file.filename)
     file_object, file_path = get_unique_file_path(file_path)
+    file_object.close()
     file.filename = os.path.split(file_path)[-1]
     file.name = file.filename
-    file_object.write(file_data)
-    file_object.close()
-    file_data = None
+    file.checksum, temp_path = write_blob(file_data, files_path)
+    file_data = data['base64_encoded_file'] = None
+    store_blob(temp_path, file.checksum, files_path, file_path)
     file.size = os.path.getsize(file_path)
 
     file = restrict_file_by_forms(file)
@@ -555,7 +720,7 @@ def create_subinterval_referencing_file(data):
     schema = FileSubintervalReferencingSchema()
     state = h.State()
     state.full_dict = data
-    state.user = session['user']
+    state.user = h.get_principal()
     data = schema.to_python(data, state)
 
     file = File()
@@ -605,17 +770,170 @@ def create_plain_file():
     files_path = h.get_OLD_directory_path('files', config=config)
     file_path = os.path.join(files_path, file.filename)
     file_object, file_path = get_unique_file_path(file_path)
+    file_object.close()
     file.filename = os.path.split(file_path)[-1]
     file.name = file.filename
-    shutil.copyfileobj(filedata.file, file_object)
+    file.checksum, temp_path = write_blob(filedata.file, files_path)
     filedata.file.close()
-    file_object.close()
+    store_blob(temp_path, file.checksum, files_path, file_path)
     file.size = os.path.getsize(file_path)
 
     file = add_standard_metadata(file, data)
 
     return file
 
+################################################################################
+# Chunked Upload Functionality
+################################################################################
+
+# Uploads are stored in files/uploads as a pair of files: ``<id>`` contains the
+# file data received so far and ``<id>.json`` the upload's metadata.  The
+# SHA-256 of the data is computed as chunks arrive and is kept in memory; if it
+# is lost (e.g., the server restarted mid-upload), it is recomputed from disk
+# on finalization.
+upload_checksums = {}       # upload id -> (bytes hashed, sha256 object)
+upload_locks = {}           # upload id -> lock held while a chunk is written
+upload_locks_lock = threading.Lock()
+upload_read_size = 65536
+
+def get_upload_lock(upload_id):
+    with upload_locks_lock:
+        return upload_locks.setdefault(upload_id, threading.Lock())
+
+def get_upload_paths(upload_id):
+    """Return the paths to the data and metadata files of an upload."""
+    uploads_path = h.get_OLD_directory_path('uploads', config=config)
+    data_path = os.path.join(uploads_path, upload_id)
+    return data_path, '%s.json' % data_path
+
+def get_upload(upload_id):
+    """Return the upload with ``upload_id`` as a dict, or ``None`` if there is none.
+
+    The ``offset`` of the upload is the number of bytes received so far.
+
+    """
+    try:
+        upload_id = str(upload_id)
+        if os.path.split(upload_id)[-1] != upload_id or upload_id.startswith('.'):
+            return None
+        data_path, metadata_path = get_upload_paths(upload_id)
+        with open(metadata_path) as f:
+            upload = json.load(f)
+        upload['offset'] = os.path.getsize(data_path)
+        return upload
+    except (IOError, OSError, ValueError, UnicodeEncodeError):
+        return None
+
+def create_upload(data):
+    """Create a new (empty) upload and return it as a dict.
+
+    :param dict data: the validated upload data, i.e., ``filename`` and ``size``.
+
+    """
+    upload_id = unicode(uuid4())
+    upload = {
+        'id': upload_id,
+        'filename': data['filename'],
+        'size': data['size'],
+        'user_id': h.get_principal().id,
+        'datetime_entered': h.now().isoformat()
+    }
+    data_path, metadata_path = get_upload_paths(upload_id)
+    open(data_path, 'wb').close()
+    with open(metadata_path, 'w') as f:
+        json.dump(upload, f)
+    upload_checksums[upload_id] = (0, sha256())
+    upload['offset'] = 0
+    return upload
+
+def write_upload_chunk(upload, stream, length):
+    """Append ``length`` bytes read from ``stream`` to the data of ``upload``.
+
+    The data are copied in small pieces so that the chunk is never held in
+    memory in its entirety.
+
+    :returns: the upload with its new offset.
+
+    """
+    data_path = get_upload_paths(upload['id'])[0]
+    hashed, checksum = upload_checksums.get(upload['id'], (None, None))
+    if hashed != upload['offset']:
+        checksum = None
+    remaining = length
+    with open(data_path, 'ab') as f:
+        while remaining > 0:
+            piece = stream.read(min(upload_read_size, remaining))
+            if not piece:
+                break
+            f.write(piece)
+            if checksum:
+                checksum.update(piece)
+            remaining -= len(piece)
+    upload['offset'] = os.path.getsize(data_path)
+    if checksum:
+        upload_checksums[upload['id']] = (upload['offset'], checksum)
+    else:
+        upload_checksums.pop(upload['id'], None)
+    return upload
+
+def get_upload_checksum(upload):
+    """Return the SHA-256 hex digest of the data of ``upload``."""
+    hashed, checksum = upload_checksums.get(upload['id'], (None, None))
+    if checksum and hashed == upload['offset']:
+        return unicode(checksum.hexdigest())
+    return get_checksum(get_upload_paths(upload['id'])[0])
+
+def create_file_from_upload(upload, values):
+    """Create a local file model from a completed upload.
+
+    The MIME type is determined from the filename and the first KB of the
+    uploaded data; the data are moved (not copied) into the blob store.
+
+    :param dict upload: the upload, cf. ``get_upload``.
+    :param dict values: the metadata of the file.
+    :returns: an SQLAlchemy model object representing the file.
+
+    """
+    data_path = get_upload_paths(upload['id'])[0]
+    for attr in ('description', 'date_elicited', 'elicitor', 'speaker', 'utterance_type'):
+        values.setdefault(attr, u'')
+    for attr in ('tags', 'forms'):
+        values.setdefault(attr, [])
+    values['filename'] = upload['filename']
+    with open(data_path, 'rb') as f:
+        values['filedata_first_KB'] = f.read(1024)
+    schema = FileCreateWithFiledataSchema()
+    data = schema.to_python(values)
+
+    file = File()
+    file.filename = h.normalize(data['filename'])
+    file.MIME_type = data['MIME_type']
+    file.checksum = get_upload_checksum(upload)
+
+    files_path = h.get_OLD_directory_path('files', config=config)
+    file_path = os.path.join(files_path, file.filename)
+    file_object, file_path = get_unique_file_path(file_path)
+    file_object.close()
+    store_blob(data_path, file.checksum, files_path, file_path)
+    file.filename = os.path.split(file_path)[-1]
+    file.name = file.filename
+    file.size = os.path.getsize(file_path)
+
+    file = add_standard_metadata(file, data)
+    file = restrict_file_by_forms(file)
+    return file
+
+def remove_upload(upload, keep_data=False):
+    """Remove the metadata (and, unless ``keep_data`` is true, the data) of an upload."""
+    data_path, metadata_path = get_upload_paths(upload['id'])
+    paths = [metadata_path] if keep_data else [data_path, metadata_path]
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+    upload_checksums.pop(upload['id'], None)
+    with upload_locks_lock:
+        upload_locks.pop(upload['id'], None)
+
 ################################################################################
 # File Update Functionality
 ################################################################################
@@ -674,7 +992,7 @@ def update_file(file):
     data = json.loads(unicode(request.body, request.charset))
     state = h.State()
     state.full_dict = data
-    state.user = session['user']
+    state.user = h.get_principal()
     data = schema.to_python(data, state)
     file, changed = update_standard_metadata(file, data, changed)
     if changed:
@@ -696,7 +1014,7 @@ def update_subinterval_referencing_file(file):
     data['name'] = data.get('name') or u''
     state = h.State()
     state.full_dict = data
-    state.user = session['user']
+    state.user = h.get_principal()
     data = schema.to_python(data, state)
 
     # Data unique to referencing subinterval files
@@ -750,12 +1068,14 @@ def delete_file(file):
     :returns: ``None``.
 
     This deletes the file model object from the database as well as any binary
-    files associated with it that are stored on the filesystem.
+    files associated with it that are stored on the filesystem.  The file's
+    blob is removed only if no other file has the same content.
 
     """
+    files_path = h.get_OLD_directory_path('files', config=config)
+    checksum = getattr(file, 'checksum', None)
     if getattr(file, 'filename', None):
-        file_path = os.path.join(h.get_OLD_directory_path('files', config=config),
-                                file.filename)
+        file_path = os.path.join(files_path, file.filename)
         os.remove(file_path)
     if getattr(file, 'lossy_filename', None):
         file_path = os.path.join(h.get_OLD_directory_path('reduced_files', config=config),
@@ -763,6 +1083,7 @@ def delete_file(file):
         os.remove(file_path)
     Session.delete(file)
     Session.commit()
+    release_blob(checksum, files_path)
 
 
 ################################################################################
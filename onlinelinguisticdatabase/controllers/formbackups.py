@@ -159,9 +159,8 @@ class FormbackupsController(BaseController):
         """
         form_backup = Session.query(FormBackup).get(id)
         if form_backup:
-            unrestricted_users = h.get_unrestricted_users()
-            user = session['user']
-            if h.user_is_authorized_to_access_model(user, form_backup, unrestricted_users):
+            user = h.get_principal()
+            if h.user_is_authorized_to_access_model(user, form_backup):
                 return form_backup
             else:
                 response.status_int = 403
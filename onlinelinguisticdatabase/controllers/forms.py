@@ -29,6 +29,7 @@ from sqlalchemy import bindparam
 from sqlalchemy.sql import asc, or_
 from sqlalchemy.orm import subqueryload
 from onlinelinguisticdatabase.lib.base import BaseController
+from onlinelinguisticdatabase.lib.backupwriter import BackupWriter
 from onlinelinguisticdatabase.lib.schemata import FormSchema, FormIdsSchema
 import onlinelinguisticdatabase.lib.helpers as h
 from onlinelinguisticdatabase.lib.SQLAQueryBuilder import SQLAQueryBuilder, OLDSearchParseError
@@ -82,7 +83,7 @@ class FormsController(BaseController):
             return {'errors': e.unpack_errors()}
         except Exception, e:
             log.warn("%s's filter expression (%s) raised an unexpected exception: %s." % (
-                h.get_user_full_name(session['user']), request.body, e))
+                h.get_user_full_name(h.get_principal()), request.body, e))
             response.status_int = 400
             return {'error': u'The specified search parameters generated an invalid database query'}
 
@@ -201,9 +202,8 @@ class FormsController(BaseController):
         """
         form = h.eagerload_form(Session.query(Form)).get(int(id))
         if form:
-            unrestricted_users = h.get_unrestricted_users()
-            user = session['user']
-            if h.user_is_authorized_to_access_model(user, form, unrestricted_users):
+            user = h.get_principal()
+            if h.user_is_authorized_to_access_model(user, form):
                 try:
                     schema = FormSchema()
                     values = json.loads(unicode(request.body, request.charset))
@@ -255,8 +255,9 @@ class FormsController(BaseController):
         """
         form = h.eagerload_form(Session.query(Form)).get(id)
         if form:
-            if session['user'].role == u'administrator' or \
-            getattr(form.enterer, 'id', None) == getattr(session['user'], 'id', False):
+            principal = h.get_principal()
+            if principal.role == u'administrator' or \
+            form.enterer_id == principal.id:
                 form_dict = form.get_dict()
                 backup_form(form_dict)
                 update_collections_referencing_this_form(form)
@@ -285,9 +286,8 @@ class FormsController(BaseController):
         """
         form = h.eagerload_form(Session.query(Form)).get(id)
         if form:
-            unrestricted_users = h.get_unrestricted_users()
-            user = session['user']
-            if h.user_is_authorized_to_access_model(user, form, unrestricted_users):
+            user = h.get_principal()
+            if h.user_is_authorized_to_access_model(user, form):
                 if dict(request.GET).get('minimal'):
                     return h.minimal_model(form)
                 return form
@@ -327,8 +327,7 @@ class FormsController(BaseController):
         """
         form = h.eagerload_form(Session.query(Form)).get(id)
         if form:
-            unrestricted_users = h.get_unrestricted_users()
-            if h.user_is_authorized_to_access_model(session['user'], form, unrestricted_users):
+            if h.user_is_authorized_to_access_model(h.get_principal(), form):
                 return {'data': get_new_edit_form_data(request.GET), 'form': form}
             else:
                 response.status_int = 403
@@ -354,23 +353,39 @@ class FormsController(BaseController):
             requested and the value of the ``previous_versions`` key is a list of
             dictionaries representing previous versions of the form.
 
+            If the ``page`` and ``items_per_page`` query string parameters are
+            supplied, ``previous_versions`` contains only the requested page
+            of previous versions (most recent first) and the dictionary has a
+            ``paginator`` key whose value includes the total ``count``.
+
         """
-        form, previous_versions = h.get_model_and_previous_versions('Form', id)
-        if form or previous_versions:
-            unrestricted_users = h.get_unrestricted_users()
-            user = session['user']
+        try:
+            form, previous_versions = h.get_model_and_previous_versions(
+                'Form', id, dict(request.GET))
+        except Invalid, e:
+            response.status_int = 400
+            return {'errors': e.unpack_errors()}
+        paginator = None
+        if isinstance(previous_versions, dict):
+            paginator = previous_versions['paginator']
+            previous_versions = previous_versions['items']
+        if form or previous_versions or (paginator and paginator['count']):
+            user = h.get_principal()
             accessible = h.user_is_authorized_to_access_model
             unrestricted_previous_versions = [fb for fb in previous_versions
-                                    if accessible(user, fb, unrestricted_users)]
-            form_is_restricted = form and not accessible(user, form, unrestricted_users)
+                                    if accessible(user, fb)]
+            form_is_restricted = form and not accessible(user, form)
             previous_versions_are_restricted = previous_versions and not \
                 unrestricted_previous_versions
             if form_is_restricted or previous_versions_are_restricted :
                 response.status_int = 403
                 return h.unauthorized_msg
             else :
-                return {'form': form,
-                        'previous_versions': unrestricted_previous_versions}
+                result = {'form': form,
+                          'previous_versions': unrestricted_previous_versions}
+                if paginator:
+                    result['paginator'] = paginator
+                return result
         else:
             response.status_int = 404
             return {'error': 'No forms or form backups match %s' % id}
@@ -392,7 +407,7 @@ class FormsController(BaseController):
         try:
             schema = FormIdsSchema
             values = json.loads(unicode(request.body, request.charset))
-            data = schema.to_python(values)
+            data = schema.to_python(values, h.State())
             forms = [f for f in data['forms'] if f]
         except h.JSONDecodeError:
             response.status_int = 400
@@ -402,14 +417,12 @@ class FormsController(BaseController):
             return {'errors': e.unpack_errors()}
         else:
             if forms:
-                accessible = h.user_is_authorized_to_access_model
-                unrestricted_users = h.get_unrestricted_users()
-                user = session['user']
-                unrestricted_forms = [f for f in forms
-                                     if accessible(user, f, unrestricted_users)]
+                user = h.get_user()
+                authorized = h.get_authorized_ids(user, 'Form', [f.id for f in forms])
+                unrestricted_forms = [f for f in forms if authorized.get(f.id)]
                 if unrestricted_forms:
-                    session['user'].remembered_forms += unrestricted_forms
-                    session['user'].datetime_modified = h.now()
+                    user.remembered_forms += unrestricted_forms
+                    user.datetime_modified = h.now()
                     Session.commit()
                     return [f.id for f in unrestricted_forms]
                 else:
@@ -551,9 +564,7 @@ def backup_form(form_dict):
     :returns: ``None``
 
     """
-    form_backup = FormBackup()
-    form_backup.vivify(form_dict)
-    Session.add(form_backup)
+    BackupWriter().add(FormBackup, form_dict).flush()
 
 
 ################################################################################
@@ -616,12 +627,12 @@ def create_new_form(data):
     form.datetime_entered = form.datetime_modified = h.now()
     # Because of SQLAlchemy's uniqueness constraints, we may need to set the
     # enterer to the elicitor/verifier.
-    if data['elicitor'] and (data['elicitor'].id == session['user'].id):
+    if data['elicitor'] and (data['elicitor'].id == h.get_principal().id):
         form.enterer = form.modifier = data['elicitor']
-    elif data['verifier'] and (data['verifier'].id == session['user'].id):
+    elif data['verifier'] and (data['verifier'].id == h.get_principal().id):
         form.enterer = form.modifier = data['verifier']
     else:
-        form.enterer = form.modifier = session['user']
+        form.enterer = form.modifier = h.get_user()
 
     # Create the morpheme_break_ids and morpheme_gloss_ids attributes.
     # We add the form first to get an ID so that monomorphemic Forms can be
@@ -716,8 +727,7 @@ def update_form(form, data):
 
     if changed:
         form.datetime_modified = h.now()
-        session['user'] = Session.merge(session['user'])
-        form.modifier = session['user']
+        form.modifier = h.get_user()
         return form
     return changed
 
@@ -746,8 +756,7 @@ def update_morpheme_references_of_form(form, valid_delimiters=None, **kwargs):
     changed = form.set_attr('break_gloss_category', break_gloss_category, changed)
     if changed:
         form.datetime_modified = h.now()
-        session['user'] = Session.merge(session['user'])
-        form.modifier = session['user']
+        form.modifier = h.get_user()
         return form, cache
     return changed, cache
 
@@ -770,9 +779,9 @@ def update_morpheme_references_of_forms(forms, valid_delimiters, **kwargs):
 
     """
     form_buffer = []
-    formbackup_buffer = []
+    backup_writer = BackupWriter()
     make_backups = kwargs.get('make_backups', True)
-    modifier = session['user'] = Session.merge(session['user'])
+    modifier = h.get_user()
     modifier_id = modifier.id
     modification_datetime = h.now()
     form_table = Form.__table__
@@ -791,9 +800,7 @@ def update_morpheme_references_of_forms(forms, valid_delimiters, **kwargs):
                 'datetime_modified': modification_datetime
             })
             if make_backups:
-                formbackup = FormBackup()
-                formbackup.vivify(form.get_dict())
-                formbackup_buffer.append(formbackup)
+                backup_writer.add(FormBackup, form.get_dict())
     if form_buffer:
         rdbms_name = h.get_RDBMS_name(config=config)
         if rdbms_name == 'mysql':
@@ -801,8 +808,8 @@ def update_morpheme_references_of_forms(forms, valid_delimiters, **kwargs):
         update = form_table.update().where(form_table.c.id==bindparam('id_')).\
                     values(**dict([(k, bindparam(k)) for k in form_buffer[0] if k != 'id_']))
         Session.execute(update, form_buffer)
-    if make_backups and formbackup_buffer:
-        Session.add_all(formbackup_buffer)
+    if make_backups and backup_writer.rows:
+        backup_writer.flush()
         Session.commit()
     return [f['id_'] for f in form_buffer]
 
@@ -295,7 +295,7 @@ def create_new_form_search(data):
     form_search.name = h.normalize(data['name'])
     form_search.search = data['search']      # Note that this is purposefully not normalized (reconsider this? ...)
     form_search.description = h.normalize(data['description'])
-    form_search.enterer = session['user']
+    form_search.enterer = h.get_user()
     form_search.datetime_modified = datetime.datetime.utcnow()
     return form_search
 
@@ -97,7 +97,7 @@ class InfoController(BaseController):
                     myroutes.append((path, method))
         meta = {
             'app': 'Online Lingusitic Database',
-            'version': '2.0.0',
+            'version': '2.1.0',
             'paths': ['%s %s' % (r[1], r[0]) for r in sorted(myroutes)],
             'resources': resources
         }
@@ -286,7 +286,7 @@ def create_new_keyboard(data):
 
     # OLD-generated Data
     keyboard.datetime_entered = keyboard.datetime_modified = h.now()
-    keyboard.enterer = keyboard.modifier = session['user']
+    keyboard.enterer = keyboard.modifier = h.get_user()
 
     return keyboard
 
@@ -307,8 +307,7 @@ def update_keyboard(keyboard, data):
         h.normalize(data['keyboard']), changed)
     if changed:
         keyboard.datetime_modified = h.now()
-        session['user'] = Session.merge(session['user'])
-        keyboard.modifier = session['user']
+        keyboard.modifier = h.get_user()
         return keyboard
     return changed
 
@@ -68,7 +68,8 @@ class LoginController(BaseController):
                 user = Session.query(User).filter(User.username==username).filter(
                     User.password==password).first()
                 if user:
-                    session['user'] = user
+                    session.pop('user', None)
+                    session['principal'] = h.cache_principal(user)
                     session.save()
                     home_page = Session.query(Page).filter(
                         Page.name==u'home').first()
@@ -0,0 +1,94 @@
+# Copyright 2016 Joel Dunham
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+"""Contains the :class:`MetricsController`, which serves the request metrics
+recorded by the profiling middleware (cf. ``lib/profiling.py``).
+
+"""
+
+import hmac
+import logging
+from pylons import request, response, config
+from onlinelinguisticdatabase.lib.base import BaseController
+import onlinelinguisticdatabase.lib.helpers as h
+from onlinelinguisticdatabase.lib import profiling
+
+log = logging.getLogger(__name__)
+
+def has_metrics_token():
+    """Return True if the request's ``X-Metrics-Token`` header matches the
+    ``metrics_token`` config option, which lets monitoring systems that cannot
+    log in read (but not reset) the metrics.
+    """
+    token = config.get('metrics_token')
+    header = request.headers.get('X-Metrics-Token')
+    return bool(token and header and hmac.compare_digest(str(token), str(header)))
+
+class MetricsController(BaseController):
+    """Generate responses to requests on the request metrics.
+
+    .. note::
+
+       The ``h.jsonify`` decorator converts the return value of the methods to
+       JSON.
+
+    """
+
+    @h.jsonify
+    @h.restrict('GET')
+    def index(self):
+        """Return the request metrics aggregated since they were last reset.
+
+        :URL: ``GET /metrics``
+        :returns: a dictionary with ``started``, ``actions`` and ``pools`` keys.
+
+        .. note::
+
+           Only administrators and requests with the configured metrics token
+           may read the metrics.  The response is a 404 if request profiling is
+           not enabled.
+
+        """
+        if not profiling.enabled:
+            response.status_int = 404
+            return {'error': 'Request profiling is not enabled.'}
+        if has_metrics_token():
+            return profiling.metrics.get_dict()
+        return self._get_metrics()
+
+    @h.authenticate
+    @h.authorize(['administrator'])
+    def _get_metrics(self):
+        return profiling.metrics.get_dict()
+
+    @h.jsonify
+    @h.restrict('DELETE')
+    @h.authenticate
+    @h.authorize(['administrator'])
+    def delete(self):
+        """Reset the request metrics.
+
+        :URL: ``DELETE /metrics``
+        :returns: the (empty) metrics.
+
+        .. note::
+
+           Only administrators may reset the metrics.
+
+        """
+        if not profiling.enabled:
+            response.status_int = 404
+            return {'error': 'Request profiling is not enabled.'}
+        profiling.metrics.clear()
+        return profiling.metrics.get_dict()
@@ -26,11 +26,11 @@ import logging
 import simplejson as json
 import os
 from uuid import uuid4
-from paste.fileapp import FileApp
 from pylons.controllers.util import forward
 from pylons import request, response, session, config
 from formencode.validators import Invalid
 from onlinelinguisticdatabase.lib.base import BaseController
+from onlinelinguisticdatabase.lib.backupwriter import BackupWriter
 from onlinelinguisticdatabase.lib.schemata import MorphemeLanguageModelSchema, MorphemeSequencesSchema
 import onlinelinguisticdatabase.lib.helpers as h
 from onlinelinguisticdatabase.lib.SQLAQueryBuilder import SQLAQueryBuilder, OLDSearchParseError
@@ -322,8 +322,9 @@ class MorphemelanguagemodelsController(BaseController):
             return {'error': 'There is no morpheme language model with id %s' % id}
         args = {
             'morpheme_language_model_id': lm.id,
-            'user_id': session['user'].id,
-            'timeout': h.morpheme_language_model_generate_timeout
+            'user_id': h.get_principal().id,
+            'timeout': h.morpheme_language_model_generate_timeout,
+            'corpora_path': h.get_OLD_directory_path('corpora', config=config)
         }
         foma_worker_q.put({
             'id': h.generate_salt(),
@@ -371,8 +372,9 @@ class MorphemelanguagemodelsController(BaseController):
     def compute_perplexity(self, id):
         """Compute the perplexity of the LM's corpus according to the LM.
 
-        Randomly divide the corpus into training and test sets multiple times and compute
-        the perplexity and return the average.  See ``evaluate_morpheme_language_model`` in lib/foma_worker.py.
+        Divide the corpus into five disjoint folds, compute the perplexity of each fold
+        according to an LM generated from the other four and store the average.  See
+        ``compute_perplexity`` in lib/foma_worker.py and lib/perplexity.py.
 
         """
         lm = Session.query(MorphemeLanguageModel).get(id)
@@ -381,8 +383,9 @@ class MorphemelanguagemodelsController(BaseController):
             return {'error': 'There is no morpheme language model with id %s' % id}
         args = {
             'morpheme_language_model_id': lm.id,
-            'user_id': session['user'].id,
-            'timeout': h.morpheme_language_model_generate_timeout
+            'user_id': h.get_principal().id,
+            'timeout': h.morpheme_language_model_generate_timeout,
+            'corpora_path': h.get_OLD_directory_path('corpora', config=config)
         }
         foma_worker_q.put({
             'id': h.generate_salt(),
@@ -405,8 +408,8 @@ class MorphemelanguagemodelsController(BaseController):
         if lm:
             arpa_path = lm.get_file_path('arpa')
             if os.path.isfile(arpa_path):
-                if authorized_to_access_arpa_file(session['user'], lm):
-                    return forward(FileApp(arpa_path, content_type='text/plain'))
+                if authorized_to_access_arpa_file(h.get_principal(), lm):
+                    return forward(h.FileServer(arpa_path, content_type='text/plain'))
                 else:
                     response.status_int = 403
                     return json.dumps(h.unauthorized_msg)
@@ -421,7 +424,7 @@ class MorphemelanguagemodelsController(BaseController):
 def authorized_to_access_arpa_file(user, morpheme_language_model):
     """Return True if user is authorized to access the ARPA file of the morpheme LM."""
     if (morpheme_language_model.restricted and user.role != u'administrator' and
-    user not in h.get_unrestricted_users()):
+    user.id not in h.get_unrestricted_user_ids()):
         return False
     return True
 
@@ -447,9 +450,7 @@ def backup_morpheme_language_model(morpheme_language_model_dict):
     :returns: ``None``
 
     """
-    morpheme_language_model_backup = MorphemeLanguageModelBackup()
-    morpheme_language_model_backup.vivify(morpheme_language_model_dict)
-    Session.add(morpheme_language_model_backup)
+    BackupWriter().add(MorphemeLanguageModelBackup, morpheme_language_model_dict).flush()
 
 ################################################################################
 # MorphemeLanguageModel Create & Update Functions
@@ -471,8 +472,8 @@ def create_new_morpheme_language_model(data):
         UUID = unicode(uuid4()),
         name = h.normalize(data['name']),
         description = h.normalize(data['description']),
-        enterer = session['user'],
-        modifier = session['user'],
+        enterer = h.get_user(),
+        modifier = h.get_user(),
         datetime_modified = h.now(),
         datetime_entered = h.now(),
         vocabulary_morphology = data['vocabulary_morphology'],
@@ -506,8 +507,7 @@ def update_morpheme_language_model(morpheme_language_model, data):
     changed = morpheme_language_model.set_attr('start_symbol', h.lm_start, changed)
     changed = morpheme_language_model.set_attr('end_symbol', h.lm_end, changed)
     if changed:
-        session['user'] = Session.merge(session['user'])
-        morpheme_language_model.modifier = session['user']
+        morpheme_language_model.modifier = h.get_user()
         morpheme_language_model.datetime_modified = h.now()
         return morpheme_language_model
     return changed
@@ -26,17 +26,19 @@ from shutil import copytree, copyfile, rmtree
 from uuid import uuid4
 import codecs
 import cPickle
-from paste.fileapp import FileApp
 from pylons.controllers.util import forward
 from pylons import request, response, session, config
 from formencode.validators import Invalid
 from onlinelinguisticdatabase.lib.base import BaseController
+from onlinelinguisticdatabase.lib.backupwriter import BackupWriter
 from onlinelinguisticdatabase.lib.schemata import MorphologicalParserSchema, TranscriptionsSchema, MorphemeSequencesSchema
 import onlinelinguisticdatabase.lib.helpers as h
 from onlinelinguisticdatabase.lib.SQLAQueryBuilder import SQLAQueryBuilder, OLDSearchParseError
 from onlinelinguisticdatabase.model.meta import Session
 from onlinelinguisticdatabase.model import MorphologicalParser, MorphologicalParserBackup
+from onlinelinguisticdatabase.model.morphologicalparser import get_parse_count, get_parse_pages
 from onlinelinguisticdatabase.lib.foma_worker import foma_worker_q
+from onlinelinguisticdatabase.lib.parser import Cache as ParseCache
 
 log = logging.getLogger(__name__)
 
@@ -488,7 +490,7 @@ class MorphologicalparsersController(BaseController):
             if h.foma_installed():
                 binary_path = parser.get_file_path('binary')
                 if os.path.isfile(binary_path):
-                    return forward(FileApp(binary_path))
+                    return forward(h.FileServer(binary_path))
                 else:
                     response.status_int = 400
                     return json.dumps({'error': 'The morphophonology foma script of '
@@ -530,7 +532,7 @@ class MorphologicalparsersController(BaseController):
             data_path = os.path.join(archive_dir, 'data.pickle')
             cPickle.dump(data, open(data_path, 'wb'))
             zip_path = h.zipdir(archive_dir)
-            return forward(FileApp(zip_path))
+            return forward(h.FileServer(zip_path))
         except Exception, e:
             log.warn(e)
             response.status_int = 400
@@ -550,42 +552,103 @@ class MorphologicalparsersController(BaseController):
             $ cd archive
             $ ./parse.py chiens chats tombait
 
+        The archive is streamed to the client as it is generated, with the
+        parse cache paged from the database.  It is also saved in the parser's
+        directory, keyed by the parser's ``compile_attempt`` and the number of
+        cached parses, so that repeat downloads are served from disk.
+
         """
         try:
             parser = Session.query(MorphologicalParser).get(id)
-            directory = parser.directory
-            lib_path = os.path.abspath(os.path.dirname(h.__file__))
-
-            # config.pickle is a dict used to construct the parser (see lib/parse.py)
-            config_ = parser.export()
-            config_path = os.path.join(directory, 'config.pickle')
-            cPickle.dump(config_, open(config_path, 'wb'))
-
-            # cache.pickle is a dict encoding the cached parses of this parser
-            cache_dict = parser.cache.export()
-            cache_path = os.path.join(directory, 'cache.pickle')
-            cPickle.dump(cache_dict, open(cache_path, 'wb'))
-
-            # create the .zip archive, including the files of the parser, the simplelm package,
-            # the parser.py module and the parse.py executable.
-            zip_path = os.path.join(directory, 'archive.zip')
-            zip_file = h.ZipFile(zip_path, 'w')
-            #zip_file.write_directory(parser.directory)
-            for file_name in os.listdir(directory):
-                if (os.path.splitext(file_name)[1] not in ('.log', '.sh', '.zip') and
-                    file_name != 'morpheme_language_model.pickle'):
-                    zip_file.write_file(os.path.join(directory, file_name))
-            zip_file.write_directory(os.path.join(lib_path, 'simplelm'), keep_dir=True)
-            zip_file.write_file(os.path.join(lib_path, 'parser.py'))
-            zip_file.write_file(os.path.join(lib_path, 'parse.py'))
-            zip_file.close()
-            return forward(FileApp(zip_path))
+            archive_path = get_archive_path(parser)
+            if os.path.isfile(archive_path):
+                return forward(h.FileServer(archive_path))
+            chunks = generate_archive(parser.directory, parser.export(),
+                                      get_parse_pages(parser.id))
+            response.content_type = 'application/zip'
+            return save_archive(chunks, archive_path)
         except Exception, e:
             log.warn(e)
             response.status_int = 400
             return json.dumps({'error': 'An error occured while attempting to export '
                 'morphological parser %s: %s' % (id, e)})
 
+################################################################################
+# Export Functionality
+################################################################################
+
+def get_archive_path(parser):
+    """Return the path to the cached export archive of the parser in its current state."""
+    return os.path.join(parser.directory, 'archive_%s_%d.zip' % (
+        parser.compile_attempt, get_parse_count(parser.id)))
+
+def generate_archive(directory, config_, cache_pages):
+    """Generate the .zip archive of a parser as a sequence of byte strings.
+
+    The archive includes the files in the parser's ``directory``, a
+    config.pickle file containing ``config_`` (used to construct the parser, see
+    lib/parse.py), a cache.sqlite file containing the ``cache_pages`` (dicts of
+    cached parses, cf. ``parser.Cache``), the simplelm package, the parser.py
+    module and the parse.py executable.  The cache file is built in the
+    parser's directory a page at a time and removed once it has been archived.
+
+    Since this runs after the controller action has returned, it must not
+    access attributes of model objects.
+
+    """
+    lib_path = os.path.abspath(os.path.dirname(h.__file__))
+    zip_stream = h.ZipStream('archive')
+    for file_name in sorted(os.listdir(directory)):
+        if (os.path.splitext(file_name)[1] not in ('.log', '.sh', '.zip', '.part') and
+            file_name not in ('morpheme_language_model.pickle', 'config.pickle',
+                              'cache.pickle', 'cache.sqlite')):
+            for chunk in zip_stream.write_file(os.path.join(directory, file_name)):
+                yield chunk
+    for chunk in zip_stream.write_iter('config.pickle', [cPickle.dumps(config_)]):
+        yield chunk
+    cache_path = os.path.join(directory, 'cache.sqlite.%s.part' % uuid4().hex)
+    try:
+        ParseCache.write(cache_path, cache_pages)
+        for chunk in zip_stream.write_file(cache_path, 'cache.sqlite'):
+            yield chunk
+    finally:
+        if os.path.exists(cache_path):
+            os.remove(cache_path)
+    for chunk in zip_stream.write_directory(os.path.join(lib_path, 'simplelm')):
+        yield chunk
+    for chunk in zip_stream.write_file(os.path.join(lib_path, 'parser.py')):
+        yield chunk
+    for chunk in zip_stream.write_file(os.path.join(lib_path, 'parse.py')):
+        yield chunk
+    for chunk in zip_stream.close():
+        yield chunk
+
+def save_archive(chunks, archive_path):
+    """Pass on the chunks of an archive while saving them to ``archive_path``.
+
+    The archive is moved into place only once it is complete; earlier archives
+    of the parser are then removed.  Since the chunks are consumed after the
+    controller has returned (and its database session has been removed), the
+    session used to page the cache is removed here.
+
+    """
+    temp_path = '%s.%s.part' % (archive_path, uuid4().hex)
+    try:
+        with open(temp_path, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+                yield chunk
+        os.rename(temp_path, archive_path)
+        directory, archive_name = os.path.split(archive_path)
+        for file_name in os.listdir(directory):
+            if (file_name.startswith('archive_') and file_name.endswith('.zip') and
+                file_name != archive_name):
+                os.remove(os.path.join(directory, file_name))
+    finally:
+        Session.remove()
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
 def get_data_for_new_edit(GET_params):
     """Return the data needed to create a new morphological parser or edit one."""
     model_name_map = {
@@ -611,9 +674,7 @@ def backup_morphological_parser(morphological_parser_dict):
     :returns: ``None``
 
     """
-    morphological_parser_backup = MorphologicalParserBackup()
-    morphological_parser_backup.vivify(morphological_parser_dict)
-    Session.add(morphological_parser_backup)
+    BackupWriter().add(MorphologicalParserBackup, morphological_parser_dict).flush()
 
 
 ################################################################################
@@ -632,8 +693,8 @@ def create_new_morphological_parser(data):
         UUID = unicode(uuid4()),
         name = h.normalize(data['name']),
         description = h.normalize(data['description']),
-        enterer = session['user'],
-        modifier = session['user'],
+        enterer = h.get_user(),
+        modifier = h.get_user(),
         datetime_modified = h.now(),
         datetime_entered = h.now(),
         phonology = data['phonology'],
@@ -658,8 +719,7 @@ def update_morphological_parser(morphological_parser, data):
     changed = morphological_parser.set_attr('morphology', data['morphology'], changed)
     changed = morphological_parser.set_attr('language_model', data['language_model'], changed)
     if changed:
-        session['user'] = Session.merge(session['user'])
-        morphological_parser.modifier = session['user']
+        morphological_parser.modifier = h.get_user()
         morphological_parser.datetime_modified = h.now()
         return morphological_parser
     return changed
@@ -678,7 +738,7 @@ def generate_and_compile_morphological_parser(morphological_parser_id, compile_=
         'args': {
             'morphological_parser_id': morphological_parser.id,
             'compile': compile_,
-            'user_id': session['user'].id,
+            'user_id': h.get_principal().id,
             'timeout': h.morphological_parser_compile_timeout
         }
     })
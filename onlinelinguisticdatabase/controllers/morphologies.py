@@ -25,11 +25,11 @@ import os
 import cPickle
 from uuid import uuid4
 import codecs
-from paste.fileapp import FileApp
 from pylons.controllers.util import forward
 from pylons import request, response, session, config
 from formencode.validators import Invalid
 from onlinelinguisticdatabase.lib.base import BaseController
+from onlinelinguisticdatabase.lib.backupwriter import BackupWriter
 from onlinelinguisticdatabase.lib.schemata import MorphologySchema, MorphemeSequencesSchema
 import onlinelinguisticdatabase.lib.helpers as h
 from onlinelinguisticdatabase.lib.SQLAQueryBuilder import SQLAQueryBuilder, OLDSearchParseError
@@ -377,7 +377,7 @@ class MorphologiesController(BaseController):
             if h.foma_installed():
                 foma_file_path = morphology.get_file_path('binary')
                 if os.path.isfile(foma_file_path):
-                    return forward(FileApp(foma_file_path))
+                    return forward(h.FileServer(foma_file_path))
                 else:
                     response.status_int = 400
                     return json.dumps({'error': 'Morphology %d has not been compiled yet.' % morphology.id})
@@ -478,9 +478,7 @@ def backup_morphology(morphology_dict):
     :returns: ``None``
 
     """
-    morphology_backup = MorphologyBackup()
-    morphology_backup.vivify(morphology_dict)
-    Session.add(morphology_backup)
+    BackupWriter().add(MorphologyBackup, morphology_dict).flush()
 
 
 ################################################################################
@@ -502,8 +500,8 @@ def create_new_morphology(data):
         UUID = unicode(uuid4()),
         name = h.normalize(data['name']),
         description = h.normalize(data['description']),
-        enterer = session['user'],
-        modifier = session['user'],
+        enterer = h.get_user(),
+        modifier = h.get_user(),
         datetime_modified = h.now(),
         datetime_entered = h.now(),
         lexicon_corpus = data['lexicon_corpus'],
@@ -540,8 +538,7 @@ def update_morphology(morphology, data):
     changed = morphology.set_attr('rare_delimiter', h.rare_delimiter, changed)
     changed = morphology.set_attr('word_boundary_symbol', h.word_boundary_symbol, changed)
     if changed:
-        session['user'] = Session.merge(session['user'])
-        morphology.modifier = session['user']
+        morphology.modifier = h.get_user()
         morphology.datetime_modified = h.now()
         return morphology
     return changed
@@ -560,8 +557,9 @@ def generate_and_compile_morphology(morphology_id, compile_=True):
         'args': {
             'morphology_id': morphology.id,
             'compile': compile_,
-            'user_id': session['user'].id,
-            'timeout': h.morphology_compile_timeout
+            'user_id': h.get_principal().id,
+            'timeout': h.morphology_compile_timeout,
+            'corpora_path': h.get_OLD_directory_path('corpora', config=config)
         }
     })
     return morphology
@@ -27,6 +27,7 @@ import simplejson as json
 from pylons import request, response, session, config
 from formencode.validators import Invalid
 from onlinelinguisticdatabase.lib.base import BaseController
+from onlinelinguisticdatabase.lib.backupwriter import BackupWriter
 from onlinelinguisticdatabase.lib.schemata import CollectionSchema
 import onlinelinguisticdatabase.lib.helpers as h
 from onlinelinguisticdatabase.lib.SQLAQueryBuilder import SQLAQueryBuilder, OLDSearchParseError
@@ -163,12 +164,10 @@ class OldcollectionsController(BaseController):
 
         """
         try:
-            unrestricted_users = h.get_unrestricted_users()
-            user = session['user']
+            user = h.get_principal()
             schema = CollectionSchema()
             values = json.loads(unicode(request.body, request.charset))
-            collections_referenced = get_collections_referenced(values['contents'],
-                                                        user, unrestricted_users)
+            collections_referenced = get_collections_referenced(values['contents'], user)
             values = add_contents_unpacked_to_values(values, collections_referenced)
             values = add_form_ids_list_to_values(values)
             state = h.get_state_object(values)
@@ -183,7 +182,7 @@ class OldcollectionsController(BaseController):
         except InvalidCollectionReferenceError, e:
             response.status_int = 400
             return {'error': u'Invalid collection reference error: there is no collection with id %d' % e.args[0]}
-        except UnauthorizedCollectionReferenceError:
+        except UnauthorizedCollectionReferenceError, e:
             response.status_int = 403
             return {'error': u'Unauthorized collection reference error: you are not authorized to access collection %d' % e.args[0]}
         except Invalid, e:
@@ -225,14 +224,13 @@ class OldcollectionsController(BaseController):
         collection = h.eagerload_collection(Session.query(Collection),
                                            eagerload_forms=True).get(int(id))
         if collection:
-            unrestricted_users = h.get_unrestricted_users()
-            user = session['user']
-            if h.user_is_authorized_to_access_model(user, collection, unrestricted_users):
+            user = h.get_principal()
+            if h.user_is_authorized_to_access_model(user, collection):
                 try:
                     schema = CollectionSchema()
                     values = json.loads(unicode(request.body, request.charset))
                     collections_referenced = get_collections_referenced(
-                                values['contents'], user, unrestricted_users, id)
+                                values['contents'], user, id)
                     values = add_contents_unpacked_to_values(values, collections_referenced)
                     values = add_form_ids_list_to_values(values)
                     state = h.get_state_object(values)
@@ -294,10 +292,10 @@ class OldcollectionsController(BaseController):
         collection = h.eagerload_collection(Session.query(Collection),
                                            eagerload_forms=True).get(id)
         if collection:
-            if session['user'].role == u'administrator' or \
-            collection.enterer is session['user']:
-                session['user'] = Session.merge(session['user'])
-                collection.modifier = session['user']
+            principal = h.get_principal()
+            if principal.role == u'administrator' or \
+            collection.enterer_id == principal.id:
+                collection.modifier = h.get_user()
                 collection_dict = collection.get_full_dict()
                 backup_collection(collection_dict)
                 update_collections_that_reference_this_collection(collection,
@@ -337,9 +335,8 @@ class OldcollectionsController(BaseController):
         collection = h.eagerload_collection(Session.query(Collection),
                                            eagerload_forms=True).get(id)
         if collection:
-            unrestricted_users = h.get_unrestricted_users()
-            user = session['user']
-            if h.user_is_authorized_to_access_model(user, collection, unrestricted_users):
+            user = h.get_principal()
+            if h.user_is_authorized_to_access_model(user, collection):
                 result = collection.get_full_dict()
                 # TODO: deal with markdown2latex ...
                 if request.GET.get('latex') and \
@@ -384,9 +381,8 @@ class OldcollectionsController(BaseController):
         """
         collection = h.eagerload_collection(Session.query(Collection)).get(id)
         if collection:
-            unrestricted_users = h.get_unrestricted_users()
             if h.user_is_authorized_to_access_model(
-                                session['user'], collection, unrestricted_users):
+                                h.get_principal(), collection):
                 data = get_new_edit_collection_data(request.GET)
                 return {'data': data, 'collection': collection}
             else:
@@ -414,22 +410,38 @@ class OldcollectionsController(BaseController):
             is a list of dictionaries representing previous versions of the
             collection.
 
+            If the ``page`` and ``items_per_page`` query string parameters are
+            supplied, ``previous_versions`` contains only the requested page
+            of previous versions (most recent first) and the dictionary has a
+            ``paginator`` key whose value includes the total ``count``.
+
         """
-        collection, previous_versions = h.get_model_and_previous_versions('Collection', id)
-        if collection or previous_versions:
-            unrestricted_users = h.get_unrestricted_users()
-            user = session['user']
+        try:
+            collection, previous_versions = h.get_model_and_previous_versions(
+                'Collection', id, dict(request.GET))
+        except Invalid, e:
+            response.status_int = 400
+            return {'errors': e.unpack_errors()}
+        paginator = None
+        if isinstance(previous_versions, dict):
+            paginator = previous_versions['paginator']
+            previous_versions = previous_versions['items']
+        if collection or previous_versions or (paginator and paginator['count']):
+            user = h.get_principal()
             accessible = h.user_is_authorized_to_access_model
             unrestricted_previous_versions = [cb for cb in previous_versions
-                                    if accessible(user, cb, unrestricted_users)]
-            collection_is_restricted = collection and not accessible(user, collection, unrestricted_users)
+                                    if accessible(user, cb)]
+            collection_is_restricted = collection and not accessible(user, collection)
             previous_versions_are_restricted = previous_versions and not unrestricted_previous_versions
             if collection_is_restricted or previous_versions_are_restricted :
                 response.status_int = 403
                 return h.unauthorized_msg
             else :
-                return {'collection': collection,
-                        'previous_versions': unrestricted_previous_versions}
+                result = {'collection': collection,
+                          'previous_versions': unrestricted_previous_versions}
+                if paginator:
+                    result['paginator'] = paginator
+                return result
         else:
             response.status_int = 404
             return {'error': 'No collections or collection backups match %s' % id}
@@ -446,9 +458,7 @@ def backup_collection(collection_dict):
     :returns: ``None``
 
     """
-    collection_backup = CollectionBackup()
-    collection_backup.vivify(collection_dict)
-    Session.add(collection_backup)
+    BackupWriter().add(CollectionBackup, collection_dict).flush()
 
 
 ################################################################################
@@ -464,16 +474,18 @@ def backup_collection(collection_dict):
 # collection objects, which dict is used by add_contents_unpacked_to_values, the
 # output of the latter being used to generate the list of referenced forms.
 
-def get_collections_referenced(contents, user=None, unrestricted_users=None,
-                             collection_id=None, patt=None):
+def get_collections_referenced(contents, user=None, collection_id=None, patt=None):
     """Return the collections (recursively) referenced by the input ``contents`` value.
     
     That is, return all of the collections referenced in the input ``contents``
     value, plus all of the collections referenced in those collections, etc.
+    The references are followed breadth-first so that each level of the
+    reference graph is fetched in a single query and each collection is
+    fetched only once.
 
     :param unicode contents: the value of the ``contents`` attribute of a collection.
-    :param user: the user model who made the request.
-    :param list unrestricted_users: the unrestricted user models of the application.
+    :param user: the user model who made the request; if ``None``, access to
+        the referenced collections is not checked.
     :param int collection_id: the ``id`` value of a collection.
     :param patt: a compiled regular expression object.
     :returns: a dictionary whose keys are collection ``id`` values and whose
@@ -481,14 +493,16 @@ def get_collections_referenced(contents, user=None, unrestricted_users=None,
 
     """
     patt = patt or re.compile(h.collection_reference_pattern)
-    collections_referenced = dict([(int(id), get_collection(int(id), user, unrestricted_users))
-                                  for id in patt.findall(contents)])
-    temp = collections_referenced.copy()
-    if collection_id in collections_referenced:
-        raise CircularCollectionReferenceError(collection_id)
-    [collections_referenced.update(get_collections_referenced(
-        collections_referenced[id].contents, user, unrestricted_users, collection_id, patt))
-     for id in temp]
+    collections_referenced = {}
+    ids = [int(id) for id in patt.findall(contents)]
+    while ids:
+        collections = get_collections(ids, user)
+        if collection_id in collections:
+            raise CircularCollectionReferenceError(collection_id)
+        collections_referenced.update(collections)
+        ids = [int(id) for collection in collections.itervalues()
+               for id in patt.findall(collection.contents)
+               if int(id) not in collections_referenced]
     return collections_referenced
 
 def add_form_ids_list_to_values(values):
@@ -577,8 +591,7 @@ def update_collections_that_reference_this_collection(collection, query_builder,
                     h.form_reference_pattern.findall(collection.contents_unpacked)]
     def update_modification_values(collection, now):
         collection.datetime_modified = now
-        session['user'] = Session.merge(session['user'])
-        collection.modifier = session['user']
+        collection.modifier = h.get_user()
     restricted = kwargs.get('restricted', False)
     contents_changed = kwargs.get('contents_changed', False)
     deleted = kwargs.get('deleted', False)
@@ -597,7 +610,10 @@ def update_collections_that_reference_this_collection(collection, query_builder,
             [update_contents_unpacked_etc(c, collection_id=collection.id, deleted=True)
              for c in collections_referencing_this_collection]
         [update_modification_values(c, now) for c in collections_referencing_this_collection]
-        [backup_collection(cd) for cd in collections_referencing_this_collection_dicts]
+        backup_writer = BackupWriter()
+        for collection_dict in collections_referencing_this_collection_dicts:
+            backup_writer.add(CollectionBackup, collection_dict)
+        backup_writer.flush()
         Session.add_all(collections_referencing_this_collection)
         Session.commit()
 
@@ -729,26 +745,28 @@ class InvalidCollectionReferenceError(Exception):
 class UnauthorizedCollectionReferenceError(Exception):
     pass
 
-def get_collection(collection_id, user, unrestricted_users):
-    """Return the collection such that ``collection.id==collection_id``.
+def get_collections(collection_ids, user=None):
+    """Return the collections whose ``id`` values are in ``collection_ids``.
 
-    If the collection does not exist or if ``user`` is not authorized to access
-    it, raise an appropriate error.
+    If any of the collections does not exist or if ``user`` is not authorized
+    to access it, raise an appropriate error for the first such id.
 
-    :param int collection_id: the ``id`` value of a collection.
-    :param user: a user model of the logged in user.
-    :param list unrestricted_users: the unrestricted users of the system.
-    :return: a collection model object.
+    :param list collection_ids: ``id`` values of collections.
+    :param user: a user model of the logged in user; if ``None``, access is
+        not checked.
+    :return: a dictionary from ``id`` values to collection models.
 
     """
-    collection = Session.query(Collection).get(collection_id)
-    if collection:
-        if user is None or unrestricted_users is None or \
-        h.user_is_authorized_to_access_model(user, collection, unrestricted_users):
-            return collection
-        else:
+    collections = dict((collection.id, collection) for collection in
+        Session.query(Collection).filter(Collection.id.in_(set(collection_ids))).all())
+    if user is not None:
+        authorized = h.get_authorized_ids(user, 'Collection', collections.keys())
+    for collection_id in collection_ids:
+        if collection_id not in collections:
+            raise InvalidCollectionReferenceError(collection_id)
+        if user is not None and not authorized[collection_id]:
             raise UnauthorizedCollectionReferenceError(collection_id)
-    raise InvalidCollectionReferenceError(collection_id)
+    return collections
 
 
 ################################################################################
@@ -881,10 +899,10 @@ def create_new_collection(data, collections_referenced):
     collection.datetime_modified = now
     # Because of SQLAlchemy's uniqueness constraints, we may need to set the
     # enterer to the elicitor.
-    if data['elicitor'] and (data['elicitor'].id == session['user'].id):
+    if data['elicitor'] and (data['elicitor'].id == h.get_principal().id):
         collection.enterer = data['elicitor']
     else:
-        collection.enterer = session['user']
+        collection.enterer = h.get_user()
 
     return collection
 
@@ -961,7 +979,6 @@ def update_collection(collection, data, collections_referenced):
 
     if changed:
         collection.datetime_modified = datetime.datetime.utcnow()
-        session['user'] = Session.merge(session['user'])
-        collection.modifier = session['user']
+        collection.modifier = h.get_user()
         return collection, restricted, contents_changed
     return changed, restricted, contents_changed
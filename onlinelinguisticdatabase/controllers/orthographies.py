@@ -130,7 +130,7 @@ class OrthographiesController(BaseController):
 
         """
         orthography = Session.query(Orthography).get(int(id))
-        user = session['user']
+        user = h.get_principal()
         if orthography:
             app_set = h.get_application_settings()
             if user.role == u'administrator' or orthography not in (
@@ -184,7 +184,7 @@ class OrthographiesController(BaseController):
         orthography = Session.query(Orthography).get(id)
         if orthography:
             app_set = h.get_application_settings()
-            if session['user'].role == u'administrator' or orthography not in (
+            if h.get_principal().role == u'administrator' or orthography not in (
             app_set.storage_orthography, app_set.input_orthography, app_set.output_orthography):
                 Session.delete(orthography)
                 Session.commit()
@@ -23,11 +23,11 @@ import logging
 import simplejson as json
 import os
 from uuid import uuid4
-from paste.fileapp import FileApp
 from pylons.controllers.util import forward
 from pylons import request, response, session, config
 from formencode.validators import Invalid
 from onlinelinguisticdatabase.lib.base import BaseController
+from onlinelinguisticdatabase.lib.backupwriter import BackupWriter
 from onlinelinguisticdatabase.lib.schemata import PhonologySchema, MorphophonemicTranscriptionsSchema
 import onlinelinguisticdatabase.lib.helpers as h
 from onlinelinguisticdatabase.lib.SQLAQueryBuilder import SQLAQueryBuilder, OLDSearchParseError
@@ -324,7 +324,7 @@ class PhonologiesController(BaseController):
                     'func': 'compile_phonology',
                     'args': {
                         'phonology_id': phonology.id,
-                        'user_id': session['user'].id,
+                        'user_id': h.get_principal().id,
                         'timeout': h.phonology_compile_timeout
                     }
                 })
@@ -351,7 +351,7 @@ class PhonologiesController(BaseController):
             if h.foma_installed():
                 compiled_path = phonology.get_file_path('binary')
                 if os.path.isfile(compiled_path):
-                    return forward(FileApp(compiled_path))
+                    return forward(h.FileServer(compiled_path))
                 else:
                     response.status_int = 400
                     return json.dumps({'error': 'Phonology %d has not been compiled yet.' % phonology.id})
@@ -457,9 +457,7 @@ def backup_phonology(phonology_dict):
     :returns: ``None``
 
     """
-    phonology_backup = PhonologyBackup()
-    phonology_backup.vivify(phonology_dict)
-    Session.add(phonology_backup)
+    BackupWriter().add(PhonologyBackup, phonology_dict).flush()
 
 
 ################################################################################
@@ -480,8 +478,8 @@ def create_new_phonology(data):
         name = h.normalize(data['name']),
         description = h.normalize(data['description']),
         script = h.normalize(data['script']).replace(u'\r', u''),  # normalize or not?
-        enterer = session['user'],
-        modifier = session['user'],
+        enterer = h.get_user(),
+        modifier = h.get_user(),
         datetime_modified = h.now(),
         datetime_entered = h.now()
     )
@@ -504,8 +502,7 @@ def update_phonology(phonology, data):
     changed = phonology.set_attr('word_boundary_symbol', h.word_boundary_symbol, changed)
 
     if changed:
-        session['user'] = Session.merge(session['user'])
-        phonology.modifier = session['user']
+        phonology.modifier = h.get_user()
         phonology.datetime_modified = h.now()
         return phonology
     return changed
@@ -126,12 +126,10 @@ class RememberedformsController(BaseController):
             try:
                 schema = FormIdsSchemaNullable
                 values = json.loads(unicode(request.body, request.charset))
-                data = schema.to_python(values)
+                data = schema.to_python(values, h.State())
                 forms = [f for f in data['forms'] if f]
-                accessible = h.user_is_authorized_to_access_model
-                unrestricted_users = h.get_unrestricted_users()
-                unrestricted_forms = [f for f in forms
-                                     if accessible(user, f, unrestricted_users)]
+                authorized = h.get_authorized_ids(user, 'Form', [f.id for f in forms])
+                unrestricted_forms = [f for f in forms if authorized.get(f.id)]
                 if set(user.remembered_forms) != set(unrestricted_forms):
                     user.remembered_forms = unrestricted_forms
                     user.datetime_modified = h.now()
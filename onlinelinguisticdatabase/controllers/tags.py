@@ -131,6 +131,7 @@ class TagsController(BaseController):
                 values = json.loads(unicode(request.body, request.charset))
                 state = h.get_state_object(values)
                 state.id = id
+                state.tag = tag
                 data = schema.to_python(values, state)
                 tag = update_tag(tag, data)
                 # tag will be False if there are no changes (cf. update_tag).
@@ -142,14 +142,14 @@ class UsersController(BaseController):
                 values = json.loads(unicode(request.body, request.charset))
                 state = h.get_state_object(values)
                 state.user_to_update = user.get_full_dict()
-                current_user = Session.query(User).get(session['user'].id)
-                state.user = current_user.get_full_dict()
+                state.user = h.get_user().get_full_dict()
                 data = schema.to_python(values, state)
                 user = update_user(user, data)
                 # user will be False if there are no changes (cf. update_user).
                 if user:
                     Session.add(user)
                     Session.commit()
+                    h.invalidate_principal(user.id)
                     return user.get_full_dict()
                 else:
                     response.status_int = 400
@@ -182,6 +182,7 @@ class UsersController(BaseController):
             h.destroy_user_directory(user)
             Session.delete(user)
             Session.commit()
+            h.invalidate_principal(user.id)
             return user.get_full_dict()
         else:
             response.status_int = 404
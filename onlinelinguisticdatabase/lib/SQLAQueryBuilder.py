@@ -397,7 +397,9 @@ class SQLAQueryBuilder(object):
     # 'relation' key (cf. schema['Form']['translations'] below). Certain
     # attributes require value converters -- functions that change the value in
     # some attribute-specific way, e.g., conversion of ISO 8601 datetimes to
-    # Python datetime objects.
+    # Python datetime objects.  Attributes with a true 'delta_encoded' value
+    # cannot be searched since most rows hold only a delta in place of their
+    # values (cf. lib/history.py).
     schema = {
         'Collection': {
             'id': {},
@@ -429,8 +431,8 @@ class SQLAQueryBuilder(object):
             'url': {},
             'description': {},
             'markup_language': {},
-            'contents': {},
-            'html': {},
+            'contents': {'delta_encoded': True},
+            'html': {'delta_encoded': True},
             'speaker': {},
             'source': {},
             'elicitor': {},
@@ -463,7 +465,7 @@ class SQLAQueryBuilder(object):
             'name': {},
             'type': {},
             'description': {},
-            'content': {},
+            'content': {'delta_encoded': True},
             'enterer': {},
             'modifier': {},
             'datetime_entered': {'value_converter': '_get_datetime_value'},
@@ -935,6 +937,11 @@ class SQLAQueryBuilder(object):
         if attribute_dict is None and report_error:
             self._add_to_errors('%s.%s' % (model_name, attribute_name),
                 u'Searching on %s.%s is not permitted' % (model_name, attribute_name))
+        elif attribute_dict and attribute_dict.get('delta_encoded') and report_error:
+            self._add_to_errors('%s.%s' % (model_name, attribute_name),
+                u'Searching on %s.%s is not permitted because most backups store'
+                u' their %s values as deltas against an earlier backup' % (
+                model_name, attribute_name, attribute_name))
         return attribute_dict
 
     def _get_attribute(self, attribute_name, model, model_name):
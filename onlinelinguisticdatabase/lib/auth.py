@@ -21,8 +21,8 @@
 
 import simplejson as json
 from decorator import decorator
-from pylons import session, response
-from utils import unauthorized_msg
+from pylons import response
+from utils import unauthorized_msg, get_principal
 import logging
 
 log = logging.getLogger(__name__)
@@ -37,7 +37,7 @@ def authenticate(target):
     """
 
     def wrapper(target, *args, **kwargs):
-        if getattr(session.get('user'), 'username', None):
+        if getattr(get_principal(), 'username', None):
             return target(*args, **kwargs)
         response.status_int = 401
         return {'error': 'Authentication is required to access this resource.'}
@@ -56,7 +56,7 @@ def authenticate_with_JSON(target):
     """
 
     def wrapper(target, *args, **kwargs):
-        if getattr(session.get('user'), 'username', None):
+        if getattr(get_principal(), 'username', None):
             return target(*args, **kwargs)
         response.status_int = 401
         return json.dumps({'error': 'Authentication is required to access this resource.'})
@@ -94,9 +94,10 @@ def authorize(roles, users=None, user_id_is_args1=False):
 
     def wrapper(target, *args, **kwargs):
         # Check for authorization via role.
-        role = getattr(session.get('user'), 'role', None)
+        principal = get_principal()
+        role = getattr(principal, 'role', None)
         if role in roles:
-            id = getattr(session.get('user'), 'id', None)
+            id = getattr(principal, 'id', None)
             # Check for authorization via user.
             if users:
                 if role != 'administrator' and id not in users:
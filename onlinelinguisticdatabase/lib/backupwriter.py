@@ -0,0 +1,397 @@
+# Copyright 2016 Joel Dunham
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+"""The backupwriter module contains the writer of backup models, i.e., of the
+previous versions of forms, collections, corpora, etc.
+
+A :class:`BackupWriter` converts the dict representations of the models to be
+backed up into backup table rows and inserts them with one executemany INSERT
+per backup table, without creating ORM instances or going through the unit of
+work of the session.  Example usage::
+
+    writer = BackupWriter()
+    for form in forms:
+        writer.add(FormBackup, form.get_dict())
+    writer.flush()
+
+By default the rows are inserted in the transaction of the current request so
+they are committed (or rolled back) with the changes that they back up.  If
+the ``defer_backups`` config option is true, :meth:`BackupWriter.flush` instead
+writes the rows to a pending journal file in ``<permanent_store>/backup_journal``
+and syncs it to disk.  When the transaction of the request commits, the journal
+file is released, i.e., renamed to its ``.json`` name, and handed to the backup
+flusher thread, which inserts the rows in batches and then deletes the journal
+file; when the transaction is rolled back, the journal file is discarded.  If
+the insert fails, the journal files are retried with an exponential backoff.
+Journal files left over when a process dies (or whose claim has expired) are
+replayed by the flushers, which rescan the journal directory whenever they are
+idle, so the backups of committed changes are written at least once.  (Pending
+journal files left over by a dead process are discarded, since it cannot be
+known whether their transaction committed.)
+"""
+
+import os
+import time
+import Queue
+import datetime
+import threading
+from uuid import uuid4
+import simplejson as json
+from sqlalchemy import event
+from paste.deploy.converters import asbool
+from pylons import config as pylons_config
+from onlinelinguisticdatabase.lib.utils import get_OLD_directory_path, make_directory_safely
+import onlinelinguisticdatabase.lib.history as history
+from onlinelinguisticdatabase.model.meta import Session, Base
+
+import logging
+log = logging.getLogger(__name__)
+
+################################################################################
+# Backup rows
+################################################################################
+
+def get_backup_row(backup_model, model_dict):
+    """Return the row of the backup of the model represented by ``model_dict``.
+
+    :param backup_model: a backup model class, e.g., ``FormBackup``.
+    :param dict model_dict: the dict representation of the model to be backed up.
+    :returns: a dict from column names to values (the primary key is omitted).
+
+    """
+    backup = backup_model()
+    backup.vivify(model_dict)
+    row = {}
+    for column in backup_model.__table__.columns:
+        if column.primary_key:
+            continue
+        value = getattr(backup, column.key)
+        if value is None and column.default is not None and column.default.is_scalar:
+            value = column.default.arg
+        row[column.key] = value
+    return row
+
+def insert_backup_rows(rows):
+    """Insert backup rows with one executemany INSERT per table.  The large
+    text columns of collection and corpus backups are delta-encoded first and
+    those rows are inserted one at a time (see :mod:`history`).
+
+    :param dict rows: maps backup table names to lists of row dicts.
+
+    """
+    for table_name, table_rows in sorted(rows.items()):
+        if table_rows:
+            history.insert_backup_rows(Base.metadata.tables[table_name], table_rows)
+
+
+class BackupWriter(object):
+    """Collects backup rows and writes them in batches.
+
+    :param config: a Pylons config object; if ``None``, ``pylons.config`` is used.
+
+    """
+
+    def __init__(self, config=None):
+        self.config = pylons_config if config is None else config
+        self.rows = {}
+
+    def add(self, backup_model, model_dict):
+        """Add a backup of the model represented by ``model_dict`` to the batch.
+
+        :returns: the writer so that calls can be chained.
+
+        """
+        self.rows.setdefault(backup_model.__tablename__, []).append(
+            get_backup_row(backup_model, model_dict))
+        return self
+
+    def flush(self):
+        """Write the batched backup rows and empty the batch.
+
+        The rows are inserted in the current transaction unless backups are
+        deferred, in which case they are journaled for the backup flusher once
+        the current transaction commits.
+
+        """
+        rows, self.rows = self.rows, {}
+        if not rows:
+            return
+        if asbool(self.config.get('defer_backups', 0)):
+            get_pending_journal_files(Session()).append(
+                write_journal_file(rows, self.config, pending=True))
+        else:
+            insert_backup_rows(rows)
+
+
+################################################################################
+# Backup journal
+################################################################################
+
+def get_journal_path(config):
+    return get_OLD_directory_path('backup_journal', config=config)
+
+def encode_journal_value(obj):
+    """JSON-encode the dates and datetimes in backup rows."""
+    if isinstance(obj, datetime.datetime):
+        return {'__datetime__': [obj.year, obj.month, obj.day, obj.hour,
+                                 obj.minute, obj.second, obj.microsecond]}
+    if isinstance(obj, datetime.date):
+        return {'__date__': [obj.year, obj.month, obj.day]}
+    raise TypeError(repr(obj) + ' is not JSON serializable')
+
+def decode_journal_value(dict_):
+    if '__datetime__' in dict_:
+        return datetime.datetime(*dict_['__datetime__'])
+    if '__date__' in dict_:
+        return datetime.date(*dict_['__date__'])
+    return dict_
+
+def write_journal_file(rows, config, pending=False):
+    """Durably write backup rows to a new journal file and return its path.
+
+    The rows are written to a temporary file which is synced to disk before it
+    is renamed to its ``.json`` name, so a journal file is always complete.  If
+    ``pending`` is true, the file is given a pending name instead, which
+    records the pid of the process and the time of the write; the flushers
+    ignore it until it is released, cf. :func:`release_journal_file`.
+
+    """
+    journal_path = get_journal_path(config)
+    make_directory_safely(journal_path)
+    name = '%s-%s.json' % (datetime.datetime.utcnow().strftime('%Y%m%d%H%M%S%f'),
+                           uuid4().hex)
+    path = os.path.join(journal_path, name)
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as f:
+        json.dump(rows, f, default=encode_journal_value)
+        f.flush()
+        os.fsync(f.fileno())
+    if pending:
+        path = '%s.pending-%d-%d' % (path, os.getpid(), int(time.time()))
+    os.rename(temp_path, path)
+    return path
+
+def release_journal_file(pending_path):
+    """Rename a pending journal file to its ``.json`` name and return the new path."""
+    path = pending_path.split('.pending-')[0]
+    os.rename(pending_path, path)
+    return path
+
+def get_pending_journal_files(session):
+    """Return the list of the pending journal files written in the current
+    transaction of ``session``.
+    """
+    try:
+        return session.pending_journal_files
+    except AttributeError:
+        session.pending_journal_files = []
+        return session.pending_journal_files
+
+@event.listens_for(Session, 'after_commit')
+def queue_pending_journal_files(session):
+    """Release the pending journal files of the transaction that has just been
+    committed and hand them to the backup flusher.
+    """
+    paths, session.pending_journal_files = get_pending_journal_files(session), []
+    for path in paths:
+        try:
+            backup_flusher_q.put(release_journal_file(path))
+        except OSError, e:
+            log.warn('Unable to release the backup journal file %s: %s' % (path, e))
+
+@event.listens_for(Session, 'after_soft_rollback')
+def discard_pending_journal_files(session, previous_transaction):
+    """Delete the pending journal files of the transaction that has just been
+    rolled back: the changes that they back up were not made.
+    """
+    paths, session.pending_journal_files = get_pending_journal_files(session), []
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError, e:
+            log.warn('Unable to discard the backup journal file %s: %s' % (path, e))
+
+# The number of seconds after which a claim on a journal file expires even if
+# a process with the claimant's pid is alive, since the pid may have been reused.
+backup_claim_timeout = 3600
+
+def claim_journal_file(path):
+    """Atomically claim a journal file for this process by renaming it.
+
+    The claimed name records the pid of the process and the time of the claim,
+    cf. :func:`get_unflushed_journal_files`.
+
+    :returns: the path of the claimed file or ``None`` if another process (or
+        thread) has already claimed it.
+
+    """
+    claimed_path = '%s.claimed-%d-%d' % (path, os.getpid(), int(time.time()))
+    try:
+        os.rename(path, claimed_path)
+    except OSError:
+        return None
+    return claimed_path
+
+def read_journal_file(path):
+    with open(path, 'rb') as f:
+        return json.load(f, object_hook=decode_journal_value)
+
+def process_is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+def claim_is_live(pid, claimed):
+    """Return True if the claim made by process ``pid`` at time ``claimed`` may
+    still be flushed.  A claim older than ``backup_claim_timeout`` is not, since
+    a live process with ``pid`` may be one that reused the claimant's pid.
+    """
+    return time.time() - claimed < backup_claim_timeout and process_is_alive(pid)
+
+def get_unflushed_journal_files(config):
+    """Return the paths of the journal files that no live process will flush,
+    i.e., unclaimed files and files whose claims are not live.  Pending files
+    that no live process will release are deleted.
+    """
+    journal_path = get_journal_path(config)
+    if not journal_path or not os.path.isdir(journal_path):
+        return []
+    paths = []
+    for name in sorted(os.listdir(journal_path)):
+        if name.endswith('.json'):
+            paths.append(os.path.join(journal_path, name))
+        elif '.json.claimed-' in name:
+            try:
+                pid, claimed = map(int, name.split('.claimed-')[1].split('-'))
+            except ValueError:
+                continue
+            if not claim_is_live(pid, claimed):
+                path = os.path.join(journal_path, name.split('.claimed-')[0])
+                try:
+                    os.rename(os.path.join(journal_path, name), path)
+                except OSError:
+                    continue
+                paths.append(path)
+        elif '.json.pending-' in name:
+            try:
+                pid, written = map(int, name.split('.pending-')[1].split('-'))
+            except ValueError:
+                continue
+            if not claim_is_live(pid, written):
+                log.warn('Discarding the backup journal file %s of a process'
+                         ' that died before releasing it.' % name)
+                try:
+                    os.remove(os.path.join(journal_path, name))
+                except OSError:
+                    continue
+    return paths
+
+
+################################################################################
+# Backup flusher
+################################################################################
+
+backup_flusher_q = Queue.Queue()
+
+# The maximum number of journal files whose rows the flusher inserts in a
+# single transaction.
+backup_flusher_batch_size = 100
+
+# The number of seconds the flusher waits before retrying journal files whose
+# flush failed; the delay doubles with each consecutive failure up to the max.
+backup_flusher_retry_delay = 1
+backup_flusher_max_retry_delay = 300
+
+# The number of seconds the flusher may be idle before it rescans the journal
+# directory for files that no live process will flush.
+backup_flusher_rescan_interval = 60
+
+def flush_journal_files(paths):
+    """Insert the rows of the journal files at ``paths`` in one transaction and
+    delete the files.  Files claimed by another process are skipped.
+    """
+    claimed_paths = filter(None, [claim_journal_file(path) for path in paths])
+    if not claimed_paths:
+        return
+    try:
+        rows = {}
+        for path in claimed_paths:
+            for table_name, table_rows in read_journal_file(path).items():
+                rows.setdefault(table_name, []).extend(table_rows)
+        insert_backup_rows(rows)
+        Session.commit()
+    except Exception:
+        Session.rollback()
+        # Release the files so that they are replayed later.
+        for path in claimed_paths:
+            os.rename(path, path.split('.claimed-')[0])
+        raise
+    for path in claimed_paths:
+        os.remove(path)
+
+def get_retry_delay(failures):
+    """Return the number of seconds to wait after ``failures`` consecutive failed flushes."""
+    return min(backup_flusher_retry_delay * 2 ** (failures - 1),
+               backup_flusher_max_retry_delay)
+
+class BackupFlusherThread(threading.Thread):
+    """Define the backup flusher, i.e., a thread that inserts journaled backups.
+    """
+    def __init__(self, config):
+        threading.Thread.__init__(self)
+        self.config = config
+
+    def run(self):
+        failures = 0
+        while True:
+            try:
+                paths = [backup_flusher_q.get(timeout=backup_flusher_rescan_interval)]
+            except Queue.Empty:
+                for path in get_unflushed_journal_files(self.config):
+                    backup_flusher_q.put(path)
+                continue
+            while len(paths) < backup_flusher_batch_size:
+                try:
+                    paths.append(backup_flusher_q.get_nowait())
+                except Queue.Empty:
+                    break
+            try:
+                flush_journal_files(paths)
+                failures = 0
+            except Exception, e:
+                failures += 1
+                log.warn('Unable to write the backups in %s (retrying in %d seconds): %s' % (
+                    ', '.join(paths), get_retry_delay(failures), e))
+            finally:
+                Session.remove()
+            if failures:
+                time.sleep(get_retry_delay(failures))
+                for path in paths:
+                    backup_flusher_q.put(path)
+            for path in paths:
+                backup_flusher_q.task_done()
+
+def start_backup_flusher(config):
+    """Start the backup flusher if the ``defer_backups`` config option is true
+    and queue the journal files left over by processes that have died.  Called
+    in :mod:`onlinelinguisticdatabase.config.environment.py`.
+    """
+    if asbool(config.get('defer_backups', 0)):
+        for path in get_unflushed_journal_files(config):
+            backup_flusher_q.put(path)
+        backup_flusher = BackupFlusherThread(config)
+        backup_flusher.setDaemon(True)
+        backup_flusher.start()
@@ -16,17 +16,23 @@
 
 Provides the BaseController class for subclassing.
 """
+import time
 from pylons.controllers import WSGIController
 from pylons.templating import render_mako as render
 
+from onlinelinguisticdatabase.model import meta
 from onlinelinguisticdatabase.model.meta import Session
 from onlinelinguisticdatabase.model import User
-from pylons import request, response, session, app_globals
+from pylons import request, response, session, app_globals, config
 import onlinelinguisticdatabase.lib.helpers as h
 
 import logging
 log = logging.getLogger(__name__)
 
+# The read-only controller actions, i.e., those whose queries may be sent to a
+# read replica, cf. model/meta.py.
+replica_actions = ('index', 'show', 'search', 'history', 'new_search')
+
 class BaseController(WSGIController):
 
     def __call__(self, environ, start_response):
@@ -48,7 +54,7 @@ class BaseController(WSGIController):
         
         If present, environ['test.authentication.role'] will evaluate to a user
         role that can be used to retrieve a user with that role from the db and
-        put it in the (Beaker) session.  This permits simulation of
+        put its principal in the (Beaker) session.  This permits simulation of
         authentication and authorization. See https://groups.google.com/forum/?fromgroups=#!searchin/pylons-discuss/test$20session/pylons-discuss/wiwOQBIxDw8/0yR3z3YiYzYJ
         for the origin of this hack.
 
@@ -66,20 +72,41 @@ class BaseController(WSGIController):
         masse.
         """
 
+        if request.environ.get('test.application_settings'):
+            app_globals.application_settings = h.ApplicationSettings()
         if 'test.authentication.role' in request.environ:
             role = unicode(request.environ['test.authentication.role'])
             user = Session.query(User).filter(User.role==role).first()
             if user:
-                session['user'] = user
+                session['principal'] = h.cache_principal(user)
         if 'test.authentication.id' in request.environ:
             user = Session.query(User).get(
                 request.environ['test.authentication.id'])
             if user:
-                session['user'] = user
-        if request.environ.get('test.application_settings'):
-            app_globals.application_settings = h.ApplicationSettings()
+                session['principal'] = h.cache_principal(user)
+        self.route_to_replica()
+
+    def route_to_replica(self):
+        """Send the queries of read-only actions to a read replica, unless the
+        user has written within the last ``replica_pin_seconds`` seconds, in
+        which case the replicas may not have caught up with the write yet.
+        """
+        if meta.replica_engines:
+            action = request.environ['pylons.routes_dict'].get('action')
+            Session().use_replica = action in replica_actions and \
+                session.get('primary_pinned_until', 0) < time.time()
+
+    def pin_to_primary(self):
+        """Pin the user to the primary database for ``replica_pin_seconds``
+        seconds if the request has written to it.
+        """
+        if meta.replica_engines and Session().wrote:
+            session['primary_pinned_until'] = time.time() + \
+                float(config.get('replica_pin_seconds', 10))
+            session.save()
 
     def __after__(self):
+        self.pin_to_primary()
         if request.environ.get('test.application_settings') and \
         not request.environ.get('test.retain_application_settings'):
             del app_globals.application_settings
@@ -0,0 +1,145 @@
+# Copyright 2016 Joel Dunham
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+"""The blobstore module contains the content-addressed storage of file data.
+
+The data of each local file are stored once in files/blobs under their SHA-256
+hex digest.  The file's own name in files/ (i.e., ``file.filename``) is a hard
+link to its blob, so everything that reads file data by filename keeps working,
+but identical uploads occupy the disk only once.  Where hard links are not
+supported the blob is copied instead and only the hashing benefits remain.
+
+The reference count of a blob is the number of rows in the file table with its
+checksum: when the last such file is deleted, the blob is removed.
+
+Typical usage in the files controller::
+
+    checksum, temp_path = write_blob(source, files_path)
+    file.checksum = checksum
+    store_blob(temp_path, checksum, files_path, file_path)
+
+"""
+
+import os
+import shutil
+import threading
+from hashlib import sha256
+from tempfile import mkstemp
+from uuid import uuid4
+from sqlalchemy.sql import func
+from onlinelinguisticdatabase.model.meta import Session
+from onlinelinguisticdatabase.model import File
+
+import logging
+log = logging.getLogger(__name__)
+
+blob_read_size = 65536
+
+# Storing a blob (and linking it to a filename) and removing an unreferenced
+# blob are serialized per checksum stripe so that a blob is never removed
+# between the moment a duplicate upload finds it and the moment it is linked.
+blob_locks = [threading.Lock() for i in range(16)]
+
+def get_blob_lock(checksum):
+    return blob_locks[int(checksum[:8], 16) % len(blob_locks)]
+
+def get_blobs_path(files_path):
+    """Return the path to the blob directory, creating it if necessary."""
+    blobs_path = os.path.join(files_path, 'blobs')
+    if not os.path.isdir(blobs_path):
+        try:
+            os.makedirs(blobs_path)
+        except OSError:
+            pass    # created concurrently
+    return blobs_path
+
+def get_blob_path(files_path, checksum):
+    return os.path.join(files_path, 'blobs', checksum)
+
+def write_blob(source, files_path):
+    """Write the data of ``source`` to a temporary file in the blob directory,
+    computing their SHA-256 hex digest as they are written.
+
+    :param source: a file-like object to be read to EOF, or a string.
+    :param str files_path: absolute path to the files directory.
+    :returns: a tuple: the checksum (a unicode string) and the path of the
+        temporary file, which should be passed to :func:`store_blob`.
+
+    """
+    checksum = sha256()
+    descriptor, temp_path = mkstemp(suffix='.part', dir=get_blobs_path(files_path))
+    with os.fdopen(descriptor, 'wb') as temp_file:
+        if isinstance(source, basestring):
+            checksum.update(source)
+            temp_file.write(source)
+        else:
+            for piece in iter(lambda: source.read(blob_read_size), ''):
+                checksum.update(piece)
+                temp_file.write(piece)
+    return unicode(checksum.hexdigest()), temp_path
+
+def store_blob(data_path, checksum, files_path, file_path):
+    """Move the data at ``data_path`` into the blob store and link ``file_path`` to it.
+
+    If a blob with the same checksum already exists, the data at ``data_path``
+    are discarded, i.e., a duplicate upload costs no extra disk space.
+
+    :param str data_path: path to the data, on the same filesystem as the files directory.
+    :param str checksum: the SHA-256 hex digest of the data.
+    :param str files_path: absolute path to the files directory.
+    :param str file_path: the path of the file, which may already exist (e.g.,
+        as an empty placeholder created by ``get_unique_file_path``).
+    :returns: ``True`` if the data were a duplicate of an existing blob.
+
+    """
+    blob_path = get_blob_path(files_path, checksum)
+    with get_blob_lock(checksum):
+        duplicate = os.path.isfile(blob_path)
+        if duplicate:
+            os.remove(data_path)
+        else:
+            os.rename(data_path, blob_path)
+        link_blob(blob_path, file_path)
+    return duplicate
+
+def link_blob(blob_path, file_path):
+    """Atomically make ``file_path`` a hard link to (or, failing that, a copy of) ``blob_path``."""
+    temp_path = '%s.%s.part' % (blob_path, uuid4().hex)
+    try:
+        os.link(blob_path, temp_path)
+    except (OSError, AttributeError):
+        shutil.copyfile(blob_path, temp_path)
+    os.rename(temp_path, file_path)
+
+def get_blob_reference_count(checksum):
+    """Return the number of files whose data are the blob with ``checksum``."""
+    return Session.query(func.count(File.id)).filter(File.checksum == checksum).scalar()
+
+def release_blob(checksum, files_path):
+    """Remove the blob with ``checksum`` if no file references it any longer.
+
+    Should be called after the deletion of a file with ``checksum`` has been
+    committed.  Files created before the blob store existed have no blob, in
+    which case this does nothing.
+
+    """
+    if not checksum:
+        return
+    blob_path = get_blob_path(files_path, checksum)
+    with get_blob_lock(checksum):
+        if get_blob_reference_count(checksum) == 0 and os.path.isfile(blob_path):
+            try:
+                os.remove(blob_path)
+            except OSError, e:
+                log.warn('Unable to remove blob %s: %s' % (checksum, e))
@@ -0,0 +1,146 @@
+# Copyright 2016 Joel Dunham
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+"""The dbengine module contains the creation of the SQLAlchemy engines of the
+database and its read replicas from the ``sqlalchemy.*`` config options.
+
+Besides the options of ``create_engine`` (e.g., ``sqlalchemy.pool_size``,
+``sqlalchemy.max_overflow``, ``sqlalchemy.pool_timeout`` and
+``sqlalchemy.pool_recycle``), the following options are recognized:
+
+- ``sqlalchemy.pool_pre_ping``: if true, connections are tested with a
+  ``SELECT 1`` when they are checked out of the pool and transparently replaced
+  if they have been closed by the server (or a firewall);
+- ``sqlalchemy.sqlite_journal_mode``: the SQLite journal mode, e.g., ``WAL``;
+- ``sqlalchemy.sqlite_synchronous``: the SQLite synchronous mode, e.g.,
+  ``NORMAL``.
+
+SQLite databases are given a ``regexp`` function and case-sensitive LIKE
+searches.  Note that SQLite file databases do not pool connections, so the
+pool size options only apply to MySQL.
+"""
+
+import re
+from paste.deploy.converters import asbool
+from sqlalchemy import engine_from_config, event, exc
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
+from onlinelinguisticdatabase.lib import profiling
+
+import logging
+log = logging.getLogger(__name__)
+
+# The options that are handled here rather than passed to create_engine.
+engine_options = ('pool_pre_ping', 'sqlite_journal_mode', 'sqlite_synchronous')
+
+# The options that only QueuePool, i.e., the pool of MySQL engines, accepts.
+queue_pool_options = ('pool_size', 'max_overflow', 'pool_timeout')
+
+sqlite_journal_modes = ('DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF')
+sqlite_synchronous_modes = ('OFF', 'NORMAL', 'FULL', 'EXTRA', '0', '1', '2', '3')
+
+def get_engine(config, url=None, prefix='sqlalchemy.'):
+    """Return an engine configured by the ``sqlalchemy.*`` options of ``config``.
+
+    :param config: the Pylons config object.
+    :param str url: the database URL; defaults to ``sqlalchemy.url``.  Read
+        replicas are created by passing their URLs here.
+    :param str prefix: the prefix of the engine options.
+    :returns: an SQLAlchemy engine.
+
+    """
+    options = dict((key, value) for key, value in config.iteritems()
+                   if key.startswith(prefix) and key[len(prefix):] not in engine_options)
+    if url:
+        options[prefix + 'url'] = url
+    url = make_url(options[prefix + 'url'])
+    pool_class = url.get_dialect().get_pool_class(url)
+    if not issubclass(pool_class, QueuePool):
+        for option in queue_pool_options:
+            if options.pop(prefix + option, None) is not None:
+                log.info('Ignoring %s%s: %s connections are not pooled.' % (
+                    prefix, option, url.drivername))
+    kwargs = {}
+    instrument = asbool(config.get('profile_requests', 0))
+    key = profiling.get_engine_key(url)
+    if instrument:
+        kwargs['poolclass'] = profiling.get_timed_pool_class(pool_class, key)
+    engine = engine_from_config(options, prefix, **kwargs)
+    if url.drivername.startswith('sqlite'):
+        add_sqlite_patches(engine,
+            get_pragma_value(config, prefix + 'sqlite_journal_mode', sqlite_journal_modes),
+            get_pragma_value(config, prefix + 'sqlite_synchronous', sqlite_synchronous_modes))
+    if asbool(config.get(prefix + 'pool_pre_ping', False)):
+        add_pre_ping(engine, key)
+    if instrument:
+        profiling.instrument_engine(engine, key)
+    return engine
+
+def get_pragma_value(config, option, values):
+    """Return the upper-cased value of a SQLite pragma option or ``None`` if it
+    is not set; raise a ``ValueError`` if it is not one of ``values``.
+    """
+    value = config.get(option)
+    if not value:
+        return None
+    value = value.strip().upper()
+    if value not in values:
+        raise ValueError(u'%s must be one of %s.' % (option, u', '.join(values)))
+    return value
+
+def regexp(expr, item):
+    """This is the Python re-based regexp function that we provide for SQLite.
+    Note that searches will be case-sensitive by default.  Such behaviour is
+    assured in MySQL by inserting COLLATE expressions into the query (cf. in
+    SQLAQueryBuilder.py).
+    """
+    patt = re.compile(expr)
+    try:
+        return item and patt.search(item) is not None
+    # This will make regexp searches work on int, date & datetime fields.
+    except TypeError:
+        return item and patt.search(str(item)) is not None
+
+def add_sqlite_patches(engine, journal_mode=None, synchronous=None):
+    """Give the connections of a SQLite engine a ``regexp`` function,
+    case-sensitive LIKE searches and the configured journal and synchronous
+    modes.
+    """
+    @event.listens_for(engine, 'connect')
+    def sqlite_patches(dbapi_connection, connection_record):
+        dbapi_connection.create_function('regexp', 2, regexp)
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA case_sensitive_like=ON')
+        if journal_mode:
+            cursor.execute('PRAGMA journal_mode=%s' % journal_mode)
+        if synchronous:
+            cursor.execute('PRAGMA synchronous=%s' % synchronous)
+        cursor.close()
+
+def add_pre_ping(engine, key=None):
+    """Test connections when they are checked out of the pool of ``engine``.
+
+    A connection that fails the test is reported to the pool as disconnected,
+    whereupon the pool replaces it with a new connection and tries again.
+
+    """
+    @event.listens_for(engine, 'checkout')
+    def ping_connection(dbapi_connection, connection_record, connection_proxy):
+        try:
+            cursor = dbapi_connection.cursor()
+            cursor.execute('SELECT 1')
+            cursor.close()
+        except Exception, e:
+            profiling.record_pool_disconnect(key)
+            raise exc.DisconnectionError(u'Pre-ping failed: %s' % e)
@@ -15,8 +15,8 @@
 """This module contains some multithreading worker and queue logic plus the functionality -- related
 to foma compilation ang LM estimation -- that the worther thread initiates.
 
-The the foma worker compiles foma FST phonology, morphology and morphophonology scripts
-and estimates morpheme language models.  Having a worker perform these tasks in a separate
+The the foma worker compiles foma FST phonology, morphology and morphophonology scripts,
+estimates morpheme language models and writes corpora to file.  Having a worker perform these tasks in a separate
 thread from that processing the HTTP request allows us to immediately respond to the user.
 
 The foma worker can only run a callable that is a global in
@@ -28,7 +28,7 @@ Example usage::
         'id': h.generate_salt(),
         'func': 'compile_foma_script',
         'args': {'model_name': u'Phonology', 'model_id': phonology.id,
-            'script_dir_path': phonology_dir_path, 'user_id': session['user'].id,
+            'script_dir_path': phonology_dir_path, 'user_id': h.get_principal().id,
             'verification_string': u'defined phonology: ', 'timeout': h.phonology_compile_timeout}
     })
 
@@ -39,6 +39,7 @@ http://www.ibm.com/developerworks/aix/library/au-threadingpython/.
 
 """
 
+import os
 import Queue
 import threading
 import logging
@@ -103,12 +104,18 @@ def generate_and_compile_morphology(**kwargs):
     :param bool kwargs['compile']: if True, the script will be generated *and* compiled.
     :param int kwargs['user_id']: id of the user model performing the generation/compilation.
     :param float kwargs['timeout']: how many seconds to wait before killing the foma compile process.
+    :param str kwargs['corpora_path']: absolute path to the corpora directory, where tokenized corpora are cached.
 
     """
     morphology = Session.query(model.Morphology).get(kwargs['morphology_id'])
     unknown_category = h.unknown_category
     try:
-        morphology.write(unknown_category)
+        corpora = [morphology.lexicon_corpus]
+        if not morphology.rules:
+            corpora.append(morphology.rules_corpus)
+        tokenized_corpora = dict((corpus.id, get_tokenized_corpus(corpus, morphology, kwargs))
+                                 for corpus in corpora if corpus)
+        morphology.write(unknown_category, tokenized_corpora)
     except Exception, e:
         log.warn(e)
         pass
@@ -133,6 +140,7 @@ def generate_language_model(**kwargs):
     :param str kwargs['morpheme_language_model_id']: ``id`` value of a morpheme LM.
     :param int/float kwargs['timeout']: seconds to allow for ARPA file creation.
     :param str kwargs['user_id']: ``id`` value of an OLD user.
+    :param str kwargs['corpora_path']: absolute path to the corpora directory, where tokenized corpora are cached.
     :returns: ``None``; side-effect is to change relevant attributes of LM object.
 
     """
@@ -142,7 +150,7 @@ def generate_language_model(**kwargs):
     trie_mod_time = lm.get_modification_time(trie_path)
     lm.generate_succeeded = False
     try:
-        lm.write_corpus()
+        lm.write_corpus(get_tokenized_corpus(lm.corpus, lm, kwargs))
     except Exception, e:
         lm.generate_message = u'Error writing the corpus file. %s' % e
     try:
@@ -173,10 +181,14 @@ def compute_perplexity(**kwargs):
     """
     lm = Session.query(model.MorphemeLanguageModel).get(kwargs['morpheme_language_model_id'])
     timeout = kwargs['timeout']
-    iterations = 5
+    folds = 5
     try:
-        lm.perplexity = lm.compute_perplexity(timeout, iterations)
-    except Exception:
+        evaluation = lm.evaluate_perplexity(timeout, folds=folds,
+            tokenized_corpus=get_tokenized_corpus(lm.corpus, lm, kwargs))
+        lm.perplexity = evaluation['perplexity']
+        log.info('Perplexity evaluation of morpheme language model %s: %s' % (lm.id, evaluation))
+    except Exception, e:
+        log.warn('Unable to evaluate the perplexity of morpheme language model %s: %s' % (lm.id, e))
         lm.perplexity = None
     if lm.perplexity is None:
         lm.perplexity_computed = False
@@ -187,6 +199,22 @@ def compute_perplexity(**kwargs):
     lm.datetime_modified = h.now()
     Session.commit()
 
+def get_tokenized_corpus(corpus, parse_model, kwargs):
+    """Return ``corpus`` tokenized using the morpheme delimiters of ``parse_model``, a morphology or LM.
+
+    The tokenized corpus is cached in the corpus's directory if the worker
+    was passed the path to the corpora directory.  Returns ``None`` if the
+    corpus could not be tokenized, in which case the model tokenizes its
+    corpus itself.
+
+    """
+    try:
+        return h.get_tokenized_corpus(corpus, parse_model.morpheme_splitter,
+                                      parse_model.delimiters, kwargs.get('corpora_path'))
+    except Exception, e:
+        log.warn('Unable to get the tokenized corpus of corpus %s: %s' % (corpus.id, e))
+        return None
+
 ################################################################################
 # MORPHOLOGICAL PARSER (MORPHOPHONOLOGY)
 ################################################################################
@@ -207,3 +235,125 @@ def generate_and_compile_parser(**kwargs):
         parser.cache.clear(persist=True)
     Session.commit()
 
+################################################################################
+# CORPUS FILE
+################################################################################
+
+def write_corpus_file(**kwargs):
+    """Write a corpus to file, along with a gzipped copy and (for treebanks) a TGrep2 index.
+
+    :param int kwargs['corpus_file_id']: id of the corpus file model to (re-)write.
+    :param str kwargs['file_path']: absolute path to the corpus file.
+    :param int kwargs['user_id']: id of the user model requesting the write.
+    :returns: ``None``; side-effect is to write the files and to update the
+        ``write_*``, ``forms_written`` and related attributes of the corpus file.
+
+    The corpus file is regenerated incrementally using its manifest (cf.
+    :class:`onlinelinguisticdatabase.lib.utils.CorpusFileManifest`): if the
+    ids and modification times of the corpus's forms match those recorded in
+    the manifest, the files are left untouched.  Otherwise, only forms that are
+    new or have been modified since the last write are fetched and rendered;
+    the representations of the others are copied from the existing file.
+
+    The plain and gzipped files are written in a single pass to temporary
+    paths and then moved into place so that a previous version of the file
+    remains servable until the new one is complete.  The manifest records the
+    size and checksum of the file it describes; if they do not match the file
+    on disk, it is ignored and the file is re-written from scratch.  The TGrep2 indexing is a
+    subsequent stage reported via a ``write_status`` of ``u'indexing'``; if it
+    fails, the ``write_status`` is ``u'failed'``.
+
+    """
+    corpus_file = Session.query(model.CorpusFile).get(kwargs['corpus_file_id'])
+    corpus = corpus_file.corpus
+    format_ = corpus_file.format
+    file_path = kwargs['file_path']
+    gzipped_file_path = '%s.gz' % file_path
+    tmp_suffix = '.%s.tmp' % corpus_file.write_attempt
+    corpus_file.write_status = u'writing'
+    Session.commit()
+    writer = h.corpus_formats[format_]['writer']
+    columns = h.corpus_formats[format_]['columns']
+    restricted = False
+    try:
+        manifest = h.CorpusFileManifest.load(file_path)
+        listing = h.get_corpus_file_listing(corpus)
+        corpus_file.form_count = len(listing)
+        corpus_file.forms_written = 0
+        Session.commit()
+        if manifest.checksum and listing == manifest.get_listing() and \
+        os.path.isfile(gzipped_file_path) and \
+        (os.path.isfile('%s.t2c' % file_path) or not h.tgrep2_indexing_applies(format_)):
+            corpus_file.forms_written = len(listing)
+            corpus_file.write_status = u'complete'
+            corpus_file.write_message = u'Corpus %d file with format "%s" is already up to date.' % (
+                corpus.id, format_)
+            Session.commit()
+            return
+        new_manifest = h.CorpusFileManifest(manifest.path)
+        offset = 0
+        with open(file_path, 'rb') if manifest.entries else open(os.devnull, 'rb') as old_file:
+            with h.TeeFile(file_path + tmp_suffix, gzipped_file_path + tmp_suffix) as f:
+                for chunk in h.chunker(listing, h.corpus_file_chunk_size):
+                    form_ids = [form_id for form_id, datetime_modified in chunk]
+                    if not restricted:
+                        restricted = h.corpus_forms_restricted(form_ids)
+                    rows = h.get_form_rows([form_id for form_id, datetime_modified in chunk
+                        if manifest.get_segment(form_id, datetime_modified) is None], columns)
+                    for form_id, datetime_modified in chunk:
+                        segment = manifest.get_segment(form_id, datetime_modified)
+                        if segment is None:
+                            data = writer(rows[form_id]).encode('utf8')
+                        else:
+                            old_file.seek(segment[0])
+                            data = old_file.read(segment[1])
+                        f.write(data)
+                        new_manifest.append(form_id, datetime_modified, offset, len(data))
+                        offset += len(data)
+                    corpus_file.forms_written += len(chunk)
+                    Session.commit()
+                checksum = unicode(f.checksum.hexdigest())
+        new_manifest.size = offset
+        new_manifest.checksum = checksum
+        new_manifest.save(tmp_suffix)
+        # The old manifest is removed first and the new one moved into place
+        # last so that a crash in between cannot pair a file with the
+        # manifest of another version of it.
+        if os.path.exists(new_manifest.path):
+            os.remove(new_manifest.path)
+        os.rename(file_path + tmp_suffix, file_path)
+        os.rename(gzipped_file_path + tmp_suffix, gzipped_file_path)
+        os.rename(new_manifest.path + tmp_suffix, new_manifest.path)
+    except Exception, e:
+        log.warn('Unable to write corpus %d to file: %s' % (corpus.id, e))
+        for path in (file_path, gzipped_file_path, h.CorpusFileManifest.get_path(file_path)):
+            if os.path.exists(path + tmp_suffix):
+                os.remove(path + tmp_suffix)
+        corpus_file.write_status = u'failed'
+        corpus_file.write_message = u'Unable to write corpus %d to file with format "%s". (%s)' % (
+            corpus.id, format_, e)
+        Session.commit()
+        return
+    corpus_file.restricted = restricted
+    corpus_file.checksum = checksum
+    corpus_file.write_status = u'indexing'
+    Session.commit()
+    try:
+        indexed = h.create_tgrep2_corpus_file(gzipped_file_path, format_) or \
+            not h.tgrep2_indexing_applies(format_)
+        error = u'TGrep2 did not create a .t2c file'
+    except Exception, e:
+        indexed = False
+        error = e
+    if indexed:
+        corpus_file.write_status = u'complete'
+        corpus_file.write_message = u'Corpus %d successfully written to file with format "%s".' % (
+            corpus.id, format_)
+    else:
+        log.warn('Unable to index corpus %d file with TGrep2: %s' % (corpus.id, error))
+        corpus_file.write_status = u'failed'
+        corpus_file.write_message = u'Unable to index corpus %d file with format "%s". (%s)' % (
+            corpus.id, format_, error)
+    corpus_file.modifier_id = kwargs['user_id']
+    corpus_file.datetime_modified = h.now()
+    Session.commit()
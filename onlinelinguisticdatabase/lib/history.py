@@ -0,0 +1,280 @@
+# Copyright 2016 Joel Dunham
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+"""The history module contains the delta encoding of the large text columns of
+backups.
+
+Every update of a collection or corpus saves a backup of its previous version
+and most of these versions differ only slightly in their (possibly very long)
+``contents``, ``html`` or ``content`` values.  The columns listed in
+``delta_encoded_columns`` are therefore stored as follows.  The backups of a
+model (i.e., those sharing a ``UUID``) form chains in ``id`` order.  The first
+backup of a chain is a snapshot: its ``snapshot`` value is true and its columns
+hold their full values.  Each subsequent backup has a false ``snapshot`` value,
+``NULL`` values in the delta-encoded columns and, in its ``delta`` column, a
+JSON object whose ``base`` value is the id of the snapshot and whose ``diffs``
+value maps each of those columns to a diff against the snapshot.  A new chain
+is started every ``backup_snapshot_interval`` backups and whenever a diff would
+not be much smaller than the values themselves.  Backups with a ``NULL``
+``snapshot`` value, i.e., those created before delta encoding, are snapshots.
+
+Since every delta names its base and diffs against it alone, a backup can be
+restored from two rows and backups written concurrently (e.g., by two requests
+updating the same collection or by the backup flushers of two processes) never
+depend on each other; at worst a chain grows a little beyond the interval.
+
+:func:`insert_backup_rows` is called by the backup writer to delta-encode and
+insert backup rows and :func:`restore_backups` restores the values of backup
+models before they are returned.  Since the values of the deltas are not in
+the database, searches on delta-encoded columns are rejected by the query
+builder (cf. the ``delta_encoded`` attributes in ``SQLAQueryBuilder.schema``).
+
+This module does not depend on the Pylons environment so that it can be used
+by the database update scripts.
+"""
+
+import re
+import logging
+from difflib import SequenceMatcher
+import simplejson as json
+from sqlalchemy.sql import select, func, and_, or_
+from sqlalchemy.orm.attributes import set_committed_value
+from onlinelinguisticdatabase.model.meta import Session
+
+log = logging.getLogger(__name__)
+
+# Maps the names of backup tables to the names of their delta-encoded columns.
+delta_encoded_columns = {
+    u'collectionbackup': ('contents', 'html'),
+    u'corpusbackup': ('content',)
+}
+
+# The maximum number of backups in a chain, i.e., a snapshot and the backups
+# that are diffs against it.
+backup_snapshot_interval = 10
+
+# Texts are diffed as sequences of lines and comma-terminated segments; the
+# latter matter for the comma-delimited form ids in corpus content values.
+segment_pattern = re.compile(u'[^\n,]*[\n,]|[^\n,]+$')
+
+################################################################################
+# Diffs
+################################################################################
+
+def get_diff(old, new):
+    """Return a JSON-serializable diff that turns ``old`` into ``new``.
+
+    The diff of two texts is a list of ``[i, j, segments]`` triples, each
+    meaning that the old segments from ``i`` to ``j`` are replaced by
+    ``segments``.  If either value is not a text, the diff is ``{"value": new}``.
+
+    """
+    if not (isinstance(old, basestring) and isinstance(new, basestring)):
+        return {'value': new}
+    old_segments = segment_pattern.findall(old)
+    new_segments = segment_pattern.findall(new)
+    matcher = SequenceMatcher(None, old_segments, new_segments, autojunk=False)
+    return [[i1, i2, new_segments[j1:j2]] for tag, i1, i2, j1, j2
+            in matcher.get_opcodes() if tag != 'equal']
+
+def apply_diff(old, diff):
+    """Return the value that results from applying ``diff`` to ``old``."""
+    if isinstance(diff, dict):
+        return diff['value']
+    old_segments = segment_pattern.findall(old)
+    new_segments = []
+    position = 0
+    for i1, i2, segments in diff:
+        new_segments.extend(old_segments[position:i1])
+        new_segments.extend(segments)
+        position = i2
+    new_segments.extend(old_segments[position:])
+    return u''.join(new_segments)
+
+def get_delta(base_id, base_values, values, columns):
+    """Return the JSON ``delta`` value of a backup with ``values`` whose base is
+    the snapshot with ``base_id`` and ``base_values``.
+    """
+    return unicode(json.dumps({
+        'base': base_id,
+        'diffs': dict((column, get_diff(base_values[column], values[column]))
+                      for column in columns)}, separators=(',', ':')))
+
+def apply_delta(delta, base_values, columns):
+    """Return the delta-encoded column values of a backup, given its parsed
+    ``delta`` value and the values of its base snapshot.
+    """
+    return dict((column, apply_diff(base_values[column], delta['diffs'][column]))
+                for column in columns)
+
+def is_snapshot(table):
+    return or_(table.c.snapshot == None, table.c.snapshot == True)
+
+def is_delta(row):
+    return row['snapshot'] is not None and not row['snapshot']
+
+################################################################################
+# Encoding
+################################################################################
+
+def get_chain_head(table, UUID, columns, bind):
+    """Return the chain head of the backups with ``UUID``, i.e., a 3-item list
+    containing the id and column values of their last snapshot and the length
+    of its chain, or ``None`` if there are no such backups.
+    """
+    snapshot = bind.execute(
+        select([table.c.id] + [table.c[column] for column in columns]).where(
+        and_(table.c.UUID == UUID, is_snapshot(table))).order_by(
+        table.c.id.desc()).limit(1)).fetchone()
+    if snapshot is None:
+        return None
+    length = bind.execute(select([func.count(table.c.id)]).where(
+        and_(table.c.UUID == UUID, table.c.id >= snapshot['id']))).scalar()
+    return [snapshot['id'], dict((column, snapshot[column]) for column in columns),
+            length]
+
+def encode_backup_row(row, head, columns):
+    """Delta-encode ``row`` (in place) against the snapshot of the chain head
+    ``head`` if that is worthwhile.
+
+    :returns: the values of the delta-encoded columns of ``row`` if it has
+        become a snapshot, else ``None``.
+
+    """
+    values = dict((column, row[column]) for column in columns)
+    row['snapshot'] = True
+    row['delta'] = None
+    if head and head[2] < backup_snapshot_interval:
+        delta = get_delta(head[0], head[1], values, columns)
+        size = sum(len(value) for value in values.values()
+                   if isinstance(value, basestring))
+        if len(delta) * 2 < size:
+            row['snapshot'] = False
+            row['delta'] = delta
+            for column in columns:
+                row[column] = None
+            return None
+    return values
+
+def insert_backup_rows(table, rows, bind=None):
+    """Insert backup rows into ``table``, delta-encoding the delta-encoded
+    columns first.
+
+    Rows of tables without delta-encoded columns are inserted with one
+    executemany INSERT.  The rows of the other tables are inserted one at a
+    time so that the snapshots among them can serve as the bases of the rows
+    that follow.
+
+    :param table: an SQLAlchemy ``Table`` instance, e.g., ``CollectionBackup.__table__``.
+    :param list rows: the row dicts, in insertion order; they are modified in place.
+    :param bind: an object with an ``execute`` method; defaults to ``Session``.
+
+    """
+    bind = bind or Session
+    columns = delta_encoded_columns.get(table.name)
+    if not columns:
+        bind.execute(table.insert(), rows)
+        return
+    heads = {}
+    for row in rows:
+        UUID = row.get('UUID')
+        if UUID is None:
+            row['snapshot'] = True
+            row['delta'] = None
+            bind.execute(table.insert(), row)
+            continue
+        if UUID not in heads:
+            heads[UUID] = get_chain_head(table, UUID, columns, bind)
+        values = encode_backup_row(row, heads[UUID], columns)
+        result = bind.execute(table.insert(), row)
+        if values is None:
+            heads[UUID][2] += 1
+        else:
+            heads[UUID] = [result.inserted_primary_key[0], values, 1]
+
+def compress_backups(table, bind):
+    """Delta-encode the existing backups in ``table``, e.g., after an upgrade.
+
+    :param table: an SQLAlchemy ``Table`` instance of a backup table.
+    :param bind: an engine or connection.
+    :returns: the number of backups that were delta-encoded.
+
+    """
+    columns = delta_encoded_columns[table.name]
+    UUIDs = [r[0] for r in bind.execute(
+        select([table.c.UUID]).where(table.c.UUID != None).distinct()).fetchall()]
+    count = 0
+    for UUID in UUIDs:
+        rows = bind.execute(
+            select([table.c.id, table.c.snapshot, table.c.delta] +
+                   [table.c[column] for column in columns]).where(
+            table.c.UUID == UUID).order_by(table.c.id)).fetchall()
+        snapshots = {}
+        head = None
+        for row in rows:
+            if is_delta(row):
+                delta = json.loads(row['delta'])
+                values = apply_delta(delta, snapshots[delta['base']], columns)
+            else:
+                values = dict((column, row[column]) for column in columns)
+                snapshots[row['id']] = values
+            row = dict(values, snapshot=row['snapshot'], delta=row['delta'], id=row['id'])
+            snapshot_values = encode_backup_row(row, head, columns)
+            if snapshot_values is None:
+                head[2] += 1
+                count += 1
+            else:
+                head = [row['id'], snapshot_values, 1]
+            update = dict((column, row[column]) for column in columns)
+            update.update(snapshot=row['snapshot'], delta=row['delta'])
+            bind.execute(table.update().where(table.c.id == row['id']).values(**update))
+    return count
+
+################################################################################
+# Restoration
+################################################################################
+
+def restore_backups(backups, bind=None):
+    """Restore the delta-encoded column values of backup models in place.
+
+    :param backups: a list of backup models or a dict whose ``items`` value is
+        such a list, i.e., the return value of ``add_pagination``.
+    :param bind: an object with an ``execute`` method; defaults to ``Session``.
+    :returns: ``backups``.
+
+    """
+    items = backups.get('items', []) if isinstance(backups, dict) else backups
+    encoded = {}
+    for backup in items:
+        if getattr(backup, 'snapshot', None) is False and \
+        getattr(backup, '__tablename__', None) in delta_encoded_columns:
+            encoded.setdefault(backup.__table__, []).append(
+                (backup, json.loads(backup.delta)))
+    bind = bind or Session
+    for table, backups_deltas in encoded.iteritems():
+        columns = delta_encoded_columns[table.name]
+        base_ids = set(delta['base'] for backup, delta in backups_deltas)
+        bases = dict((row['id'], row) for row in bind.execute(
+            select([table.c.id] + [table.c[column] for column in columns]).where(
+            table.c.id.in_(base_ids))).fetchall())
+        for backup, delta in backups_deltas:
+            base = bases.get(delta['base'])
+            if base is None:
+                log.warn('Unable to restore %s %s: its base snapshot %s does not exist.' % (
+                    table.name, backup.id, delta['base']))
+                continue
+            values = apply_delta(delta, base, columns)
+            for column in columns:
+                set_committed_value(backup, column, values[column])
+    return backups
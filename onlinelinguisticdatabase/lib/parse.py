@@ -54,8 +54,12 @@ if not 'PhonologyFST' in dir(parser):
 config_file = 'config.pickle'
 config_path = os.path.join(script_dir, config_file)
 config = cPickle.load(open(config_path, 'rb'))
-cache_file = 'cache.pickle'
+cache_file = 'cache.sqlite'
 cache_path = os.path.join(script_dir, cache_file)
+# Archives exported by older OLDs have a pickled cache; parser.Cache converts it.
+legacy_cache_path = os.path.join(script_dir, 'cache.pickle')
+if os.path.isfile(legacy_cache_path) and not os.path.isfile(cache_path):
+    os.rename(legacy_cache_path, cache_path)
 
 phonology = parser.PhonologyFST(
     parent_directory = script_dir,
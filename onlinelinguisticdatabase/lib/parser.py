@@ -40,9 +40,14 @@ from shutil import copyfile
 import errno
 import re
 import cPickle
+import sqlite3
 from shutil import rmtree
 from uuid import uuid4
-from subprocess import Popen, PIPE
+from subprocess import PIPE
+try:
+    from onlinelinguisticdatabase.lib.profiling import Popen
+except ImportError:
+    from subprocess import Popen
 from itertools import product
 import threading
 from signal import SIGKILL
@@ -803,7 +808,8 @@ class LanguageModel(Command, Parse):
 
     .. note::
 
-        At present, only support for the MITLM toolkit is implemented.
+        Two toolkits are supported: MITLM, which is run as a subprocess, and
+        simplelm, which estimates the LM in-process (see ``simplelm.NGramEstimator``).
 
     .. note::
 
@@ -825,6 +831,11 @@ class LanguageModel(Command, Parse):
                 # cf. http://code.google.com/p/mitlm/wiki/Tutorial
                 'ML', 'FixKN', 'FixModKN', 'FixKNn', 'KN', 'ModKN', 'KNn'], 
             'verification_string_getter': lambda x: u'Saving LM to %s' % x
+        },
+        'simplelm': {
+            'executable': None,
+            'smoothing_algorithms': simplelm.NGramEstimator.smoothing_algorithms,
+            'verification_string_getter': None
         }
     }
 
@@ -905,6 +916,8 @@ class LanguageModel(Command, Parse):
 
         """
 
+        if self.toolkit == u'simplelm':
+            return self.write_arpa_simplelm()
         verification_string = self.verification_string
         arpa_path = self.get_file_path('arpa')
         arpa_mod_time = self.get_modification_time(arpa_path)
@@ -917,6 +930,35 @@ class LanguageModel(Command, Parse):
         if not succeeded:
             raise Exception('method write_arpa failed.')
 
+    def write_arpa_simplelm(self):
+        """Estimate the LM in-process using ``simplelm.NGramEstimator`` and write its ARPA file.
+
+        The trie is built directly from the estimator and kept on the instance so
+        that ``generate_trie`` does not need to parse the ARPA file just written.
+
+        """
+        estimator = self.get_estimator()
+        estimator.add_corpus(self.get_file_path('corpus'))
+        estimator.estimate()
+        estimator.write_arpa(self.get_file_path('arpa'))
+        self._estimated_trie = estimator.get_trie()
+
+    def get_estimator(self):
+        """Return a ``simplelm.NGramEstimator`` configured with this LM's order, smoothing and vocabulary."""
+        return simplelm.NGramEstimator(
+            order=self.order,
+            smoothing=self.smoothing or 'ModKN',
+            sb=self.start_symbol,
+            se=self.end_symbol,
+            vocabulary=self.read_vocabulary())
+
+    def read_vocabulary(self):
+        """Return the list of words in the vocabulary file, or ``None`` if there is none."""
+        if not self.vocabulary:
+            return None
+        with codecs.open(self.get_file_path('vocabulary'), encoding='utf8') as f:
+            return [line.strip() for line in f if line.strip()]
+
     @property
     def write_arpa_command(self):
         """Returns a list of strings representing a command to generate an ARPA file using the toolkit."""
@@ -944,7 +986,12 @@ class LanguageModel(Command, Parse):
             ``simplelm.LMTree`` instance.
 
         """
-        self._trie = simplelm.load_arpa(self.get_file_path('arpa'), 'utf8')
+        trie = getattr(self, '_estimated_trie', None)
+        if trie is None:
+            trie = simplelm.load_arpa(self.get_file_path('arpa'), 'utf8')
+        else:
+            self._estimated_trie = None
+        self._trie = trie
         cPickle.dump(self._trie, open(self.get_file_path('trie'), 'wb'))
 
     @property
@@ -968,7 +1015,7 @@ class LanguageModel(Command, Parse):
 
 
 class Cache(object):
-    """For caching parses; basically a dict with some conveniences and pickle-based persistence.
+    """For caching parses; basically a dict with some conveniences and SQLite-based persistence.
 
     A MorphologicalParser instance can be expected to access and set keys via the familiar Python
     dictionary interface as well as request that the cache be persisted, i.e., by calling
@@ -979,54 +1026,162 @@ class Cache(object):
     - ``get(k, default)``
     - ``persist()``
 
+    The persistence layer is an SQLite file with one row per key, so lookups
+    do not require loading the entire cache and ``persist()`` only inserts the
+    entries added since the last call.  A file at ``path`` in the older format
+    (a pickled dict, or a sequence of them) is converted on first use.
+
     """
 
+    sqlite_header = 'SQLite format 3\x00'
+
     def __init__(self, path=None):
         self.updated = False # means that ``self._store`` is in sync with persistent cache
-        self.path = path # without a path, pickle-based persistence is impossible
+        self.path = path # without a path, persistence is impossible
         self._store = {}
-        if self.path and os.path.isfile(self.path):
+        self._unpersisted = {}
+        self._connection = None
+        self._lock = threading.RLock()
+        if self.path:
             try:
-                self._store = cPickle.load(open(self.path, 'rb'))
-                if not isinstance(self._store, dict):
-                    self._store = {}
-            except Exception:
-                pass
+                self._connect()
+            except Exception, e:
+                log.warn('Unable to open parse cache %s: %s' % (self.path, e))
+                self.path = None
+
+    def _connect(self):
+        if os.path.isfile(self.path):
+            with open(self.path, 'rb') as f:
+                is_sqlite = f.read(len(self.sqlite_header)) == self.sqlite_header
+            if not is_sqlite:
+                self._convert()
+        self._connection = self._open(self.path)
+
+    def _open(self, path):
+        connection = sqlite3.connect(path, check_same_thread=False)
+        connection.text_factory = unicode
+        connection.execute('CREATE TABLE IF NOT EXISTS cache '
+            '(key TEXT PRIMARY KEY, value BLOB)')
+        connection.commit()
+        return connection
+
+    def _convert(self):
+        """Convert the cache file at ``self.path`` from the older, pickled format.
+
+        The SQLite file is built at a temporary path and then renamed over the
+        pickled file, so the latter is only replaced once it has been converted.
+        If it cannot be unpickled, it is left untouched and the exception is raised.
+
+        """
+        legacy = self._load_pickles(self.path)
+        tmp_path = '%s.%s.tmp' % (self.path, uuid4().hex)
+        try:
+            self._connection = self._open(tmp_path)
+            self._insert(legacy)
+            self.close()
+            os.rename(tmp_path, self.path)
+        except Exception:
+            self.close()
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def _load_pickles(self, path):
+        """Return the dict(s) pickled in the file at ``path`` merged into one dict."""
+        store = {}
+        with open(path, 'rb') as f:
+            while True:
+                try:
+                    page = cPickle.load(f)
+                except EOFError:
+                    break
+                if isinstance(page, dict):
+                    store.update(page)
+        return store
+
+    def _insert(self, dict_):
+        with self._lock:
+            self._connection.executemany('INSERT OR REPLACE INTO cache VALUES (?, ?)',
+                ((k, buffer(cPickle.dumps(v, cPickle.HIGHEST_PROTOCOL)))
+                 for k, v in dict_.iteritems()))
+            self._connection.commit()
+
+    def _select(self, k):
+        if not self._connection:
+            raise KeyError(k)
+        with self._lock:
+            row = self._connection.execute('SELECT value FROM cache WHERE key = ?',
+                                           (k,)).fetchone()
+        if row is None:
+            raise KeyError(k)
+        return cPickle.loads(str(row[0]))
 
     def __setitem__(self, k, v):
-        if k not in self._store:
-            self.updated = True
-        self._store[k] = v
+        self.updated = True
+        self._store[k] = self._unpersisted[k] = v
 
     def __getitem__(self, k):
-        return self._store[k]
+        try:
+            return self._store[k]
+        except KeyError:
+            self._store[k] = self._select(k)
+            return self._store[k]
 
     def __len__(self):
-        return len(self._store)
+        if not self._connection:
+            return len(self._store)
+        with self._lock:
+            count = self._connection.execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+        return count + len([k for k in self._unpersisted if not self._is_persisted(k)])
+
+    def _is_persisted(self, k):
+        try:
+            self._select(k)
+            return True
+        except KeyError:
+            return False
 
     def get(self, k, default=None):
-        return self._store.get(k, default)
+        try:
+            return self[k]
+        except KeyError:
+            return default
 
     def update(self, dict_, **kwargs):
-        old_keys = self._store.keys()
-        self._store.update(dict_, **kwargs)
-        if set(old_keys) != set(self._store.keys()):
-            self.updated = True
+        for k, v in dict(dict_, **kwargs).iteritems():
+            self[k] = v
 
     def persist(self):
-        """Update the persistence layer with the value of ``self._store``.
+        """Insert the entries added since the last call into the persistence layer.
         """
-        if self.updated and self.path:
-            cPickle.dump(self._store, open(self.path, 'wb'))
+        if self.updated and self._connection:
+            self._insert(self._unpersisted)
+            self._unpersisted = {}
             self.updated = False
 
     def clear(self, persist=False):
         """Clear the cache and its persistence layer.
         """
         self._store = {}
-        if persist:
-            self.updated = True
-            self.persist()
+        self._unpersisted = {}
+        self.updated = False
+        if persist and self._connection:
+            with self._lock:
+                self._connection.execute('DELETE FROM cache')
+                self._connection.commit()
+
+    @classmethod
+    def write(cls, path, pages):
+        """Write a cache file at ``path`` from an iterable of dicts of entries."""
+        cache = cls(path)
+        for page in pages:
+            cache._insert(page)
+        cache.close()
+
+    def close(self):
+        if self._connection:
+            self._connection.close()
+            self._connection = None
 
 
 class MorphologicalParser(FomaFST, Parse):
@@ -1287,5 +1442,5 @@ class MorphologicalParser(FomaFST, Parse):
             return self._file_type2extension
         else:
             self._file_type2extension = super(MorphologicalParser, self).file_type2extension.copy()
-            self._file_type2extension.update({'cache': '_cache.pickle'})
+            self._file_type2extension.update({'cache': '_cache.sqlite'})
             return self._file_type2extension
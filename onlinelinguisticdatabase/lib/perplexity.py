@@ -0,0 +1,204 @@
+# Copyright 2016 Joel Dunham
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+"""K-fold perplexity evaluation of morpheme language models.
+
+The corpus of a language model is a list of words, each of which is a list of
+morphemes (or categories).  :func:`evaluate_folds` divides it into ``k`` disjoint
+folds using a seeded shuffle, so that the same corpus and seed always yield the
+same folds, and then, for each fold, estimates an LM from the other ``k - 1``
+folds and computes the perplexity of the held-out fold.  The folds are
+evaluated concurrently by a pool of threads.  (A process pool is not used: the
+evaluations are run by the foma worker thread and forking a multi-threaded
+process can deadlock.)  Folds that fail are logged and given a perplexity of
+``None``.
+
+The per-fold work is done by a fold evaluator, a function that is called with
+the training words, the test words, the index of the fold and a dict of
+toolkit-specific options and which returns a perplexity or ``None``:
+
+- :func:`simplelm_fold_perplexity` estimates the LM in-process.
+- :func:`mitlm_fold_perplexity` writes the sets to disk and runs MITLM's
+  ``estimate-ngram -eval-perp``.
+
+"""
+
+import codecs
+import multiprocessing
+import os
+import Queue
+import random
+import threading
+import time
+from signal import SIGKILL
+from subprocess import PIPE, STDOUT
+from onlinelinguisticdatabase.lib import simplelm
+from onlinelinguisticdatabase.lib.profiling import Popen
+
+import logging
+log = logging.getLogger(__name__)
+
+def get_folds(size, k, seed):
+    """Return ``k`` disjoint, sorted lists of indices that together cover ``range(size)``.
+
+    The indices are shuffled using a ``random.Random`` instance seeded with
+    ``seed`` and then dealt out round-robin, so fold sizes differ by at most one.
+
+    """
+    indices = range(size)
+    random.Random(seed).shuffle(indices)
+    return [sorted(indices[i::k]) for i in xrange(k)]
+
+def evaluate_fold(corpus, fold_evaluator, index, test_indices, options):
+    """Evaluate one fold of ``corpus``; return a (perplexity, seconds) 2-tuple."""
+    start = time.time()
+    test_indices = set(test_indices)
+    training = [words for i, words in enumerate(corpus) if i not in test_indices]
+    test = [corpus[i] for i in sorted(test_indices)]
+    try:
+        perplexity = fold_evaluator(training, test, index, options)
+    except Exception, e:
+        log.warn('Unable to evaluate perplexity fold %d: %s' % (index, e))
+        perplexity = None
+    return perplexity, time.time() - start
+
+def evaluate_folds(corpus, fold_evaluator, options, k=5, seed=0, threads=None):
+    """Compute the k-fold cross-validated perplexity of an LM configuration on ``corpus``.
+
+    :param list corpus: a list of words, each a list of strings.
+    :param function fold_evaluator: see the module docstring.
+    :param dict options: passed to ``fold_evaluator``.
+    :param int k: the number of folds.
+    :param int seed: the seed of the shuffle that assigns words to folds.
+    :param int threads: the size of the thread pool; defaults to the lesser of
+        ``k`` and the number of CPUs.  With 1, the folds are evaluated serially
+        in the calling thread.
+    :returns: a dict with the mean perplexity of the folds that could be evaluated
+        (``None`` if none could), the per-fold perplexities and sizes and the
+        wall-clock seconds taken by each fold and by the whole evaluation.
+
+    """
+    start = time.time()
+    folds = get_folds(len(corpus), k, seed)
+    if threads is None:
+        try:
+            threads = multiprocessing.cpu_count()
+        except NotImplementedError:
+            threads = 1
+    threads = max(1, min(threads, k))
+    results = [None] * len(folds)
+    task_q = Queue.Queue()
+    for index, fold in enumerate(folds):
+        task_q.put((index, fold))
+    def evaluate_queued_folds():
+        while True:
+            try:
+                index, fold = task_q.get_nowait()
+            except Queue.Empty:
+                return
+            results[index] = evaluate_fold(corpus, fold_evaluator, index, fold, options)
+    if threads == 1:
+        evaluate_queued_folds()
+    else:
+        workers = [threading.Thread(target=evaluate_queued_folds) for i in range(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+    perplexities = [perplexity for perplexity, seconds in results]
+    evaluated = [perplexity for perplexity in perplexities if perplexity]
+    return {
+        'perplexity': sum(evaluated) / len(evaluated) if evaluated else None,
+        'perplexities': perplexities,
+        'fold_sizes': [len(fold) for fold in folds],
+        'seed': seed,
+        'threads': threads,
+        'timings': {
+            'folds': [seconds for perplexity, seconds in results],
+            'total': time.time() - start
+        }
+    }
+
+################################################################################
+# Fold evaluators
+################################################################################
+
+def simplelm_fold_perplexity(training, test, index, options):
+    """Estimate an LM from ``training`` with ``simplelm.NGramEstimator`` and return its perplexity on ``test``.
+
+    :param dict options: the ``order``, ``smoothing``, ``sb``, ``se`` and
+        ``vocabulary`` arguments of ``simplelm.NGramEstimator``.
+
+    """
+    estimator = simplelm.NGramEstimator(**options)
+    for words in training:
+        estimator.add_sentence(words)
+    return simplelm.compute_perplexity(estimator.get_trie(), test, options['sb'], options['se'])
+
+def mitlm_fold_perplexity(training, test, index, options):
+    """Write ``training`` and ``test`` to disk and return the perplexity computed by MITLM.
+
+    :param dict options: ``path_prefix`` (the files written are
+        ``<path_prefix>_training_<index>.txt``, etc.), ``command`` (the
+        ``estimate-ngram`` command minus the files) and ``timeout``.
+
+    """
+    path_prefix = options['path_prefix']
+    training_set_path = '%s_training_%s.txt' % (path_prefix, index)
+    test_set_path = '%s_test_%s.txt' % (path_prefix, index)
+    training_set_lm_path = '%s_training_%s.lm' % (path_prefix, index)
+    try:
+        write_words(training_set_path, training)
+        write_words(test_set_path, test)
+        cmd = options['command'] + ['-t', training_set_path, '-wl', training_set_lm_path,
+                                    '-eval-perp', test_set_path]
+        returncode, output = run_command(cmd, options['timeout'])
+        if returncode == 0 and os.path.isfile(training_set_lm_path):
+            return extract_mitlm_perplexity(output)
+    finally:
+        for path in (training_set_path, test_set_path, training_set_lm_path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+def write_words(path, words_list):
+    """Write each list of words in ``words_list`` to a line of the file at ``path``."""
+    with codecs.open(path, mode='w', encoding='utf8') as f:
+        for words in words_list:
+            f.write(u'%s\n' % u' '.join(words))
+
+def run_command(cmd, timeout):
+    """Run ``cmd``, killing it after ``timeout`` seconds; return its return code and output."""
+    process = Popen(cmd, stdout=PIPE, stderr=STDOUT)
+    def kill():
+        try:
+            os.kill(process.pid, SIGKILL)
+        except OSError:
+            pass
+    timer = threading.Timer(timeout, kill)
+    timer.start()
+    try:
+        output = process.communicate()[0]
+    finally:
+        timer.cancel()
+    return process.returncode, output
+
+def extract_mitlm_perplexity(output):
+    """Extract the perplexity value from the output of MITLM."""
+    try:
+        last_line = output.splitlines()[-1]
+        return float(last_line.split()[-1])
+    except Exception:
+        return None
@@ -0,0 +1,436 @@
+# Copyright 2016 Joel Dunham
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+"""The profiling module contains the opt-in instrumentation of requests.
+
+If the ``profile_requests`` config option is true, the
+:class:`ProfilingMiddleware` (cf. ``config/middleware.py``) records the
+following for each request:
+
+- its wall time;
+- the number and total duration of its SQL statements (cf.
+  :func:`instrument_engine`);
+- the number and durations of the subprocesses that it spawns, e.g., foma,
+  flookup, estimate-ngram, tgrep2 and ffmpeg (cf. :class:`Popen`);
+- the time spent serializing its response to JSON (cf. ``utils.jsonify``);
+- the time spent waiting for database connections to be checked out of the
+  connection pool (cf. :func:`get_timed_pool_class`).
+
+The measurements are aggregated per routed controller/action and returned by
+``GET /metrics``; ``DELETE /metrics`` resets them (cf.
+``controllers/metrics.py``; only administrators may do either, though the
+``metrics_token`` config option lets monitoring systems read them).  The connection pool
+checkouts, their wait times and the connections opened (i.e., the connection
+churn) and found disconnected by pre-pings (cf. ``lib/dbengine.py``) are also
+aggregated per database engine under ``pools``.  Subprocesses that are not
+spawned by requests, e.g., the foma compilations of the foma worker, are
+aggregated under ``background``.  If the ``profile_sample_rate`` config option
+is greater than 0, that fraction of requests is also run under cProfile and
+the stats are dumped to ``<permanent_store>/profiles``.
+
+This module only depends on the standard library so that ``lib/parser.py``,
+which is also used outside of the OLD, can use :class:`Popen`.
+"""
+
+import os
+import time
+import random
+import datetime
+import threading
+import subprocess
+import urllib
+import cProfile
+import logging
+log = logging.getLogger(__name__)
+
+# Nothing is recorded unless a ProfilingMiddleware has been created.
+enabled = False
+
+################################################################################
+# Per-request statistics
+################################################################################
+
+class RequestStats(object):
+    """The measurements of a single request."""
+
+    def __init__(self):
+        self.sql_count = 0
+        self.sql_time = 0.0
+        self.sql_started = None
+        self.json_time = 0.0
+        self.pool_wait_time = 0.0
+        self.subprocesses = {}
+
+    def add_subprocess(self, name, duration):
+        subprocess_stats = self.subprocesses.setdefault(name, [0, 0.0])
+        subprocess_stats[0] += 1
+        subprocess_stats[1] += duration
+
+request_stats = threading.local()
+
+def get_request_stats():
+    """Return the stats of the request being processed by the current thread
+    or ``None`` if there is no such request.
+    """
+    return getattr(request_stats, 'stats', None)
+
+def record_json(duration):
+    stats = get_request_stats()
+    if stats is not None:
+        stats.json_time += duration
+
+def record_subprocess(name, duration, stats=None):
+    """Record a subprocess run for ``stats`` or, if it is ``None``, as
+    background work.
+    """
+    if not enabled:
+        return
+    if stats is None:
+        metrics.add_background_subprocess(name, duration)
+    else:
+        stats.add_subprocess(name, duration)
+
+def record_pool_checkout(key, duration):
+    if not enabled:
+        return
+    stats = get_request_stats()
+    if stats is not None:
+        stats.pool_wait_time += duration
+    metrics.add_pool_checkout(key, duration)
+
+def record_pool_connect(key):
+    if enabled:
+        metrics.add_pool_event(key, 'connections_opened')
+
+def record_pool_disconnect(key):
+    if enabled:
+        metrics.add_pool_event(key, 'disconnects')
+
+def get_engine_key(url):
+    """Return the key of the metrics of the engine of ``url``, i.e., the URL
+    without its password.
+    """
+    if url.password is None:
+        return str(url)
+    return str(url).replace(':%s@' % urllib.quote_plus(url.password), ':***@', 1)
+
+def get_timed_pool_class(pool_class, key):
+    """Return a subclass of the SQLAlchemy pool class ``pool_class`` that
+    records how long checkouts wait for a connection, including the time spent
+    opening new connections, under ``key``.  Pools that are recreated, e.g.,
+    after a disconnect, keep the subclass.
+    """
+    def _do_get(self):
+        started = time.time()
+        try:
+            return pool_class._do_get(self)
+        finally:
+            record_pool_checkout(key, time.time() - started)
+    return type('Timed%s' % pool_class.__name__, (pool_class,), {'_do_get': _do_get})
+
+def instrument_engine(engine, key=None):
+    """Count and time the SQL statements executed by ``engine`` on behalf of
+    requests and count the connections that it opens.  Called in
+    ``lib/dbengine.py``.
+    """
+    from sqlalchemy import event
+    key = key or get_engine_key(engine.url)
+
+    @event.listens_for(engine, 'connect')
+    def connect(dbapi_connection, connection_record):
+        record_pool_connect(key)
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context,
+                              executemany):
+        stats = get_request_stats()
+        if stats is not None:
+            stats.sql_started = time.time()
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context,
+                             executemany):
+        stats = get_request_stats()
+        if stats is not None and stats.sql_started is not None:
+            stats.sql_count += 1
+            stats.sql_time += time.time() - stats.sql_started
+            stats.sql_started = None
+
+
+################################################################################
+# Subprocesses
+################################################################################
+
+def get_program_name(args):
+    """Return the name of the program run by a subprocess.
+
+    The OLD runs foma and flookup via the shell scripts that it writes (cf.
+    ``lib/parser.py``): ``apply_*.sh`` scripts run flookup and compiler
+    scripts run foma.
+
+    """
+    if isinstance(args, basestring):
+        args = args.split()
+    if not args:
+        return u''
+    name = os.path.basename(args[0])
+    if name.endswith('.sh'):
+        return 'flookup' if name.startswith('apply_') else 'foma'
+    return name
+
+class Popen(subprocess.Popen):
+    """A ``subprocess.Popen`` that records its duration, i.e., the time from
+    its spawning to its termination being observed by ``wait``, ``poll`` or
+    ``communicate``.
+    """
+
+    def __init__(self, args, *popenargs, **kwargs):
+        self.program_name = get_program_name(args)
+        self.stats = get_request_stats()
+        self.started = time.time()
+        self.recorded = False
+        subprocess.Popen.__init__(self, args, *popenargs, **kwargs)
+
+    def record(self):
+        if not self.recorded:
+            self.recorded = True
+            record_subprocess(self.program_name, time.time() - self.started,
+                              self.stats)
+
+    def wait(self):
+        returncode = subprocess.Popen.wait(self)
+        self.record()
+        return returncode
+
+    def poll(self):
+        returncode = subprocess.Popen.poll(self)
+        if returncode is not None:
+            self.record()
+        return returncode
+
+def call(*popenargs, **kwargs):
+    """Run a command, wait for it to complete and return its return code, cf.
+    ``subprocess.call``.
+    """
+    return Popen(*popenargs, **kwargs).wait()
+
+
+################################################################################
+# Aggregated metrics
+################################################################################
+
+class Metrics(object):
+    """The measurements of requests aggregated per controller/action."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.started = datetime.datetime.utcnow()
+            self.actions = {}
+            self.pools = {}
+
+    def get_action(self, key):
+        return self.actions.setdefault(key, {
+            'requests': 0,
+            'errors': 0,
+            'wall_time': 0.0,
+            'max_wall_time': 0.0,
+            'sql_count': 0,
+            'sql_time': 0.0,
+            'json_time': 0.0,
+            'pool_wait_time': 0.0,
+            'subprocesses': {},
+            'profiled': 0
+        })
+
+    def add_subprocesses(self, action, subprocesses):
+        for name, (count, duration) in subprocesses.iteritems():
+            subprocess_stats = action['subprocesses'].setdefault(
+                name, {'count': 0, 'time': 0.0})
+            subprocess_stats['count'] += count
+            subprocess_stats['time'] += duration
+
+    def add(self, key, wall_time, stats, status, profiled=False):
+        """Add the measurements of a request routed to ``key``."""
+        with self.lock:
+            action = self.get_action(key)
+            action['requests'] += 1
+            if status >= 500:
+                action['errors'] += 1
+            action['wall_time'] += wall_time
+            action['max_wall_time'] = max(action['max_wall_time'], wall_time)
+            action['sql_count'] += stats.sql_count
+            action['sql_time'] += stats.sql_time
+            action['json_time'] += stats.json_time
+            action['pool_wait_time'] += stats.pool_wait_time
+            self.add_subprocesses(action, stats.subprocesses)
+            if profiled:
+                action['profiled'] += 1
+
+    def add_background_subprocess(self, name, duration):
+        with self.lock:
+            self.add_subprocesses(self.get_action('background'),
+                                  {name: (1, duration)})
+
+    def get_pool(self, key):
+        return self.pools.setdefault(key, {
+            'checkouts': 0,
+            'checkout_wait_time': 0.0,
+            'max_checkout_wait_time': 0.0,
+            'connections_opened': 0,
+            'disconnects': 0
+        })
+
+    def add_pool_checkout(self, key, duration):
+        with self.lock:
+            pool = self.get_pool(key)
+            pool['checkouts'] += 1
+            pool['checkout_wait_time'] += duration
+            pool['max_checkout_wait_time'] = max(pool['max_checkout_wait_time'], duration)
+
+    def add_pool_event(self, key, name):
+        with self.lock:
+            self.get_pool(key)[name] += 1
+
+    def get_dict(self):
+        """Return the aggregated measurements, including per-request means."""
+        with self.lock:
+            actions = {}
+            for key, action in self.actions.iteritems():
+                action = dict(action, subprocesses=dict(
+                    (name, dict(subprocess_stats))
+                    for name, subprocess_stats in action['subprocesses'].iteritems()))
+                if action['requests']:
+                    action['mean_wall_time'] = action['wall_time'] / action['requests']
+                    action['mean_sql_count'] = float(action['sql_count']) / action['requests']
+                    action['mean_sql_time'] = action['sql_time'] / action['requests']
+                actions[key] = action
+            pools = {}
+            for key, pool in self.pools.iteritems():
+                pool = dict(pool)
+                if pool['checkouts']:
+                    pool['mean_checkout_wait_time'] = pool['checkout_wait_time'] / pool['checkouts']
+                pools[key] = pool
+            return {'started': self.started.isoformat(), 'actions': actions,
+                    'pools': pools}
+
+metrics = Metrics()
+
+
+################################################################################
+# Middleware
+################################################################################
+
+def get_action_key(environ):
+    """Return the ``controller.action`` string of the route matched by the
+    request or ``'unrouted'``.
+    """
+    try:
+        match = environ['wsgiorg.routing_args'][1]
+        return '%s.%s' % (match['controller'], match['action'])
+    except (KeyError, IndexError, TypeError):
+        return 'unrouted'
+
+class ProfilingMiddleware(object):
+    """Middleware that records the measurements of requests.
+
+    :param app: the WSGI application; it must be (or contain) the routes
+        middleware so that requests can be attributed to controller/actions.
+    :param float sample_rate: the fraction of requests to run under cProfile.
+    :param str profile_dir: the directory to dump the cProfile stats to.
+
+    """
+
+    def __init__(self, app, sample_rate=0.0, profile_dir=None):
+        global enabled
+        enabled = True
+        self.app = app
+        self.sample_rate = sample_rate if profile_dir else 0.0
+        self.profile_dir = profile_dir
+
+    def __call__(self, environ, start_response):
+        statuses = []
+        def profiling_start_response(status, headers, exc_info=None):
+            statuses.append(status)
+            return start_response(status, headers, exc_info)
+        profiler = None
+        if self.sample_rate and random.random() < self.sample_rate:
+            profiler = cProfile.Profile()
+        stats = request_stats.stats = RequestStats()
+        started = time.time()
+        def finish():
+            wall_time = time.time() - started
+            request_stats.stats = None
+            key = get_action_key(environ)
+            try:
+                status = int(statuses[-1].split()[0])
+            except (IndexError, ValueError):
+                status = 500
+            if profiler:
+                self.dump_profile(profiler, key)
+            metrics.add(key, wall_time, stats, status, profiler is not None)
+        try:
+            if profiler:
+                app_iter = profiler.runcall(self.app, environ, profiling_start_response)
+            else:
+                app_iter = self.app(environ, profiling_start_response)
+        except Exception:
+            finish()
+            raise
+        return ProfiledResponse(app_iter, finish, profiler)
+
+    def dump_profile(self, profiler, key):
+        path = os.path.join(self.profile_dir, '%s_%s_%d.prof' % (
+            key, datetime.datetime.utcnow().strftime('%Y%m%d%H%M%S%f'), os.getpid()))
+        try:
+            profiler.dump_stats(path)
+        except (IOError, OSError), e:
+            log.warn('Unable to write the profile %s: %s' % (path, e))
+
+class ProfiledResponse(object):
+    """Wraps the response iterable of a request recorded by the
+    :class:`ProfilingMiddleware` so that the measurement of the request is
+    finished when the server closes the iterable, i.e., once the response body
+    has been generated and sent, rather than when the application returns.
+
+    :param app_iter: the response iterable returned by the application.
+    :param finish: a callable that finishes the measurement.
+    :param profiler: the ``cProfile.Profile`` instance of the request, or ``None``.
+
+    """
+
+    def __init__(self, app_iter, finish, profiler=None):
+        self.app_iter = app_iter
+        self.finish = finish
+        self.profiler = profiler
+
+    def __iter__(self):
+        iterator = iter(self.app_iter)
+        while True:
+            if self.profiler:
+                yield self.profiler.runcall(iterator.next)
+            else:
+                yield iterator.next()
+
+    def close(self):
+        try:
+            if hasattr(self.app_iter, 'close'):
+                self.app_iter.close()
+        finally:
+            if self.finish:
+                finish, self.finish = self.finish, None
+                finish()
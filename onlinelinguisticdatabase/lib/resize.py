@@ -18,44 +18,300 @@ image and audio files with reduced sizes.
 1. Image resizing using PIL
 2. wav-2-ogg conversion using ffmpeg
 
-The meta-function save_reduced_copy provides an interface to this functionality
+The meta-function queue_reduced_copy provides an interface to this functionality
 that is used in the create action of the files controller.  It handles .wav and
-image files appropriately and returns None for other file types.
+image files appropriately and ignores other file types.  Reduced copies are
+created by a pool of derivative worker threads so that the HTTP request does
+not have to wait for (possibly very long) ffmpeg conversions.  The progress of
+a file's reduced copy is recorded in its ``lossy_status`` attribute; reduced
+copies that were still queued when the application stopped are re-queued when
+it starts.
+
+Files with identical content (as determined by their SHA-256 checksums) share
+a single derivative: if a reduced copy has already been created for a file with
+the same content, it is hard-linked (or copied) instead of being re-generated.
 """
 
+import os
+import Queue
+import shutil
+import threading
+from hashlib import sha256
 from paste.deploy.converters import asbool
-from subprocess import call
+from onlinelinguisticdatabase.lib.profiling import call
 from onlinelinguisticdatabase.lib.utils import ffmpeg_encodes, get_subprocess, get_OLD_directory_path
-import os
+from onlinelinguisticdatabase.model.meta import Session
+from onlinelinguisticdatabase.model import File
 try:
     import Image
 except ImportError:
     try:
         from PIL import Image
     except ImportError:
-        pass
+        Image = None
 
 import logging
 log = logging.getLogger(__name__)
 
+# The values of the ``lossy_status`` attribute of a file whose reduced copy has
+# been requested.  A ``complete`` file with no ``lossy_filename`` did not need
+# a reduced copy, e.g., it is an image that is already small.
+lossy_statuses = (u'queued', u'processing', u'complete', u'failed')
+
+# How many seconds clients are told to wait before re-requesting a reduced copy
+# that is still being created.
+lossy_retry_after = 5
+
+
+def queue_reduced_copy(file, config):
+    """Have a derivative worker save a smaller copy of the file in files/reduced_files.
+
+    Only works if the file is a .wav file or an image and the requisite
+    utility (ffmpeg or PIL) is installed.  The file must already have been
+    committed to the database.
+
+    :param file: a file model.
+    :param config: the Pylons config object.
+    :returns: ``True`` if a reduced copy was queued (or was linked from a file
+        with the same content), ``False`` otherwise.
 
-def save_reduced_copy(file, config):
-    """Save a smaller copy of the file in files/reduced_files.  Only works if
-    the file is a .wav file or an image.  Returns None or the reduced file filename,
-    depending on whether the reduction failed or succeeded, repectively.
     """
     if getattr(file, 'filename') and asbool(config.get('create_reduced_size_file_copies', 1)):
         files_path = get_OLD_directory_path('files', config=config['app_conf'])
         reduced_files_path = os.path.join(files_path, 'reduced_files')
-        if u'image' in file.MIME_type:
-            return save_reduced_size_image(file, files_path, reduced_files_path)
-        elif file.MIME_type == u'audio/x-wav':
-            format_ = config.get('preferred_lossy_audio_format', 'ogg')
-            return save_wav_as(file, format_, files_path, reduced_files_path)
-        else:
-            return None
+        reducible, format_ = get_reduced_copy_format(file, config)
+        if not reducible:
+            return False
+        if link_duplicate_derivative(file, format_, reduced_files_path):
+            return True
+        file.lossy_status = u'queued'
+        Session.commit()
+        derivative_q.put({'file_id': file.id, 'format_': format_,
+                          'files_path': files_path,
+                          'reduced_files_path': reduced_files_path})
+        return True
+    return False
+
+def get_reduced_copy_format(file, config):
+    """Return whether a reduced copy of ``file`` can be created and the format
+    to convert it to, i.e., ``None`` for an image and, for a .wav file, the
+    preferred lossy audio format if ffmpeg encodes it and .ogg otherwise.
+
+    The answers of ffmpeg are cached in ``config['pylons.app_globals']`` so
+    that this can be called outside of a request, e.g., at startup.
+
+    :param file: a file model.
+    :param config: the Pylons config object.
+    :returns: a ``(reducible, format_)`` tuple.
+
+    """
+    if u'image' in file.MIME_type:
+        return bool(Image), None
+    if file.MIME_type == u'audio/x-wav':
+        globals_ = config.get('pylons.app_globals')
+        format_ = config.get('preferred_lossy_audio_format', 'ogg')
+        if not ffmpeg_encodes(format_, globals_):
+            format_ = 'ogg'     # .ogg is the default
+        if ffmpeg_encodes(format_, globals_):
+            return True, format_
+    return False, None
+
+################################################################################
+# Derivative worker pool
+################################################################################
+
+derivative_q = Queue.Queue()
+
+# Reduced copies of files with the same checksum are created one at a time so
+# that a duplicate upload can reuse the first upload's derivative.
+derivative_locks = [threading.Lock() for i in range(16)]
+
+class DerivativeWorkerThread(threading.Thread):
+    """Define a derivative worker, i.e., a thread that creates reduced copies of files.
+    """
+    def run(self):
+        while True:
+            msg = derivative_q.get()
+            try:
+                save_reduced_copy(**msg)
+            except Exception, e:
+                log.warn('Unable to create reduced copy of file %s: %s' % (msg.get('file_id'), e))
+            finally:
+                Session.remove()
+            derivative_q.task_done()
+
+def start_derivative_workers(config):
+    """Start the pool of derivative workers; the size of the pool is set by the
+    ``derivative_workers`` config option (default 2).  Called in
+    :mod:`onlinelinguisticdatabase.config.environment.py`.
+    """
+    for i in range(int(config.get('derivative_workers', 2))):
+        derivative_worker = DerivativeWorkerThread()
+        derivative_worker.setDaemon(True)
+        derivative_worker.start()
+    requeue_reduced_copies(config)
+
+def requeue_reduced_copies(config):
+    """Re-queue the reduced copies that were queued or being created when the
+    application last stopped.
+
+    The derivative queue is held in memory, so without this such files would
+    keep a ``lossy_status`` of ``queued`` or ``processing`` (and their reduced
+    copies would be served as 202 responses) forever.
+
+    :param config: the Pylons config object.
+    :returns: the number of files whose reduced copies were re-queued.  The
+        reduced copies that can no longer be created, e.g., because ffmpeg has
+        been uninstalled, are marked as failed.
+
+    """
+    files_path = get_OLD_directory_path('files', config=config['app_conf'])
+    reduced_files_path = os.path.join(files_path, 'reduced_files')
+    requeued = 0
+    try:
+        files = Session.query(File).filter(
+            File.lossy_status.in_([u'queued', u'processing'])).all()
+        for file in files:
+            reducible, format_ = get_reduced_copy_format(file, config)
+            if not reducible:
+                log.warn('Unable to re-queue the reduced copy of file %s: the'
+                         ' requisite utility is not available.' % file.id)
+                file.lossy_status = u'failed'
+                Session.commit()
+                continue
+            file.lossy_status = u'queued'
+            Session.commit()
+            derivative_q.put({'file_id': file.id, 'format_': format_,
+                              'files_path': files_path,
+                              'reduced_files_path': reduced_files_path})
+            requeued += 1
+    except Exception, e:
+        # E.g., the file table does not exist yet because setup-app is running.
+        log.warn('Unable to re-queue reduced copies of files: %s' % e)
+        Session.rollback()
+        return 0
+    finally:
+        Session.remove()
+    if requeued:
+        log.info('Re-queued the reduced copies of %d files.' % requeued)
+    return requeued
+
+def get_checksum(path):
+    """Return the SHA-256 hex digest of the file at ``path``, reading it in chunks."""
+    checksum = sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1048576), ''):
+            checksum.update(chunk)
+    return unicode(checksum.hexdigest())
+
+def save_reduced_copy(file_id, format_, files_path, reduced_files_path):
+    """Save a smaller copy of the file with ``file_id`` in ``reduced_files_path``.
+
+    Called by a derivative worker.  Sets the ``lossy_filename`` and
+    ``lossy_status`` attributes of the file.
+
+    :param int file_id: the ``id`` value of the file.
+    :param str format_: the lossy audio format to convert .wav files to.
+    :param str files_path: absolute path to the files directory.
+    :param str reduced_files_path: absolute path to the reduced files directory.
+
+    """
+    file = Session.query(File).get(file_id)
+    if not file:
+        return
+    file.lossy_status = u'processing'
+    Session.commit()
+    try:
+        if not file.checksum:
+            file.checksum = get_checksum(os.path.join(files_path, file.filename))
+            # Commit now so that no write transaction is held open during conversion.
+            Session.commit()
+        with derivative_locks[int(file.checksum[:8], 16) % len(derivative_locks)]:
+            duplicate = get_duplicate_derivative(file, format_, reduced_files_path)
+            if duplicate:
+                file.lossy_filename = link_reduced_copy(file, duplicate, reduced_files_path)
+            elif format_:
+                file.lossy_filename = save_wav_as(file, format_, files_path, reduced_files_path)
+            else:
+                file.lossy_filename = save_reduced_size_image(file, files_path, reduced_files_path)
+            file.lossy_status = u'complete'
+            Session.commit()
+    except Exception, e:
+        log.warn('Unable to create reduced copy of file %s: %s' % (file_id, e))
+        Session.rollback()
+        file = Session.query(File).get(file_id)
+        if file:
+            file.lossy_status = u'failed'
+            Session.commit()
+
+def link_duplicate_derivative(file, format_, reduced_files_path):
+    """Give ``file`` the reduced copy of a file with the same content, if one is complete.
+
+    Called in the request thread so that duplicate uploads need not wait for a
+    derivative worker.  If a worker is currently creating a reduced copy for
+    the same checksum, this gives up rather than blocking the request.
+
+    :returns: ``True`` if the file's reduced copy was linked.
+
+    """
+    if not file.checksum:
+        return False
+    lock = derivative_locks[int(file.checksum[:8], 16) % len(derivative_locks)]
+    if not lock.acquire(False):
+        return False
+    try:
+        duplicate = get_duplicate_derivative(file, format_, reduced_files_path)
+        if not duplicate:
+            return False
+        file.lossy_filename = link_reduced_copy(file, duplicate, reduced_files_path)
+        file.lossy_status = u'complete'
+        Session.commit()
+        return True
+    finally:
+        lock.release()
+
+def get_duplicate_derivative(file, format_, reduced_files_path):
+    """Return a file with the same content as ``file`` whose reduced copy is complete, or ``None``.
+
+    Images whose duplicates needed no reduced copy are matched too; for audio,
+    the duplicate's reduced copy must be in ``format_``.
+
+    """
+    duplicates = Session.query(File).filter(File.checksum == file.checksum).\
+        filter(File.id != file.id).filter(File.lossy_status == u'complete').all()
+    for duplicate in duplicates:
+        if duplicate.lossy_filename:
+            if format_ and not duplicate.lossy_filename.endswith('.%s' % format_):
+                continue
+            if os.path.isfile(os.path.join(reduced_files_path, duplicate.lossy_filename)):
+                return duplicate
+        elif not format_:
+            return duplicate
     return None
 
+def link_reduced_copy(file, duplicate, reduced_files_path):
+    """Give ``file`` the reduced copy of ``duplicate``, a file with the same content.
+
+    The reduced copy is hard-linked under a name derived from the file's
+    filename (falling back to copying if hard links are not supported).
+
+    :returns: the filename of the reduced copy, or ``None`` if the duplicate has none.
+
+    """
+    if not duplicate.lossy_filename:
+        return None
+    out_name = u'%s%s' % (os.path.splitext(file.filename)[0],
+                          os.path.splitext(duplicate.lossy_filename)[1])
+    in_path = os.path.join(reduced_files_path, duplicate.lossy_filename)
+    out_path = os.path.join(reduced_files_path, out_name)
+    if os.path.exists(out_path):
+        os.remove(out_path)
+    try:
+        os.link(in_path, out_path)
+    except (OSError, AttributeError):
+        shutil.copyfile(in_path, out_path)
+    return out_name
+
 ################################################################################
 # Image Resizing using PIL
 ################################################################################
@@ -87,21 +343,18 @@ def save_reduced_size_image(file, files_path, reduced_files_path):
 
 def save_wav_as(file, format_, files_path, reduced_files_path):
     """Attempts to use ffmpeg to create a lossy copy of the contents of file in
-    files/reduced_files according to the format (i.e., 'ogg' or 'mp3').
+    files/reduced_files according to the format (i.e., 'ogg' or 'mp3').  The
+    caller is responsible for checking that ffmpeg encodes the format, cf.
+    queue_reduced_copy.
     """
     try:
-        if not ffmpeg_encodes(format_):
-            format_ = 'ogg'     # .ogg is the default
-        if not ffmpeg_encodes(format_):
-            return None
-        else:
-            in_path = os.path.join(files_path, file.filename)
-            out_name = '%s.%s' % (os.path.splitext(file.filename)[0], format_)
-            out_path = os.path.join(reduced_files_path, out_name)
-            with open(os.devnull, "w") as fnull:
-                result = call(['ffmpeg', '-i', in_path, out_path], stdout=fnull, stderr=fnull)
-            if os.path.isfile(out_path):
-                return out_name
-            return None
+        in_path = os.path.join(files_path, file.filename)
+        out_name = '%s.%s' % (os.path.splitext(file.filename)[0], format_)
+        out_path = os.path.join(reduced_files_path, out_name)
+        with open(os.devnull, "w") as fnull:
+            result = call(['ffmpeg', '-i', in_path, out_path], stdout=fnull, stderr=fnull)
+        if os.path.isfile(out_path):
+            return out_name
+        return None
     except Exception, e:
         return None
@@ -275,7 +275,11 @@ class ValidOLDModelObject(FancyValidator):
             return None
         else:
             id = Int().to_python(value, state)
-            model_object = Session.query(getattr(model, self.model_name)).get(id)
+            prefetched = getattr(state, 'prefetched_model_objects', {}).get(self.model_name, {})
+            if id in prefetched:
+                model_object = prefetched[id]
+            else:
+                model_object = Session.query(getattr(model, self.model_name)).get(id)
             if model_object is None:
                 raise Invalid(self.message("invalid_model", state, id=id,
                     model_name_eng=h.camel_case2lower_space(self.model_name)),
@@ -283,8 +287,7 @@ class ValidOLDModelObject(FancyValidator):
             else:
                 if self.model_name in ('Form', 'File', 'Collection') and \
                 getattr(state, 'user', None):
-                    unrestricted_users = h.get_unrestricted_users()
-                    if h.user_is_authorized_to_access_model(state.user, model_object, unrestricted_users):
+                    if h.user_is_authorized_to_access_model(state.user, model_object):
                         return model_object
                     else:
                         raise Invalid(self.message("restricted_model", state, id=id,
@@ -294,6 +297,61 @@ class ValidOLDModelObject(FancyValidator):
                     return model_object
 
 
+class PrefetchOLDModelObjects(FancyValidator):
+    """Pre-validator that fetches all of the OLD model objects referenced by id
+    in the input values, using one query per model (per ``chunk_size`` ids),
+    so that the ``ValidOLDModelObject`` validators of the schema's fields do
+    not each query the database.
+
+    The ``fields`` attribute maps the names of fields whose values are ids (or
+    lists of ids) to model names, e.g.,
+    ``PrefetchOLDModelObjects(fields={'tags': 'Tag', 'forms': 'Form'})``.  The
+    fetched models are stored in ``state.prefetched_model_objects``, a dict
+    from model names to dicts from ids to model objects (``None`` for ids that
+    do not exist); the fields' validators then report each invalid or
+    unauthorized id.  (If ``state.user`` is set, access to the fetched forms,
+    files and collections is decided in bulk from their ``restricted`` and
+    ``enterer_id`` values, which requires no further queries, cf.
+    ``h.get_authorized_ids``.)  Values are returned unchanged.
+
+    """
+
+    fields = {}
+    chunk_size = 500
+
+    def is_empty(self, value):
+        # Empty values must reach the schema unchanged.
+        return False
+
+    def _to_python(self, values, state):
+        if state is None or not hasattr(values, 'get'):
+            return values
+        ids = {}
+        for field, model_name in self.fields.iteritems():
+            value = values.get(field)
+            if not isinstance(value, (list, tuple)):
+                value = [value]
+            for id in value:
+                try:
+                    ids.setdefault(model_name, set()).add(int(id))
+                except (TypeError, ValueError):
+                    pass
+        prefetched = getattr(state, 'prefetched_model_objects', None) or {}
+        for model_name, model_ids in ids.iteritems():
+            model_ = getattr(model, model_name)
+            model_objects = prefetched.setdefault(model_name, {})
+            model_ids = list(model_ids - set(model_objects))
+            for chunk in h.chunker(model_ids, self.chunk_size):
+                model_objects.update(dict.fromkeys(chunk))
+                model_objects.update((model_object.id, model_object) for model_object in
+                    Session.query(model_).filter(model_.id.in_(chunk)).all())
+            if model_name in ('Form', 'File', 'Collection') and getattr(state, 'user', None):
+                h.get_authorized_ids(state.user, model_name,
+                    [id for id, model_object in model_objects.iteritems() if model_object])
+        state.prefetched_model_objects = prefetched
+        return values
+
+
 class AtLeastOneTranscriptionTypeValue(FancyValidator):
     """Every form must have a value for at least one of transcription,
     phonetic_transcription, narrow_phonetic_transcription, or morpheme_break.
@@ -321,6 +379,11 @@ class FormSchema(Schema):
     """
     allow_extra_fields = True
     filter_extra_fields = True
+    pre_validators = [PrefetchOLDModelObjects(fields={
+        'elicitation_method': 'ElicitationMethod',
+        'syntactic_category': 'SyntacticCategory', 'speaker': 'Speaker',
+        'elicitor': 'User', 'verifier': 'User', 'source': 'Source',
+        'tags': 'Tag', 'files': 'File'})]
 
     chained_validators = [AtLeastOneTranscriptionTypeValue()]
     #transcription = ValidOrthographicTranscription(not_empty=True, max=255)
@@ -354,6 +417,7 @@ class FormIdsSchema(Schema):
     """
     allow_extra_fields = True
     filter_extra_fields = True
+    pre_validators = [PrefetchOLDModelObjects(fields={'forms': 'Form'})]
     forms = ForEach(ValidOLDModelObject(model_name='Form'), not_empty=True)
 
 
@@ -364,6 +428,7 @@ class FormIdsSchemaNullable(Schema):
     """
     allow_extra_fields = True
     filter_extra_fields = True
+    pre_validators = [PrefetchOLDModelObjects(fields={'forms': 'Form'})]
     forms = ForEach(ValidOLDModelObject(model_name='Form'))
 
 
@@ -407,6 +472,8 @@ class FileUpdateSchema(Schema):
     """
     allow_extra_fields = True
     filter_extra_fields = True
+    pre_validators = [PrefetchOLDModelObjects(fields={'speaker': 'Speaker',
+        'elicitor': 'User', 'tags': 'Tag', 'forms': 'Form'})]
     description = UnicodeString()
     utterance_type = OneOf(h.utterance_types)
     speaker = ValidOLDModelObject(model_name='Speaker')
@@ -466,7 +533,8 @@ class FileCreateWithFiledataSchema(Schema):
     """
     allow_extra_fields = True
     filter_extra_fields = True
-    pre_validators = [NestedVariables()]
+    pre_validators = [NestedVariables(), PrefetchOLDModelObjects(fields={
+        'speaker': 'Speaker', 'elicitor': 'User', 'tags': 'Tag', 'forms': 'Form'})]
     chained_validators = [AddMIMETypeToValues()]
     filename = ValidFileName(not_empty=True, max=255)
     filedata_first_KB = String()
@@ -478,6 +546,15 @@ class FileCreateWithFiledataSchema(Schema):
     forms = ForEach(ValidOLDModelObject(model_name='Form'))
     date_elicited = DateConverter(month_style='mm/dd/yyyy')
 
+class FileUploadSchema(Schema):
+    """Schema for validating the request that initiates a chunked file upload.
+    The (optional) size is the total number of bytes that will be uploaded.
+    """
+    allow_extra_fields = True
+    filter_extra_fields = True
+    filename = ValidFileName(not_empty=True, max=255)
+    size = Int(min=0)
+
 class ValidAudioVideoFile(FancyValidator):
     """Validator for input values that are integer ids (i.e., primary keys) of
     OLD File objects representing audio or video files.  Note that the referenced
@@ -503,8 +580,7 @@ class ValidAudioVideoFile(FancyValidator):
             else:
                 if h.is_audio_video_file(file_object):
                     if file_object.parent_file is None:
-                        unrestricted_users = h.get_unrestricted_users()
-                        if h.user_is_authorized_to_access_model(state.user, file_object, unrestricted_users):
+                        if h.user_is_authorized_to_access_model(state.user, file_object):
                             return file_object
                         else:
                             raise Invalid(self.message("restricted_file", state, id=id),
@@ -571,6 +647,9 @@ class CollectionSchema(Schema):
     """
     allow_extra_fields = True
     filter_extra_fields = True
+    pre_validators = [PrefetchOLDModelObjects(fields={'speaker': 'Speaker',
+        'source': 'Source', 'elicitor': 'User', 'tags': 'Tag', 'files': 'File',
+        'forms': 'Form'})]
     title = UnicodeString(max=255, not_empty=True)
     type = OneOf(h.collection_types)
     url = Regex('^[a-zA-Z0-9_/-]{0,255}$')
@@ -609,6 +688,9 @@ class ApplicationSettingsSchema(Schema):
     """
     allow_extra_fields = True
     filter_extra_fields = True
+    pre_validators = [PrefetchOLDModelObjects(fields={'unrestricted_users': 'User',
+        'orthographies': 'Orthography', 'storage_orthography': 'Orthography',
+        'input_orthography': 'Orthography', 'output_orthography': 'Orthography'})]
     object_language_name = UnicodeString(max=255)
     object_language_id = UnicodeString(max=3)
     metalanguage_name = UnicodeString(max=255)
@@ -924,8 +1006,10 @@ class SyntacticCategorySchema(Schema):
     description = UnicodeString()
 
 class ValidTagName(FancyValidator):
-    """Validator ensures that tag names are unique and prevents the names
-    'restricted' and 'foreign word' from being updated.
+    """Validator prevents the names 'restricted' and 'foreign word' from being
+    updated, i.e., it prevents the tags with these names from being renamed and
+    other tags from being renamed to them.  The tag being updated is
+    ``state.tag``.
     """
 
     messages = {'unchangeable':
@@ -933,7 +1017,10 @@ class ValidTagName(FancyValidator):
 
     def validate_python(self, value, state):
         tag = getattr(state, 'tag', None)
-        if tag and tag.name in ('restricted', 'foreign word'):
+        reserved_names = (u'restricted', u'foreign word')
+        name = h.normalize(value.get('name'))
+        if tag and name != tag.name and \
+        (tag.name in reserved_names or name in reserved_names):
             raise Invalid(self.message('unchangeable', state), value, state)
 
 class TagSchema(Schema):
@@ -1147,6 +1234,8 @@ class CorpusSchema(Schema):
     chained_validators = [ValidFormReferences()]
     allow_extra_fields = True
     filter_extra_fields = True
+    pre_validators = [PrefetchOLDModelObjects(fields={'tags': 'Tag',
+        'form_search': 'FormSearch'})]
     name = UniqueUnicodeValue(max=255, not_empty=True, model_name='Corpus', attribute_name='name')
     description = UnicodeString()
     content = UnicodeString()
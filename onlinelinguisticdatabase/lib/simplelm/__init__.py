@@ -28,6 +28,9 @@
 # NOTE: this __init__ module was created in order to make an importable
 # Python package out of Novak's SimpleLM project. 
 
-from evaluatelm import load_arpa, compute_sentence_prob, LMTree
+from evaluatelm import load_arpa, read_arpa, compute_sentence_prob, LMTree
+from arraylm import ArrayLM
+from estimate import NGramEstimator, compute_perplexity
 
-__all__ = ['load_arpa', 'compute_sentence_prob', 'LMTree']
+__all__ = ['load_arpa', 'read_arpa', 'compute_sentence_prob', 'LMTree', 'ArrayLM',
+           'NGramEstimator', 'compute_perplexity']
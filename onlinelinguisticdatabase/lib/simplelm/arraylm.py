@@ -0,0 +1,170 @@
+# Copyright 2016 Joel Dunham
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+"""A compact, array-based representation of a backoff n-gram language model.
+
+An ``LMTree`` holds one Python object (with a dict of children) per n-gram,
+which makes large models slow to build and to pickle and expensive to keep in
+memory.  An ``ArrayLM`` stores the same information in a handful of flat
+arrays per order, i.e., as a sorted array trie:
+
+- unigrams are numbered in the order they are added and ``vocabulary`` maps
+  each word to its number;
+- the n-grams of order n > 1 are sorted by the index of their (n - 1)-gram
+  prefix and then by the number of their last word, so that the extensions of
+  an n-gram are contiguous and can be found by binary search;
+- ``offsets[n - 1][i]`` is the index (among the n-grams of order n + 1) of the
+  first extension of the i-th n-gram of order n.
+
+Probabilities and back-off weights are stored as single-precision floats.
+
+An ``ArrayLM`` is built from a stream of (order, words, prob, bow) 4-tuples
+in which all of the n-grams of an order precede those of the next order, e.g.,
+the output of :func:`evaluatelm.read_arpa`; see ``load_arpa(path, compact=True)``
+and ``NGramEstimator.get_trie(compact=True)``.  Its ``get_ngram_p`` method
+behaves like that of ``LMTree`` so that ``compute_sentence_prob`` accepts
+either.
+
+"""
+
+from array import array
+from bisect import bisect_left
+
+
+class ArrayLM(object):
+    """A read-only n-gram language model stored in arrays.  See the module docstring."""
+
+    def __init__(self, max_order=0):
+        self.max_order = max_order
+        self.vocabulary = {}
+        # Indexed by order - 1.  ``words[0]`` is empty since a unigram's word
+        # number is its index.
+        self.words = []
+        self.probs = []
+        self.bows = []
+        self.offsets = []
+
+    @classmethod
+    def from_ngrams(cls, ngrams, max_order):
+        """Build an ``ArrayLM`` from an iterable of (order, words, prob, bow) 4-tuples.
+
+        :raises ValueError: if an n-gram's prefix or last word is not in the model.
+
+        """
+        lm = cls(max_order)
+        order = 0
+        parents = words = probs = bows = None
+        # Consecutive n-grams often share a prefix, e.g., in sorted ARPA files.
+        last_prefix, last_parent = None, -1
+        for ngram_order, ngram, prob, bow in ngrams:
+            if ngram_order != order:
+                if order > 1:
+                    lm._add_order(parents, words, probs, bows)
+                order = ngram_order
+                if order != len(lm.probs) + 1:
+                    raise ValueError('The %d-grams must follow the %d-grams' % (order, order - 1))
+                parents, words, probs, bows = array('i'), array('i'), array('f'), array('f')
+                if order == 1:
+                    lm.words.append(array('i'))
+                    lm.probs.append(probs)
+                    lm.bows.append(bows)
+            if order == 1:
+                word = ngram[0]
+                if word not in lm.vocabulary:
+                    lm.vocabulary[word] = len(probs)
+                    probs.append(prob)
+                    bows.append(bow)
+            else:
+                prefix = ngram[:-1]
+                if prefix != last_prefix:
+                    last_prefix, last_parent = prefix, lm.find(prefix)
+                parent = last_parent
+                word = lm.vocabulary.get(ngram[-1], -1)
+                if parent == -1 or word == -1:
+                    raise ValueError('The prefix and last word of the n-gram %s must be in the model' %
+                                     u' '.join(ngram))
+                parents.append(parent)
+                words.append(word)
+                probs.append(prob)
+                bows.append(bow)
+        if order > 1:
+            lm._add_order(parents, words, probs, bows)
+        return lm
+
+    def _add_order(self, parents, words, probs, bows):
+        """Sort the n-grams of a new order by (parent, word), dropping duplicates, and index them."""
+        vocabulary_size = len(self.vocabulary)
+        index = sorted(xrange(len(words)),
+                       key=lambda i: parents[i] * vocabulary_size + words[i])
+        sorted_words, sorted_probs, sorted_bows = array('i'), array('f'), array('f')
+        offsets = array('i', [0]) * (len(self.probs[-1]) + 1)
+        last = None
+        for i in index:
+            key = (parents[i], words[i])
+            if key == last:
+                continue # keep the first of any duplicates, as LMTree does
+            last = key
+            sorted_words.append(words[i])
+            sorted_probs.append(probs[i])
+            sorted_bows.append(bows[i])
+            offsets[parents[i] + 1] += 1
+        for i in xrange(1, len(offsets)):
+            offsets[i] += offsets[i - 1]
+        self.offsets.append(offsets)
+        self.words.append(sorted_words)
+        self.probs.append(sorted_probs)
+        self.bows.append(sorted_bows)
+
+    def _walk(self, ngram, start):
+        """Return the length of the longest prefix of ``ngram[start:]`` in the model and its index."""
+        index = self.vocabulary.get(ngram[start], -1)
+        if index == -1:
+            return 0, -1
+        for n in xrange(1, len(ngram) - start):
+            if n >= len(self.words):
+                return n, index
+            word = self.vocabulary.get(ngram[start + n], -1)
+            words = self.words[n]
+            lo, hi = self.offsets[n - 1][index], self.offsets[n - 1][index + 1]
+            extension = bisect_left(words, word, lo, hi)
+            if extension == hi or words[extension] != word:
+                return n, index
+            index = extension
+        return len(ngram) - start, index
+
+    def find(self, ngram, start=0):
+        """Return the index of ``ngram[start:]`` among the n-grams of its order or -1 if it is not in the model."""
+        length, index = self._walk(ngram, start)
+        if length == len(ngram) - start:
+            return index
+        return -1
+
+    def get_ngram_p(self, ngram, i=0):
+        """Return the probability of ``ngram[i:]`` or, if it is not in the model, the
+        back-off weight of its longest prefix that is, along with a boolean that
+        is True if the first value is a probability.  Cf. ``LMTree.get_ngram_p``.
+
+        """
+        if i == len(ngram):
+            return 0.0, True
+        length, index = self._walk(ngram, i)
+        if length == 0:
+            return 0.0, False
+        if length == len(ngram) - i:
+            return self.probs[length - 1][index], True
+        return self.bows[length - 1][index], False
+
+    def __len__(self):
+        """Return the number of n-grams in the model."""
+        return sum(len(probs) for probs in self.probs)
@@ -0,0 +1,444 @@
+# Copyright 2016 Joel Dunham
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+"""In-process n-gram language model estimation.
+
+The smoothers in this package (``ModKNSmoother``, ``KNSmoother``, ``AbsSmoother``
+and ``MLCounter``) are command-line scripts: they read a training file, key
+every n-gram by a space-joined string and print an ARPA file to stdout.  The
+``NGramEstimator`` defined here implements the same estimators for use within
+the OLD: sentences are interned as arrays of integer word ids, n-grams are
+counted once as tuples of ids, the smoothers' statistics (numerators,
+denominators, counts-of-counts and discounts) are derived from those raw counts
+and the interpolated probabilities are computed order by order.  The result
+can be written as an ARPA file or turned directly into an ``LMTree`` instance
+without re-parsing the ARPA file.
+
+Given the same training corpus, the ARPA output is identical (modulo the number
+of decimal places) to that of the corresponding script, e.g.,
+``SimpleModKN.py -t train.corpus``.
+
+"""
+
+import codecs
+from array import array
+from collections import defaultdict
+from math import log
+
+from evaluatelm import LMTree
+from arraylm import ArrayLM
+
+def log10(x):
+    """Return the base-10 log of ``x`` or -99 (the ARPA convention) if ``x`` is not positive."""
+    if x > 0.0:
+        return log(x, 10.)
+    return -99.0
+
+
+class NGramEstimator(object):
+    """Estimates an n-gram language model from a corpus of sentences.
+
+    Usage::
+
+        estimator = NGramEstimator(order=3, smoothing='ModKN')
+        for line in codecs.open(corpus_path, encoding='utf8'):
+            estimator.add_sentence(line.split())
+        estimator.estimate()
+        estimator.write_arpa(arpa_path)
+        trie = estimator.get_trie()
+
+    :param int order: the maximum n-gram order.
+    :param str smoothing: one of ``smoothing_algorithms``.
+    :param unicode sb: the sentence-begin token.
+    :param unicode se: the sentence-end token.
+    :param iterable vocabulary: optional list of words that should be in the
+        model even if they do not occur in the training data.  If any such words
+        are missing from the training data, the unigram distribution is
+        interpolated with a uniform distribution over the vocabulary so that
+        they receive some probability mass.
+
+    """
+
+    smoothing_algorithms = ['ModKN', 'KN', 'Abs', 'ML']
+
+    def __init__(self, order=3, smoothing='ModKN', sb=u'<s>', se=u'</s>', vocabulary=None):
+        if smoothing not in self.smoothing_algorithms:
+            raise ValueError('Unsupported smoothing algorithm %s' % smoothing)
+        if order < 2:
+            raise ValueError('The order of an n-gram model must be at least 2')
+        self.order = order
+        self.smoothing = smoothing
+        self.sb = sb
+        self.se = se
+        self.word2id = {}
+        self.id2word = []
+        self.sb_id = self.get_id(sb)
+        self.se_id = self.get_id(se)
+        # self.counts[n-1] maps n-tuples of word ids to their raw frequencies.
+        self.counts = [defaultdict(int) for i in xrange(order)]
+        self.sentence_count = 0
+        self.vocabulary = set()
+        if vocabulary:
+            for word in vocabulary:
+                if word and word != sb:
+                    self.vocabulary.add(self.get_id(word))
+        self.estimated = False
+
+    def get_id(self, word):
+        """Return the integer id of ``word``, assigning a new one if necessary."""
+        try:
+            return self.word2id[word]
+        except KeyError:
+            id_ = self.word2id[word] = len(self.id2word)
+            self.id2word.append(word)
+            return id_
+
+    def add_sentence(self, words):
+        """Count all of the n-grams of the sentence ``words`` (a list of strings).
+
+        The sentence-begin and sentence-end tokens are added here and should
+        not be present in ``words``.
+
+        """
+        get_id = self.get_id
+        ids = array('l', [self.sb_id])
+        ids.extend([get_id(word) for word in words])
+        ids.append(self.se_id)
+        counts = self.counts
+        order = self.order
+        self.sentence_count += 1
+        for end in xrange(2, len(ids) + 1):
+            for n in xrange(1, min(order, end) + 1):
+                counts[n - 1][tuple(ids[end - n:end])] += 1
+        self.estimated = False
+
+    def add_corpus(self, path, encoding='utf8'):
+        """Count the n-grams of each line of the file at ``path``."""
+        with codecs.open(path, encoding=encoding) as f:
+            for line in f:
+                words = line.split()
+                if words:
+                    self.add_sentence(words)
+
+    ############################################################################
+    # Estimation
+    ############################################################################
+
+    def estimate(self):
+        """Compute the smoothed probabilities and back-off weights of all n-grams.
+
+        :side effects: ``self.probabilities[n-1]`` maps each n-gram (tuple of
+            ids) to its log10 probability and ``self.bows[n-1]`` maps each n-gram
+            that can be a history to its log10 back-off weight.
+
+        """
+        if self.smoothing == 'ML':
+            self._estimate_ml()
+        else:
+            self._count_numerators()
+            self._compute_counts_of_counts()
+            self._compute_discounts()
+            self._compute_interpolated_probs()
+        self.estimated = True
+
+    def _count_numerators(self):
+        """Derive the smoothers' numerators, denominators and non-zero counts from the raw counts.
+
+        For absolute discounting, the numerators are simply the raw counts.  For
+        the Kneser-Ney variants they are the raw counts only for n-grams of the
+        maximum order and for n-grams beginning with the sentence-begin token
+        (which cannot be extended to the left); for all other n-grams they are
+        continuation counts, i.e., the number of distinct words that precede the
+        n-gram.  This is what the recursions in ``SimpleKN.py`` and
+        ``SimpleModKN.py`` compute one token at a time.
+
+        """
+        order = self.order
+        counts = self.counts
+        sb_id = self.sb_id
+        numerators = [defaultdict(int) for i in xrange(order - 1)]
+        if self.smoothing == 'Abs':
+            for n in xrange(2, order + 1):
+                numerators[n - 2].update(counts[n - 1])
+            self.UN = dict((ngram[0], count) for ngram, count in counts[0].iteritems()
+                           if ngram[0] != sb_id)
+        else:
+            numerators[order - 2].update(counts[order - 1])
+            for n in xrange(order - 1, 1, -1):
+                numerator = numerators[n - 2]
+                for ngram, count in counts[n - 1].iteritems():
+                    if ngram[0] == sb_id:
+                        numerator[ngram] = count
+                for ngram in counts[n]:
+                    numerator[ngram[1:]] += 1
+            UN = defaultdict(int)
+            for ngram in numerators[0]:
+                UN[ngram[1]] += 1
+            self.UN = dict(UN)
+        for id_ in self.vocabulary:
+            self.UN.setdefault(id_, 0)
+        self.UD = float(sum(self.UN.itervalues()))
+        # denominators[i][history] is the sum of the numerators of the n-grams
+        # extending history; non_zeros[i][history] is the number of those
+        # n-grams whose numerators are 1, 2 and 3+.
+        self.denominators = [defaultdict(int) for i in xrange(order - 1)]
+        self.non_zeros = [defaultdict(lambda: [0, 0, 0]) for i in xrange(order - 1)]
+        for i, numerator in enumerate(numerators):
+            denominator = self.denominators[i]
+            non_zero = self.non_zeros[i]
+            for ngram, count in numerator.iteritems():
+                history = ngram[:-1]
+                denominator[history] += count
+                non_zero[history][min(count, 3) - 1] += 1
+        self.numerators = numerators
+
+    def _compute_counts_of_counts(self):
+        """Compute the counts-of-counts (CoC) for each n-gram order; only CoC<=4 are relevant."""
+        self.CoC = [[0.0 for j in xrange(4)] for i in xrange(self.order)]
+        for count in self.UN.itervalues():
+            if 0 < count <= 4:
+                self.CoC[0][count - 1] += 1.
+        for i, numerator in enumerate(self.numerators):
+            for count in numerator.itervalues():
+                if count <= 4:
+                    self.CoC[i + 1][count - 1] += 1.
+
+    def _get_fixed_discount(self, coc):
+        """Return D = N_1 / (N_1 + 2 N_2), the KN and absolute discount for an order."""
+        if coc[0] + 2 * coc[1] == 0:
+            return 0.0
+        return coc[0] / (coc[0] + 2 * coc[1])
+
+    def _compute_discounts(self):
+        """Compute the discount parameters for each order above the unigrams.
+
+        Modified Kneser-Ney (Chen & Goodman '98) uses three discounts per order::
+
+            Y    = N_1 / (N_1 + 2*N_2)
+            D_1  = 1 - 2*Y * (N_2 / N_1)
+            D_2  = 2 - 3*Y * (N_3 / N_2)
+            D_3+ = 3 - 4*Y * (N_4 / N_3)
+
+        while Kneser-Ney and absolute discounting use one, D = N_1 / (N_1 + 2*N_2),
+        here stored three times so that all three algorithms can share the same
+        code below.
+
+        """
+        self.discounts = []
+        for o in xrange(self.order - 1):
+            coc = self.CoC[o + 1]
+            Y = self._get_fixed_discount(coc)
+            if self.smoothing == 'ModKN':
+                discounts = []
+                for i in xrange(3):
+                    if coc[i] > 0:
+                        discounts.append((i + 1) - (i + 2) * Y * (coc[i + 1] / coc[i]))
+                    else:
+                        discounts.append(float(i + 1))
+            else:
+                discounts = [Y, Y, Y]
+            self.discounts.append(discounts)
+        # Unigrams are not discounted unless there are vocabulary items that are
+        # unattested in the training data and need some probability mass.  If
+        # there are no unigrams seen once or twice, a discount of 0.5 is used.
+        self.unigram_discount = 0.0
+        if [id_ for id_, count in self.UN.iteritems() if not count]:
+            self.unigram_discount = self._get_fixed_discount(self.CoC[0]) or 0.5
+
+    def _get_lambda(self, i, history):
+        """Return the (un-normalized) back-off weight of ``history`` at order index ``i``.
+
+        This is the discounted mass, \Sum_i D_i*N_i, divided by the history's denominator.
+
+        """
+        n1, n2, n3 = self.non_zeros[i][history]
+        d1, d2, d3 = self.discounts[i]
+        return (d1 * n1 + d2 * n2 + d3 * n3) / self.denominators[i][history]
+
+    def _compute_interpolated_probs(self):
+        """Compute p(a_z) = (c(a_z) - D) / c(a_) + bow(a_) p(_z) for each n-gram, lowest order first.
+
+        Because the suffix _z of every n-gram in the model is itself in the
+        model, p(_z) is always available from the previous order.  This is
+        equivalent to the per-n-gram recursion of the smoothers'
+        ``_compute_interpolated_prob`` methods.
+
+        """
+        UN = self.UN
+        UD = self.UD
+        D = self.unigram_discount
+        seen = len([count for count in UN.itervalues() if count])
+        uniform = D * seen / len(UN)
+        probs = dict(((id_,), (max(count - D, 0.0) + uniform) / UD)
+                     for id_, count in UN.iteritems())
+        self.probabilities = [dict((ngram, log10(p)) for ngram, p in probs.iteritems())]
+        self.probabilities[0][(self.sb_id,)] = -99.0
+        self.bows = []
+        for i, numerator in enumerate(self.numerators):
+            denominators = self.denominators[i]
+            discounts = self.discounts[i]
+            lower_probs = probs
+            probs = {}
+            lambdas = {}
+            for ngram, count in numerator.iteritems():
+                history = ngram[:-1]
+                try:
+                    lmda = lambdas[history]
+                except KeyError:
+                    lmda = lambdas[history] = self._get_lambda(i, history)
+                probs[ngram] = ((count - discounts[min(count, 3) - 1]) / denominators[history] +
+                                lmda * lower_probs[ngram[1:]])
+            self.probabilities.append(dict((ngram, log10(p)) for ngram, p in probs.iteritems()))
+            self.bows.append(dict((history, log10(lmda)) for history, lmda in lambdas.iteritems()))
+        self.bows.append({})
+
+    def _estimate_ml(self):
+        """Compute an unsmoothed maximum likelihood model, as ``MLCounter`` does.
+
+        The sentence-begin token is not a unigram event but is counted as a history.
+
+        """
+        counts = self.counts
+        sb_id = self.sb_id
+        for id_ in self.vocabulary:
+            counts[0].setdefault((id_,), 0)
+        counts[0][(sb_id,)] = self.sentence_count
+        total = float(sum(counts[0].itervalues()) - self.sentence_count)
+        self.probabilities = [dict((ngram, log10(count / total))
+                                   for ngram, count in counts[0].iteritems())]
+        self.probabilities[0][(sb_id,)] = -99.0
+        for n in xrange(2, self.order + 1):
+            history_counts = counts[n - 2]
+            self.probabilities.append(dict((ngram, log10(float(count) / history_counts[ngram[:-1]]))
+                                           for ngram, count in counts[n - 1].iteritems()))
+        self.bows = [{} for n in xrange(self.order)]
+
+    ############################################################################
+    # Output
+    ############################################################################
+
+    def get_words(self, ngram):
+        """Return the n-gram of ids ``ngram`` as a list of words."""
+        return [self.id2word[id_] for id_ in ngram]
+
+    def write_arpa(self, path, encoding='utf8'):
+        """Write the estimated model to ``path`` in ARPA format.
+
+        Within each order, n-grams are sorted by their space-delimited string
+        representations.  N-grams that cannot be histories (those of the maximum
+        order and those ending in the sentence-end token) have no back-off
+        weight, except for the unigram </s> which, following the smoothers, is
+        given a back-off weight of -99.
+
+        """
+        if not self.estimated:
+            self.estimate()
+        se_id = self.se_id
+        with codecs.open(path, mode='w', encoding=encoding) as f:
+            f.write(u'\\data\\\n')
+            for n, probabilities in enumerate(self.probabilities):
+                f.write(u'ngram %d=%d\n' % (n + 1, len(probabilities)))
+            for n, probabilities in enumerate(self.probabilities):
+                f.write(u'\n\\%d-grams:\n' % (n + 1))
+                bows = self.bows[n]
+                ngrams = sorted((u' '.join(self.get_words(ngram)), ngram) for ngram in probabilities)
+                for key, ngram in ngrams:
+                    prob = probabilities[ngram]
+                    if ngram in bows:
+                        f.write(u'%0.7f\t%s\t%0.7f\n' % (prob, key, bows[ngram]))
+                    elif n == 0 and ngram[0] == se_id and self.smoothing != 'ML':
+                        f.write(u'%0.7f\t%s\t-99\n' % (prob, key))
+                    else:
+                        f.write(u'%0.7f\t%s\n' % (prob, key))
+            f.write(u'\n\\end\\\n')
+
+    def get_trie(self, compact=False):
+        """Return an ``LMTree`` instance encoding the estimated model.
+
+        The trie is built directly from the estimated probabilities; it is
+        equivalent to ``load_arpa`` applied to the output of ``write_arpa``.
+
+        :param bool compact: if True, return an ``ArrayLM`` instead.
+
+        """
+        if not self.estimated:
+            self.estimate()
+        if compact:
+            return ArrayLM.from_ngrams(self.get_ngrams(), self.order)
+        trie = LMTree(u'<start>')
+        for order, words, prob, bow in self.get_ngrams():
+            trie.add_child(words, prob, bow)
+        trie.max_order = self.order
+        return trie
+
+    def get_ngrams(self):
+        """Yield the n-grams of the estimated model, order by order, as (order, words, prob, bow) 4-tuples."""
+        for n, probabilities in enumerate(self.probabilities):
+            bows = self.bows[n]
+            for ngram, prob in probabilities.iteritems():
+                yield n + 1, self.get_words(ngram), prob, bows.get(ngram, 0.0)
+
+
+def get_ngram_logprob(trie, ngram):
+    """Return the log10 probability of the last word of ``ngram`` given the rest, backing off as needed.
+
+    :param instance trie: an ``LMTree`` instance.
+    :param list ngram: a list of words whose last word is in the model.
+
+    """
+    total = 0.0
+    for start in xrange(len(ngram)):
+        node = trie
+        for word in ngram[start:-1]:
+            node = node.children.get(word)
+            if node is None:
+                break
+        if node is None:
+            continue # unseen history: its back-off weight is 1
+        child = node.children.get(ngram[-1])
+        if child is not None:
+            return total + child.prob
+        total += node.bow
+    return total
+
+
+def compute_perplexity(trie, sentences, sb=u'<s>', se=u'</s>'):
+    """Return the perplexity of the model ``trie`` on ``sentences``, a list of lists of words.
+
+    Perplexity is 10 ** (-logprob / N) where N is the number of words (including
+    the sentence-end token) that are in the model's vocabulary.  As with SRILM
+    and MITLM, out-of-vocabulary words are not scored and the history is reset
+    after each one.
+
+    :returns: a float or ``None`` if there are no in-vocabulary words to score.
+
+    """
+    history_length = (trie.max_order or 1) - 1
+    vocabulary = trie.children
+    logprob = 0.0
+    token_count = 0
+    for words in sentences:
+        history = [sb]
+        for word in list(words) + [se]:
+            if word not in vocabulary:
+                history = []
+                continue
+            logprob += get_ngram_logprob(trie, history + [word])
+            token_count += 1
+            history.append(word)
+            if len(history) > history_length:
+                del history[0]
+    if not token_count:
+        return None
+    return 10. ** (-logprob / token_count)
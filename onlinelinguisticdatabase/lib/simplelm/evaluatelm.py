@@ -33,11 +33,21 @@
 #  * some minor code formatting
 #  * load_arpa now has an encoding parameter to allow for UTF-8-encoded
 #    ARPA files.
+#  * the ARPA file is parsed by read_arpa, which streams the n-grams using
+#    only str.split (no regular expressions); LMTree.add_child and
+#    LMTree.get_ngram_p are iterative and do not pop from the n-gram list;
+#    garbage collection is suspended while the trie is built.
+#  * load_arpa has a compact parameter which causes it to build an ArrayLM
+#    (see arraylm.py) directly, without creating LMTree nodes.
 
 import re
+import io
+import gc
 import codecs
 import logging
 
+from arraylm import ArrayLM
+
 log = logging.getLogger(__name__)
 
 class LMTree():
@@ -77,65 +87,107 @@ class LMTree():
         of children for this node.
 
         """
-        if len(ngram) == 1:
-            if ngram[0] in self.children:
-                return #Already have this node
-            self.children[ngram[0]] = LMTree(ngram[0], prob, bow, self)
-        else:
-            n0 = ngram.pop(0)
-            if n0 in self.children:
-                self.children[n0].add_child(ngram, prob, bow)
-            else:
-                self.children[n0] = LMTree(n0, 0.0, 0.0, self)
-                self.children[n0].add_child(ngram, prob, bow)
+        node = self
+        for word in ngram[:-1]:
+            child = node.children.get(word)
+            if child is None:
+                child = node.children[word] = LMTree(word, 0.0, 0.0, node)
+            node = child
+        word = ngram[-1]
+        if word not in node.children: # else we already have this node
+            node.children[word] = LMTree(word, prob, bow, node)
 
     def get_ngram_p(self, ngram, i=0):
-        """Recursive method for retrieving the probability or backoff weight for
+        """Method for retrieving the probability or backoff weight for
         an input ngram. If the ngram exists, the probability is returned.
         If not, the backoff weight for the highest order ngram prefix of the
         input is returned. Also returns a boolean value indicating whether
         the first parameter is a prob or bow.
 
         """
-        if i == len(ngram):
-            return self.prob, True
-        if ngram[i] in self.children:
-            return self.children[ngram[i]].get_ngram_p(ngram, i + 1)
-        else:
-            return self.bow, False
+        node = self
+        for word in ngram[i:]:
+            child = node.children.get(word)
+            if child is None:
+                return node.bow, False
+            node = child
+        return node.prob, True
 
 
-def load_arpa(arpa_file, encoding=None):
-    """Load an ARPA format LM into a simple trie structure."""
+def read_arpa(arpa_file, encoding=None):
+    """Read an ARPA format LM.
 
-    # Initialize the ngram trie
-    arpalm = LMTree("<start>")
-    order = max_order = 0
+    :returns: a 2-tuple: a dict from n-gram orders to the n-gram counts in the
+        header and a generator that streams the n-grams of the file as (order,
+        words, prob, bow) 4-tuples, where ``words`` is a list and ``bow`` is 0.0
+        if the n-gram has no back-off weight (as is the case for all n-grams of
+        the maximum order).
 
-    for line in codecs.open(arpa_file, encoding=encoding):
+    """
+    f = io.open(arpa_file, encoding=encoding) if encoding else open(arpa_file, 'rb')
+    counts = {}
+    order = 0
+    for line in f:
         line = line.strip()
-        # Read the model header info and find the max ngram order
-        if line.startswith("ngram"):
-            max_order = int(re.sub(r"^ngram\s+(\d+)=.*$", r"\1", line))
-
-        # Now insert each ngram into the trie based on its order
-        if order > 0 and not line.startswith("\\") and not line=="":
-            parts = line.split("\t")
-            words = parts[1].split(" ")
-            if order < max_order:
-                if len(parts) == 3:
-                    arpalm.add_child(words, float(parts[0]), float(parts[-1]))
+        if line.startswith('ngram'):
+            n, count = line[5:].split('=')
+            counts[int(n)] = int(count)
+        elif line.startswith('\\') and line[1:2].isdigit():
+            order = int(line[1:line.index('-')])
+            break
+    max_order = max(counts) if counts else 0
+
+    def ngrams(order):
+        with f:
+            for line in f:
+                line = line.strip()
+                if line.startswith('\\'):
+                    if line[1:2].isdigit():
+                        order = int(line[1:line.index('-')])
+                    else:
+                        order = 0
+                    continue
+                parts = line.split('\t')
+                if order == 0 or len(parts) < 2:
+                    continue
+                if len(parts) == 3 and order < max_order:
+                    bow = float(parts[2])
                 else:
-                    arpalm.add_child(words, float(parts[0]), 0.0)
-            else:
-                arpalm.add_child(words, float(parts[0]))
+                    bow = 0.0
+                yield order, parts[1].split(' '), float(parts[0]), bow
 
-        # Extract the current ngram order
-        if re.match(r"^\\\d+",line):
-            line = re.sub(r"^\\(\d+).*$", r"\1", line)
-            order = int(line)
+    if order:
+        return counts, ngrams(order)
+    f.close()
+    return counts, iter(())
+
+
+def load_arpa(arpa_file, encoding=None, compact=False):
+    """Load an ARPA format LM into a simple trie structure.
+
+    :param bool compact: if True, return an ``ArrayLM`` instead of an ``LMTree``.
 
-    arpalm.max_order=max_order
+    """
+
+    counts, ngrams = read_arpa(arpa_file, encoding)
+    max_order = max(counts) if counts else 0
+    if compact:
+        return ArrayLM.from_ngrams(ngrams, max_order)
+
+    # Initialize the ngram trie
+    arpalm = LMTree("<start>")
+    add_child = arpalm.add_child
+    # Creating many nodes triggers frequent (and fruitless) cyclic garbage
+    # collection, which can more than double the time taken to load the trie.
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for order, words, prob, bow in ngrams:
+            add_child(words, prob, bow)
+    finally:
+        if gc_enabled:
+            gc.enable()
+    arpalm.max_order = max_order
     return arpalm
 
 def compute_sentence_prob(arpalm, sentence):
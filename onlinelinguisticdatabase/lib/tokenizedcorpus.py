@@ -0,0 +1,198 @@
+# Copyright 2016 Joel Dunham
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+"""Pre-tokenized representations of the forms of a corpus.
+
+Morphologies and morpheme language models are built from the morpheme break,
+morpheme gloss and syntactic category string values of the forms of their
+corpora, which must be split into words and then into morphemes and
+delimiters.  A :class:`TokenizedCorpus` holds the result of that splitting for
+each form of a corpus, with every morpheme, gloss, category and delimiter
+interned as an integer id, so that the splitting is done once per form and
+shared by all of the builders that use the corpus.
+
+A tokenized corpus records the (id, datetime_modified) listing of the forms
+it was built from.  :func:`onlinelinguisticdatabase.lib.utils.get_tokenized_corpus`
+uses the listing to decide whether the copy persisted in the corpus's
+directory is current and, if it is not, re-tokenizes only the forms that are
+new or have been modified.  :func:`tokenize_corpus` builds an uncached
+tokenized corpus from a corpus model's forms.
+
+"""
+
+import os
+import cPickle
+from uuid import uuid4
+
+import logging
+log = logging.getLogger(__name__)
+
+class TokenizedCorpus(object):
+    """The forms of a corpus with their category, morpheme and gloss words split into morphemes.
+
+    Each word is stored as a tuple of symbol ids corresponding to the output of
+    a morpheme splitter, i.e., morphemes at even indices and delimiters at odd
+    ones.
+
+    """
+
+    def __init__(self, delimiters=None):
+        self.delimiters = list(delimiters or [])
+        self.symbols = []
+        self.symbol_ids = {}
+        # Maps form ids to (datetime_modified, restricted, category_words,
+        # morpheme_words, gloss_words) tuples.
+        self.forms = {}
+        # The (id, datetime_modified) pairs of the forms, in corpus order.
+        self.listing = []
+
+    def intern(self, symbol):
+        """Return the id of ``symbol``, adding it to the symbol table if necessary."""
+        try:
+            return self.symbol_ids[symbol]
+        except KeyError:
+            self.symbol_ids[symbol] = id_ = len(self.symbols)
+            self.symbols.append(symbol)
+            return id_
+
+    def tokenize(self, string, morpheme_splitter):
+        """Return the words of ``string`` as tuples of symbol ids."""
+        return tuple(tuple(self.intern(symbol) for symbol in morpheme_splitter(word))
+                     for word in (string or u'').split())
+
+    def add_form(self, form_id, datetime_modified, restricted, morpheme_break,
+                 morpheme_gloss, syntactic_category_string, morpheme_splitter):
+        """Tokenize the morpheme break, morpheme gloss and category string of a form."""
+        if syntactic_category_string:
+            self.forms[form_id] = (datetime_modified, restricted,
+                self.tokenize(syntactic_category_string, morpheme_splitter),
+                self.tokenize(morpheme_break, morpheme_splitter),
+                self.tokenize(morpheme_gloss, morpheme_splitter))
+        else:
+            self.forms[form_id] = (datetime_modified, restricted, None, None, None)
+
+    def is_current(self, form_id, datetime_modified):
+        """Return True if the form with ``form_id`` has been tokenized and not modified since."""
+        form = self.forms.get(form_id)
+        return form is not None and form[0] == datetime_modified
+
+    def set_listing(self, listing):
+        """Set the listing of the corpus and discard any forms not in it."""
+        self.listing = list(listing)
+        form_ids = set(form_id for form_id, datetime_modified in self.listing)
+        for form_id in self.forms.keys():
+            if form_id not in form_ids:
+                del self.forms[form_id]
+
+    @property
+    def restricted(self):
+        """True if any form with a syntactic category string is tagged as restricted."""
+        return any(form[1] for form in self.forms.itervalues() if form[2] is not None)
+
+    def get_forms(self, unique=False):
+        """Yield the tokenized forms that have a syntactic category string, in corpus order.
+
+        :param bool unique: if True, a form that occurs more than once in the
+            corpus is only yielded the first time.
+        :yields: (restricted, category_words, morpheme_words, gloss_words)
+            4-tuples; each word is a tuple of strings, the output of the morpheme
+            splitter used in tokenization.
+
+        """
+        symbols = self.symbols
+        words = {}
+        def decode(word):
+            try:
+                return words[word]
+            except KeyError:
+                words[word] = decoded = tuple(symbols[id_] for id_ in word)
+                return decoded
+        seen = set()
+        for form_id, datetime_modified in self.listing:
+            if unique:
+                if form_id in seen:
+                    continue
+                seen.add(form_id)
+            datetime_modified, restricted, category_words, morpheme_words, gloss_words = \
+                self.forms[form_id]
+            if category_words is not None:
+                yield (restricted, map(decode, category_words), map(decode, morpheme_words),
+                       map(decode, gloss_words))
+
+    @classmethod
+    def load(cls, path, delimiters=None):
+        """Return the tokenized corpus pickled at ``path`` or ``None`` if there is no usable one there."""
+        if not os.path.isfile(path):
+            return None
+        try:
+            with open(path, 'rb') as f:
+                state = cPickle.load(f)
+            if state['delimiters'] != list(delimiters or []):
+                return None
+            tokenized_corpus = cls(state['delimiters'])
+            tokenized_corpus.symbols = state['symbols']
+            tokenized_corpus.symbol_ids = dict((symbol, id_) for id_, symbol in
+                                               enumerate(state['symbols']))
+            tokenized_corpus.forms = state['forms']
+            tokenized_corpus.listing = state['listing']
+            return tokenized_corpus
+        except Exception, e:
+            log.warn('Unable to load the tokenized corpus at %s: %s' % (path, e))
+            return None
+
+    def save(self, path):
+        """Pickle the tokenized corpus to ``path``.
+
+        The pickle is written to a temporary file which is then moved into
+        place so that concurrent readers never see a partial file.
+
+        """
+        tmp_path = '%s.%s.tmp' % (path, uuid4().hex)
+        state = {'delimiters': self.delimiters, 'symbols': self.symbols,
+                 'forms': self.forms, 'listing': self.listing}
+        try:
+            with open(tmp_path, 'wb') as f:
+                cPickle.dump(state, f, cPickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+def get_datetime_string(datetime_modified):
+    """Return ``datetime_modified`` as it appears in a tokenized corpus listing."""
+    return datetime_modified and datetime_modified.isoformat()
+
+def tokenize_corpus(corpus, morpheme_splitter, delimiters=None):
+    """Return an (uncached) tokenized corpus built from the form models of ``corpus``.
+
+    A corpus defined by a form search contains its forms in the order of its
+    ``forms`` collection; otherwise the forms are ordered (and possibly
+    repeated) as they are referenced in ``corpus.content``.
+
+    """
+    forms = corpus.forms
+    if not corpus.form_search:
+        forms_by_id = dict((form.id, form) for form in forms)
+        forms = [forms_by_id[id_] for id_ in corpus.get_form_references(corpus.content)]
+    tokenized_corpus = TokenizedCorpus(delimiters)
+    listing = []
+    for form in forms:
+        datetime_modified = get_datetime_string(form.datetime_modified)
+        if not tokenized_corpus.is_current(form.id, datetime_modified):
+            tokenized_corpus.add_form(form.id, datetime_modified, bool(form.restricted),
+                form.morpheme_break, form.morpheme_gloss, form.syntactic_category_string,
+                morpheme_splitter)
+        listing.append((form.id, datetime_modified))
+    tokenized_corpus.set_listing(listing)
+    return tokenized_corpus
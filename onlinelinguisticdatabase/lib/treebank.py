@@ -0,0 +1,578 @@
+# Copyright 2016 Joel Dunham
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+"""The treebank module contains the functionality for searching corpora that
+have been written to file as treebanks, i.e., the logic behind
+``SEARCH /corpora/id/tgrep2``.
+
+1. An in-process treebank search engine: the ``(TOP-<id> ...)`` trees of a
+   treebank corpus file are parsed once into label, parent/child and
+   dominance indexes against which a subset of the TGrep2 pattern language is
+   evaluated by index intersection.
+2. Running TGrep2 against a corpus's ``.t2c`` file (with a bounded number of
+   concurrent TGrep2 processes) for patterns the in-process engine does not
+   support.
+3. Caching the ids of the forms matched by a pattern, keyed by the checksum of
+   the corpus file and the pattern.
+
+The match ids of a query are stored as a sorted ``array`` of integers, which
+allows the controller to paginate directly from the cached list.
+
+The supported pattern subset is: node labels (``NP-SBJ``, ``"."``), the
+wildcard ``__``, regular expressions (``/^NP/``), basic categories
+(``@NP``), alternatives (``NP|/^VB/``), parenthesized sub-patterns, negation
+(``!``) and the relations ``<``, ``>``, ``<<``, ``>>``, ``.``, ``,``,
+``..``, ``,,`` and ``$``.  As in TGrep2, every relation in a sequence like
+``NP-SBJ < DT . VP`` applies to the first node.
+"""
+
+import os
+import re
+import threading
+import time
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict, defaultdict
+from subprocess import PIPE
+
+from onlinelinguisticdatabase.lib.utils import command_line_program_installed
+from onlinelinguisticdatabase.lib.profiling import Popen
+
+import logging
+log = logging.getLogger(__name__)
+
+# The maximum number of TGrep2 processes that may run at the same time.
+tgrep2_max_processes = 2
+tgrep2_semaphore = threading.BoundedSemaphore(tgrep2_max_processes)
+
+# The maximum number of (corpus file, pattern) results to keep in the cache.
+match_cache_max_size = 500
+
+
+class MatchCache(object):
+    """A thread-safe, size-bounded, in-process cache of treebank search results.
+
+    Keys are (corpus file fingerprint, pattern) pairs and values are sorted
+    arrays of form ids.  Because the fingerprint changes whenever the corpus
+    file is re-written, stale results are never returned; they are simply
+    evicted as the cache fills up.
+
+    """
+
+    def __init__(self, max_size=match_cache_max_size):
+        self.max_size = max_size
+        self.store = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            try:
+                match_ids = self.store.pop(key)
+            except KeyError:
+                return None
+            self.store[key] = match_ids
+            return match_ids
+
+    def set(self, key, match_ids):
+        with self.lock:
+            self.store.pop(key, None)
+            self.store[key] = match_ids
+            while len(self.store) > self.max_size:
+                self.store.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.store.clear()
+
+match_cache = MatchCache()
+
+
+def get_corpus_file_fingerprint(corpus_file, path):
+    """Return a string that changes whenever the contents of the corpus file change.
+
+    The SHA-1 checksum computed when the file was written is combined with the
+    size and modification time of the file at ``path``; the latter guard
+    against the (brief) window in which a re-written file has been moved into
+    place but its new checksum has not yet been saved.
+
+    """
+    return '%s-%s-%s' % (corpus_file.checksum, os.path.getsize(path),
+                         os.path.getmtime(path))
+
+
+def get_form_id_from_tgrep2_output_line(line):
+    """Return the form id in a line of ``tgrep2 -wu`` output, e.g., ``TOP-123``."""
+    try:
+        return int(line.split('-')[1])
+    except Exception:
+        return None
+
+
+def tgrep2(tgrep2_corpus_file_path, pattern):
+    """Return a sorted array of the ids of the forms whose trees match ``pattern``.
+
+    At most ``tgrep2_max_processes`` TGrep2 processes are run at once; callers
+    block until a slot is free.  The output is read from a pipe, i.e., no
+    temporary files are written.
+
+    """
+    if isinstance(pattern, unicode):
+        pattern = pattern.encode('utf8')
+    with tgrep2_semaphore:
+        with open(os.devnull, 'w') as fnull:
+            # The -wu option causes TGrep2 to print only the root symbol of each matching tree
+            process = Popen(['tgrep2', '-c', tgrep2_corpus_file_path, '-wu', pattern],
+                            stdout=PIPE, stderr=fnull)
+            match_ids = set(filter(None, map(get_form_id_from_tgrep2_output_line,
+                                             process.stdout)))
+            process.wait()
+    return array('l', sorted(match_ids))
+
+
+################################################################################
+# In-process treebank search engine
+################################################################################
+
+class UnsupportedPatternError(Exception):
+    """Raised when a pattern uses TGrep2 syntax that the in-process engine lacks."""
+    pass
+
+
+class Treebank(object):
+    """An index over the phrase structure trees of a treebank corpus file.
+
+    Nodes (including terminals) are numbered in pre-order across the entire
+    corpus so that node ``n`` dominates node ``m`` iff
+    ``n < m < n + self.size[n]``.  The terminals of each tree are numbered
+    consecutively, with a gap between trees; the span of a node is the
+    half-open interval ``[self.start[n], self.end[n])`` of its terminals.
+
+    """
+
+    token_pattern = re.compile(r'\(|\)|[^\s()]+')
+
+    def __init__(self):
+        self.parent = array('l')
+        self.size = array('l')
+        self.start = array('l')
+        self.end = array('l')
+        self.tree = array('l')
+        self.labels = defaultdict(list)   # label -> sorted list of node ids
+        self.tree_count = 0
+        self._leaf = 0
+
+    def __len__(self):
+        return len(self.parent)
+
+    @classmethod
+    def from_file(cls, path):
+        """Build a treebank from a file containing one ``(TOP-<id> ...)`` tree per line."""
+        treebank = cls()
+        with open(path) as f:
+            for line in f:
+                treebank.add_tree(line.decode('utf8'))
+        return treebank
+
+    def add_tree(self, tree_string):
+        """Parse the bracketed tree ``tree_string`` and add it to the indexes.
+
+        Trees that are malformed or whose root is not a ``TOP-<id>`` node are
+        skipped.
+
+        """
+        nodes = []      # (label, parent, start, end, size) with offsets local to the tree
+        stack = []
+        leaf = 0
+        tokens = self.token_pattern.findall(tree_string)
+        i = 0
+        try:
+            while i < len(tokens):
+                token = tokens[i]
+                if token == u'(':
+                    label = u''
+                    if i + 1 < len(tokens) and tokens[i + 1] not in (u'(', u')'):
+                        label = tokens[i + 1]
+                        i += 1
+                    if not stack and nodes:
+                        return False   # more than one root
+                    nodes.append([label, stack[-1] if stack else -1, leaf, None, None])
+                    stack.append(len(nodes) - 1)
+                elif token == u')':
+                    node = stack.pop()
+                    nodes[node][3] = leaf
+                    nodes[node][4] = len(nodes) - node
+                else:
+                    nodes.append([token, stack[-1], leaf, leaf + 1, 1])
+                    leaf += 1
+                i += 1
+        except IndexError:
+            return False
+        if stack or not nodes:
+            return False
+        try:
+            tree_id = int(nodes[0][0].split(u'-')[1])
+        except (IndexError, ValueError):
+            return False
+        offset = len(self.parent)
+        for node, (label, parent, start, end, size) in enumerate(nodes):
+            self.parent.append(parent + offset if parent != -1 else -1)
+            self.size.append(size)
+            self.start.append(start + self._leaf)
+            self.end.append(end + self._leaf)
+            self.tree.append(tree_id)
+            self.labels[label].append(node + offset)
+        self._leaf += leaf + 1   # the gap keeps precedence from crossing trees
+        self.tree_count += 1
+        return True
+
+    def search(self, pattern):
+        """Return a sorted array of the ids of the trees containing a node that matches ``pattern``.
+
+        :raises UnsupportedPatternError: if ``pattern`` is not in the supported subset.
+
+        """
+        if not pattern.strip():
+            return array('l')
+        matches = PatternParser(pattern, self).parse()
+        return array('l', sorted(set(self.tree[n] for n in matches)))
+
+    # Node specifications
+
+    def all_nodes(self):
+        return set(xrange(len(self)))
+
+    def label_nodes(self, label):
+        return set(self.labels.get(label, ()))
+
+    def regex_nodes(self, regex):
+        nodes = set()
+        for label, label_nodes in self.labels.iteritems():
+            if regex.search(label):
+                nodes.update(label_nodes)
+        return nodes
+
+    def basic_category_nodes(self, category):
+        """Nodes whose label is ``category`` once function tags and indices (``-SBJ``, ``=2``) are removed."""
+        nodes = set()
+        for label, label_nodes in self.labels.iteritems():
+            if re.split(u'[-=]', label, 1)[0] == category:
+                nodes.update(label_nodes)
+        return nodes
+
+    # Relations: each returns the subset of ``candidates`` standing in the
+    # relation to at least one of ``others``.
+
+    def immediately_dominates(self, candidates, others):
+        return candidates & set(self.parent[m] for m in others)
+
+    def immediately_dominated_by(self, candidates, others):
+        parent = self.parent
+        return set(n for n in candidates if parent[n] in others)
+
+    def dominates(self, candidates, others):
+        others = sorted(others)
+        size = self.size
+        result = set()
+        for n in candidates:
+            i = bisect_right(others, n)
+            if i < len(others) and others[i] < n + size[n]:
+                result.add(n)
+        return result
+
+    def dominated_by(self, candidates, others):
+        parent = self.parent
+        result = set()
+        for n in candidates:
+            p = parent[n]
+            while p != -1:
+                if p in others:
+                    result.add(n)
+                    break
+                p = parent[p]
+        return result
+
+    def immediately_precedes(self, candidates, others):
+        starts = set(self.start[m] for m in others)
+        end = self.end
+        return set(n for n in candidates if end[n] in starts)
+
+    def immediately_follows(self, candidates, others):
+        ends = set(self.end[m] for m in others)
+        start = self.start
+        return set(n for n in candidates if start[n] in ends)
+
+    def precedes(self, candidates, others):
+        latest_start = {}
+        for m in others:
+            tree = self.tree[m]
+            latest_start[tree] = max(latest_start.get(tree, self.start[m]), self.start[m])
+        tree, end = self.tree, self.end
+        return set(n for n in candidates
+                   if tree[n] in latest_start and latest_start[tree[n]] >= end[n])
+
+    def follows(self, candidates, others):
+        earliest_end = {}
+        for m in others:
+            tree = self.tree[m]
+            earliest_end[tree] = min(earliest_end.get(tree, self.end[m]), self.end[m])
+        tree, start = self.tree, self.start
+        return set(n for n in candidates
+                   if tree[n] in earliest_end and earliest_end[tree[n]] <= start[n])
+
+    def sister_of(self, candidates, others):
+        parent = self.parent
+        counts = defaultdict(int)
+        for m in others:
+            if parent[m] != -1:
+                counts[parent[m]] += 1
+        return set(n for n in candidates if parent[n] != -1 and
+                   counts.get(parent[n], 0) - (n in others) > 0)
+
+    relations = {
+        u'<': immediately_dominates,
+        u'>': immediately_dominated_by,
+        u'<<': dominates,
+        u'>>': dominated_by,
+        u'.': immediately_precedes,
+        u',': immediately_follows,
+        u'..': precedes,
+        u',,': follows,
+        u'$': sister_of
+    }
+
+
+class PatternParser(object):
+    """Parse a TGrep2 pattern and evaluate it against a treebank.
+
+    Grammar of the supported subset::
+
+        pattern  := node (['!'] relation node)*
+        node     := '(' pattern ')' | spec ('|' spec)*
+        spec     := label | '"' label '"' | '/' regex '/' | '@' label | '__'
+
+    """
+
+    token_pattern = re.compile(r"""
+        \s*(?:
+            (?P<relation><<|>>|\.\.|,,|<|>|\.|,|\$)
+          | (?P<punctuation>[()!|])
+          | (?P<regex>/(?:[^/\\]|\\.)*/i?)
+          | (?P<quoted>"[^"]*")
+          | (?P<basic>@[^\s()<>.,$!|/"@&=\[\]:;%~]+)
+          | (?P<label>[^\s()<>.,$!|/"@&=\[\]:;%~]+)
+        )\s*""", re.VERBOSE | re.UNICODE)
+
+    def __init__(self, pattern, treebank):
+        self.treebank = treebank
+        self.tokens = self.tokenize(pattern)
+        self.position = 0
+
+    def tokenize(self, pattern):
+        tokens = []
+        position = 0
+        pattern = pattern.strip()
+        while position < len(pattern):
+            match = self.token_pattern.match(pattern, position)
+            if not match or match.end() == position:
+                raise UnsupportedPatternError(
+                    u'unsupported syntax at "%s"' % pattern[position:])
+            tokens.append((match.lastgroup, match.group(match.lastgroup)))
+            position = match.end()
+        return tokens
+
+    def peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return (None, None)
+
+    def next(self):
+        token = self.peek()
+        self.position += 1
+        return token
+
+    def parse(self):
+        nodes = self.parse_pattern()
+        if self.position != len(self.tokens):
+            raise UnsupportedPatternError(u'unexpected "%s"' % self.peek()[1])
+        return nodes
+
+    def parse_pattern(self):
+        nodes = self.parse_node()
+        while True:
+            type_, value = self.peek()
+            negated = False
+            if (type_, value) == ('punctuation', u'!'):
+                self.next()
+                negated = True
+                type_, value = self.peek()
+            if type_ != 'relation':
+                if negated:
+                    raise UnsupportedPatternError(u'"!" must precede a relation')
+                return nodes
+            self.next()
+            others = self.parse_node()
+            related = Treebank.relations[value](self.treebank, nodes, others)
+            nodes = nodes - related if negated else related
+
+    def parse_node(self):
+        type_, value = self.peek()
+        if (type_, value) == ('punctuation', u'('):
+            self.next()
+            nodes = self.parse_pattern()
+            if self.next() != ('punctuation', u')'):
+                raise UnsupportedPatternError(u'unbalanced parentheses')
+            return nodes
+        nodes = self.parse_spec()
+        while self.peek() == ('punctuation', u'|'):
+            self.next()
+            nodes = nodes | self.parse_spec()
+        return nodes
+
+    def parse_spec(self):
+        type_, value = self.next()
+        if type_ == 'label':
+            if value == u'__':
+                return self.treebank.all_nodes()
+            return self.treebank.label_nodes(value)
+        elif type_ == 'quoted':
+            return self.treebank.label_nodes(value[1:-1])
+        elif type_ == 'basic':
+            return self.treebank.basic_category_nodes(value[1:])
+        elif type_ == 'regex':
+            flags = re.UNICODE
+            if value.endswith(u'i'):
+                flags |= re.IGNORECASE
+                value = value[:-1]
+            try:
+                regex = re.compile(value[1:-1], flags)
+            except re.error, e:
+                raise UnsupportedPatternError(u'invalid regular expression %s: %s' % (value, e))
+            return self.treebank.regex_nodes(regex)
+        raise UnsupportedPatternError(u'expected a node but found "%s"' % (value or u'nothing'))
+
+
+# The maximum number of parsed treebanks to keep in memory.
+treebank_cache_max_size = 4
+treebank_cache = OrderedDict()
+treebank_cache_lock = threading.Lock()
+
+# Locks that let one thread per corpus file fingerprint parse the treebank
+# while the others wait for it.  Guarded by ``treebank_cache_lock``.
+treebank_build_locks = {}
+
+def get_treebank(corpus_file, corpus_file_path):
+    """Return the (possibly cached) ``Treebank`` built from the file at ``corpus_file_path``.
+
+    The file is parsed outside of ``treebank_cache_lock`` so that searches of
+    the other cached treebanks are not blocked while a large corpus is parsed;
+    concurrent requests for the same file wait for a single parse.
+
+    """
+    fingerprint = get_corpus_file_fingerprint(corpus_file, corpus_file_path)
+    with treebank_cache_lock:
+        treebank = treebank_cache.pop(fingerprint, None)
+        if treebank is not None:
+            treebank_cache[fingerprint] = treebank
+            return treebank
+        build_lock = treebank_build_locks.setdefault(fingerprint, threading.Lock())
+    with build_lock:
+        with treebank_cache_lock:
+            treebank = treebank_cache.get(fingerprint)
+        if treebank is None:
+            try:
+                treebank = Treebank.from_file(corpus_file_path)
+            except Exception:
+                with treebank_cache_lock:
+                    treebank_build_locks.pop(fingerprint, None)
+                raise
+            with treebank_cache_lock:
+                treebank_cache[fingerprint] = treebank
+                while len(treebank_cache) > treebank_cache_max_size:
+                    treebank_cache.popitem(last=False)
+                treebank_build_locks.pop(fingerprint, None)
+    return treebank
+
+
+def search(corpus_file, corpus_file_path, pattern):
+    """Return the sorted array of ids of forms in the corpus file that match ``pattern``.
+
+    The in-process engine is used if it supports ``pattern``; otherwise the
+    search falls back to TGrep2, if installed.
+
+    :param corpus_file: a corpus file model whose format is ``'treebank'``.
+    :param str corpus_file_path: absolute path to the (uncompressed) treebank file.
+    :param unicode pattern: a TGrep2 pattern.
+    :returns: an ``array`` of form ids, from the cache if possible.
+
+    Results are only cached while the corpus file is completely written: while
+    it is being re-written (in particular, while its new ``.t2c`` file is being
+    indexed) the TGrep2 fallback may still read the previous ``.t2c`` file.
+
+    """
+    key = (get_corpus_file_fingerprint(corpus_file, corpus_file_path), pattern)
+    cacheable = corpus_file.write_status == u'complete'
+    match_ids = match_cache.get(key) if cacheable else None
+    if match_ids is None:
+        try:
+            match_ids = get_treebank(corpus_file, corpus_file_path).search(pattern)
+        except UnsupportedPatternError, e:
+            tgrep2_corpus_file_path = '%s.t2c' % corpus_file_path
+            if not (command_line_program_installed('tgrep2') and
+                    os.path.exists(tgrep2_corpus_file_path)):
+                raise UnsupportedPatternError(
+                    u'%s (TGrep2 is not installed so only a subset of TGrep2 syntax is supported)' % e)
+            match_ids = tgrep2(tgrep2_corpus_file_path, pattern)
+        if cacheable:
+            match_cache.set(key, match_ids)
+    return match_ids
+
+
+def benchmark(corpus_file_path, patterns, repeat=3):
+    """Time the in-process engine against the TGrep2 binary on the treebank at ``corpus_file_path``.
+
+    The ``.t2c`` file must exist alongside the treebank file for TGrep2 to be
+    timed.  Example::
+
+        python -m onlinelinguisticdatabase.lib.treebank store/corpora/corpus_1/corpus_1.tbk 'S < NP-SBJ'
+
+    :returns: a dict with the index build time and, for each pattern, the
+        match count and best-of-``repeat`` times of both engines in seconds.
+
+    """
+    start = time.time()
+    treebank = Treebank.from_file(corpus_file_path)
+    result = {'trees': treebank.tree_count, 'nodes': len(treebank),
+              'index_seconds': time.time() - start, 'patterns': {}}
+    tgrep2_corpus_file_path = '%s.t2c' % corpus_file_path
+    use_tgrep2 = command_line_program_installed('tgrep2') and \
+        os.path.exists(tgrep2_corpus_file_path)
+    for pattern in patterns:
+        pattern_result = result['patterns'][pattern] = {}
+        for engine, function in (('treebank', lambda: treebank.search(pattern)),
+                                 ('tgrep2', lambda: tgrep2(tgrep2_corpus_file_path, pattern))):
+            if engine == 'tgrep2' and not use_tgrep2:
+                continue
+            times = []
+            for i in range(repeat):
+                start = time.time()
+                match_ids = function()
+                times.append(time.time() - start)
+            pattern_result[engine] = {'seconds': min(times), 'matches': len(match_ids)}
+    return result
+
+
+if __name__ == '__main__':
+    import sys
+    import simplejson as json
+    print json.dumps(benchmark(sys.argv[1], [p.decode('utf8') for p in sys.argv[2:]]), indent=2)
@@ -30,8 +30,16 @@ import string
 import smtplib
 import gzip
 import zipfile
+import struct
+import zlib
 import codecs
 import ConfigParser
+import threading
+import time
+from itertools import count
+from collections import OrderedDict
+from email.utils import formatdate, parsedate_tz, mktime_tz
+from hashlib import sha1
 from random import choice, shuffle
 from shutil import rmtree
 from passlib.hash import pbkdf2_sha512
@@ -41,18 +49,22 @@ import simplejson as json
 from simplejson.decoder import JSONDecodeError
 from sqlalchemy.sql import or_, not_, desc, asc
 from sqlalchemy.orm import subqueryload, joinedload
+from sqlalchemy.orm.util import identity_key
 import onlinelinguisticdatabase.model as model
 from onlinelinguisticdatabase.model import Form, File, Collection
 from onlinelinguisticdatabase.model.meta import Session, Model, Base
+from onlinelinguisticdatabase.lib.tokenizedcorpus import TokenizedCorpus
+from onlinelinguisticdatabase.lib.history import restore_backups
 from paste.deploy import appconfig
-from pylons import app_globals, session, url
+from pylons import app_globals, session, url, request
 from formencode.schema import Schema
 from formencode.validators import Int, UnicodeString, OneOf
 from markdown import Markdown
 from docutils.core import publish_parts
 from decorator import decorator
 from pylons.decorators.util import get_pylons
-from subprocess import Popen, PIPE
+from subprocess import PIPE
+from onlinelinguisticdatabase.lib.profiling import Popen, record_json
 
 import logging
 
@@ -163,7 +175,11 @@ def jsonify(func, *args, **kwargs):
     pylons = get_pylons(args)
     pylons.response.headers['Content-Type'] = 'application/json'
     data = func(*args, **kwargs)
-    return json.dumps(data, cls=JSONOLDEncoder)
+    started = time.time()
+    try:
+        return json.dumps(data, cls=JSONOLDEncoder)
+    finally:
+        record_json(time.time() - started)
 
 
 def restrict(*methods):
@@ -191,6 +207,10 @@ map2directory = {
     u'file': u'files',
     u'files': u'files',
     u'reduced_files': os.path.join(u'files', u'reduced_files'),
+    u'uploads': os.path.join(u'files', u'uploads'),
+    u'blobs': os.path.join(u'files', u'blobs'),
+    u'backup_journal': u'backup_journal',
+    u'profiles': u'profiles',
     u'users': u'users',
     u'user': u'users',
     u'corpora': u'corpora',
@@ -278,7 +298,7 @@ def create_OLD_directories(**kwargs):
     :param kwargs['config_filename']: the name of a config file, e.g., "test.ini"
 
     """
-    for directory_name in ('files', 'reduced_files', 'users', 'corpora', 'phonologies', 'morphologies', 'morphological_parsers'):
+    for directory_name in ('files', 'reduced_files', 'uploads', 'blobs', 'users', 'corpora', 'phonologies', 'morphologies', 'morphological_parsers'):
         make_directory_safely(get_OLD_directory_path(directory_name, **kwargs))
 
 
@@ -479,6 +499,8 @@ def normalize_dict(dict_):
 # ApplicationSettings
 ################################################################################
 
+application_settings_versions = count(1)
+
 class ApplicationSettings(object):
     """ApplicationSettings is a class that adds functionality to a
     ApplicationSettings object.
@@ -487,10 +509,15 @@ class ApplicationSettings(object):
     ApplicationSettings model.  Other values, e.g., storage_orthography or
     morpheme_break_inventory, are class instances or other data structures built
     upon the application settings properties.
+
+    Each instance gets a new ``version`` so that values derived from the
+    settings elsewhere (e.g., the cached principals) can tell when they are stale.
     """
 
     def __init__(self):
+        self.version = next(application_settings_versions)
         self.application_settings = get_application_settings()
+        self.unrestricted_user_ids = set()
         if self.application_settings:
             self.get_attributes()
 
@@ -498,6 +525,9 @@ class ApplicationSettings(object):
         """Generate some higher-level data structures for the application
         settings model, providing sensible defaults where appropriate.
         """
+        self.unrestricted_user_ids = set(
+            u.id for u in self.application_settings.unrestricted_users)
+
         self.morpheme_delimiters = []
         if self.application_settings.morpheme_delimiters:
             self.morpheme_delimiters = \
@@ -781,9 +811,8 @@ def get_start_and_end_from_paginator(paginator):
     return (start, start + paginator['items_per_page'])
 
 def filter_restricted_models(model_name, query, user=None):
-    user = user or session['user']
-    unrestricted_users = get_unrestricted_users()
-    userIsUnrestricted_ = user_is_unrestricted(user, unrestricted_users)
+    user = user or get_principal()
+    userIsUnrestricted_ = user_is_unrestricted(user)
     if userIsUnrestricted_:
         return query
     else:
@@ -795,8 +824,8 @@ def filter_restricted_models_from_query(model_name, query, user):
         enterer_condition = model_.enterer.like(u'%' + u'"id": %d' % user.id + u'%')
         unrestricted_condition = not_(model_.tags.like(u'%"name": "restricted"%'))
     else:
-        enterer_condition = model_.enterer == user
-        unrestricted_condition = not_(model_.tags.any(model.Tag.name==u'restricted'))
+        enterer_condition = model_.enterer_id == user.id
+        unrestricted_condition = not_(model_.restricted)
     return query.filter(or_(enterer_condition, unrestricted_condition))
 
 def get_forms_user_can_access(user, paginator=None):
@@ -821,15 +850,18 @@ def get_model_by_UUID(model_name, UUID):
     return get_eagerloader(model_name)(Session.query(getattr(model, model_name)))\
         .filter(getattr(model, model_name).UUID==UUID).first()
 
-def get_backups_by_UUID(model_name, UUID):
-    """Return all backup models of the model with ``model_name`` using the ``UUID`` value."""
+def get_backups_query_by_UUID(model_name, UUID):
+    """Return a query over the backup models of the model with ``model_name``
+    using the ``UUID`` value, most recent first.
+    """
     backup_model = getattr(model, model_name + 'Backup')
     return Session.query(backup_model).\
             filter(backup_model.UUID==UUID).\
-            order_by(desc(backup_model.id)).all()
+            order_by(desc(backup_model.id))
 
-def get_backups_by_model_id(model_name, model_id):
-    """Return all backup models of the model with ``model_name`` using the ``id`` value of the model.
+def get_backups_query_by_model_id(model_name, model_id):
+    """Return a query over the backup models of the model with ``model_name``
+    using the ``id`` value of the model, most recent first.
 
     .. warning::
     
@@ -840,37 +872,53 @@ def get_backups_by_model_id(model_name, model_id):
     backup_model = getattr(model, model_name + 'Backup')
     return Session.query(backup_model).\
         filter(getattr(backup_model, model_name.lower() + '_id')==model_id).\
-        order_by(desc(backup_model.id)).all()
+        order_by(desc(backup_model.id))
+
+def get_backups_by_UUID(model_name, UUID):
+    """Return all backup models of the model with ``model_name`` using the ``UUID`` value."""
+    return restore_backups(get_backups_query_by_UUID(model_name, UUID).all())
+
+def get_backups_by_model_id(model_name, model_id):
+    """Return all backup models of the model with ``model_name`` using the ``id`` value of the model."""
+    return restore_backups(get_backups_query_by_model_id(model_name, model_id).all())
 
-def get_model_and_previous_versions(model_name, id):
+def get_model_and_previous_versions(model_name, id, paginator=None):
     """Return a model and its previous versions.
 
     :param str model_name: a model name, e.g., 'Form'
     :param str id: the ``id`` or ``UUID`` value of the model whose history
         is requested.
+    :param dict paginator: optional ``page`` and ``items_per_page`` values.
     :returns: a tuple whose first element is the model and whose second element
-        is a list of the model's backup models.
+        is a list of the model's backup models or, if ``paginator`` is valid, a
+        dict with ``paginator`` and ``items`` keys (cf. :func:`add_pagination`).
+
+    .. note::
+
+        Raises ``formencode.Invalid`` if ``paginator`` is invalid.
 
     """
     model_ = None
-    previous_versions = []
+    query = None
     try:
         id = int(id)
         # add eagerload function ...
         model_ = get_eagerloader(model_name)(
             Session.query(getattr(model, model_name))).get(id)
         if model_:
-            previous_versions = get_backups_by_UUID(model_name, model_.UUID)
+            query = get_backups_query_by_UUID(model_name, model_.UUID)
         else:
-            previous_versions = get_backups_by_model_id(model_name, id)
+            query = get_backups_query_by_model_id(model_name, id)
     except ValueError:
         try:
             model_UUID = unicode(UUID(id))
             model_ = get_model_by_UUID(model_name, model_UUID)
-            previous_versions = get_backups_by_UUID(model_name, model_UUID)
+            query = get_backups_query_by_UUID(model_name, model_UUID)
         except (AttributeError, ValueError):
             pass    # id is neither an integer nor a UUID
-    return model_, previous_versions
+    if query is None:
+        return model_, []
+    return model_, restore_backups(add_pagination(query, paginator))
 
 
 def get_collections():
@@ -1330,42 +1378,244 @@ def get_state_object(values):
     """
     state = State()
     state.full_dict = values
-    state.user = session['user']
+    state.user = get_principal()
     return state
 
+################################################################################
+# Authentication Principal
+################################################################################
+
+class Principal(object):
+    """The authenticated user as stored in the (Beaker) session.
+
+    A principal holds only what authentication and authorization need, so that
+    requests do not have to unpickle and ``Session.merge`` a ``User`` model.
+    Use :func:`get_principal` to get the principal of the current request and
+    :func:`get_user` when the ``User`` model itself is needed, e.g., to set a
+    model's ``enterer`` or ``modifier``.
+
+    ``version`` is the version of the application settings that ``unrestricted``
+    was computed from (see :class:`ApplicationSettings`).
+
+    """
+
+    def __init__(self, id, username, role, first_name, last_name,
+                 unrestricted=False, version=None):
+        self.id = id
+        self.username = username
+        self.role = role
+        self.first_name = first_name
+        self.last_name = last_name
+        self.unrestricted = unrestricted
+        self.version = version
+
+    def __repr__(self):
+        return '<Principal %s (%s)>' % (self.id, self.role)
+
+
+# Maps user ids to principals; shared by all requests served by this process.
+principal_cache = {}
+
+def get_application_settings_version():
+    """Return the version of app_globals.application_settings, or None."""
+    try:
+        return getattr(getattr(app_globals, 'application_settings', None),
+                       'version', None)
+    except TypeError:
+        return None
+
+def cache_principal(user):
+    """Build the principal of ``user``, a ``User`` model (or a row with the same
+    attributes), cache it and return it.
+    """
+    principal = Principal(user.id, user.username, user.role, user.first_name,
+        user.last_name, user.id in get_unrestricted_user_ids(),
+        get_application_settings_version())
+    principal_cache[user.id] = principal
+    return principal
+
+def invalidate_principal(user_id):
+    """Remove the cached principal of the user with id ``user_id``.  Call this
+    whenever a user's username, role or name changes or the user is deleted.
+    """
+    principal_cache.pop(user_id, None)
+
+def get_principal():
+    """Return the principal of the authenticated user, or None.
+
+    The principal in the session is only used for its id: the cached principal
+    is returned if its version matches that of the current application settings;
+    otherwise the user's attributes are re-selected (without building a ``User``
+    model) and cached.  None is returned if the user no longer exists.
+
+    """
+    try:
+        principal = session.get('principal')
+    except TypeError:
+        # Outside of a request there is no session.
+        return None
+    if principal is None:
+        return None
+    cached = principal_cache.get(principal.id)
+    if cached and cached.version == get_application_settings_version():
+        return cached
+    User = model.User
+    row = Session.query(User.id, User.username, User.role, User.first_name,
+        User.last_name).autoflush(False).filter(User.id == principal.id).first()
+    if row is None:
+        invalidate_principal(principal.id)
+        return None
+    return cache_principal(row)
+
+def get_user():
+    """Return the ``User`` model of the authenticated user, or None.
+
+    The model is only selected when this is first called in a request; later
+    calls are served from the identity map of the request's ``Session``.  The
+    select does not autoflush since it is typically issued while a new model is
+    still being built.
+
+    """
+    principal = get_principal()
+    if principal is None:
+        return None
+    return Session.query(model.User).autoflush(False).get(principal.id)
+
 ################################################################################
 # Authorization Functions
 ################################################################################
 
-def user_is_authorized_to_access_model(user, model_object, unrestricted_users):
+def user_is_authorized_to_access_model(user, model_object, unrestricted_users=None):
     """Return True if the user is authorized to access the model object.  Models
     tagged with the 'restricted' tag are only accessible to administrators, their
     enterers and unrestricted users.
+
+    Forms, files and collections are checked using their ``restricted`` and
+    ``enterer_id`` columns and the decision is memoized for the current request
+    (see :func:`get_authorized_ids`, which decides lists of ids in bulk).  If
+    ``unrestricted_users`` (a list of user models) is not supplied, whether the
+    user is unrestricted is decided by :func:`is_unrestricted_user`.
+
     """
     if user.role == u'administrator':
         return True
-    if isinstance(model_object, (Form, File, Collection)):
-        tags = model_object.tags
-        tag_names = [t.name for t in tags]
-        enterer_id = model_object.enterer_id
+    if unrestricted_users is None:
+        unrestricted = is_unrestricted_user(user)
     else:
-        model_backup_dict = model_object.get_dict()
-        tags = model_backup_dict['tags']
-        tag_names = [t['name'] for t in tags]
-        enterer_id = model_backup_dict['enterer'].get('id', None)
+        unrestricted = user.id in set(u.id for u in unrestricted_users)
+    if isinstance(model_object, (Form, File, Collection)):
+        memo = get_authorization_memo()
+        key = (user.id, model_object.__class__.__name__, model_object.id)
+        if unrestricted_users is None and memo is not None and key in memo:
+            return memo[key]
+        authorized = not model_object.restricted or \
+            unrestricted or \
+            user.id == model_object.enterer_id
+        if unrestricted_users is None and memo is not None and model_object.id is not None:
+            memo[key] = authorized
+        return authorized
+    model_backup_dict = model_object.get_dict()
+    tags = model_backup_dict['tags']
+    tag_names = [t['name'] for t in tags]
+    enterer_id = model_backup_dict['enterer'].get('id', None)
     return not tags or \
         'restricted' not in tag_names or \
-        user in unrestricted_users or \
+        unrestricted or \
         user.id == enterer_id
 
 
-def user_is_unrestricted(user, unrestricted_users):
+def get_authorization_memo():
+    """Return the dict that memoizes the authorization decisions of the current
+    request, or None if there is no current request (e.g., in a worker thread).
+    Its keys are (user id, model name, model id) 3-tuples and its values are
+    booleans.
+
+    """
+    try:
+        return request.environ.setdefault('old.authorization_memo', {})
+    except TypeError:
+        return None
+
+
+authorization_chunk_size = 500
+
+def get_authorized_ids(user, model_name, ids):
+    """Return the authorization decisions of ``user`` for the forms, files or
+    collections with the ids in ``ids``.
+
+    Decisions not already memoized for the current request are made from the
+    models already loaded in the session or else in one query (per
+    ``authorization_chunk_size`` ids) on the ``restricted`` and ``enterer_id``
+    columns.
+
+    :param user: a user model.
+    :param str model_name: 'Form', 'File' or 'Collection'.
+    :param ids: an iterable of integer ids.
+    :returns: a dict from ids to booleans (True if the user is authorized).
+        Ids of non-existent models are absent from the dict.
+
+    """
+    memo = get_authorization_memo()
+    if memo is None:
+        memo = {}
+    decisions = {}
+    unchecked = []
+    for id_ in set(ids):
+        key = (user.id, model_name, id_)
+        if key in memo:
+            decisions[id_] = memo[key]
+        else:
+            unchecked.append(id_)
+    if unchecked:
+        model_ = getattr(model, model_name)
+        unrestricted = user.role == u'administrator' or is_unrestricted_user(user)
+        rows = []
+        unloaded = []
+        for id_ in unchecked:
+            # Only use loaded models whose columns are not expired, lest
+            # reading them issue a query per model.
+            model_object = Session.identity_map.get(identity_key(model_, id_))
+            if model_object is not None and 'restricted' in model_object.__dict__ and \
+            'enterer_id' in model_object.__dict__:
+                rows.append((id_, model_object.restricted, model_object.enterer_id))
+            else:
+                unloaded.append(id_)
+        for chunk in chunker(unloaded, authorization_chunk_size):
+            rows += Session.query(model_.id, model_.restricted, model_.enterer_id).\
+                filter(model_.id.in_(chunk)).all()
+        for id_, restricted, enterer_id in rows:
+            decisions[id_] = memo[(user.id, model_name, id_)] = \
+                unrestricted or not restricted or user.id == enterer_id
+    return decisions
+
+
+def user_is_unrestricted(user, unrestricted_users=None):
     """Return True if the user is an administrator, unrestricted or there is no
     restricted tag.
     """
-    restricted_tag = get_restricted_tag()
-    return not restricted_tag or user.role == u'administrator' or \
-                                           user in unrestricted_users
+    if user.role == u'administrator':
+        return True
+    if unrestricted_users is None:
+        if is_unrestricted_user(user):
+            return True
+    elif user in unrestricted_users:
+        return True
+    return not get_restricted_tag()
+
+
+def is_unrestricted_user(user):
+    """Return True if ``user`` is one of the unrestricted users of the application
+    settings.
+
+    :param user: a :class:`Principal`, whose ``unrestricted`` attribute was
+        computed from the current application settings (cf. :func:`get_principal`),
+        or a user model, whose id is looked up in the precomputed unrestricted
+        user ids.
+
+    """
+    if isinstance(user, Principal):
+        return user.unrestricted
+    return user.id in get_unrestricted_user_ids()
 
 
 def get_unrestricted_users():
@@ -1376,6 +1626,21 @@ def get_unrestricted_users():
                    'application_settings', None), 'unrestricted_users', [])
 
 
+def get_unrestricted_user_ids():
+    """Return the set of the ids of the unrestricted users.  The set is
+    precomputed when app_globals.application_settings is built.
+    """
+    try:
+        application_settings = getattr(app_globals, 'application_settings', None)
+    except TypeError:
+        # Outside of a request (e.g., during testing) app_globals may not be present.
+        return set()
+    try:
+        return application_settings.unrestricted_user_ids
+    except AttributeError:
+        return set(u.id for u in get_unrestricted_users())
+
+
 unauthorized_msg = {'error': 'You are not authorized to access this resource.'}
 
 
@@ -1469,19 +1734,306 @@ collection_types = (
 # treebank will output a file containing representations of phrase structure for
 # each form in the corpus and the file will be called ``corpus_1.tbk`` ...
 
+# The ``columns`` of a format are the form attributes its ``writer`` needs;
+# corpus files are written from rows containing only these columns.
+
 corpus_formats = {
     'treebank': {
         'extension': 'tbk',
         'suffix': '',
+        'columns': ('id', 'syntax'),
         'writer': lambda f: u'(TOP-%d %s)\n' % (f.id, f.syntax)
     },
     'transcriptions only': {
         'extension': 'txt',
         'suffix': '_transcriptions',
+        'columns': ('id', 'transcription'),
         'writer': lambda f: u'%s\n' % f.transcription
     }
 }
 
+# How many form rows to fetch (and write) at a time when writing a corpus to file.
+corpus_file_chunk_size = 1000
+
+# The stages a corpus file passes through when it is written by the worker.
+corpus_file_write_statuses = (
+    u'queued',
+    u'writing',
+    u'indexing',
+    u'complete',
+    u'failed'
+)
+
+def get_corpus_form_count(corpus):
+    """Return the number of forms that will be written when ``corpus`` is written to file."""
+    if corpus.form_search:
+        return Session.query(model.CorpusForm).filter(
+            model.CorpusForm.corpus_id == corpus.id).count()
+    return len(corpus.get_form_references(corpus.content))
+
+def get_corpus_form_rows(corpus, columns, chunk_size=corpus_file_chunk_size):
+    """Generate the forms of a corpus in chunks of rows containing only ``columns``.
+
+    :param corpus: a corpus model.
+    :param tuple columns: names of the form attributes to select, e.g., ``('id', 'syntax')``.
+    :param int chunk_size: maximum number of rows per chunk.
+    :yields: lists of keyed tuples, one per form, in the order they belong in
+        the corpus file.
+
+    A corpus defined by a form search contains its forms in the order they were
+    added; otherwise the forms are ordered (and possibly repeated) as they are
+    referenced in ``corpus.content``.  Each chunk is a complete query so the
+    caller may commit between chunks.
+
+    """
+    attributes = [getattr(Form, column) for column in columns]
+    if corpus.form_search:
+        last_id = 0
+        while True:
+            rows = Session.query(model.CorpusForm.id, *attributes).\
+                join(Form, Form.id == model.CorpusForm.form_id).\
+                filter(model.CorpusForm.corpus_id == corpus.id).\
+                filter(model.CorpusForm.id > last_id).\
+                order_by(asc(model.CorpusForm.id)).limit(chunk_size).all()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            yield [Row(zip(columns, row[1:])) for row in rows]
+    else:
+        for form_references in chunker(corpus.get_form_references(corpus.content), chunk_size):
+            rows = get_form_rows(form_references, columns)
+            yield [rows[id] for id in form_references]
+
+def get_form_rows(form_ids, columns):
+    """Return a dict from the ids in ``form_ids`` to rows containing only ``columns``."""
+    if not form_ids:
+        return {}
+    attributes = [getattr(Form, column) for column in columns]
+    rows = Session.query(Form.id, *attributes).filter(Form.id.in_(set(form_ids))).all()
+    return dict([(row[0], Row(zip(columns, row[1:]))) for row in rows])
+
+def corpus_forms_restricted(form_ids):
+    """Return True if any of the forms with ids in ``form_ids`` is restricted."""
+    return bool(Session.query(Form.id).filter(Form.id.in_(set(form_ids))).\
+        filter(Form.restricted == True).first())
+
+def get_restricted_form_ids(form_ids):
+    """Return the set of ids in ``form_ids`` that belong to restricted forms."""
+    if not form_ids:
+        return set()
+    return set(id for (id,) in Session.query(Form.id).filter(Form.id.in_(set(form_ids))).\
+        filter(Form.restricted == True).all())
+
+def get_tokenized_corpus(corpus, morpheme_splitter, delimiters, corpora_path=None):
+    """Return the forms of ``corpus`` tokenized using ``morpheme_splitter``.
+
+    :param corpus: a corpus model.
+    :param morpheme_splitter: callable that splits a word into morphemes and
+        delimiters, e.g., the ``morpheme_splitter`` of a morphology.
+    :param list delimiters: the delimiters ``morpheme_splitter`` splits on.
+    :param str corpora_path: absolute path to the corpora directory; if
+        supplied, the tokenized corpus is persisted in the corpus's directory.
+    :returns: a :class:`onlinelinguisticdatabase.lib.tokenizedcorpus.TokenizedCorpus`.
+
+    The persisted copy is keyed by the delimiters and by the ids and
+    modification times of the corpus's forms.  If the listing of the corpus has
+    changed, only the forms that are new or have been modified are fetched and
+    re-tokenized.
+
+    """
+    listing = get_corpus_file_listing(corpus)
+    path = tokenized_corpus = None
+    if corpora_path:
+        path = os.path.join(corpora_path, 'corpus_%d' % corpus.id, 'tokenized_%s.pickle' %
+            sha1(u','.join(delimiters).encode('utf8')).hexdigest())
+        tokenized_corpus = TokenizedCorpus.load(path, delimiters)
+    if tokenized_corpus is None:
+        tokenized_corpus = TokenizedCorpus(delimiters)
+    elif tokenized_corpus.listing == listing:
+        return tokenized_corpus
+    stale = OrderedDict((form_id, datetime_modified) for form_id, datetime_modified in listing
+        if not tokenized_corpus.is_current(form_id, datetime_modified))
+    columns = ('morpheme_break', 'morpheme_gloss', 'syntactic_category_string')
+    for form_ids in chunker(stale.keys(), corpus_file_chunk_size):
+        rows = get_form_rows(form_ids, columns)
+        restricted_ids = get_restricted_form_ids(form_ids)
+        for form_id in form_ids:
+            row = rows[form_id]
+            tokenized_corpus.add_form(form_id, stale[form_id], form_id in restricted_ids,
+                row.morpheme_break, row.morpheme_gloss, row.syntactic_category_string,
+                morpheme_splitter)
+    tokenized_corpus.set_listing(listing)
+    if path:
+        make_directory_safely(os.path.dirname(path))
+        tokenized_corpus.save(path)
+    return tokenized_corpus
+
+class Row(dict):
+    """A dict whose keys are also accessible as attributes, i.e., a lightweight
+    stand-in for a form model when only a few of its columns have been selected.
+
+    """
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+class TeeFile(object):
+    """Write UTF-8-encoded data to a plain file and to a gzipped file in a single pass.
+    The SHA-1 checksum of the data is computed as it is written.
+
+    Usage::
+
+        with TeeFile(path, '%s.gz' % path) as f:
+            f.write(u'...')
+
+    """
+
+    def __init__(self, path, gzipped_path):
+        self.files = [open(path, 'wb'), gzip.open(gzipped_path, 'wb')]
+        self.checksum = sha1()
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf8')
+        self.checksum.update(data)
+        for file_ in self.files:
+            file_.write(data)
+
+    def close(self):
+        for file_ in self.files:
+            file_.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class CorpusFileManifest(object):
+    """Records, for each form written to a corpus file, its ``datetime_modified``
+    value and the byte offset and length of its representation in the file.
+
+    The manifest is stored as JSON next to the corpus file, i.e., at
+    ``<corpus file path>.manifest``.  When a corpus is re-written, the
+    representations of forms that have not been modified since the last write
+    can be copied from the existing file instead of being re-rendered.  The
+    size and SHA-1 checksum of the corpus file are recorded too so that a
+    manifest that does not describe the file on disk is never trusted.
+
+    """
+
+    def __init__(self, path, entries=None, size=None, checksum=None):
+        self.path = path
+        self.entries = entries or []
+        self.index = dict([(e[0], e) for e in self.entries])
+        self.size = size
+        self.checksum = checksum
+
+    @classmethod
+    def get_path(cls, corpus_file_path):
+        return '%s.manifest' % corpus_file_path
+
+    @classmethod
+    def load(cls, corpus_file_path):
+        """Return the manifest of the corpus file at ``corpus_file_path``.
+
+        An empty manifest is returned if the file or its manifest does not exist,
+        if the manifest cannot be parsed or if the size or checksum of the file
+        do not match those recorded in the manifest, e.g., because the write
+        that produced the file was interrupted.  The corpus file is then
+        re-written from scratch.
+
+        """
+        path = cls.get_path(corpus_file_path)
+        if not os.path.isfile(corpus_file_path):
+            return cls(path)
+        try:
+            with open(path) as f:
+                manifest = json.load(f)
+            size = manifest['size']
+            checksum = manifest['checksum']
+            if size != os.path.getsize(corpus_file_path) or \
+            checksum != get_file_sha1(corpus_file_path):
+                log.warn('The manifest of corpus file %s does not match it.' % corpus_file_path)
+                return cls(path)
+            return cls(path, [tuple(e) for e in manifest['entries']], size, checksum)
+        except Exception:
+            return cls(path)
+
+    def append(self, form_id, datetime_modified, offset, length):
+        entry = (form_id, datetime_modified, offset, length)
+        self.entries.append(entry)
+        self.index[form_id] = entry
+
+    def get_listing(self):
+        """Return the (id, datetime_modified) sequence of the forms in the file."""
+        return [e[:2] for e in self.entries]
+
+    def get_segment(self, form_id, datetime_modified):
+        """Return the (offset, length) of the form in the file if it is current, else ``None``."""
+        entry = self.index.get(form_id)
+        if entry and entry[1] == datetime_modified:
+            return entry[2:]
+        return None
+
+    def save(self, tmp_suffix=''):
+        with open(self.path + tmp_suffix, 'w') as f:
+            json.dump({'entries': self.entries, 'size': self.size,
+                       'checksum': self.checksum}, f)
+        return self.path + tmp_suffix
+
+def get_file_sha1(path):
+    """Return the SHA-1 hex digest of the file at ``path``, reading it in chunks."""
+    checksum = sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1048576), ''):
+            checksum.update(chunk)
+    return unicode(checksum.hexdigest())
+
+def get_corpus_file_listing(corpus):
+    """Return the (id, datetime_modified) pairs of the forms of ``corpus``, in corpus file order.
+
+    Datetimes are ISO 8601 strings so that the listing can be compared to that
+    of a :class:`CorpusFileManifest`.
+
+    """
+    listing = []
+    for rows in get_corpus_form_rows(corpus, ('id', 'datetime_modified')):
+        listing += [(row.id, row.datetime_modified and row.datetime_modified.isoformat())
+                    for row in rows]
+    return listing
+
+def create_tgrep2_corpus_file(gzipped_corpus_file_path, format_):
+    """Use TGrep2 to create a .t2c corpus file from the gzipped file of phrase-structure trees.
+
+    :param str gzipped_corpus_file_path: absolute path to the gzipped corpus file.
+    :param str format_: the format in which the corpus has just been written to disk.
+    :returns: the absolute path to the .t2c file or ``False``.
+
+    Any existing .t2c file is removed first so that a failed run cannot leave
+    the index of a previous version of the corpus file in place.
+
+    """
+    if tgrep2_indexing_applies(format_):
+        out_path = '%s.t2c' % os.path.splitext(gzipped_corpus_file_path)[0]
+        if os.path.exists(out_path):
+            os.remove(out_path)
+        with open(os.devnull, "w") as fnull:
+            process = Popen(['tgrep2', '-p', gzipped_corpus_file_path, out_path],
+                            stdout=fnull, stderr=fnull)
+            process.communicate()
+        if process.returncode == 0 and os.path.exists(out_path):
+            return out_path
+        return False
+    return False
+
+def tgrep2_indexing_applies(format_):
+    """Return True if corpus files in ``format_`` get a TGrep2 .t2c index."""
+    return format_ == u'treebank' and command_line_program_installed('tgrep2')
+
 
 # This is the regex for finding form references in the contents of collections.
 form_reference_pattern = re.compile('[Ff]orm\[([0-9]+)\]')
@@ -1522,8 +2074,67 @@ markup_language_to_func = {
 
 markup_languages = markup_language_to_func.keys()
 
+html_cache_max_size = 5000
+
+class HTMLCache(object):
+    """A thread-safe, size-bounded, in-process cache of rendered HTML.
+
+    Entries are keyed by the markup language and a SHA-1 hash of the markup
+    string being rendered, so a change to the markup (e.g., to the unpacked
+    contents of a collection after a form it references has changed) simply
+    misses the cache.  The least recently used entries are evicted first.
+
+    """
+
+    def __init__(self, max_size=html_cache_max_size):
+        self.max_size = max_size
+        self.store = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get_key(self, contents, markup_language):
+        if isinstance(contents, unicode):
+            contents = contents.encode('utf8')
+        return (markup_language, sha1(contents).hexdigest())
+
+    def get(self, key):
+        with self.lock:
+            try:
+                html = self.store.pop(key)
+            except KeyError:
+                return None
+            self.store[key] = html
+            return html
+
+    def set(self, key, html):
+        with self.lock:
+            self.store.pop(key, None)
+            self.store[key] = html
+            while len(self.store) > self.max_size:
+                self.store.popitem(last=False)
+
+    def render(self, contents, markup_language):
+        key = self.get_key(contents, markup_language)
+        html = self.get(key)
+        if html is None:
+            html = markup_language_to_func.get(markup_language, rst2html)(contents)
+            self.set(key, html)
+        return html
+
+    def clear(self):
+        with self.lock:
+            self.store.clear()
+
+html_cache = HTMLCache()
+
 def get_HTML_from_contents(contents, markup_language):
-    return markup_language_to_func.get(markup_language, rst2html)(contents)
+    """Return ``contents`` rendered as HTML, using the cache where possible.
+
+    :param unicode contents: a markup string.
+    :param str markup_language: one of ``markup_languages``; defaults to reStructuredText.
+    :returns: an HTML string.
+
+    """
+    return html_cache.render(contents, markup_language)
 
 
 # Subject to change!  Or maybe these should be user-definable ...
@@ -1705,17 +2316,19 @@ def command_line_program_installed(program):
             return True
     return False
 
-def ffmpeg_installed():
+def ffmpeg_installed(globals_=None):
     """Check if the ffmpeg command-line utility is installed on the host.
 
-    Check first if the answer to this question is cached in app_globals.
+    Check first if the answer to this question is cached in app_globals (or in
+    ``globals_``, e.g., ``config['pylons.app_globals']`` outside of a request).
 
     """
+    globals_ = app_globals if globals_ is None else globals_
     try:
-        return app_globals.ffmpeg_installed
+        return globals_.ffmpeg_installed
     except AttributeError:
         ffmpeg_installed = command_line_program_installed('ffmpeg')
-        app_globals.ffmpeg_installed = ffmpeg_installed
+        globals_.ffmpeg_installed = ffmpeg_installed
         return ffmpeg_installed
 
 def foma_installed(force_check=False):
@@ -1735,19 +2348,23 @@ def foma_installed(force_check=False):
         app_globals.foma_installed = foma_installed
         return foma_installed
 
-def ffmpeg_encodes(format_):
-    """Check if ffmpeg encodes the input format.  First check if it's installed."""
-    if ffmpeg_installed():
+def ffmpeg_encodes(format_, globals_=None):
+    """Check if ffmpeg encodes the input format.  First check if it's installed.
+    The answers are cached as in :func:`ffmpeg_installed`.
+
+    """
+    globals_ = app_globals if globals_ is None else globals_
+    if ffmpeg_installed(globals_):
         try:
-            return app_globals.ffmpeg_encodes[format_]
+            return globals_.ffmpeg_encodes[format_]
         except (AttributeError, KeyError):
             process = Popen(['ffmpeg', '-formats'], stderr=PIPE, stdout=PIPE)
             stdout, stderr = process.communicate()
             encodes_format = 'E %s' % format_ in stdout
             try:
-                app_globals.ffmpeg_encodes[format_] = encodes_format
+                globals_.ffmpeg_encodes[format_] = encodes_format
             except AttributeError:
-                app_globals.ffmpeg_encodes = {format_: encodes_format}
+                globals_.ffmpeg_encodes = {format_: encodes_format}
             return encodes_format
     return False
 
@@ -1984,6 +2601,268 @@ class ZipFile(zipfile.ZipFile):
         self.write(file_path, new_path, zipfile.ZIP_DEFLATED)
 
 
+class ZipStream(object):
+    """Produce a .zip archive incrementally, as an iterable of byte strings.
+
+    Unlike ``zipfile.ZipFile``, no seekable output file is needed and entry
+    data are never held in memory in full: each entry is deflated as its data
+    are read and its CRC and sizes follow it in a data descriptor.  Usage::
+
+        zip_stream = ZipStream('archive')
+        for chunk in zip_stream.write_file('/path/to/parse.py'): ...
+        for chunk in zip_stream.write_iter('config.pickle', [data]): ...
+        for chunk in zip_stream.close(): ...
+
+    Entries are placed in a top-level directory called ``directory_name``, cf.
+    :class:`ZipFile`.  Zip64 is not supported, i.e., entries and the archive
+    must be smaller than 4GB.
+
+    """
+
+    def __init__(self, directory_name):
+        self.directory_name = directory_name
+        self.offset = 0
+        self.entries = []
+
+    def _out(self, data):
+        self.offset += len(data)
+        return data
+
+    def write_file(self, file_path, arcname=None, block_size=65536):
+        """Write the file at ``file_path`` to the archive (under its basename by default)."""
+        def read_blocks():
+            with open(file_path, 'rb') as f:
+                for block in iter(lambda: f.read(block_size), ''):
+                    yield block
+        stat = os.stat(file_path)
+        return self.write_iter(arcname or os.path.basename(file_path), read_blocks(),
+                               mtime=stat.st_mtime, mode=stat.st_mode)
+
+    def write_directory(self, directory_path, block_size=65536):
+        """Write the files in the tree under ``directory_path`` to the archive,
+        keeping their paths relative to the parent of ``directory_path``.
+        """
+        parent_path = os.path.dirname(directory_path.rstrip(os.sep))
+        for root, dirs, files in os.walk(directory_path):
+            for file_name in files:
+                file_path = os.path.join(root, file_name)
+                for chunk in self.write_file(file_path,
+                        os.path.relpath(file_path, parent_path), block_size):
+                    yield chunk
+
+    def write_iter(self, arcname, chunks, mtime=None, mode=0644):
+        """Write an entry whose data are the byte strings of the iterable ``chunks``."""
+        filename = os.path.join(self.directory_name, arcname)
+        if isinstance(filename, unicode):
+            filename = filename.encode('utf8')
+            flag_bits = 0x08 | 0x800    # data descriptor, UTF-8 filename
+        else:
+            flag_bits = 0x08
+        date_time = datetime.datetime.fromtimestamp(mtime or time.time())
+        dos_time = date_time.hour << 11 | date_time.minute << 5 | date_time.second // 2
+        dos_date = (date_time.year - 1980) << 9 | date_time.month << 5 | date_time.day
+        header_offset = self.offset
+        yield self._out(struct.pack(zipfile.structFileHeader, zipfile.stringFileHeader,
+            20, 0, flag_bits, zipfile.ZIP_DEFLATED, dos_time, dos_date,
+            0, 0, 0, len(filename), 0) + filename)
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        crc = compress_size = file_size = 0
+        for chunk in chunks:
+            file_size += len(chunk)
+            crc = zlib.crc32(chunk, crc)
+            compressed = compressor.compress(chunk)
+            if compressed:
+                compress_size += len(compressed)
+                yield self._out(compressed)
+        compressed = compressor.flush()
+        compress_size += len(compressed)
+        crc &= 0xffffffff
+        yield self._out(compressed + struct.pack('<4s3L', 'PK\x07\x08', crc,
+                                                 compress_size, file_size))
+        self.entries.append((filename, flag_bits, dos_time, dos_date, crc,
+                             compress_size, file_size, mode, header_offset))
+
+    def close(self):
+        """Write the central directory; return an iterable of its byte strings."""
+        central_directory_offset = self.offset
+        for (filename, flag_bits, dos_time, dos_date, crc, compress_size,
+                file_size, mode, header_offset) in self.entries:
+            yield self._out(struct.pack(zipfile.structCentralDir,
+                zipfile.stringCentralDir, 20, 3, 20, 0, flag_bits,
+                zipfile.ZIP_DEFLATED, dos_time, dos_date, crc, compress_size,
+                file_size, len(filename), 0, 0, 0, 0, (mode & 0xffff) << 16,
+                header_offset) + filename)
+        yield self._out(struct.pack(zipfile.structEndArchive, zipfile.stringEndArchive,
+            0, 0, len(self.entries), len(self.entries),
+            self.offset - central_directory_offset, central_directory_offset, 0))
+
+
+################################################################################
+# Serving files
+################################################################################
+
+file_serve_block_size = 65536
+
+class FileServer(object):
+    """A WSGI application that serves the file at ``path`` with support for
+    conditional (``If-None-Match``, ``If-Modified-Since``) and byte-range
+    (``Range``, ``If-Range``) requests.
+
+    The entity tag is ``etag`` (e.g., a checksum of the file stored in the
+    database) or, if that is not supplied, one derived from the size and
+    modification time of the file.  The file is never read into memory: if the
+    server provides ``wsgi.file_wrapper`` (which may use ``sendfile``), it is
+    used whenever the response extends to the end of the file; otherwise the
+    file is streamed in blocks.
+
+    Usage in a controller: ``return forward(h.FileServer(path))``.
+
+    """
+
+    def __init__(self, path, content_type=None, etag=None):
+        self.path = path
+        self.content_type = content_type or guess_type(path)[0] or 'application/octet-stream'
+        self.etag = etag and str(etag) # WSGI header values must be byte strings
+
+    def __call__(self, environ, start_response):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            start_response('404 Not Found', [('Content-Type', 'text/plain')])
+            return ['The resource does not exist']
+        size = stat.st_size
+        etag = '"%s"' % (self.etag or '%x-%x' % (int(stat.st_mtime * 1000), size))
+        last_modified = formatdate(stat.st_mtime, usegmt=True)
+        headers = [('ETag', etag), ('Last-Modified', last_modified),
+                   ('Accept-Ranges', 'bytes'), ('Cache-Control', 'private')]
+        if self.not_modified(environ, etag, stat.st_mtime):
+            start_response('304 Not Modified', headers)
+            return []
+        byte_range = self.get_range(environ, etag, size)
+        if byte_range is False:
+            start_response('416 Requested Range Not Satisfiable',
+                           headers + [('Content-Range', 'bytes */%d' % size)])
+            return []
+        headers.append(('Content-Type', self.content_type))
+        if byte_range:
+            start, end = byte_range
+            headers.append(('Content-Range', 'bytes %d-%d/%d' % (start, end, size)))
+            status = '206 Partial Content'
+        else:
+            start, end = 0, size - 1
+            status = '200 OK'
+        length = end - start + 1
+        headers.append(('Content-Length', str(length)))
+        start_response(status, headers)
+        if environ['REQUEST_METHOD'] == 'HEAD' or not length:
+            return []
+        file_ = open(self.path, 'rb')
+        file_.seek(start)
+        file_wrapper = environ.get('wsgi.file_wrapper')
+        if file_wrapper and end == size - 1:
+            return file_wrapper(file_, file_serve_block_size)
+        return FileIterator(file_, length)
+
+    def not_modified(self, environ, etag, mtime):
+        """Return ``True`` if the client's cached copy is current."""
+        if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+        if if_none_match:
+            client_etags = [e.strip().replace('W/', '', 1) for e in if_none_match.split(',')]
+            return etag in client_etags or '*' in client_etags
+        if_modified_since = environ.get('HTTP_IF_MODIFIED_SINCE')
+        if if_modified_since:
+            client_time = parsedate_tz(if_modified_since.split(';')[0])
+            if client_time:
+                return int(mtime) <= mktime_tz(client_time)
+        return False
+
+    def get_range(self, environ, etag, size):
+        """Return the (inclusive) ``(start, end)`` byte range requested,
+        ``None`` if the whole file should be served, or ``False`` if the range
+        cannot be satisfied.  Only single ranges are supported; requests for
+        multiple ranges receive the whole file.
+        """
+        range_header = environ.get('HTTP_RANGE', '').replace(' ', '')
+        if not range_header.startswith('bytes=') or ',' in range_header:
+            return None
+        if_range = environ.get('HTTP_IF_RANGE')
+        if if_range and if_range != etag:
+            return None
+        try:
+            first, last = range_header[6:].split('-')
+            if first:
+                start = int(first)
+                end = min(int(last), size - 1) if last else size - 1
+            else:
+                start = max(size - int(last), 0)
+                end = size - 1
+        except ValueError:
+            return None
+        if start > end or start >= size:
+            return False
+        return start, end
+
+class FileIterator(object):
+    """Iterate over the next ``length`` bytes of an open file in blocks."""
+
+    def __init__(self, file_, length, block_size=file_serve_block_size):
+        self.file = file_
+        self.remaining = length
+        self.block_size = block_size
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self.remaining <= 0:
+            raise StopIteration
+        data = self.file.read(min(self.block_size, self.remaining))
+        if not data:
+            raise StopIteration
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.file.close()
+
+# Authorization decisions for serving file data are cached briefly so that
+# clients issuing many range requests on the same file (e.g., media players
+# seeking in a recording) do not trigger the same tag queries on each request.
+# Keys include the file's datetime_modified, so tagging a file via an update
+# takes effect immediately.
+file_authorization_cache_ttl = 30
+file_authorization_cache_max_size = 10000
+file_authorization_cache = OrderedDict()
+file_authorization_cache_lock = threading.Lock()
+
+def user_is_authorized_to_access_file(user, file, unrestricted_users=None):
+    """Return True if the user is authorized to access the data of the file model.
+
+    Equivalent to ``user_is_authorized_to_access_model`` but the decision is
+    cached per user and file for ``file_authorization_cache_ttl`` seconds.
+
+    """
+    if user.role == u'administrator':
+        return True
+    if unrestricted_users is None:
+        unrestricted = is_unrestricted_user(user)
+    else:
+        unrestricted = user in unrestricted_users
+    key = (user.id, user.role, unrestricted, file.id, file.datetime_modified)
+    now_ = time.time()
+    with file_authorization_cache_lock:
+        cached = file_authorization_cache.get(key)
+    if cached and cached[1] > now_:
+        return cached[0]
+    authorized = user_is_authorized_to_access_model(user, file, unrestricted_users)
+    with file_authorization_cache_lock:
+        file_authorization_cache.pop(key, None)
+        file_authorization_cache[key] = (authorized, now_ + file_authorization_cache_ttl)
+        while len(file_authorization_cache) > file_authorization_cache_max_size:
+            file_authorization_cache.popitem(last=False)
+    return authorized
+
+
 def pretty_print_bytes(num_bytes):
     """Print an integer byte count to human-readable form.
     """
@@ -2126,6 +3005,10 @@ language_model_toolkits = {
     'mitlm': {
         'smoothing_algorithms': ['ML', 'FixKN', 'FixModKN', 'FixKNn', 'KN', 'ModKN', 'KNn'], # cf. http://code.google.com/p/mitlm/wiki/Tutorial
         'executable': 'estimate-ngram'
+    },
+    'simplelm': {
+        'smoothing_algorithms': ['ModKN', 'KN', 'Abs', 'ML'], # cf. lib/simplelm/estimate.py
+        'executable': None # estimation is done in-process
     }
 }
 
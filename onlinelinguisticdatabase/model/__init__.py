@@ -14,6 +14,7 @@
 
 """The application's model objects"""
 
+from onlinelinguisticdatabase.model import meta
 from onlinelinguisticdatabase.model.meta import Session, Base
 
 from onlinelinguisticdatabase.model.applicationsettings import ApplicationSettings, ApplicationSettingsUser
@@ -57,7 +58,13 @@ __all__ = ['Session', 'Base', 'ApplicationSettings', 'ApplicationSettingsUser',
     'UserForm']
 
 
-def init_model(engine):
-    """Call me before using any of the tables or classes in the model"""
+def init_model(engine, replica_engines=None):
+    """Call me before using any of the tables or classes in the model.
+
+    :param engine: the engine of the primary database.
+    :param list replica_engines: the engines of its read replicas, if any.
+
+    """
     #Session.configure(autoflush=True, bind=engine)
     Session.configure(bind=engine)
+    meta.replica_engines[:] = replica_engines or []
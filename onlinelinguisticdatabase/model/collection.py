@@ -15,9 +15,9 @@
 """Collection model"""
 
 from sqlalchemy import Column, Sequence, ForeignKey
-from sqlalchemy.types import Integer, Unicode, UnicodeText, Date, DateTime
+from sqlalchemy.types import Integer, Unicode, UnicodeText, Date, DateTime, Boolean
 from sqlalchemy.orm import relation
-from onlinelinguisticdatabase.model.meta import Base, now
+from onlinelinguisticdatabase.model.meta import Base, now, track_restricted_tag
 
 class CollectionFile(Base):
 
@@ -71,6 +71,8 @@ class Collection(Base):
     datetime_entered = Column(DateTime)
     datetime_modified = Column(DateTime, default=now)
     tags = relation('Tag', secondary=CollectionTag.__table__)
+    # True if the model is tagged with the restricted tag; cf. meta.track_restricted_tag.
+    restricted = Column(Boolean, default=False, index=True)
     files = relation('File', secondary=CollectionFile.__table__, backref='collections')
     # forms attribute is defined in a relation/backref in the form model
 
@@ -121,3 +123,4 @@ class Collection(Base):
         result['forms'] = self.get_forms_list(self.forms)
         return result
 
+track_restricted_tag(Collection.tags)
@@ -20,7 +20,7 @@ seemed like more trouble than it's worth.
 """
 
 from sqlalchemy import Column, Sequence
-from sqlalchemy.types import Integer, Unicode, UnicodeText, Date, DateTime
+from sqlalchemy.types import Integer, Unicode, UnicodeText, Date, DateTime, Boolean
 from onlinelinguisticdatabase.model.meta import Base, now
 import simplejson as json
 
@@ -52,6 +52,9 @@ class CollectionBackup(Base):
     tags = Column(UnicodeText)
     files = Column(UnicodeText)
     forms = Column(UnicodeText)
+    # Delta encoding of the large text columns, cf. lib/history.py.
+    snapshot = Column(Boolean, default=True)
+    delta = Column(UnicodeText)
 
     def vivify(self, collection_dict):
         """The vivify method gives life to CollectionBackup by specifying its
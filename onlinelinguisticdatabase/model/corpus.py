@@ -150,6 +150,13 @@ class CorpusFile(Base):
     datetime_modified = Column(DateTime, default=now)
     datetime_created = Column(DateTime)
     restricted = Column(Boolean)
+    # Corpus files are written by a worker thread; these values report its progress.
+    write_attempt = Column(Unicode(36)) # a UUID
+    write_status = Column(Unicode(255)) # one of h.corpus_file_write_statuses
+    write_message = Column(Unicode(255))
+    form_count = Column(Integer)
+    forms_written = Column(Integer)
+    checksum = Column(Unicode(40)) # SHA-1 of the file's contents
 
     def get_dict(self):
         """Return a Python dictionary representation of the corpus file."""
@@ -162,5 +169,11 @@ class CorpusFile(Base):
             'modifier': self.get_mini_user_dict(self.modifier),
             'datetime_modified': self.datetime_modified,
             'datetime_entered': self.datetime_entered,
-            'restricted': self.restricted
+            'restricted': self.restricted,
+            'write_attempt': self.write_attempt,
+            'write_status': self.write_status,
+            'write_message': self.write_message,
+            'form_count': self.form_count,
+            'forms_written': self.forms_written,
+            'checksum': self.checksum
         }
@@ -15,7 +15,7 @@
 """Corpus backup model"""
 
 from sqlalchemy import Column, Sequence
-from sqlalchemy.types import Integer, Unicode, UnicodeText, DateTime
+from sqlalchemy.types import Integer, Unicode, UnicodeText, DateTime, Boolean
 from onlinelinguisticdatabase.model.meta import Base, now
 import simplejson as json
 
@@ -49,6 +49,9 @@ class CorpusBackup(Base):
     datetime_entered = Column(DateTime)
     datetime_modified = Column(DateTime, default=now)
     tags = Column(UnicodeText)
+    # Delta encoding of the large text columns, cf. lib/history.py.
+    snapshot = Column(Boolean, default=True)
+    delta = Column(UnicodeText(length=2**31))
 
     def vivify(self, corpus_dict):
         """The vivify method gives life to a corpus_backup by specifying its
@@ -0,0 +1,193 @@
+#!/usr/bin/python
+
+# Copyright 2016 Joel Dunham
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+"""This executable updates an OLD 2.0.0 MySQL database and makes it compatible
+with the OLD 2.1.0 data structure
+
+Usage:
+
+    $ ./old_update_db_2.0.0_2.1.0.py \
+        -d mysql_db_name \
+        -u mysql_username \
+        -p mysql_password \
+
+"""
+
+import os
+import sys
+import subprocess
+from sqlalchemy import create_engine, MetaData, Table
+
+# update_SQL holds the SQL statements that add the denormalized ``restricted``
+# columns (and their indices) to the form, file and collection tables and
+# backfill them from the existing tag associations.  It also adds the
+# ``snapshot`` and ``delta`` columns of the delta-encoded collection and corpus
+# backups and the ``lossy_status`` column of files, which tracks the creation of
+# their reduced-size copies, and the indexed ``checksum`` column of files, which
+# names their blobs (cf. lib/blobstore.py).  The checksums of existing files stay
+# NULL: their data remain where they are and are never shared with a blob.
+# Finally, it adds the columns that report the progress and checksum of the
+# asynchronous writing of corpus files; the existing corpus files were written
+# synchronously, so they are marked as complete.
+update_SQL = '''
+ALTER TABLE form ADD `restricted` tinyint(1) DEFAULT 0;
+ALTER TABLE file ADD `restricted` tinyint(1) DEFAULT 0;
+ALTER TABLE collection ADD `restricted` tinyint(1) DEFAULT 0;
+CREATE INDEX ix_form_restricted ON form (restricted);
+CREATE INDEX ix_file_restricted ON file (restricted);
+CREATE INDEX ix_collection_restricted ON collection (restricted);
+UPDATE form SET restricted = 0;
+UPDATE form SET restricted = 1 WHERE id IN (
+  SELECT formtag.form_id FROM formtag
+  JOIN tag ON tag.id = formtag.tag_id WHERE tag.name = 'restricted');
+UPDATE file SET restricted = 0;
+UPDATE file SET restricted = 1 WHERE id IN (
+  SELECT filetag.file_id FROM filetag
+  JOIN tag ON tag.id = filetag.tag_id WHERE tag.name = 'restricted');
+UPDATE collection SET restricted = 0;
+UPDATE collection SET restricted = 1 WHERE id IN (
+  SELECT collectiontag.collection_id FROM collectiontag
+  JOIN tag ON tag.id = collectiontag.tag_id WHERE tag.name = 'restricted');
+ALTER TABLE collectionbackup ADD `snapshot` tinyint(1) DEFAULT 1, ADD `delta` text;
+ALTER TABLE corpusbackup ADD `snapshot` tinyint(1) DEFAULT 1, ADD `delta` longtext;
+ALTER TABLE file ADD `lossy_status` varchar(40) DEFAULT NULL;
+ALTER TABLE file ADD `checksum` varchar(64) DEFAULT NULL;
+CREATE INDEX ix_file_checksum ON file (checksum);
+ALTER TABLE corpusfile
+    ADD `write_attempt` varchar(36) DEFAULT NULL,
+    ADD `write_status` varchar(255) DEFAULT NULL,
+    ADD `write_message` varchar(255) DEFAULT NULL,
+    ADD `form_count` int(11) DEFAULT NULL,
+    ADD `forms_written` int(11) DEFAULT NULL,
+    ADD `checksum` varchar(40) DEFAULT NULL;
+UPDATE corpusfile SET write_status = 'complete';
+'''.strip()
+
+
+def write_update_executable(mysql_update_script_name, here):
+    """Write the contents of update_SQL to an executable and return the path to
+    it.
+
+    """
+
+    mysql_update_script = os.path.join(here, mysql_update_script_name)
+    if os.path.exists(mysql_update_script):
+        os.remove(mysql_update_script)
+    with open(mysql_update_script, 'w') as f:
+        f.write(update_SQL)
+    os.chmod(mysql_update_script, 0744)
+    return mysql_update_script
+
+
+def perform_update(mysql_db_name, mysql_update_script, mysql_username, mysql_password, mysql_updater):
+    """Perform the preliminary update of the db by calling the executable at
+    ``mysql_update_script``.
+
+    """
+
+    print 'Running the MySQL update script ... '
+    mysql_script_content = '#!/bin/sh\nmysql -u %s -p%s %s < %s' % (
+        mysql_username, mysql_password, mysql_db_name, mysql_update_script)
+    with open(mysql_updater, 'w') as f:
+        f.write(mysql_script_content)
+    with open(os.devnull, 'w') as devnull:
+        subprocess.call([mysql_updater], shell=False, stdout=devnull,
+            stderr=devnull)
+    print 'done.'
+
+
+def compress_backups(mysql_db_name, mysql_username, mysql_password):
+    """Delta-encode the large text columns of the existing collection and
+    corpus backups, cf. ``onlinelinguisticdatabase/lib/history.py``.
+
+    """
+
+    try:
+        from onlinelinguisticdatabase.lib import history
+    except ImportError:
+        sys.path.insert(0, os.path.abspath(os.path.join(
+            os.path.dirname(os.path.realpath(__file__)), *['..'] * 4)))
+        from onlinelinguisticdatabase.lib import history
+    sqlalchemy_url = 'mysql://%s:%s@localhost:3306/%s' % (mysql_username,
+        mysql_password, mysql_db_name)
+    engine = create_engine(sqlalchemy_url)
+    meta = MetaData()
+    for table_name in sorted(history.delta_encoded_columns):
+        print 'Delta-encoding the %s table ... ' % table_name
+        table = Table(table_name, meta, autoload=True, autoload_with=engine)
+        count = history.compress_backups(table, engine)
+        print 'done (%d backups delta-encoded).' % count
+
+
+def parse_arguments(arg_list):
+    result = {}
+    map_ = {'-d': 'mysql_db_name', '-u': 'mysql_username', '-p': 'mysql_password'}
+    iterator = iter(arg_list)
+    try:
+        for element in iterator:
+            if element in map_:
+                result[map_[element]] = iterator.next()
+    except Exception:
+        pass
+    if len(set(['mysql_db_name', 'mysql_username', 'mysql_password']) &
+        set(result.keys())) != 3:
+        sys.exit('Usage: python old_update_db_2.0.0_2.1.0.py -d mysql_db_name'
+            ' -u mysql_username -p mysql_password')
+    return result
+
+
+def write_updater_executable(mysql_updater_name, here):
+    """Write to disk the shell script that will be used to load the various
+    MySQL scripts. Return the absolute path.
+
+    """
+
+    mysql_updater = os.path.join(here, mysql_updater_name)
+    with open(mysql_updater, 'w') as f:
+        pass
+    os.chmod(mysql_updater, 0744)
+    return mysql_updater
+
+
+if __name__ == '__main__':
+
+    # User must supply values for mysql_db_name, mysql_username and
+    # mysql_password.
+    arguments = parse_arguments(sys.argv[1:])
+    mysql_db_name = arguments.get('mysql_db_name')
+    mysql_username = arguments.get('mysql_username')
+    mysql_password = arguments.get('mysql_password')
+
+    here = os.path.dirname(os.path.realpath(__file__))
+
+    # The shell script that will be used multiple times to load the MySQL
+    # scripts below
+    mysql_updater_name = 'tmp.sh'
+    mysql_updater = write_updater_executable(mysql_updater_name, here)
+
+    # The executable that performs the update.
+    mysql_update_script_name = 'old_update_db_2.0.0_2.1.0.sql'
+    mysql_update_script = write_update_executable(mysql_update_script_name,
+        here)
+
+    # Perform the preliminary update of the database using ``mysql_update_script``
+    perform_update(mysql_db_name, mysql_update_script,
+        mysql_username, mysql_password, mysql_updater)
+
+    # Delta-encode the existing collection and corpus backups.
+    compress_backups(mysql_db_name, mysql_username, mysql_password)
+
+
@@ -15,9 +15,9 @@
 """File model"""
 
 from sqlalchemy import Column, Sequence, ForeignKey
-from sqlalchemy.types import Integer, Unicode, UnicodeText, Date, DateTime, Float
+from sqlalchemy.types import Integer, Unicode, UnicodeText, Date, DateTime, Float, Boolean
 from sqlalchemy.orm import relation
-from onlinelinguisticdatabase.model.meta import Base, now
+from onlinelinguisticdatabase.model.meta import Base, now, track_restricted_tag
 
 import logging
 log = logging.getLogger(__name__)
@@ -66,6 +66,8 @@ class File(Base):
     speaker = relation('Speaker')
     utterance_type = Column(Unicode(255))
     tags = relation('Tag', secondary=FileTag.__table__, backref='files')
+    # True if the model is tagged with the restricted tag; cf. meta.track_restricted_tag.
+    restricted = Column(Boolean, default=False, index=True)
 
     # Attributes germane to externally hosted files.
     url = Column(Unicode(255))          # for external files
@@ -78,6 +80,8 @@ class File(Base):
     end = Column(Float)
 
     lossy_filename = Column(Unicode(255))        # .ogg generated from .wav or resized images
+    lossy_status = Column(Unicode(40))           # one of resize.lossy_statuses; None if no reduced copy applies
+    checksum = Column(Unicode(64), index=True)   # SHA-256 of the file data; names its blob, cf. lib/blobstore.py
 
     def get_dict(self):
         """Return a Python dictionary representation of the File.  This
@@ -92,6 +96,8 @@ class File(Base):
             'filename': self.filename,
             'name': self.name,
             'lossy_filename': self.lossy_filename,
+            'lossy_status': self.lossy_status,
+            'checksum': self.checksum,
             'MIME_type': self.MIME_type,
             'size': self.size,
             'description': self.description,
@@ -107,3 +113,5 @@ class File(Base):
             'start': self.start,
             'end': self.end
         }
+
+track_restricted_tag(File.tags)
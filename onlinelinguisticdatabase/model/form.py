@@ -15,9 +15,9 @@
 """Form model"""
 
 from sqlalchemy import Column, Sequence, ForeignKey
-from sqlalchemy.types import Integer, Unicode, UnicodeText, Date, DateTime
+from sqlalchemy.types import Integer, Unicode, UnicodeText, Date, DateTime, Boolean
 from sqlalchemy.orm import relation
-from onlinelinguisticdatabase.model.meta import Base, now
+from onlinelinguisticdatabase.model.meta import Base, now, track_restricted_tag
 
 
 class FormFile(Base):
@@ -97,6 +97,8 @@ class Form(Base):
     files = relation('File', secondary=FormFile.__table__, backref='forms')
     collections = relation('Collection', secondary=CollectionForm.__table__, backref='forms')
     tags = relation('Tag', secondary=FormTag.__table__, backref='forms')
+    # True if the model is tagged with the restricted tag; cf. meta.track_restricted_tag.
+    restricted = Column(Boolean, default=False, index=True)
 
     def get_dict(self):
         """Return a Python dictionary representation of the Form.  This
@@ -168,3 +170,4 @@ class Form(Base):
                         morphemes.append((pos, (morpheme, gloss)))
         return pos_sequences, morphemes
 
+track_restricted_tag(Form.tags)
@@ -14,11 +14,45 @@
 
 """SQLAlchemy Metadata and Session object"""
 import datetime
+import random
+from sqlalchemy import event
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.orm.session import Session as SessionBase
+from sqlalchemy.sql.expression import UpdateBase
 from onlinelinguisticdatabase.model.model import Model
 
-__all__ = ['Base', 'Session', 'now']
+__all__ = ['Base', 'Session', 'now', 'track_restricted_tag']
+
+# The engines of the read replicas of the database.  Updated by
+# model.init_model()
+replica_engines = []
+
+class RoutingSession(SessionBase):
+    """A session that can send its reads to a read replica.
+
+    If ``use_replica`` is true (cf. ``lib/base.py``), the queries of the
+    session go to a randomly chosen replica in ``replica_engines``.  Flushes
+    and INSERT, UPDATE and DELETE statements always go to the primary engine,
+    i.e., the session's bind, and once the session has written all of its
+    queries do.  ``wrote`` tells whether the session has written.
+
+    """
+
+    def __init__(self, **kwargs):
+        SessionBase.__init__(self, **kwargs)
+        self.use_replica = False
+        self.replica = None
+        self.wrote = False
+
+    def get_bind(self, mapper=None, clause=None):
+        if self._flushing or isinstance(clause, UpdateBase):
+            self.wrote = True
+        elif self.use_replica and replica_engines and not self.wrote:
+            if self.replica is None:
+                self.replica = random.choice(replica_engines)
+            return self.replica
+        return SessionBase.get_bind(self, mapper, clause)
 
 # SQLAlchemy session manager. Updated by model.init_model()
 # Mar 18, 2014: I added expire_on_commit=False because I was getting 
@@ -27,10 +61,32 @@ __all__ = ['Base', 'Session', 'now']
 # Cf. http://stackoverflow.com/questions/3039567/sqlalchemy-detachedinstanceerror-with-regular-attribute-not-a-relation?rq=1
 # WARNING: expire_on_commit=False was causing issues with datetime objects variably having microsecond values ...
 #Session = scoped_session(sessionmaker(expire_on_commit=False))
-Session = scoped_session(sessionmaker())
+Session = scoped_session(sessionmaker(class_=RoutingSession))
 
 # The declarative Base.  It subclasses model.model.Model
 Base = declarative_base(cls=Model)
 
 def now():
     return datetime.datetime.utcnow()
+
+def track_restricted_tag(tags):
+    """Keep the ``restricted`` column of a model in sync with its ``tags`` relation.
+
+    The column denormalizes "is tagged with the restricted tag" so that access
+    filtering does not need an EXISTS subquery through the tag association
+    table.  It is updated whenever the restricted tag is added to or removed
+    from the model's tags.  (The restricted tag cannot be renamed or deleted
+    and no other tag can be renamed to it, cf. ``ValidTagName`` in
+    ``lib/schemata.py``.)
+
+    :param tags: an instrumented relation attribute, e.g., ``Form.tags``.
+
+    """
+    def append(target, value, initiator):
+        if value.name == u'restricted':
+            target.restricted = True
+    def remove(target, value, initiator):
+        if value.name == u'restricted':
+            target.restricted = False
+    event.listen(tags, 'append', append)
+    event.listen(tags, 'remove', remove)
@@ -32,7 +32,9 @@ class Model(object):
     # Maps names of tables to the sets of attributes required for mini-dict creation
     table_name2core_attributes = {
         'corpus': ['id', 'name'],
-        'corpusfile': ['id', 'filename', 'datetime_modified', 'format', 'restricted'],
+        'corpusfile': ['id', 'filename', 'datetime_modified', 'format', 'restricted',
+            'write_attempt', 'write_status', 'write_message', 'form_count', 'forms_written',
+            'checksum'],
         'elicitationmethod': ['id', 'name'],
         'file': ['id', 'name', 'filename', 'MIME_type', 'size', 'url', 'lossy_filename'],
         'formsearch': ['id', 'name'],
@@ -17,19 +17,23 @@
 import codecs
 import os
 import cPickle
-import random
+import time
 from sqlalchemy import Column, Sequence, ForeignKey
 from sqlalchemy.types import Integer, Unicode, UnicodeText, DateTime, Boolean, Float
 from sqlalchemy.orm import relation
 from onlinelinguisticdatabase.model.meta import Base, now
 from onlinelinguisticdatabase.lib.parser import LanguageModel
+from onlinelinguisticdatabase.lib.perplexity import evaluate_folds, \
+    mitlm_fold_perplexity, simplelm_fold_perplexity
+from onlinelinguisticdatabase.lib.tokenizedcorpus import tokenize_corpus
 import logging
 
 log = logging.getLogger(__name__)
 
 class MorphemeLanguageModel(LanguageModel, Base):
-    """The OLD currently uses the MITLM toolkit to build its language models. 
-    Support for CMU-Cambridge, SRILM, KenLM, etc. may be forthcoming...
+    """The OLD can build its language models using the MITLM toolkit or in-process
+    using the estimators of the vendored simplelm package.  Support for
+    CMU-Cambridge, SRILM, KenLM, etc. may be forthcoming...
 
     """
 
@@ -97,53 +101,26 @@ class MorphemeLanguageModel(LanguageModel, Base):
             'rare_delimiter': self.rare_delimiter
         }
 
-    def write_corpus(self):
+    def write_corpus(self, tokenized_corpus=None):
         """Write a word corpus text file using the LM's corpus where each line is a word.
 
         If the LM is categorial, the word is represented as a space-delimited list of category names
         corresponding to the categories of the morphemes of the word; otherwise, it is represented as 
         a space-delimited list of morphemes in form|gloss|category format.
 
+        :param tokenized_corpus: the LM's corpus as a ``TokenizedCorpus`` instance; if not supplied,
+            it is tokenized from the corpus's forms.  Cf. lib/tokenizedcorpus.py.
         :returns: the path to the LM corpus file just written.
         :side effects: if the LM's corpus contains restricted forms, set the ``restricted`` attribute 
             to ``True``.  This will prevent restricted users from accessing the source files.
 
         """
         corpus_path = self.get_file_path('corpus')
-        corpus = self.corpus
-        forms = corpus.forms
-        restricted = False
+        tokenized_corpus = tokenized_corpus or self.tokenize_corpus()
         with codecs.open(corpus_path, mode='w', encoding='utf8') as f:
-            if corpus.form_search:
-                for form in forms:
-                    if form.syntactic_category_string:
-                        if not restricted and "restricted" in [t.name for t in form.tags]:
-                            restricted = True
-                        if self.categorial:
-                            for category_word in form.syntactic_category_string.split():
-                                f.write(self._get_categorial_corpus_entry(category_word))
-                        else:
-                            for morpheme_word, gloss_word, category_word in zip(form.morpheme_break.split(),
-                                form.morpheme_gloss.split(), form.syntactic_category_string.split()):
-                                f.write(self._get_morphemic_corpus_entry(
-                                    morpheme_word, gloss_word, category_word))
-            else:
-                form_references = corpus.get_form_references(corpus.content)
-                forms = dict((f.id, f) for f in forms)
-                for id in form_references:
-                    form = forms[id]
-                    if form.syntactic_category_string:
-                        if not restricted and "restricted" in [t.name for t in form.tags]:
-                            restricted = True
-                        if self.categorial:
-                            for category_word in form.syntactic_category_string.split():
-                                f.write(self._get_categorial_corpus_entry(category_word))
-                        else:
-                            for morpheme_word, gloss_word, category_word in zip(form.morpheme_break.split(),
-                                form.morpheme_gloss.split(), form.syntactic_category_string.split()):
-                                f.write(self._get_morphemic_corpus_entry(
-                                    morpheme_word, gloss_word, category_word))
-        if restricted:
+            for entry in self.get_corpus_entries(tokenized_corpus):
+                f.write(u'%s\n' % entry)
+        if tokenized_corpus.restricted:
             self.restricted = True
         return corpus_path
 
@@ -182,145 +159,84 @@ class MorphemeLanguageModel(LanguageModel, Base):
         return vocabulary_path
 
     def compute_perplexity(self, timeout, iterations):
-        """Compute the perplexity of a the language model.
+        """Compute the perplexity of the language model.
 
-        The method used is to create ``iterations`` training/test set pairs, compute the perplexity
-        of each test set based on an LM generated from its training set and return the average
-        perplexity value.
+        :returns: the mean perplexity of ``iterations``-fold cross-validation or ``None``.
+            See ``evaluate_perplexity``.
 
         """
+        return self.evaluate_perplexity(timeout, folds=iterations)['perplexity']
 
-        perplexities = []
-        temp_paths = [] # will hold the paths to all the temporary files that we delete below.
-        if self.toolkit == 'mitlm':
-            for index in range(1, iterations + 1):
-                training_set_path, test_set_path, training_set_lm_path = \
-                    self.write_training_test_sets(index)
-                temp_paths += [training_set_path, test_set_path, training_set_lm_path]
-                order = str(self.order)
-                smoothing = self.smoothing or 'ModKN'
-                cmd = [self.executable, '-o', order, '-s', smoothing, '-t', training_set_path,
-                    '-wl', training_set_lm_path, '-eval-perp', test_set_path]
-                if self.vocabulary_morphology:
-                    vocabulary_path = self.get_file_path('vocabulary')
-                    if not os.path.isfile(vocabulary_path):
-                        return None
-                    cmd += ['-v', vocabulary_path]
-                try:
-                    returncode, output = self.run(cmd, timeout)
-                    if returncode == 0 and os.path.isfile(training_set_lm_path):
-                        perplexities.append(self.extract_perplexity(output))
-                except Exception:
-                    pass
-        else:
-            return None
-        for path in temp_paths:
-            try:
-                os.remove(path)
-            except Exception:
-                pass
-        perplexities = filter(None, perplexities)
-        if perplexities:
-            return sum(perplexities) / len(perplexities)
-        else:
-            return None
+    def evaluate_perplexity(self, timeout, folds=5, seed=0, threads=None, tokenized_corpus=None):
+        """Evaluate the language model using k-fold cross-validation.
 
-    def extract_perplexity(self, output):
-        """Extract the perplexity value from the output of MITLM.
-        """
-        try:
-            last_line = output.splitlines()[-1]
-            return float(last_line.split()[-1])
-        except Exception:
-            return None
+        The words of the LM's corpus are divided into ``folds`` disjoint folds
+        (the division is determined by ``seed``); for each fold, an LM with this
+        LM's settings is generated from the other folds and the perplexity of
+        the held-out fold is computed.  The folds are evaluated concurrently by
+        a thread pool.  See lib/perplexity.py.
 
-    def _get_morphemic_corpus_entry(self, morpheme_word, gloss_word, category_word):
-        """Return a string of morphemes, space-delimited in m|g|c format where "|" is ``self.rare_delimiter``.
+        :param int/float timeout: seconds to allow for each MITLM fold estimation;
+            ignored by the in-process simplelm toolkit.
+        :param tokenized_corpus: the LM's corpus as a ``TokenizedCorpus`` instance; optional.
+        :returns: a dict with the mean (``'perplexity'``) and per-fold perplexities
+            and timings; the mean is ``None`` if the perplexity could not be computed.
 
         """
-        return '%s\n' % u' '.join(self.rare_delimiter.join([morpheme, gloss, category])
-            for morpheme, gloss, category in
-            zip(self.morpheme_only_splitter(morpheme_word),
-                self.morpheme_only_splitter(gloss_word),
-                self.morpheme_only_splitter(category_word)))
+        if self.toolkit == 'mitlm':
+            fold_evaluator = mitlm_fold_perplexity
+            command = [self.executable, '-o', str(self.order), '-s', self.smoothing or 'ModKN']
+            if self.vocabulary_morphology:
+                if not self.vocabulary:
+                    return {'perplexity': None}
+                command += ['-v', self.get_file_path('vocabulary')]
+            options = {'path_prefix': self.directory, 'command': command, 'timeout': timeout}
+        elif self.toolkit == 'simplelm':
+            fold_evaluator = simplelm_fold_perplexity
+            if self.vocabulary_morphology and not self.vocabulary:
+                return {'perplexity': None}
+            options = {'order': self.order, 'smoothing': self.smoothing or 'ModKN',
+                       'sb': self.start_symbol, 'se': self.end_symbol,
+                       'vocabulary': self.read_vocabulary()}
+        else:
+            return {'perplexity': None}
+        start = time.time()
+        corpus = list(self.get_corpus_words(tokenized_corpus))
+        corpus_seconds = time.time() - start
+        evaluation = evaluate_folds(corpus, fold_evaluator, options, k=folds, seed=seed,
+                                    threads=threads)
+        evaluation['timings']['corpus'] = corpus_seconds
+        return evaluation
+
+    def tokenize_corpus(self):
+        """Return the LM's corpus as an (uncached) ``TokenizedCorpus`` instance."""
+        return tokenize_corpus(self.corpus, self.morpheme_splitter, self.delimiters)
+
+    def get_corpus_entries(self, tokenized_corpus):
+        """Yield the entry, i.e., line, of the corpus file for each word of ``tokenized_corpus``.
 
-    def _get_categorial_corpus_entry(self, category_word):
-        """Return a string of morpheme category names, space-delimited.
+        An entry is a string of morphemes, space-delimited in m|g|c format where "|" is
+        ``self.rare_delimiter``, or, if the LM is categorial, a string of category names.
 
         """
-        return u'%s\n' % u' '.join(self.morpheme_only_splitter(category_word))
+        rare_delimiter = self.rare_delimiter
+        for restricted, category_words, morpheme_words, gloss_words in tokenized_corpus.get_forms():
+            if self.categorial:
+                for category_word in category_words:
+                    yield u' '.join(category_word[::2])
+            else:
+                for morpheme_word, gloss_word, category_word in zip(
+                        morpheme_words, gloss_words, category_words):
+                    yield u' '.join(rare_delimiter.join(morpheme) for morpheme in
+                        zip(morpheme_word[::2], gloss_word[::2], category_word[::2]))
 
-    def write_training_test_sets(self, index):
-        """Divide the words implicit in the LM's corpus into randomly sampled training and test sets and write them to disk with the suffix ``i``.
-        Use the toolkit of the morpheme language model to generate an ARPA-formatted LM for the training set.
+    def get_corpus_words(self, tokenized_corpus=None):
+        """Yield each word of the LM's corpus as a list of morphemes (or categories).
 
-        :param instance morpheme_language_model: a LM model object.
-        :param str morpheme_language_model_path: absolute path to the LM's directory.
-        :param int i: index used in naming the test and training sets.
-        :returns: a triple of strings: the absolute paths to the training and test sets and
-        the path to the training set's ARPA-formatted LM.
+        The words are the same as the non-empty lines written by ``write_corpus``.
 
         """
-        directory = self.directory
-        test_set_path = '%s_test_%s.txt' % (directory, index)
-        training_set_path = '%s_training_%s.txt' % (directory, index)
-        training_set_lm_path = '%s_training_%s.lm' % (directory, index)
-        corpus = self.corpus
-        forms = corpus.forms
-        population = range(1, 11)
-        test_index = random.choice(population)
-        with codecs.open(training_set_path, mode='w', encoding='utf8') as f_training:
-            with codecs.open(test_set_path, mode='w', encoding='utf8') as f_test:
-                if corpus.form_search:
-                    for form in forms:
-                        if form.syntactic_category_string:
-                            if self.categorial:
-                                for category_word in form.syntactic_category_string.split():
-                                    r = random.choice(population)
-                                    if r == test_index:
-                                        f_test.write(self._get_categorial_corpus_entry(
-                                            category_word))
-                                    else:
-                                        f_training.write(self._get_categorial_corpus_entry(
-                                            category_word))
-                            else:
-                                for morpheme_word, gloss_word, category_word in zip(
-                                    form.morpheme_break.split(),
-                                    form.morpheme_gloss.split(),
-                                    form.syntactic_category_string.split()):
-                                    r = random.choice(population)
-                                    if r == test_index:
-                                        f_test.write(self._get_morphemic_corpus_entry(
-                                            morpheme_word, gloss_word, category_word))
-                                    else:
-                                        f_training.write(self._get_morphemic_corpus_entry(
-                                            morpheme_word, gloss_word, category_word))
-                else:
-                    form_references = corpus.get_form_references(corpus.content)
-                    forms = dict((f.id, f) for f in forms)
-                    for id in form_references:
-                        form = forms[id]
-                        if form.syntactic_category_string:
-                            if self.categorial:
-                                for category_word in form.syntactic_category_string.split():
-                                    r = random.choice(population)
-                                    if r == test_index:
-                                        f_test.write(self._get_categorial_corpus_entry(
-                                            category_word))
-                                    else:
-                                        f_training.write(self._get_categorial_corpus_entry(
-                                            category_word))
-                            else:
-                                for morpheme_word, gloss_word, category_word in zip(
-                                    form.morpheme_break.split(),
-                                    form.morpheme_gloss.split(),
-                                    form.syntactic_category_string.split()):
-                                    r = random.choice(population)
-                                    if r == test_index:
-                                        f_test.write(self._get_morphemic_corpus_entry(
-                                            morpheme_word, gloss_word, category_word))
-                                    else:
-                                        f_training.write(self._get_morphemic_corpus_entry(
-                                            morpheme_word, gloss_word, category_word))
-        return training_set_path, test_set_path, training_set_lm_path
-
+        for entry in self.get_corpus_entries(tokenized_corpus or self.tokenize_corpus()):
+            words = entry.split()
+            if words:
+                yield words
@@ -36,7 +36,7 @@ parser has a one-to-many collection in ``self.parses``.  However, interaction
 with the parser's cache is mediated via a ``Cache`` instance (see below) that
 provides a standardized interface to cached parses (i.e., self.cache[k],
 self.cache[k] = v, self.cache.get(k, default), self.cache.update() and
-self.cache.clear()), cf. ``lib/parser.py`` for a pickle-based Cache class.
+self.cache.clear()), cf. ``lib/parser.py`` for an SQLite-based Cache class.
 
 The following attributes are those crucial to parsing functionality. (Note
 that the files that are crucial to a parser's parsing functionality are
@@ -106,6 +106,7 @@ from hashlib import md5
 from sqlalchemy import Column, Sequence, ForeignKey
 from sqlalchemy.types import Integer, Unicode, UnicodeText, DateTime, Boolean
 from sqlalchemy.orm import relation
+from sqlalchemy.sql import func
 from onlinelinguisticdatabase.model.meta import Base, now, Session
 from onlinelinguisticdatabase.lib.parser import MorphologicalParser, LanguageModel, MorphologyFST, PhonologyFST
 from shutil import copyfile
@@ -584,3 +585,25 @@ class Cache(object):
         self._store.update(persisted)
         return self._store
 
+def get_parse_count(parser_id):
+    """Return the number of parses cached by the parser with ``parser_id``."""
+    return Session.query(func.count(Parse.id)).filter(Parse.parser_id==parser_id).scalar()
+
+def get_parse_pages(parser_id, page_size=1000):
+    """Generate the parses cached by the parser with ``parser_id`` as dicts of
+    at most ``page_size`` parses.
+
+    Unlike ``Cache.export``, this never holds the entire cache in memory: rows
+    are fetched a page at a time (keyed on ``id``) as the generator is consumed.
+
+    """
+    last_id = 0
+    while True:
+        rows = Session.query(Parse.id, Parse.transcription, Parse.parse, Parse.candidates).\
+            filter(Parse.parser_id==parser_id).filter(Parse.id > last_id).\
+            order_by(Parse.id).limit(page_size).all()
+        if not rows:
+            break
+        yield dict((row.transcription, (row.parse, json.loads(row.candidates)))
+                   for row in rows)
+        last_id = rows[-1].id
@@ -23,6 +23,7 @@ from sqlalchemy.types import Integer, Unicode, UnicodeText, DateTime, Boolean
 from sqlalchemy.orm import relation
 from onlinelinguisticdatabase.model.meta import Base, now
 from onlinelinguisticdatabase.lib.parser import MorphologyFST
+from onlinelinguisticdatabase.lib.tokenizedcorpus import tokenize_corpus
 import logging
 
 log = logging.getLogger(__name__)
@@ -92,17 +93,19 @@ class Morphology(MorphologyFST, Base):
             'include_unknowns': self.include_unknowns
         }
 
-    def generate_rules_and_lexicon(self):
+    def generate_rules_and_lexicon(self, tokenized_corpora=None):
         try:
-            return self._generate_rules_and_lexicon()
+            return self._generate_rules_and_lexicon(tokenized_corpora)
         except Exception, e:
             log.warn('GOT EXCEPTION TRYING TO GENERATE RULES AND LEXICON')
             log.warn(e)
             return [], {}
 
-    def _generate_rules_and_lexicon(self):
+    def _generate_rules_and_lexicon(self, tokenized_corpora=None):
         """Generate morphotactic rules and a lexicon for this morphology based on its corpora.
 
+        :param dict tokenized_corpora: maps corpus ids to ``TokenizedCorpus`` instances;
+            corpora not in it are tokenized from their forms.  Cf. lib/tokenizedcorpus.py.
         :returns: 2-tuple: <rules, morphemes>
 
         """
@@ -114,10 +117,9 @@ class Morphology(MorphologyFST, Base):
         if (self.lexicon_corpus and
             (not self.rules_corpus or
             self.lexicon_corpus.id != self.rules_corpus.id)):
-            for form in self.lexicon_corpus.forms:
-                new_morphemes = self._extract_morphemes_from_form(form, morpheme_splitter)
-                for pos, data in new_morphemes:
-                    morphemes.setdefault(pos, set()).add(data)
+            tokenized_corpus = self.get_tokenized_corpus(self.lexicon_corpus, tokenized_corpora)
+            for pos, data in self._extract_morphemes(tokenized_corpus):
+                morphemes.setdefault(pos, set()).add(data)
         # Get the pos sequences (and morphemes) from the user-specified ``rules`` string value or else from the 
         # words in the rules corpus.
         pos_sequences = set()
@@ -126,40 +128,55 @@ class Morphology(MorphologyFST, Base):
                 pos_sequence = tuple(morpheme_splitter(pos_sequence_string))
                 pos_sequences.add(pos_sequence)
         else:
-            for form in self.rules_corpus.forms:
-                new_pos_sequences, new_morphemes = form.extract_word_pos_sequences(
-                    self.unknown_category, morpheme_splitter,
-                    self.extract_morphemes_from_rules_corpus)
-                if new_pos_sequences:
-                    pos_sequences |= new_pos_sequences
-                    for pos, data in new_morphemes:
-                        morphemes.setdefault(pos, set()).add(data)
+            tokenized_corpus = self.get_tokenized_corpus(self.rules_corpus, tokenized_corpora)
+            new_pos_sequences, new_morphemes = self._extract_pos_sequences(
+                tokenized_corpus, self.extract_morphemes_from_rules_corpus)
+            pos_sequences |= new_pos_sequences
+            for pos, data in new_morphemes:
+                morphemes.setdefault(pos, set()).add(data)
         pos_sequences = self._filter_invalid_sequences(pos_sequences, morphemes)
         # sort and delistify the rules and lexicon
         pos_sequences = sorted(pos_sequences)
         morphemes = dict([(pos, sorted(data)) for pos, data in morphemes.iteritems()])
         return pos_sequences, morphemes
 
-    def _extract_morphemes_from_form(self, form, morpheme_splitter):
-        """Return the morphemes in ``form`` as a list of tuples of the form (pos, (mb, mg)).
+    def get_tokenized_corpus(self, corpus, tokenized_corpora=None):
+        """Return ``corpus`` as a ``TokenizedCorpus``, from ``tokenized_corpora`` if it is there."""
+        tokenized_corpus = (tokenized_corpora or {}).get(corpus.id)
+        return tokenized_corpus or tokenize_corpus(corpus, self.morpheme_splitter, self.delimiters)
+
+    def _extract_morphemes(self, tokenized_corpus):
+        """Return the morphemes in ``tokenized_corpus`` as a list of tuples of the form (pos, (mb, mg)).
 
         """
 
         morphemes = []
-        if not form.syntactic_category_string:
-            return morphemes
-        sc_words = form.syntactic_category_string.split()
-        mb_words = form.morpheme_break.split()
-        mg_words = form.morpheme_gloss.split()
-        for sc_word, mb_word, mg_word in zip(sc_words, mb_words, mg_words):
-            pos_sequence = morpheme_splitter(sc_word)[::2]
-            morpheme_sequence = morpheme_splitter(mb_word)[::2]
-            gloss_sequence = morpheme_splitter(mg_word)[::2]
-            for pos, morpheme, gloss in zip(pos_sequence, morpheme_sequence, gloss_sequence):
-                if pos != self.unknown_category:
-                    morphemes.append((pos, (morpheme, gloss)))
+        for restricted, sc_words, mb_words, mg_words in tokenized_corpus.get_forms(unique=True):
+            for sc_word, mb_word, mg_word in zip(sc_words, mb_words, mg_words):
+                for pos, morpheme, gloss in zip(sc_word[::2], mb_word[::2], mg_word[::2]):
+                    if pos != self.unknown_category:
+                        morphemes.append((pos, (morpheme, gloss)))
         return morphemes
 
+    def _extract_pos_sequences(self, tokenized_corpus, extract_morphemes=False):
+        """Return the unique word-based pos sequences, as well as (possibly) the morphemes, implicit in ``tokenized_corpus``.
+
+        Cf. ``Form.extract_word_pos_sequences``.
+
+        :returns: 2-tuple: (set of pos/delimiter sequences, list of morphemes as (pos, (mb, mg)) tuples).
+
+        """
+        pos_sequences = set()
+        morphemes = []
+        for restricted, sc_words, mb_words, mg_words in tokenized_corpus.get_forms(unique=True):
+            for pos_sequence, mb_word, mg_word in zip(sc_words, mb_words, mg_words):
+                if self.unknown_category not in pos_sequence:
+                    pos_sequences.add(pos_sequence)
+                    if extract_morphemes:
+                        for pos, morpheme, gloss in zip(pos_sequence[::2], mb_word[::2], mg_word[::2]):
+                            morphemes.append((pos, (morpheme, gloss)))
+        return pos_sequences, morphemes
+
     def _filter_invalid_sequences(self, pos_sequences, morphemes):
         """Remove category sequences from pos_sequences if they contain categories not listed as 
         keys of the morphemes dict or if they contain delimiters not listed in self.delimiters.
@@ -195,12 +212,14 @@ class Morphology(MorphologyFST, Base):
                 dictionary.setdefault(form, []).append((gloss, category))
         return dictionary
 
-    def write(self, unknown_category):
+    def write(self, unknown_category, tokenized_corpora=None):
         """Write the files of the morphology (script, compiler, lexicon,
         dictionary) to disk.
 
         :param unicode unknown_category: what the system uses to mark morphemes
             without categories.
+        :param dict tokenized_corpora: maps corpus ids to ``TokenizedCorpus``
+            instances of the morphology's corpora; optional.
         :returns: None; side-effects: generates data structures, writes them to
             disk, specifies values of the morphology object.
 
@@ -213,7 +232,7 @@ class Morphology(MorphologyFST, Base):
         """
 
         self.unknown_category = unknown_category
-        rules, lexicon = self.generate_rules_and_lexicon()
+        rules, lexicon = self.generate_rules_and_lexicon(tokenized_corpora)
         self.rules_generated = u' '.join(map(u''.join, rules))
         cPickle.dump(lexicon, open(self.get_file_path('lexicon'), 'wb'))
         if not self.rich_upper:
@@ -73,6 +73,8 @@ class TestController(TestCase):
         self.here = config['here']
         self.files_path = h.get_OLD_directory_path('files', config=config)
         self.reduced_files_path = h.get_OLD_directory_path('reduced_files', config=config)
+        self.uploads_path = h.get_OLD_directory_path('uploads', config=config)
+        self.blobs_path = h.get_OLD_directory_path('blobs', config=config)
         self.test_files_path = os.path.join(self.here, 'onlinelinguisticdatabase', 'tests',
                              'data', 'files')
         self.create_reduced_size_file_copies = asbool(config.get(
@@ -19,6 +19,7 @@ from onlinelinguisticdatabase.tests import TestController, url
 import onlinelinguisticdatabase.model as model
 from onlinelinguisticdatabase.model.meta import Session
 import onlinelinguisticdatabase.lib.helpers as h
+import onlinelinguisticdatabase.lib.history as history
 from onlinelinguisticdatabase.lib.SQLAQueryBuilder import SQLAQueryBuilder
 
 log = logging.getLogger(__name__)
@@ -315,3 +316,114 @@ class TestCollectionbackupsController(TestController):
                                 extra_environ=self.extra_environ_view)
         resp = json.loads(response.body)
         assert resp['search_parameters'] == h.get_search_parameters(query_builder)
+
+    @nottest
+    def test_delta_encoded_history(self):
+        """Tests that collection backups are delta-encoded and restored correctly."""
+
+        application_settings = h.generate_default_application_settings()
+        Session.add(application_settings)
+        Session.commit()
+        admin = {'test.authentication.role': u'administrator', 'test.application_settings': True}
+
+        # Create a collection with long contents and make a small change to it
+        # many times.
+        lines = [u'Line %d of a long collection of lorem ipsum text.' % i
+                 for i in range(200)]
+        params = self.collection_create_params.copy()
+        params.update({'title': u'Version 0', 'contents': u'\n'.join(lines)})
+        response = self.app.post(url('collections'), json.dumps(params),
+                                 self.json_headers, admin)
+        collection_id = json.loads(response.body)['id']
+        versions = [params['contents']]
+        for i in range(1, 15):
+            lines[i * 10] = u'Line %d was changed in version %d.' % (i * 10, i)
+            params.update({'title': u'Version %d' % i, 'contents': u'\n'.join(lines)})
+            self.app.put(url('collection', id=collection_id), json.dumps(params),
+                         self.json_headers, admin)
+            versions.append(params['contents'])
+
+        # Most backups store only a delta; the others are snapshots.
+        backups = Session.query(model.CollectionBackup).order_by(
+            model.CollectionBackup.id).all()
+        assert len(backups) == 14
+        deltas = [b for b in backups if b.snapshot is False]
+        snapshots = [b for b in backups if b.snapshot]
+        assert len(deltas) == 12
+        assert len(snapshots) == 2
+        assert backups[0].snapshot and backups[10].snapshot
+        assert not [b for b in deltas if b.contents is not None or b.html is not None]
+
+        # The history returns the full contents of every previous version.
+        response = self.app.get(
+            url(controller='oldcollections', action='history', id=collection_id),
+            headers=self.json_headers, extra_environ=admin)
+        resp = json.loads(response.body)
+        assert resp['collection']['contents'] == versions[-1]
+        assert len(resp['previous_versions']) == 14
+        for previous_version in resp['previous_versions']:
+            version = int(previous_version['title'].split()[1])
+            assert previous_version['contents'] == versions[version]
+            assert u'Line 199 of a long' in previous_version['html']
+        assert 'paginator' not in resp
+
+        # The history can be paginated.
+        response = self.app.get(
+            url(controller='oldcollections', action='history', id=collection_id),
+            {'page': 2, 'items_per_page': 5}, headers=self.json_headers,
+            extra_environ=admin)
+        resp = json.loads(response.body)
+        assert resp['paginator']['count'] == 14
+        assert [pv['title'] for pv in resp['previous_versions']] == \
+            [u'Version %d' % i for i in range(8, 3, -1)]
+        assert [pv['contents'] for pv in resp['previous_versions']] == \
+            [versions[i] for i in range(8, 3, -1)]
+        response = self.app.get(
+            url(controller='oldcollections', action='history', id=collection_id),
+            {'page': 0, 'items_per_page': 5}, headers=self.json_headers,
+            extra_environ=admin, status=400)
+        assert json.loads(response.body)['errors']['page'] == \
+            u'Please enter a number that is 1 or greater'
+
+        # Collection backups requests restore the contents too.
+        response = self.app.get(url('collectionbackup', id=backups[5].id),
+                                headers=self.json_headers, extra_environ=admin)
+        assert json.loads(response.body)['contents'] == versions[5]
+        response = self.app.get(url('collectionbackups'),
+                                {'page': 1, 'items_per_page': 3},
+                                headers=self.json_headers, extra_environ=admin)
+        resp = json.loads(response.body)
+        assert [cb['contents'] for cb in resp['items']] == versions[:3]
+
+        # Backups encoded concurrently against the same chain head restore to
+        # their own contents: each delta is against the snapshot that it names.
+        table = model.CollectionBackup.__table__
+        columns = history.delta_encoded_columns[table.name]
+        head = history.get_chain_head(table, backups[0].UUID, columns, Session)
+        concurrent_versions = []
+        for i in range(2):
+            lines[5 + i] = u'Line %d was changed concurrently.' % (5 + i)
+            row = {'UUID': backups[0].UUID, 'title': u'Concurrent %d' % i,
+                   'contents': u'\n'.join(lines), 'html': u'html'}
+            history.encode_backup_row(row, head, columns)
+            assert row['snapshot'] is False
+            Session.execute(table.insert(), row)
+            concurrent_versions.append(u'\n'.join(lines))
+        Session.commit()
+        concurrent_backups = h.restore_backups(
+            Session.query(model.CollectionBackup).filter(
+            model.CollectionBackup.title.like(u'Concurrent %')).order_by(
+            model.CollectionBackup.id).all())
+        assert [b.contents for b in concurrent_backups] == concurrent_versions
+
+        # Searches on the delta-encoded columns are rejected since the values
+        # of the deltas are not in the database.
+        self._add_SEARCH_to_web_test_valid_methods()
+        for attribute in (u'contents', u'html'):
+            json_query = json.dumps({'query': {'filter':
+                            ['CollectionBackup', attribute, 'like', u'%Line 199%']}})
+            response = self.app.request(url('collectionbackups'), method='SEARCH',
+                body=json_query, headers=self.json_headers, environ=admin, status=400)
+            resp = json.loads(response.body)
+            assert resp['errors']['CollectionBackup.%s' % attribute].startswith(
+                u'Searching on CollectionBackup.%s is not permitted because' % attribute)
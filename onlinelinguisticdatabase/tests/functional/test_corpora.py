@@ -34,6 +34,24 @@ class TestCorporaController(TestController):
     def tearDown(self):
         TestController.tearDown(self, dirs_to_destroy=['user', 'corpus'])
 
+    def write_to_file(self, corpus_id, params):
+        """Request ``PUT /corpora/id/writetofile`` and wait for the corpus file writer to finish.
+
+        :returns: the JSON representation of the corpus once the write has terminated.
+
+        """
+        self.app.put(url('/corpora/%d/writetofile' % corpus_id), params,
+            headers=self.json_headers, extra_environ=self.extra_environ_admin)
+        while True:
+            response = self.app.get(url('corpus', id=corpus_id),
+                headers=self.json_headers, extra_environ=self.extra_environ_admin)
+            resp = json.loads(response.body)
+            if [cf for cf in resp['files']
+                if cf['write_status'] in (u'queued', u'writing', u'indexing')]:
+                sleep(1)
+            else:
+                return resp
+
     @nottest
     def test_index(self):
         """Tests that GET /corpora returns an array of all corpora and that order_by and pagination parameters work correctly."""
@@ -1062,3 +1080,119 @@ class TestCorporaController(TestController):
             headers=self.json_headers, extra_environ=extra_environ)
         by_corpus_id_resp = json.loads(response.body)
         assert by_corpus_id_resp == by_UUID_resp
+
+    @nottest
+    def test_tgrep2_restricted(self):
+        """Tests that SEARCH /corpora/id/tgrep2 excludes the forms that the user
+        is not authorized to access, even if they were restricted after the
+        corpus was written to file.
+
+        """
+        forms = []
+        for index in range(1, 6):
+            form = model.Form()
+            form.transcription = u'Form %d' % index
+            form.syntax = u'(S (NP-SBJ (DT the) (NN dog%d)) (VP (VBD barked)))' % index
+            translation = model.Translation()
+            translation.transcription = u'Translation %d' % index
+            form.translation = translation
+            forms.append(form)
+        Session.add_all(forms)
+        Session.commit()
+        form_ids = sorted([form.id for form in forms])
+
+        params = self.corpus_create_params.copy()
+        params.update({
+            'name': u'Treebank corpus',
+            'content': u','.join(map(str, form_ids))
+        })
+        response = self.app.post(url('corpora'), json.dumps(params),
+            self.json_headers, self.extra_environ_admin)
+        corpus_id = json.loads(response.body)['id']
+
+        # Write the corpus to file as a treebank and wait for the writer.
+        self.write_to_file(corpus_id, json.dumps({'format': 'treebank'}))
+
+        # Restrict a form only now, i.e., after the corpus file was written.
+        restricted_tag = h.generate_restricted_tag()
+        Session.add(restricted_tag)
+        restricted_form = Session.query(model.Form).get(form_ids[0])
+        restricted_form.tags.append(restricted_tag)
+        Session.commit()
+
+        query = {'tgrep2pattern': u'S < NP-SBJ'}
+        paginated_query = {'tgrep2pattern': u'S < NP-SBJ',
+                           'paginator': {'page': 1, 'items_per_page': 2}}
+
+        # The administrator gets all of the matches.
+        response = self.app.request(url(controller='corpora', action='tgrep2', id=corpus_id),
+                method='SEARCH', body=json.dumps(query), headers=self.json_headers,
+                environ=self.extra_environ_admin)
+        resp = json.loads(response.body)
+        assert [f['id'] for f in resp] == form_ids
+
+        # The viewer does not get the restricted form ...
+        response = self.app.request(url(controller='corpora', action='tgrep2', id=corpus_id),
+                method='SEARCH', body=json.dumps(query), headers=self.json_headers,
+                environ=self.extra_environ_view)
+        resp = json.loads(response.body)
+        assert [f['id'] for f in resp] == form_ids[1:]
+
+        # ... not even on the pages of a paginated search.
+        response = self.app.request(url(controller='corpora', action='tgrep2', id=corpus_id),
+                method='SEARCH', body=json.dumps(paginated_query),
+                headers=self.json_headers, environ=self.extra_environ_view)
+        resp = json.loads(response.body)
+        assert resp['paginator']['count'] == 4
+        assert [f['id'] for f in resp['items']] == form_ids[1:3]
+
+    @nottest
+    def test_writetofile_manifest(self):
+        """Tests that a corpus file that does not match its manifest, e.g., because
+        a write was interrupted, is re-written from scratch.
+
+        """
+        forms = []
+        for index in range(1, 6):
+            form = model.Form()
+            form.transcription = u'Form %d' % index
+            form.syntax = u'(S (NP-SBJ (DT the) (NN dog%d)) (VP (VBD barked)))' % index
+            translation = model.Translation()
+            translation.transcription = u'Translation %d' % index
+            form.translation = translation
+            forms.append(form)
+        Session.add_all(forms)
+        Session.commit()
+        form_ids = sorted([form.id for form in forms])
+
+        params = self.corpus_create_params.copy()
+        params.update({
+            'name': u'Treebank corpus',
+            'content': u','.join(map(str, form_ids))
+        })
+        response = self.app.post(url('corpora'), json.dumps(params),
+            self.json_headers, self.extra_environ_admin)
+        corpus_id = json.loads(response.body)['id']
+        corpus_file_path = os.path.join(self.corpora_path, 'corpus_%d' % corpus_id,
+                                        'corpus_%d.tbk' % corpus_id)
+        params = json.dumps({'format': 'treebank'})
+
+        resp = self.write_to_file(corpus_id, params)
+        assert resp['files'][0]['write_status'] == u'complete'
+        corpus_file_content = open(corpus_file_path, 'rb').read()
+        checksum = resp['files'][0]['checksum']
+        assert os.path.isfile(h.CorpusFileManifest.get_path(corpus_file_path))
+
+        # An unchanged corpus is left untouched.
+        resp = self.write_to_file(corpus_id, params)
+        assert resp['files'][0]['write_message'].endswith(u'is already up to date.')
+
+        # Replace the corpus file with one that its manifest does not describe.
+        with open(corpus_file_path, 'wb') as f:
+            f.write(corpus_file_content.replace('dog', 'cat'))
+        assert h.CorpusFileManifest.load(corpus_file_path).entries == []
+        resp = self.write_to_file(corpus_id, params)
+        assert resp['files'][0]['write_message'].endswith(u'successfully written to file with format "treebank".')
+        assert resp['files'][0]['checksum'] == checksum
+        assert open(corpus_file_path, 'rb').read() == corpus_file_content
+        assert len(h.CorpusFileManifest.load(corpus_file_path).entries) == 5
@@ -35,6 +35,23 @@ class TestCorporaLargeController(TestController):
     def tearDown(self):
         pass
 
+    def write_to_file(self, corpus_id, params):
+        """Request ``PUT /corpora/id/writetofile`` and wait for the corpus file writer to finish.
+
+        :returns: the response to ``GET /corpora/id`` once the write has terminated.
+
+        """
+        response = self.app.put(url('/corpora/%d/writetofile' % corpus_id), params,
+            headers=self.json_headers, extra_environ=self.extra_environ_admin)
+        while True:
+            response = self.app.get(url('corpus', id=corpus_id),
+                headers=self.json_headers, extra_environ=self.extra_environ_admin)
+            resp = json.loads(response.body)
+            if [cf for cf in resp['files'] if cf['write_status'] in (u'queued', u'writing', u'indexing')]:
+                sleep(1)
+            else:
+                return response
+
     @nottest
     def test_aaa_initialize(self):
         """Initialize the database using pseudo-data generated from random lorem ipsum sentences.
@@ -343,19 +360,16 @@ class TestCorporaLargeController(TestController):
         # Try to TGrep2-search the corpus without first writing it to file
         # and expect to fail.
         tgrep2pattern = json.dumps({'tgrep2pattern': u'S < NP-SBJ'})
-        if h.command_line_program_installed('tgrep2'):
-            # Failed tgrep2 search with invalid corpus id.
-            response = self.app.request(url(controller='corpora', action='tgrep2', id=corpus_id),
-                    method='SEARCH', body=tgrep2pattern, headers=self.json_headers,
-                    environ=self.extra_environ_admin, status=400)
-            tgrep2resp = json.loads(response.body)
-            assert tgrep2resp['error'] == 'Corpus %d has not been written to file as a treebank.'
+        response = self.app.request(url(controller='corpora', action='tgrep2', id=corpus_id),
+                method='SEARCH', body=tgrep2pattern, headers=self.json_headers,
+                environ=self.extra_environ_admin, status=400)
+        tgrep2resp = json.loads(response.body)
+        assert tgrep2resp['error'] == 'Corpus %d has not been written to file as a treebank.'
 
         # Write the corpus to file
         sleep(1)
         params = json.dumps({'format': 'treebank'})
-        response = self.app.put(url('/corpora/%d/writetofile' % corpus_id), params,
-            headers=self.json_headers, extra_environ=self.extra_environ_admin)
+        response = self.write_to_file(corpus_id, params)
         resp2 = json.loads(response.body)
         corpus_dir_contents = os.listdir(corpus_dir)
         corpus_tbk_path = os.path.join(corpus_dir, 'corpus_%d.tbk' % corpus_id)
@@ -453,8 +467,7 @@ class TestCorporaLargeController(TestController):
         # Write the corpus to file
         sleep(1)
         params = json.dumps({'format': 'treebank'})
-        response = self.app.put(url('/corpora/%d/writetofile' % corpus_id), params,
-            headers=self.json_headers, extra_environ=self.extra_environ_admin)
+        response = self.write_to_file(corpus_id, params)
         resp2 = json.loads(response.body) # Response is a JSON repr. of the corpus
         corpus_dir_contents = os.listdir(corpus_dir)
         corpus_tbk_path = os.path.join(corpus_dir, 'corpus_%d.tbk' % corpus_id)
@@ -498,18 +511,19 @@ class TestCorporaLargeController(TestController):
         unzipped_corpus_file_content = decompress_gzip_string(response.body)
         assert unzipped_corpus_file_content == corpus_file_content
 
-        # Write the corpus to file again without any changes and expect a vacuous recreation
+        # Write the corpus to file again without any changes and expect the
+        # file to be left untouched.
         sleep(1)
         params = json.dumps({'format': 'treebank'})
-        response = self.app.put(url('/corpora/%d/writetofile' % corpus_id), params,
-            headers=self.json_headers, extra_environ=self.extra_environ_admin)
+        response = self.write_to_file(corpus_id, params)
         old_resp2 = resp2
         resp2 = json.loads(response.body) # Response is a JSON repr. of the corpus
         corpus_tbk_path = os.path.join(corpus_dir, 'corpus_%d.tbk' % corpus_id)
         old_corpus_tbk_mod_time = corpus_tbk_mod_time
         corpus_tbk_mod_time = h.get_file_modification_time(corpus_tbk_path) 
-        assert old_corpus_tbk_mod_time < corpus_tbk_mod_time
+        assert old_corpus_tbk_mod_time == corpus_tbk_mod_time
         assert len(resp2['files']) == 1
+        assert resp2['files'][0]['write_message'].endswith(u'is already up to date.')
         assert resp2['datetime_modified'] > old_resp2['datetime_modified']
         assert os.path.exists(corpus_tbk_path)
 
@@ -520,85 +534,89 @@ class TestCorporaLargeController(TestController):
         tgrep2pattern = u'S < NP-SBJ'
         query = {'paginator': {'page': 1, 'items_per_page': 10}, 'tgrep2pattern': tgrep2pattern}
         json_query = json.dumps(query)
-        if not h.command_line_program_installed('tgrep2'):
-            response = self.app.request(url(controller='corpora', action='tgrep2', id=corpus_id),
-                    method='SEARCH', body=json_query, headers=self.json_headers,
-                    environ=self.extra_environ_admin, status=400)
-            resp = json.loads(response.body)
-            assert resp["error"] ==  "TGrep2 is not installed."
-        else:
-            # TGrep2-search the corpus-as-treebank
-            response = self.app.request(url(controller='corpora', action='tgrep2', id=corpus_id),
-                    method='SEARCH', body=json_query, headers=self.json_headers,
-                    environ=self.extra_environ_admin)
-            resp = json.loads(response.body)
-            for f in resp['items']:
-                assert '(S ' in f['syntax'] and '(NP-SBJ ' in f['syntax']
+        # TGrep2-search the corpus-as-treebank
+        response = self.app.request(url(controller='corpora', action='tgrep2', id=corpus_id),
+                method='SEARCH', body=json_query, headers=self.json_headers,
+                environ=self.extra_environ_admin)
+        resp = json.loads(response.body)
+        for f in resp['items']:
+            assert '(S ' in f['syntax'] and '(NP-SBJ ' in f['syntax']
 
-            # A slightly more complex TGrep2 search
-            tgrep2pattern = u'S < NP-SBJ << DT'
-            query['tgrep2pattern'] = tgrep2pattern
-            json_query = json.dumps(query)
-            response = self.app.request(url(controller='corpora', action='tgrep2', id=corpus_id),
-                    method='SEARCH', body=json_query, headers=self.json_headers,
-                    environ=self.extra_environ_admin)
-            resp = json.loads(response.body)
-            for f in resp['items']:
-                assert ('(S ' in f['syntax'] and '(NP-SBJ ' in f['syntax'] and 
-                    '(DT ' in f['syntax'])
-
-            # Another TGrep2 search
-            tgrep2pattern = u'NP-SBJ < DT . VP'
-            query['tgrep2pattern'] = tgrep2pattern
-            json_query = json.dumps(query)
-            response = self.app.request(url(controller='corpora', action='tgrep2', id=corpus_id),
-                    method='SEARCH', body=json_query, headers=self.json_headers,
-                    environ=self.extra_environ_admin)
-            resp = json.loads(response.body)
-            match_count = resp['paginator']['count']
-            for f in resp['items']:
-                assert ('(NP-SBJ ' in f['syntax'] and '(DT ' in f['syntax'] and 
-                    '(VP ' in f['syntax'])
-
-            # Failed tgrep2 search with invalid corpus id.
-            response = self.app.request(url(controller='corpora', action='tgrep2', id=123456789),
-                    method='SEARCH', body=json_query, headers=self.json_headers,
-                    environ=self.extra_environ_admin, status=404)
-            resp = json.loads(response.body)
-            assert resp['error'] == u'There is no corpus with id 123456789'
+        # A slightly more complex TGrep2 search
+        tgrep2pattern = u'S < NP-SBJ << DT'
+        query['tgrep2pattern'] = tgrep2pattern
+        json_query = json.dumps(query)
+        response = self.app.request(url(controller='corpora', action='tgrep2', id=corpus_id),
+                method='SEARCH', body=json_query, headers=self.json_headers,
+                environ=self.extra_environ_admin)
+        resp = json.loads(response.body)
+        for f in resp['items']:
+            assert ('(S ' in f['syntax'] and '(NP-SBJ ' in f['syntax'] and 
+                '(DT ' in f['syntax'])
 
-            # Restricted user will not get all of the results.
-            response = self.app.request(url(controller='corpora', action='tgrep2', id=corpus_id),
-                    method='SEARCH', body=json_query, headers=self.json_headers,
-                    environ=self.extra_environ_view)
-            resp = json.loads(response.body)
-            restricted_match_count = resp['paginator']['count']
-            assert isinstance(restricted_match_count, int) and restricted_match_count < match_count
+        # Another TGrep2 search
+        tgrep2pattern = u'NP-SBJ < DT . VP'
+        query['tgrep2pattern'] = tgrep2pattern
+        json_query = json.dumps(query)
+        response = self.app.request(url(controller='corpora', action='tgrep2', id=corpus_id),
+                method='SEARCH', body=json_query, headers=self.json_headers,
+                environ=self.extra_environ_admin)
+        resp = json.loads(response.body)
+        match_count = resp['paginator']['count']
+        for f in resp['items']:
+            assert ('(NP-SBJ ' in f['syntax'] and '(DT ' in f['syntax'] and 
+                '(VP ' in f['syntax'])
+
+        # Failed tgrep2 search with invalid corpus id.
+        response = self.app.request(url(controller='corpora', action='tgrep2', id=123456789),
+                method='SEARCH', body=json_query, headers=self.json_headers,
+                environ=self.extra_environ_admin, status=404)
+        resp = json.loads(response.body)
+        assert resp['error'] == u'There is no corpus with id 123456789'
 
-            # Failed TGrep2 search: bad JSON in request body
-            json_query = json_query[:-1]
-            response = self.app.request(url(controller='corpora', action='tgrep2', id=corpus_id),
-                    method='SEARCH', body=json_query, headers=self.json_headers,
-                    environ=self.extra_environ_admin, status=400)
-            resp = json.loads(response.body)
-            assert resp ==  h.JSONDecodeErrorResponse
+        # Restricted user will not get all of the results.
+        response = self.app.request(url(controller='corpora', action='tgrep2', id=corpus_id),
+                method='SEARCH', body=json_query, headers=self.json_headers,
+                environ=self.extra_environ_view)
+        resp = json.loads(response.body)
+        restricted_match_count = resp['paginator']['count']
+        assert isinstance(restricted_match_count, int) and restricted_match_count < match_count
+
+        # Failed TGrep2 search: bad JSON in request body
+        json_query = json_query[:-1]
+        response = self.app.request(url(controller='corpora', action='tgrep2', id=corpus_id),
+                method='SEARCH', body=json_query, headers=self.json_headers,
+                environ=self.extra_environ_admin, status=400)
+        resp = json.loads(response.body)
+        assert resp ==  h.JSONDecodeErrorResponse
 
-            # Failed TGrep2 search: malformed params
-            tgrep2pattern = json.dumps({'TGrep2pattern': u'NP-SBJ < DT . VP'})
-            response = self.app.request(url(controller='corpora', action='tgrep2', id=corpus_id),
-                    method='SEARCH', body=tgrep2pattern, headers=self.json_headers,
-                    environ=self.extra_environ_admin, status=400)
-            resp = json.loads(response.body)
-            assert resp['errors']['tgrep2pattern'] == \
-                    "A tgrep2pattern attribute must be supplied and must have a unicode/string value"
+        # Failed TGrep2 search: malformed params
+        tgrep2pattern = json.dumps({'TGrep2pattern': u'NP-SBJ < DT . VP'})
+        response = self.app.request(url(controller='corpora', action='tgrep2', id=corpus_id),
+                method='SEARCH', body=tgrep2pattern, headers=self.json_headers,
+                environ=self.extra_environ_admin, status=400)
+        resp = json.loads(response.body)
+        assert resp['errors']['tgrep2pattern'] == \
+                "A tgrep2pattern attribute must be supplied and must have a unicode/string value"
+
+        # Empty string TGrep2 pattern results in no forms being returned.
+        tgrep2pattern = json.dumps({'tgrep2pattern': u''})
+        response = self.app.request(url(controller='corpora', action='tgrep2', id=corpus_id),
+                method='SEARCH', body=tgrep2pattern, headers=self.json_headers,
+                environ=self.extra_environ_admin)
+        resp = json.loads(response.body)
+        assert resp == []
 
-            # Empty string TGrep2 pattern results in no forms being returned.
-            tgrep2pattern = json.dumps({'tgrep2pattern': u''})
+        # Patterns outside of the subset supported by the in-process treebank
+        # search engine fail unless TGrep2 is installed.
+        tgrep2pattern = json.dumps({'tgrep2pattern': u'NP-SBJ <1 DT'})
+        if not h.command_line_program_installed('tgrep2'):
             response = self.app.request(url(controller='corpora', action='tgrep2', id=corpus_id),
                     method='SEARCH', body=tgrep2pattern, headers=self.json_headers,
-                    environ=self.extra_environ_admin)
+                    environ=self.extra_environ_admin, status=400)
             resp = json.loads(response.body)
-            assert resp == []
+            assert resp['error'].startswith(u'Unable to perform TGrep2 search')
+            assert u'TGrep2 is not installed' in resp['error']
 
     @nottest
     def test_search(self):
@@ -756,8 +774,7 @@ class TestCorporaLargeController(TestController):
         # Write the corpus to file as a treebank
         sleep(1)
         params = json.dumps({u'format': u'treebank'})
-        response = self.app.put(url('/corpora/%d/writetofile' % corpus_id), params,
-            headers=self.json_headers, extra_environ=self.extra_environ_admin)
+        response = self.write_to_file(corpus_id, params)
         resp2 = json.loads(response.body)
         corpus_dir_contents = os.listdir(corpus_dir)
         corpus_tbk_path = os.path.join(corpus_dir, 'corpus_%d.tbk' % corpus_id)
@@ -801,8 +818,7 @@ class TestCorporaLargeController(TestController):
         # Write the corpus to file as a list of transcriptions, one per line.
         sleep(1)
         params = json.dumps({u'format': u'transcriptions only'})
-        response = self.app.put(url('/corpora/%d/writetofile' % corpus_id), params,
-            headers=self.json_headers, extra_environ=self.extra_environ_admin)
+        response = self.write_to_file(corpus_id, params)
         old_resp2 = resp2
         resp2 = json.loads(response.body)
         corpus_dir_contents = os.listdir(corpus_dir)
@@ -811,11 +827,13 @@ class TestCorporaLargeController(TestController):
         corpus_TO_gzipped_size = get_file_size(corpus_TO_gzipped_path)
         corpus_TO_file_length = h.get_file_length(corpus_TO_path)
         if tgrep2_installed:
-            # Five files should be present: tbk, tbk.gz, tbk.t2c, txt and txt.gz
-            assert len(corpus_dir_contents) == 5
+            # Seven files should be present: tbk, tbk.gz, tbk.t2c, tbk.manifest,
+            # txt, txt.gz and txt.manifest
+            assert len(corpus_dir_contents) == 7
         else:
-            # Four files should be present: tbk, tbk.gz, txt and txt.gz
-            assert len(corpus_dir_contents) == 4
+            # Six files should be present: tbk, tbk.gz, tbk.manifest, txt, txt.gz
+            # and txt.manifest
+            assert len(corpus_dir_contents) == 6
         assert resp2['datetime_modified'] > old_resp2['datetime_modified']
         assert os.path.exists(corpus_TO_path)
         assert os.path.exists(corpus_TO_gzipped_path)
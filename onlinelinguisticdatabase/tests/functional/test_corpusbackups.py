@@ -246,6 +246,16 @@ class TestCorpusbackupsController(TestController):
         assert resp[0]['description'] == result_set[0]
         assert response.content_type == 'application/json'
 
+        # Searching on corpus backup content is not possible: it is delta-encoded.
+        json_query = json.dumps({'query': {'filter':
+                        ['CorpusBackup', 'content', 'like', u'%,%']}})
+        response = self.app.request(url('corpusbackups'), method='SEARCH', body=json_query,
+                        headers=self.json_headers, environ=self.extra_environ_admin,
+                        status=400)
+        resp = json.loads(response.body)
+        assert resp['errors']['CorpusBackup.content'].startswith(
+            u'Searching on CorpusBackup.content is not permitted because')
+
         # Attempting to call edit/new/create/delete/update on a read-only resource
         # will return a 404 response
         response = self.app.get(url('edit_corpusbackup', id=2232), status=404)
@@ -16,14 +16,18 @@ import datetime
 import logging
 import simplejson as json
 import os
+from time import sleep
 from base64 import b64encode
+from hashlib import sha256
 from nose.tools import nottest
 from mimetypes import guess_type
+import pylons.test
 from onlinelinguisticdatabase.tests import TestController, url
 import onlinelinguisticdatabase.model as model
 from onlinelinguisticdatabase.model.meta import Session
 import onlinelinguisticdatabase.lib.helpers as h
 from onlinelinguisticdatabase.lib.SQLAQueryBuilder import SQLAQueryBuilder
+from onlinelinguisticdatabase.lib.resize import requeue_reduced_copies
 
 try:
     import Image
@@ -39,7 +43,18 @@ class TestFilesController(TestController):
 
     def tearDown(self):
         TestController.tearDown(self, del_global_app_set=True,
-                dirs_to_clear=['files_path', 'reduced_files_path'])
+                dirs_to_clear=['files_path', 'reduced_files_path', 'uploads_path', 'blobs_path'])
+
+    def wait_for_reduced_copy(self, file_id):
+        """Return the file with ``file_id`` once the derivative workers are done with it."""
+        for i in range(300):
+            response = self.app.get(url('file', id=file_id), headers=self.json_headers,
+                                    extra_environ=self.extra_environ_admin)
+            resp = json.loads(response.body)
+            if resp['lossy_status'] not in (u'queued', u'processing'):
+                return resp
+            sleep(0.2)
+        raise Exception('The reduced copy of file %s was not created in time.' % file_id)
 
     @nottest
     def test_index(self):
@@ -1004,7 +1019,7 @@ class TestFilesController(TestController):
             })
             params = json.dumps(params)
             response = self.app.post(url('files'), params, self.json_headers, self.extra_environ_admin)
-            resp = json.loads(response.body)
+            resp = self.wait_for_reduced_copy(json.loads(response.body)['id'])
             file_count = new_file_count
             new_file_count = Session.query(model.File).count()
             new_reduced_dir_list = os.listdir(self.reduced_files_path)
@@ -1032,7 +1047,7 @@ class TestFilesController(TestController):
             params.update({'filename': long_wav_filename})
             response = self.app.post(url('/files'), params, extra_environ=self.extra_environ_admin,
                                  upload_files=[('filedata', long_wav_file_path)])
-            resp = json.loads(response.body)
+            resp = self.wait_for_reduced_copy(json.loads(response.body)['id'])
             file_count = new_file_count
             new_file_count = Session.query(model.File).count()
             new_reduced_dir_list = os.listdir(self.reduced_files_path)
@@ -1553,7 +1568,7 @@ class TestFilesController(TestController):
         })
         params = json.dumps(params)
         response = self.app.post(url('files'), params, self.json_headers, self.extra_environ_admin)
-        resp = json.loads(response.body)
+        resp = self.wait_for_reduced_copy(json.loads(response.body)['id'])
         parent_id = resp['id']
         parent_filename = resp['filename']
         parent_lossy_filename = resp['lossy_filename']
@@ -1982,6 +1997,7 @@ class TestFilesController(TestController):
         assert guess_type(wav_filename)[0] == response.headers['Content-Type']
 
         # Retrieve the reduced file data of the wav file created above.
+        self.wait_for_reduced_copy(wav_file_id)
         if self.create_reduced_size_file_copies and h.command_line_program_installed('ffmpeg'):
             response = self.app.get(url(controller='files', action='serve_reduced', id=wav_file_id),
                 headers=self.json_headers, extra_environ=extra_environ_admin)
@@ -2025,6 +2041,7 @@ class TestFilesController(TestController):
         resp = json.loads(response.body)
         jpg_filename = resp['filename']
         jpg_file_id = resp['id']
+        self.wait_for_reduced_copy(jpg_file_id)
 
         # Get the image file's contents
         response = self.app.get(url(controller='files', action='serve', id=jpg_file_id),
@@ -2110,7 +2127,7 @@ class TestFilesController(TestController):
         params = json.dumps(params)
         response = self.app.post(url('files'), params, self.json_headers,
                                  self.extra_environ_admin)
-        resp = json.loads(response.body)
+        resp = self.wait_for_reduced_copy(json.loads(response.body)['id'])
         file_count = Session.query(model.File).count()
         assert resp['filename'] == u'old_test.jpg'
         assert resp['MIME_type'] == u'image/jpeg'
@@ -2134,7 +2151,7 @@ class TestFilesController(TestController):
         params = json.dumps(params)
         response = self.app.post(url('files'), params, self.json_headers,
                                  self.extra_environ_admin)
-        resp = json.loads(response.body)
+        resp = self.wait_for_reduced_copy(json.loads(response.body)['id'])
         new_file_count = Session.query(model.File).count()
         assert new_file_count == file_count + 1
         assert resp['filename'] == filename
@@ -2162,7 +2179,7 @@ class TestFilesController(TestController):
         params = json.dumps(params)
         response = self.app.post(url('files'), params, self.json_headers,
                                  self.extra_environ_admin)
-        resp = json.loads(response.body)
+        resp = self.wait_for_reduced_copy(json.loads(response.body)['id'])
         file_count = new_file_count
         new_file_count = Session.query(model.File).count()
         assert new_file_count == file_count + 1
@@ -2187,7 +2204,7 @@ class TestFilesController(TestController):
         response = self.app.post(url('/files'), params,
                                  extra_environ=self.extra_environ_admin,
                                  upload_files=[('filedata', png_file_path)])
-        resp = json.loads(response.body)
+        resp = self.wait_for_reduced_copy(json.loads(response.body)['id'])
         file_count = new_file_count
         new_file_count = Session.query(model.File).count()
         assert new_file_count == file_count + 1
@@ -2222,7 +2239,7 @@ class TestFilesController(TestController):
         params = json.dumps(params)
         response = self.app.post(url('files'), params, self.json_headers,
                                  self.extra_environ_admin)
-        resp = json.loads(response.body)
+        resp = self.wait_for_reduced_copy(json.loads(response.body)['id'])
         file_count = new_file_count
         new_file_count = Session.query(model.File).count()
         assert resp['filename'] == filename
@@ -2246,3 +2263,238 @@ class TestFilesController(TestController):
                                 extra_environ=self.extra_environ_view)
         resp = json.loads(response.body)
         assert resp['search_parameters'] == h.get_search_parameters(query_builder)
+
+    @nottest
+    def test_chunked_upload(self):
+        """Tests that files can be created via chunked, resumable uploads."""
+
+        wav_file_path = os.path.join(self.test_files_path, 'old_test.wav')
+        wav_file_data = open(wav_file_path, 'rb').read()
+        wav_file_size = len(wav_file_data)
+        chunk_size = wav_file_size / 3 + 1
+
+        # Viewers cannot upload.
+        params = json.dumps({'filename': u'chunked.wav', 'size': wav_file_size})
+        response = self.app.post(url('/files/uploads'), params, self.json_headers,
+                                 self.extra_environ_view, status=403)
+
+        # Invalid filenames (i.e., disallowed file types) are rejected up front.
+        response = self.app.post(url('/files/uploads'),
+            json.dumps({'filename': u'chunked.exe', 'size': wav_file_size}),
+            self.json_headers, self.extra_environ_admin, status=400)
+        resp = json.loads(response.body)
+        assert u'not allowed' in resp['errors']['filename']
+
+        # Initiate the upload.
+        response = self.app.post(url('/files/uploads'), params, self.json_headers,
+                                 self.extra_environ_admin)
+        resp = json.loads(response.body)
+        upload_id = resp['id']
+        assert resp['offset'] == 0
+        assert resp['size'] == wav_file_size
+        assert resp['filename'] == u'chunked.wav'
+
+        # Upload the first chunk.
+        response = self.app.put(url('/files/uploads/%s?offset=0' % upload_id),
+            wav_file_data[:chunk_size], extra_environ=self.extra_environ_admin)
+        resp = json.loads(response.body)
+        assert resp['offset'] == chunk_size
+
+        # A chunk sent with the wrong offset is rejected and the current offset is returned.
+        response = self.app.put(url('/files/uploads/%s?offset=0' % upload_id),
+            wav_file_data[:chunk_size], extra_environ=self.extra_environ_admin, status=409)
+        resp = json.loads(response.body)
+        assert resp['offset'] == chunk_size
+
+        # Finalizing an incomplete upload fails.
+        response = self.app.post(url('/files/uploads/%s/finalize' % upload_id), '{}',
+            self.json_headers, self.extra_environ_admin, status=400)
+        resp = json.loads(response.body)
+        assert resp['error'] == u'Upload %s is incomplete: %d of %d bytes have been received.' % (
+            upload_id, chunk_size, wav_file_size)
+
+        # Resume the upload from the offset reported by the server.
+        response = self.app.get(url('/files/uploads/%s' % upload_id),
+            headers=self.json_headers, extra_environ=self.extra_environ_admin)
+        offset = json.loads(response.body)['offset']
+        while offset < wav_file_size:
+            response = self.app.put(url('/files/uploads/%s?offset=%d' % (upload_id, offset)),
+                wav_file_data[offset:offset + chunk_size], extra_environ=self.extra_environ_admin)
+            offset = json.loads(response.body)['offset']
+        assert offset == wav_file_size
+
+        # Finalize the upload with some metadata and get a file.
+        params = json.dumps({'description': u'Uploaded in chunks.'})
+        response = self.app.post(url('/files/uploads/%s/finalize' % upload_id), params,
+            self.json_headers, self.extra_environ_admin)
+        resp = json.loads(response.body)
+        file_id = resp['id']
+        assert resp['filename'] == u'chunked.wav'
+        assert resp['MIME_type'] == u'audio/x-wav'
+        assert resp['size'] == wav_file_size
+        assert resp['description'] == u'Uploaded in chunks.'
+        assert resp['checksum'] == sha256(wav_file_data).hexdigest()
+        assert open(os.path.join(self.files_path, u'chunked.wav'), 'rb').read() == wav_file_data
+        assert os.listdir(self.uploads_path) == []
+        response = self.app.get(url(controller='files', action='serve', id=file_id),
+            headers=self.json_headers, extra_environ=self.extra_environ_admin)
+        assert response.body == wav_file_data
+
+        # The upload is gone.
+        response = self.app.get(url('/files/uploads/%s' % upload_id),
+            headers=self.json_headers, extra_environ=self.extra_environ_admin, status=404)
+        resp = json.loads(response.body)
+        assert resp['error'] == u'There is no upload with id %s' % upload_id
+        self.wait_for_reduced_copy(file_id)
+
+    @nottest
+    def test_serve_ranges(self):
+        """Tests that file data can be requested by byte range and conditionally."""
+
+        wav_file_path = os.path.join(self.test_files_path, 'old_test.wav')
+        wav_file_data = open(wav_file_path, 'rb').read()
+        wav_file_size = len(wav_file_data)
+        params = self.file_create_params_base64.copy()
+        params.update({
+            'filename': u'old_test.wav',
+            'base64_encoded_file': b64encode(wav_file_data)
+        })
+        params = json.dumps(params)
+        response = self.app.post(url('files'), params, self.json_headers,
+                                 self.extra_environ_admin)
+        file_id = json.loads(response.body)['id']
+        self.wait_for_reduced_copy(file_id)
+        serve_url = url(controller='files', action='serve', id=file_id)
+
+        # A plain request gets the whole file, a strong ETag and range support.
+        response = self.app.get(serve_url, extra_environ=self.extra_environ_view)
+        etag = response.headers['ETag']
+        assert response.body == wav_file_data
+        assert response.headers['Accept-Ranges'] == 'bytes'
+        checksum = json.loads(self.app.get(url('file', id=file_id), headers=self.json_headers,
+            extra_environ=self.extra_environ_admin).body)['checksum']
+        if checksum:
+            assert etag == '"%s"' % checksum
+
+        # Byte ranges: first bytes, middle bytes, open-ended and suffix.
+        response = self.app.get(serve_url, headers={'Range': 'bytes=0-99'},
+                                extra_environ=self.extra_environ_view, status=206)
+        assert response.body == wav_file_data[:100]
+        assert response.headers['Content-Range'] == 'bytes 0-99/%d' % wav_file_size
+        assert response.headers['Content-Length'] == '100'
+        response = self.app.get(serve_url, headers={'Range': 'bytes=100-199'},
+                                extra_environ=self.extra_environ_view, status=206)
+        assert response.body == wav_file_data[100:200]
+        response = self.app.get(serve_url, headers={'Range': 'bytes=1000-'},
+                                extra_environ=self.extra_environ_view, status=206)
+        assert response.body == wav_file_data[1000:]
+        response = self.app.get(serve_url, headers={'Range': 'bytes=-50'},
+                                extra_environ=self.extra_environ_view, status=206)
+        assert response.body == wav_file_data[-50:]
+
+        # Unsatisfiable ranges get a 416.
+        response = self.app.get(serve_url, headers={'Range': 'bytes=%d-' % wav_file_size},
+                                extra_environ=self.extra_environ_view, status=416)
+        assert response.headers['Content-Range'] == 'bytes */%d' % wav_file_size
+
+        # Conditional requests: a matching ETag gets a 304 and no body.
+        response = self.app.get(serve_url, headers={'If-None-Match': etag},
+                                extra_environ=self.extra_environ_view, status=304)
+        assert response.body == ''
+        response = self.app.get(serve_url, headers={'If-None-Match': '"stale"'},
+                                extra_environ=self.extra_environ_view)
+        assert response.body == wav_file_data
+
+        # A range conditional on a stale ETag gets the whole file.
+        response = self.app.get(serve_url,
+            headers={'Range': 'bytes=0-99', 'If-Range': '"stale"'},
+            extra_environ=self.extra_environ_view)
+        assert response.body == wav_file_data
+        response = self.app.get(serve_url,
+            headers={'Range': 'bytes=0-99', 'If-Range': etag},
+            extra_environ=self.extra_environ_view, status=206)
+        assert response.body == wav_file_data[:100]
+
+    @nottest
+    def test_deduplication(self):
+        """Tests that identical file data are stored once, in the blob store."""
+
+        wav_file_path = os.path.join(self.test_files_path, 'old_test.wav')
+        wav_file_data = open(wav_file_path, 'rb').read()
+        checksum = sha256(wav_file_data).hexdigest()
+
+        # Create the same file twice, via Base64 and multipart/form-data.
+        params = self.file_create_params_base64.copy()
+        params.update({
+            'filename': u'first.wav',
+            'base64_encoded_file': b64encode(wav_file_data)
+        })
+        response = self.app.post(url('files'), json.dumps(params), self.json_headers,
+                                 self.extra_environ_admin)
+        first = json.loads(response.body)
+        first = self.wait_for_reduced_copy(first['id'])
+        params = self.file_create_params_MPFD.copy()
+        params.update({'filename': u'second.wav'})
+        response = self.app.post(url('/files'), params, extra_environ=self.extra_environ_contrib,
+            upload_files=[('filedata', wav_file_path)])
+        second = json.loads(response.body)
+        assert first['checksum'] == second['checksum'] == checksum
+        assert first['filename'] == u'first.wav'
+        assert second['filename'] == u'second.wav'
+
+        # Both filenames are links to the single blob.
+        blob_path = os.path.join(self.blobs_path, checksum)
+        assert os.listdir(self.blobs_path) == [checksum]
+        first_path = os.path.join(self.files_path, u'first.wav')
+        second_path = os.path.join(self.files_path, u'second.wav')
+        assert open(second_path, 'rb').read() == wav_file_data
+        if hasattr(os, 'link'):
+            assert os.stat(first_path).st_ino == os.stat(second_path).st_ino == \
+                os.stat(blob_path).st_ino
+
+        # The duplicate reuses the first file's reduced copy without queueing.
+        if first['lossy_filename']:
+            assert second['lossy_status'] == u'complete'
+            assert second['lossy_filename'] == u'second.%s' % first['lossy_filename'].split('.')[-1]
+        second = self.wait_for_reduced_copy(second['id'])
+
+        # Deleting one file leaves the blob for the other; deleting the last removes it.
+        self.app.delete(url('file', id=first['id']), extra_environ=self.extra_environ_admin)
+        assert not os.path.exists(first_path)
+        assert os.path.isfile(blob_path)
+        response = self.app.get(url(controller='files', action='serve', id=second['id']),
+            headers=self.json_headers, extra_environ=self.extra_environ_admin)
+        assert response.body == wav_file_data
+        self.app.delete(url('file', id=second['id']), extra_environ=self.extra_environ_admin)
+        assert os.listdir(self.blobs_path) == []
+
+    @nottest
+    def test_requeue_reduced_copies(self):
+        """Tests that reduced copies interrupted by a shutdown are re-queued on startup."""
+
+        wav_file_path = os.path.join(self.test_files_path, 'old_test.wav')
+        params = self.file_create_params_base64.copy()
+        params.update({
+            'filename': u'old_test.wav',
+            'base64_encoded_file': b64encode(open(wav_file_path, 'rb').read())
+        })
+        response = self.app.post(url('files'), json.dumps(params), self.json_headers,
+                                 self.extra_environ_admin)
+        file_id = self.wait_for_reduced_copy(json.loads(response.body)['id'])['id']
+
+        # Simulate a shutdown while the reduced copy was being created.
+        file = Session.query(model.File).get(file_id)
+        file.lossy_status = u'processing'
+        file.lossy_filename = None
+        Session.commit()
+        response = self.app.get(url(controller='files', action='serve_reduced', id=file_id),
+            headers=self.json_headers, extra_environ=self.extra_environ_admin, status=202)
+
+        # Re-queueing lets a derivative worker finish (or fail) the reduced
+        # copy; without an ffmpeg that encodes a lossy format, it fails at once.
+        app_config = pylons.test.pylonsapp.config
+        reducible = h.ffmpeg_encodes('ogg', app_config['pylons.app_globals'])
+        assert requeue_reduced_copies(app_config) == (1 if reducible else 0)
+        resp = self.wait_for_reduced_copy(file_id)
+        assert resp['lossy_status'] in (u'complete', u'failed')
+        assert requeue_reduced_copies(app_config) == 0
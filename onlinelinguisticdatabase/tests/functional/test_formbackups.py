@@ -12,6 +12,8 @@
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 
+import os
+import time
 import logging
 import simplejson as json
 from nose.tools import nottest
@@ -20,6 +22,10 @@ import onlinelinguisticdatabase.model as model
 from onlinelinguisticdatabase.model.meta import Session
 import onlinelinguisticdatabase.lib.helpers as h
 from onlinelinguisticdatabase.lib.SQLAQueryBuilder import SQLAQueryBuilder
+from onlinelinguisticdatabase.lib.backupwriter import BackupWriter, \
+    backup_flusher_q, flush_journal_files, write_journal_file, \
+    claim_journal_file, get_unflushed_journal_files, backup_claim_timeout, \
+    get_journal_path
 
 log = logging.getLogger(__name__)
 
@@ -312,3 +318,83 @@ class TestFormbackupsController(TestController):
                                 extra_environ=self.extra_environ_view)
         resp = json.loads(response.body)
         assert resp['search_parameters'] == h.get_search_parameters(query_builder)
+
+    @nottest
+    def test_deferred_backups(self):
+        """Tests that deferred backups are journaled and then written by the backup flusher."""
+        form = h.generate_default_form()
+        form.transcription = u'deferred'
+        form.date_elicited = h.now().date()
+        Session.add(form)
+        Session.commit()
+        form_dict = form.get_dict()
+
+        # With defer_backups on, flushing the writer journals the backups but
+        # does not insert them.  The journal is discarded if the transaction
+        # is rolled back ...
+        config = dict(self.config, defer_backups=u'1')
+        writer = BackupWriter(config)
+        writer.add(model.FormBackup, form_dict)
+        writer.flush()
+        assert writer.rows == {}
+        assert backup_flusher_q.empty()
+        assert len(os.listdir(get_journal_path(config))) == 1
+        Session.rollback()
+        assert os.listdir(get_journal_path(config)) == []
+        assert backup_flusher_q.empty()
+
+        # ... and handed to the backup flusher once the transaction commits.
+        writer.add(model.FormBackup, form_dict).add(model.FormBackup, form_dict)
+        writer.flush()
+        assert backup_flusher_q.empty()
+        Session.commit()
+        journal_file_path = backup_flusher_q.get_nowait()
+        backup_flusher_q.task_done()
+        assert os.path.isfile(journal_file_path)
+        assert Session.query(model.FormBackup).count() == 0
+
+        # The flusher inserts the journaled backups and deletes the journal file.
+        flush_journal_files([journal_file_path])
+        Session.remove()
+        assert not os.path.exists(journal_file_path)
+        form_backups = Session.query(model.FormBackup).all()
+        assert len(form_backups) == 2
+        for form_backup in form_backups:
+            assert form_backup.form_id == form_dict['id']
+            assert form_backup.transcription == u'deferred'
+            assert form_backup.datetime_modified == form_dict['datetime_modified']
+            assert form_backup.date_elicited == form_dict['date_elicited']
+            assert json.loads(form_backup.enterer) == form_dict['enterer']
+
+        # Without defer_backups, the backups are inserted in the current transaction.
+        BackupWriter(self.config).add(model.FormBackup, form_dict).flush()
+        Session.commit()
+        assert Session.query(model.FormBackup).count() == 3
+
+        # A journal file whose flush fails is released so that it can be retried.
+        journal_file_path = write_journal_file({'nonexistent_table': [{}]}, config)
+        try:
+            flush_journal_files([journal_file_path])
+        except KeyError:
+            pass
+        else:
+            raise AssertionError('The flush of a bad journal file should fail.')
+        Session.remove()
+        assert get_unflushed_journal_files(config) == [journal_file_path]
+
+        # A claim by a live process is respected until it expires, since the
+        # pid of a dead claimant may have been reused.
+        claimed_path = claim_journal_file(journal_file_path)
+        assert get_unflushed_journal_files(config) == []
+        expired = int(time.time()) - backup_claim_timeout - 1
+        os.rename(claimed_path, '%s.claimed-%d-%d' % (journal_file_path, os.getpid(), expired))
+        assert get_unflushed_journal_files(config) == [journal_file_path]
+        os.remove(journal_file_path)
+
+        # Pending journal files are discarded once no live process will release them.
+        expired = int(time.time()) - backup_claim_timeout - 1
+        journal_file_path = write_journal_file({'formbackup': []}, config, pending=True)
+        os.rename(journal_file_path, '%s.pending-%d-%d' % (
+            journal_file_path.split('.pending-')[0], os.getpid(), expired))
+        assert get_unflushed_journal_files(config) == []
+        assert os.listdir(get_journal_path(config)) == []
@@ -1201,6 +1201,8 @@ class TestFormsController(TestController):
         assert resp['transcription'] == original_transcription
         assert resp['translations'][0]['transcription'] == original_translation
         assert new_form_count == form_count + 1
+        # The denormalized restricted column tracks the restricted tag.
+        assert Session.query(model.Form.restricted).filter(model.Form.id==id).scalar() == True
 
         # As a viewer, attempt to update the restricted form we just created.
         # Expect to fail.
@@ -1244,6 +1246,7 @@ class TestFormsController(TestController):
         assert resp['status'] == u'requires testing'
         assert new_form_count == form_count + 1
         assert orig_backup_count + 1 == new_backup_count
+        assert Session.query(model.Form.restricted).filter(model.Form.id==id).scalar() == False
         backup = Session.query(model.FormBackup).filter(
             model.FormBackup.UUID==unicode(
             resp['UUID'])).order_by(
@@ -2542,6 +2545,57 @@ class TestFormsController(TestController):
         resp = json.loads(response.body)
         assert resp['error'] == u'You are not authorized to access this resource.'
 
+    @nottest
+    def test_authorized_ids(self):
+        """Tests that h.get_authorized_ids makes bulk authorization decisions."""
+
+        users = h.get_users()
+        administrator = [u for u in users if u.role == u'administrator'][0]
+        contributor = [u for u in users if u.role == u'contributor'][0]
+        viewer = [u for u in users if u.role == u'viewer'][0]
+        restricted_tag = h.generate_restricted_tag()
+        Session.add(restricted_tag)
+        Session.commit()
+        restricted_tag = h.get_restricted_tag()
+
+        # Forms 1-10 are entered by the contributor; the even ones are restricted.
+        forms = []
+        for index in range(1, 11):
+            form = model.Form()
+            form.transcription = u'transcription %d' % index
+            form.enterer = contributor
+            if index % 2 == 0:
+                form.tags = [restricted_tag]
+            forms.append(form)
+        Session.add_all(forms)
+        Session.commit()
+        ids = [form.id for form in forms]
+        restricted_ids = set(form.id for form in forms if form.restricted)
+        assert len(restricted_ids) == 5
+        bad_id = max(ids) + 1
+
+        decisions = h.get_authorized_ids(viewer, 'Form', ids + [bad_id])
+        assert sorted(decisions.keys()) == sorted(ids)
+        assert set(id_ for id_, authorized in decisions.items()
+                   if not authorized) == restricted_ids
+        assert all(h.get_authorized_ids(contributor, 'Form', ids).values())
+        assert all(h.get_authorized_ids(administrator, 'Form', ids).values())
+        assert h.get_authorized_ids(viewer, 'Form', []) == {}
+
+        # The per-object check agrees with the bulk one.
+        for form in forms:
+            assert h.user_is_authorized_to_access_model(viewer, form) == \
+                decisions[form.id]
+
+        # Forms already loaded in the session are decided without a query, so
+        # their (unflushed) state is used.
+        restricted_form = [form for form in forms if form.restricted][0]
+        with Session.no_autoflush:
+            restricted_form.enterer_id = viewer.id
+            assert h.get_authorized_ids(viewer, 'Form', ids)[restricted_form.id]
+            Session.expire(restricted_form)
+            assert not h.get_authorized_ids(viewer, 'Form', ids)[restricted_form.id]
+
     @nottest
     def test_normalization(self):
         """Tests that unicode input data are normalized and so too are search patterns."""
@@ -43,6 +43,29 @@ class TestLoginController(TestController):
         assert resp['authenticated'] == True
         assert response.content_type == 'application/json'
 
+        # The session holds a (cached) principal that authenticates later requests.
+        admin = Session.query(model.User).filter(model.User.username==u'admin').first()
+        principal = h.principal_cache[admin.id]
+        assert isinstance(principal, h.Principal)
+        assert principal.role == u'administrator'
+        response = self.app.get(url('forms'), headers=self.json_headers)
+        assert json.loads(response.body) == []
+
+        # The principal records whether the user is unrestricted, which decides
+        # its access to restricted forms, files and collections.
+        assert principal.unrestricted == False
+        viewer = Session.query(model.User).filter(model.User.role==u'viewer').first()
+        viewer_principal = h.Principal(viewer.id, viewer.username, viewer.role,
+            viewer.first_name, viewer.last_name, unrestricted=True)
+        form = model.Form()
+        form.restricted = True
+        form.enterer_id = admin.id
+        assert h.is_unrestricted_user(viewer_principal)
+        assert h.user_is_authorized_to_access_model(viewer_principal, form)
+        viewer_principal.unrestricted = False
+        assert not h.is_unrestricted_user(viewer_principal)
+        assert not h.user_is_authorized_to_access_model(viewer_principal, form)
+
         # Invalid POST params
         params = json.dumps({'usernamex': 'admin', 'password': 'admin'})
         response = self.app.post(url(controller='login', action='authenticate'),
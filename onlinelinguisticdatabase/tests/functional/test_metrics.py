@@ -0,0 +1,190 @@
+# Copyright 2016 Joel Dunham
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import os
+import shutil
+from time import sleep
+import tempfile
+import logging
+import simplejson as json
+import webtest
+import pylons.test
+from sqlalchemy import event
+from nose.tools import nottest
+from onlinelinguisticdatabase.tests import TestController, url
+from onlinelinguisticdatabase.model.meta import Session
+import onlinelinguisticdatabase.lib.profiling as profiling
+from onlinelinguisticdatabase.lib.dbengine import get_engine
+import onlinelinguisticdatabase.lib.helpers as h
+
+log = logging.getLogger(__name__)
+
+class TestMetricsController(TestController):
+
+    def tearDown(self):
+        TestController.tearDown(self)
+        profiling.enabled = False
+        profiling.metrics.clear()
+
+    @nottest
+    def test_metrics(self):
+        """Tests that the profiling middleware records requests and serves the metrics at /metrics."""
+
+        profile_dir = tempfile.mkdtemp()
+        try:
+            profiling.instrument_engine(Session.bind)
+            app = webtest.TestApp(profiling.ProfilingMiddleware(
+                pylons.test.pylonsapp, 1.0, profile_dir))
+            profiling.metrics.clear()
+
+            # Nothing has been recorded yet.
+            response = app.get('/metrics', extra_environ=self.extra_environ_admin)
+            resp = json.loads(response.body)
+            assert response.content_type == 'application/json'
+            assert resp['actions'] == {}
+
+            # Requests are recorded per controller/action.
+            for i in range(3):
+                app.get(url('forms'), headers=self.json_headers,
+                        extra_environ=self.extra_environ_view)
+            app.get(url('form', id=123456789), headers=self.json_headers,
+                    extra_environ=self.extra_environ_view, status=404)
+            resp = json.loads(app.get('/metrics',
+                extra_environ=self.extra_environ_admin).body)
+            index = resp['actions']['forms.index']
+            assert index['requests'] == 3
+            assert index['errors'] == 0
+            assert index['sql_count'] > 0
+            assert index['sql_time'] > 0
+            assert index['json_time'] > 0
+            assert index['wall_time'] >= index['max_wall_time'] > 0
+            assert index['mean_sql_count'] == index['sql_count'] / 3.0
+            assert index['profiled'] == 3
+            assert resp['actions']['forms.show']['requests'] == 1
+            assert len([p for p in os.listdir(profile_dir)
+                        if p.startswith('forms.index_')]) == 3
+
+            # Subprocesses are recorded for the request that spawns them and
+            # as background work otherwise.
+            stats = profiling.request_stats.stats = profiling.RequestStats()
+            profiling.Popen(['true']).communicate()
+            profiling.request_stats.stats = None
+            assert stats.subprocesses['true'][0] == 1
+            assert profiling.call(['true']) == 0
+            resp = json.loads(app.get('/metrics',
+                extra_environ=self.extra_environ_admin).body)
+            assert resp['actions']['background']['subprocesses']['true']['count'] == 1
+            assert profiling.get_program_name(['/tmp/apply_abc.sh']) == 'flookup'
+            assert profiling.get_program_name(['/tmp/phonology_1/phonology.sh']) == 'foma'
+
+            # Only administrators may read the metrics, unless a metrics token
+            # is configured, and only administrators may reset them.
+            resp = json.loads(app.get('/metrics', status=401).body)
+            assert resp['error'] == u'Authentication is required to access this resource.'
+            resp = json.loads(app.get('/metrics', status=403,
+                extra_environ=self.extra_environ_view).body)
+            assert resp == h.unauthorized_msg
+            app.delete('/metrics', status=403, extra_environ=self.extra_environ_view)
+            app.delete('/metrics', status=401)
+            app_config = pylons.test.pylonsapp.config
+            app_config['metrics_token'] = u'secret'
+            try:
+                app.get('/metrics', headers={'X-Metrics-Token': 'wrong'}, status=401)
+                resp = json.loads(app.get('/metrics',
+                    headers={'X-Metrics-Token': 'secret'}).body)
+                assert resp['actions']['forms.index']['requests'] == 3
+                app.delete('/metrics', headers={'X-Metrics-Token': 'secret'}, status=401)
+            finally:
+                del app_config['metrics_token']
+
+            # DELETE /metrics resets the metrics; other methods are not allowed.
+            resp = json.loads(app.delete('/metrics',
+                extra_environ=self.extra_environ_admin).body)
+            assert resp['actions'] == {}
+            assert resp['pools'] == {}
+            resp = json.loads(app.post('/metrics', status=405,
+                extra_environ=self.extra_environ_admin).body)
+            assert resp['error'].startswith(u'The POST method is not permitted')
+
+            # A request is measured until its response body has been generated.
+            def streaming_app(environ, start_response):
+                start_response('200 OK', [('Content-Type', 'text/plain')])
+                def body():
+                    sleep(0.2)
+                    assert profiling.get_request_stats() is not None
+                    yield 'streamed'
+                return body()
+            streaming = webtest.TestApp(profiling.ProfilingMiddleware(streaming_app))
+            assert streaming.get('/').body == 'streamed'
+            assert profiling.get_request_stats() is None
+            unrouted = profiling.metrics.actions['unrouted']
+            assert unrouted['requests'] == 1
+            assert unrouted['max_wall_time'] >= 0.2
+
+            # The metrics are not served if profiling is not enabled.
+            profiling.enabled = False
+            app.get('/metrics', extra_environ=self.extra_environ_admin, status=404)
+        finally:
+            shutil.rmtree(profile_dir)
+
+    @nottest
+    def test_engine(self):
+        """Tests the engine options and the connection pool metrics."""
+
+        profiling.enabled = True
+        profiling.metrics.clear()
+        db_fd, db_path = tempfile.mkstemp(suffix='.db')
+        os.close(db_fd)
+        try:
+            # SQLite pragmas; pool sizes are ignored as SQLite files are not pooled.
+            engine = get_engine({
+                'sqlalchemy.url': 'sqlite:///%s' % db_path,
+                'sqlalchemy.pool_size': '5',
+                'sqlalchemy.sqlite_journal_mode': 'wal',
+                'sqlalchemy.sqlite_synchronous': 'normal',
+                'profile_requests': '1'})
+            assert engine.execute('PRAGMA journal_mode').scalar() == u'wal'
+            assert engine.execute('PRAGMA synchronous').scalar() == 1
+            assert engine.execute("SELECT 'abc' REGEXP 'b'").scalar() == 1
+            assert engine.execute("SELECT 'abc' LIKE 'A%'").scalar() == 0
+            pool = profiling.metrics.get_dict()['pools']['sqlite:///%s' % db_path]
+            assert pool['checkouts'] == 4
+            assert pool['connections_opened'] == 4
+            assert pool['mean_checkout_wait_time'] > 0
+            engine.dispose()
+            try:
+                get_engine({'sqlalchemy.url': 'sqlite:///%s' % db_path,
+                            'sqlalchemy.sqlite_synchronous': 'sometimes'})
+                assert False
+            except ValueError, e:
+                assert e.args[0].startswith(u'sqlalchemy.sqlite_synchronous must be one of')
+
+            # Pre-ping replaces connections that have been closed behind the
+            # pool's back.
+            engine = get_engine({'sqlalchemy.url': 'sqlite://',
+                                 'sqlalchemy.pool_pre_ping': 'true',
+                                 'profile_requests': '1'})
+            dbapi_connections = []
+            event.listen(engine, 'connect', lambda dbapi_connection, record:
+                         dbapi_connections.append(dbapi_connection))
+            assert engine.execute('SELECT 1').scalar() == 1
+            dbapi_connections[0].close()
+            assert engine.execute('SELECT 1').scalar() == 1
+            pool = profiling.metrics.get_dict()['pools']['sqlite://']
+            assert pool['checkouts'] == 2
+            assert pool['connections_opened'] == 2
+            assert pool['disconnects'] == 1
+            engine.dispose()
+        finally:
+            os.remove(db_path)
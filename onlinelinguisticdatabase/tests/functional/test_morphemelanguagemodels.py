@@ -14,9 +14,11 @@
 
 import logging
 import os
+import re
 import codecs
+from glob import glob
 import simplejson as json
-from time import sleep
+from time import sleep, time
 from nose.tools import nottest
 from sqlalchemy.sql import desc
 from onlinelinguisticdatabase.tests import TestController, url
@@ -25,6 +27,7 @@ from onlinelinguisticdatabase.model.meta import Session
 from subprocess import call
 import onlinelinguisticdatabase.lib.helpers as h
 from onlinelinguisticdatabase.model import MorphemeLanguageModel, MorphemeLanguageModelBackup
+from onlinelinguisticdatabase.lib import simplelm
 
 log = logging.getLogger(__name__)
 
@@ -630,6 +633,103 @@ class TestMorphemelanguagemodelsController(TestController):
 
         # Further tests could be done ... cf. the tests on the history action of the phonologies controller ...
 
+    @nottest
+    def test_h_simplelm(self):
+        """Tests that morpheme language models can be estimated and evaluated in-process with simplelm."""
+
+        sentential_corpus_id = Session.query(model.Corpus).filter(
+            model.Corpus.name==u'Corpus of sentences').first().id
+        likely_word = u'%s %s' % (
+            h.rare_delimiter.join([u'chat', u'cat', u'N']),
+            h.rare_delimiter.join([u's', u'PL', u'PHI']))
+        unlikely_word = u'%s %s' % (
+            h.rare_delimiter.join([u's', u'PL', u'PHI']),
+            h.rare_delimiter.join([u'chat', u'cat', u'N']))
+        ms_params = json.dumps({'morpheme_sequences': [likely_word, unlikely_word]})
+
+        name = u'Morpheme language model simplelm'
+        params = self.morpheme_language_model_create_params.copy()
+        params.update({
+            'name': name,
+            'corpus': sentential_corpus_id,
+            'toolkit': 'simplelm',
+            'smoothing': 'KN'
+        })
+        params = json.dumps(params)
+        response = self.app.post(url('morphemelanguagemodels'), params, self.json_headers, self.extra_environ_admin)
+        resp = json.loads(response.body)
+        morpheme_language_model_id = resp['id']
+        assert resp['toolkit'] == u'simplelm'
+        assert resp['smoothing'] == u'KN'
+
+        # Generate the files of the language model
+        response = self.app.put(url(controller='morphemelanguagemodels', action='generate', id=morpheme_language_model_id),
+            {}, self.json_headers, self.extra_environ_admin)
+        resp = json.loads(response.body)
+        lm_generate_attempt = resp['generate_attempt']
+        requester = lambda: self.app.get(url('morphemelanguagemodel', id=morpheme_language_model_id),
+            headers=self.json_headers, extra_environ=self.extra_environ_admin)
+        resp = self.poll(requester, 'generate_attempt', lm_generate_attempt, log, wait=1, vocal=False)
+        assert resp['generate_message'] == u'Language model successfully generated.'
+
+        # The ARPA file and the pickled trie should agree.
+        response = self.app.get(url(controller='morphemelanguagemodels', action='serve_arpa',
+            id=morpheme_language_model_id),
+            {}, self.json_headers, self.extra_environ_admin)
+        arpa = unicode(response.body, encoding='utf8')
+        assert h.rare_delimiter.join([u'parle', u'speak', u'V']) in arpa
+        assert u'\\3-grams:' in arpa
+        response = self.app.put(url(controller='morphemelanguagemodels', action='get_probabilities',
+            id=morpheme_language_model_id),
+            ms_params, self.json_headers, self.extra_environ_admin)
+        resp = json.loads(response.body)
+        assert pow(10, resp[likely_word]) > pow(10, resp[unlikely_word])
+        lm = Session.query(MorphemeLanguageModel).get(morpheme_language_model_id)
+        arpa_trie = simplelm.load_arpa(lm.get_file_path('arpa'), 'utf8')
+        assert abs(simplelm.compute_sentence_prob(arpa_trie, [u'<s>'] + likely_word.split() + [u'</s>']) -
+                   resp[likely_word]) < 1e-5
+
+        # Compute the perplexity in-process.
+        response = self.app.put(url(controller='morphemelanguagemodels', action='compute_perplexity', id=morpheme_language_model_id),
+            {}, self.json_headers, self.extra_environ_admin)
+        resp = json.loads(response.body)
+        lm_perplexity_attempt = resp['perplexity_attempt']
+        resp = self.poll(requester, 'perplexity_attempt', lm_perplexity_attempt, log, wait=1, vocal=False)
+        assert resp['perplexity_computed'] == True
+        assert resp['perplexity'] > 1
+        log.debug('Perplexity of super toy french (6 sentence corpus, simplelm KN, n=3): %s' % resp['perplexity'])
+
+        # The k-fold evaluation is deterministic given a seed and does not depend on
+        # whether the folds are evaluated by a thread pool or serially.
+        lm = Session.query(MorphemeLanguageModel).get(morpheme_language_model_id)
+        corpus_size = len(list(lm.get_corpus_words()))
+        evaluation = lm.evaluate_perplexity(60, folds=5, seed=1)
+        assert len(evaluation['perplexities']) == 5
+        assert sum(evaluation['fold_sizes']) == corpus_size
+        assert len(evaluation['timings']['folds']) == 5
+        serial_evaluation = lm.evaluate_perplexity(60, folds=5, seed=1, threads=1)
+        assert serial_evaluation['perplexities'] == evaluation['perplexities']
+        assert serial_evaluation['perplexity'] == evaluation['perplexity']
+        assert abs(lm.evaluate_perplexity(60, folds=5)['perplexity'] - resp['perplexity']) < 1e-9
+
+        # Generation and perplexity evaluation share the tokenized corpus that is
+        # cached in the corpus's directory; it is updated when the corpus's forms change.
+        corpus = lm.corpus
+        corpora_path = h.get_OLD_directory_path('corpora', config=self.config)
+        assert len(glob(os.path.join(corpora_path, 'corpus_%d' % corpus.id, 'tokenized_*.pickle'))) == 1
+        tokenized_corpus = h.get_tokenized_corpus(corpus, lm.morpheme_splitter, lm.delimiters, corpora_path)
+        assert tokenized_corpus.listing == h.get_corpus_file_listing(corpus)
+        assert list(lm.get_corpus_words(tokenized_corpus)) == list(lm.get_corpus_words())
+        assert tokenized_corpus.restricted == lm.tokenize_corpus().restricted
+        form = corpus.forms[0]
+        form.datetime_modified = h.now()
+        Session.commit()
+        assert not tokenized_corpus.is_current(form.id, form.datetime_modified.isoformat())
+        new_tokenized_corpus = h.get_tokenized_corpus(corpus, lm.morpheme_splitter, lm.delimiters, corpora_path)
+        assert new_tokenized_corpus.listing == h.get_corpus_file_listing(corpus)
+        assert new_tokenized_corpus.is_current(form.id, form.datetime_modified.isoformat())
+        assert list(lm.get_corpus_words(new_tokenized_corpus)) == list(lm.get_corpus_words())
+
     @nottest
     def test_i_large_datasets(self):
         """Tests that morpheme language model functionality works with large datasets.
@@ -1205,6 +1305,57 @@ class TestMorphemelanguagemodelsController(TestController):
         sleep(1) # If I don't sleep here I get an odd thread-related error (conditional upon
         # this being the last test to be run, I think)...
 
+    @nottest
+    def test_j_arpa_loading(self):
+        """Benchmarks loading ARPA files into ``LMTree`` and ``ArrayLM`` instances.
+
+        LMs are estimated from the words of the lorem ipsum datasets in
+        ``tests/data/datasets``.  The trie and compact representations loaded
+        from their ARPA files must agree with each other and with the models
+        built directly by the estimator.
+
+        """
+        morpheme_splitter = re.compile(u'[-=]').split
+        arpa_path = os.path.join(self.test_datasets_path, 'loremipsum.arpa')
+        for dataset_path in (self.loremipsum100_path, self.loremipsum1000_path, self.loremipsum10000_path):
+            words = []
+            with codecs.open(dataset_path, encoding='utf8') as f:
+                for line in f:
+                    elements = filter(None, line.strip('\n').split('\t'))
+                    if len(elements) < 5:
+                        continue
+                    mb, mg, sc = elements[1], elements[2], elements[4]
+                    for mb_word, mg_word, sc_word in zip(mb.split(), mg.split(), sc.split()):
+                        words.append([h.rare_delimiter.join(morpheme) for morpheme in zip(
+                            morpheme_splitter(mb_word), morpheme_splitter(mg_word), morpheme_splitter(sc_word))])
+            estimator = simplelm.NGramEstimator(order=3, smoothing='ModKN')
+            for word in words:
+                estimator.add_sentence(word)
+            estimator.write_arpa(arpa_path)
+            start = time()
+            trie = simplelm.load_arpa(arpa_path, 'utf8')
+            trie_seconds = time() - start
+            start = time()
+            compact_lm = simplelm.load_arpa(arpa_path, 'utf8', compact=True)
+            compact_seconds = time() - start
+            log.debug('Loaded the ARPA file of %s (%d n-grams): LMTree in %0.4fs, ArrayLM in %0.4fs' % (
+                os.path.basename(dataset_path), len(compact_lm), trie_seconds, compact_seconds))
+            assert trie.max_order == compact_lm.max_order == 3
+            assert len(compact_lm) == len(estimator.get_trie(compact=True))
+            estimated_trie = estimator.get_trie()
+            for word in words[:200]:
+                sentence = [u'<s>'] + word + [u'</s>']
+                logprob = simplelm.compute_sentence_prob(estimated_trie, list(sentence))
+                assert abs(simplelm.compute_sentence_prob(trie, list(sentence)) - logprob) < 1e-5
+                assert abs(simplelm.compute_sentence_prob(compact_lm, list(sentence)) - logprob) < 1e-4
+                for i in range(len(sentence) - 1):
+                    ngram = sentence[i:i + 3]
+                    trie_p, trie_is_prob = trie.get_ngram_p(ngram)
+                    compact_p, compact_is_prob = compact_lm.get_ngram_p(ngram)
+                    assert trie_is_prob == compact_is_prob
+                    assert abs(trie_p - compact_p) < 1e-5
+            os.remove(arpa_path)
+
     @nottest
     def test_z_cleanup(self):
         """Clean up after the tests."""
@@ -1150,6 +1150,13 @@ define phonology eDrop .o. breakDrop;
         assert response.content_type == 'application/zip'
         # To ensure the exported parser works, unzip it and test it out: ./parse.py chiens chats
 
+        # A repeat export is served from the archive saved by the first one.
+        archive = response.body
+        assert len([f for f in os.listdir(morphological_parser_1_dir) if f.endswith('.zip')]) == 1
+        response = self.app.get(url(controller='morphologicalparsers', action='export',
+            id=morphological_parser_1_id), headers=self.json_headers, extra_environ=self.extra_environ_admin)
+        assert response.body == archive
+
         parser_1_cache = sorted([p.transcription for p in Session.query(model.Parse).\
             filter(model.Parse.parser_id==morphological_parser_1_id).all()])
         assert parser_1_cache == [u'abc', u'chiens', u'tombait']
@@ -572,9 +572,10 @@ class TestOldcollectionsController(TestController):
         new_collection2_contents = new_collection2.contents
         collection1_ref = u'collection[%d]' % collection1_id
         old_collection2_backups_count = new_collection2_backups_count
-        new_collection2_backups = Session.query(model.CollectionBackup).\
+        new_collection2_backups = h.restore_backups(
+            Session.query(model.CollectionBackup).\
             filter(model.CollectionBackup.collection_id == collection2_id).\
-            order_by(desc(model.CollectionBackup.id)).all()
+            order_by(desc(model.CollectionBackup.id)).all())
         new_collection2_backups_count = len(new_collection2_backups)
         assert collection1_ref in old_collection2_contents
         assert collection1_ref not in new_collection2_contents
@@ -1031,6 +1032,67 @@ class TestOldcollectionsController(TestController):
 
         h.clear_directory_of_files(self.files_path)
 
+    @nottest
+    def test_collection_references(self):
+        """Tests that references to other collections in collection contents are validated."""
+
+        admin = self.extra_environ_admin.copy()
+        admin.update({'test.application_settings': True})
+        contrib = self.extra_environ_contrib.copy()
+        contrib.update({'test.application_settings': True})
+        restricted_tag = h.generate_restricted_tag()
+        Session.add(restricted_tag)
+        Session.commit()
+        restricted_tag_id = restricted_tag.id
+
+        def create_collection(title, contents, extra_environ, status=None, tags=None):
+            params = self.collection_create_params.copy()
+            params.update({'title': title, 'contents': contents, 'tags': tags or []})
+            response = self.app.post(url('collections'), json.dumps(params),
+                                     self.json_headers, extra_environ, status=status)
+            return json.loads(response.body)
+
+        # A chain of references: C -> B -> A.
+        collection_A = create_collection(u'A', u'Contents of A.', admin)
+        collection_B = create_collection(u'B', u'collection[%d]' % collection_A['id'], admin)
+        collection_C = create_collection(u'C', u'collection(%d)' % collection_B['id'], contrib)
+        assert collection_C['contents_unpacked'] == u'Contents of A.'
+
+        # References to non-existent collections are invalid.
+        resp = create_collection(u'D', u'collection[%d]' % (collection_C['id'] + 100),
+                                 contrib, status=400)
+        assert resp['error'] == u'Invalid collection reference error: there is no ' \
+            u'collection with id %d' % (collection_C['id'] + 100)
+
+        # A restricted collection cannot be referenced, directly or indirectly,
+        # by a restricted user.
+        collection_R = create_collection(u'R', u'Restricted.', admin, tags=[restricted_tag_id])
+        collection_S = create_collection(u'S', u'collection[%d]' % collection_R['id'], admin)
+        for id_ in (collection_R['id'], collection_S['id']):
+            resp = create_collection(u'E', u'collection[%d]' % id_, contrib, status=403)
+            assert resp['error'] == u'Unauthorized collection reference error: you ' \
+                u'are not authorized to access collection %d' % id_
+        create_collection(u'E', u'collection[%d]' % collection_S['id'], admin)
+
+        # The forms referenced in the contents are validated together; each bad
+        # reference gets its own error.
+        forms = [model.Form() for index in range(20)]
+        for index, form in enumerate(forms):
+            form.transcription = u'form %d' % index
+        forms[0].tags = [h.get_restricted_tag()]
+        Session.add_all(forms)
+        Session.commit()
+        form_ids = [form.id for form in forms]
+        bad_id = max(form_ids) + 1
+        contents = u' '.join(u'form[%d]' % id_ for id_ in form_ids[1:])
+        resp = create_collection(u'F', contents, contrib)
+        assert sorted(f['id'] for f in resp['forms']) == sorted(form_ids[1:])
+        resp = create_collection(u'G', u'%s form[%d] form[%d]' % (
+            contents, form_ids[0], bad_id), contrib, status=400)
+        assert u'There is no form with id %d.' % bad_id in resp['errors']['forms']
+        assert u'You are not authorized to access the form with id %d.' % form_ids[0] \
+            in resp['errors']['forms']
+
     @nottest
     def test_new(self):
         """Tests that GET /collection/new returns an appropriate JSON object for creating a new OLD collection.
@@ -370,3 +370,55 @@ class TestPagesController(TestController):
         assert resp['page']['name'] == u'page'
         assert resp['data'] == {'markup_languages': list(h.markup_languages)}
         assert response.content_type == 'application/json'
+
+    @nottest
+    def test_html_cache(self):
+        """Tests that rendered HTML is cached and identical to uncached rendering."""
+
+        # Markdown whose blocks do not render independently: adjacent block
+        # quotes merge and raw HTML blocks are not wrapped in paragraphs.
+        contents = u'\n'.join([
+            u'> a',
+            u'',
+            u'> b',
+            u'',
+            u'<div>',
+            u'',
+            u'foo',
+            u'',
+            u'</div>',
+            u'',
+            u'* Item 1',
+            u'',
+            u'    continued',
+            u''
+        ])
+        expected = h.md2html(contents)
+        assert expected.count(u'<blockquote>') == 1
+        h.html_cache.clear()
+        assert h.get_HTML_from_contents(contents, u'Markdown') == expected
+        key = h.html_cache.get_key(contents, u'Markdown')
+        assert h.html_cache.get(key) == expected
+        assert h.get_HTML_from_contents(contents, u'Markdown') == expected
+        assert h.get_HTML_from_contents(contents, u'reStructuredText') == \
+            h.rst2html(contents)
+
+        # Collections store the uncached rendering of their contents.
+        params = self.collection_create_params.copy()
+        params.update({'title': u'HTML cache collection',
+                       'markup_language': u'Markdown', 'contents': contents})
+        response = self.app.post(url('collections'), json.dumps(params),
+                                 self.json_headers, self.extra_environ_admin)
+        assert json.loads(response.body)['html'] == expected
+
+        # The least recently used entries are evicted first.
+        cache = h.HTMLCache(max_size=2)
+        cache.render(u'a', u'Markdown')
+        cache.render(u'b', u'Markdown')
+        cache.render(u'a', u'Markdown')
+        cache.render(u'c', u'Markdown')
+        assert cache.get(cache.get_key(u'a', u'Markdown')) == h.md2html(u'a')
+        assert cache.get(cache.get_key(u'b', u'Markdown')) is None
+        assert len(cache.store) == 2
+        cache.clear()
+        assert len(cache.store) == 0
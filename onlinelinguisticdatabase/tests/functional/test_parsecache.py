@@ -0,0 +1,73 @@
+# Copyright 2016 Joel Dunham
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+"""Tests of the SQLite-based parse cache of ``lib/parser.py``."""
+
+import os
+import shutil
+import cPickle
+import logging
+import tempfile
+from unittest import TestCase
+from nose.tools import nottest
+from onlinelinguisticdatabase.lib.parser import Cache
+
+log = logging.getLogger(__name__)
+
+class TestParseCache(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'cache.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    @nottest
+    def test_persistence(self):
+        """Tests that persisted entries are available to a new cache."""
+        cache = Cache(self.path)
+        cache[u'chien'] = u'chien|dog|N'
+        cache.persist()
+        cache.close()
+        cache = Cache(self.path)
+        assert cache[u'chien'] == u'chien|dog|N'
+        assert cache.get(u'chat') is None
+        assert len(cache) == 1
+        cache.close()
+
+    @nottest
+    def test_legacy_conversion(self):
+        """Tests that a pickled cache is converted and that one that cannot be
+        unpickled is left untouched.
+        """
+        with open(self.path, 'wb') as f:
+            cPickle.dump({u'chien': u'chien|dog|N'}, f)
+            cPickle.dump({u'chat': u'chat|cat|N'}, f)
+        cache = Cache(self.path)
+        assert cache[u'chien'] == u'chien|dog|N'
+        assert cache[u'chat'] == u'chat|cat|N'
+        cache.close()
+        with open(self.path, 'rb') as f:
+            assert f.read(len(Cache.sqlite_header)) == Cache.sqlite_header
+        assert os.listdir(self.directory) == ['cache.sqlite']
+
+        with open(self.path, 'wb') as f:
+            f.write('not a pickle')
+        cache = Cache(self.path)
+        assert cache.path is None
+        assert cache.get(u'chien') is None
+        with open(self.path, 'rb') as f:
+            assert f.read() == 'not a pickle'
+        assert os.listdir(self.directory) == ['cache.sqlite']
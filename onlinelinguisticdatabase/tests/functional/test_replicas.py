@@ -0,0 +1,86 @@
+# Copyright 2016 Joel Dunham
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import os
+import tempfile
+import logging
+import simplejson as json
+import webtest
+import pylons.test
+from nose.tools import nottest
+from sqlalchemy import create_engine
+from onlinelinguisticdatabase.tests import TestController, url
+import onlinelinguisticdatabase.model as model
+from onlinelinguisticdatabase.model.meta import Session, Base
+
+log = logging.getLogger(__name__)
+
+class TestReplicasController(TestController):
+
+    @nottest
+    def test_replicas(self):
+        """Tests that read-only requests go to a read replica unless the user has just written."""
+
+        # Use an empty SQLite database as the replica of the test database.
+        primary = Session.bind
+        replica_fd, replica_path = tempfile.mkstemp(suffix='.db')
+        os.close(replica_fd)
+        replica = create_engine('sqlite:///%s' % replica_path)
+        Base.metadata.create_all(replica)
+        Session.remove()
+        model.init_model(primary, [replica])
+        try:
+            params = self.form_create_params.copy()
+            params.update({
+                'transcription': u'test_replicas_transcription',
+                'translations': [{'transcription': u'test_replicas_translation',
+                                  'grammaticality': u''}]
+            })
+            response = self.app.post(url('forms'), json.dumps(params),
+                                     self.json_headers, self.extra_environ_admin)
+            form_id = json.loads(response.body)['id']
+
+            # A user who has not written reads from the replica, which has not
+            # received the new form.
+            other_app = webtest.TestApp(pylons.test.pylonsapp)
+            response = other_app.get(url('forms'), headers=self.json_headers,
+                                     extra_environ=self.extra_environ_admin)
+            assert json.loads(response.body) == []
+            other_app.get(url('form', id=form_id), headers=self.json_headers,
+                          extra_environ=self.extra_environ_admin, status=404)
+
+            # The user who wrote is pinned to the primary database.
+            response = self.app.get(url('forms'), headers=self.json_headers,
+                                    extra_environ=self.extra_environ_admin)
+            resp = json.loads(response.body)
+            assert len(resp) == 1
+            assert resp[0]['transcription'] == u'test_replicas_transcription'
+
+            # Writes go to the primary database regardless of who makes them.
+            params.update({'transcription': u'test_replicas_transcription_2'})
+            other_app.post(url('forms'), json.dumps(params), self.json_headers,
+                           self.extra_environ_admin)
+            assert Session.query(model.Form).count() == 2
+            assert replica.execute('SELECT COUNT(*) FROM form').scalar() == 0
+
+            # Once the pin expires, the user reads from the replica again.
+            self.app.cookies.clear()
+            response = self.app.get(url('forms'), headers=self.json_headers,
+                                    extra_environ=self.extra_environ_admin)
+            assert json.loads(response.body) == []
+        finally:
+            Session.remove()
+            model.init_model(primary)
+            replica.dispose()
+            os.remove(replica_path)
@@ -203,6 +203,30 @@ class TestTagsController(TestController):
         assert resp['error'] == u'The update request failed because the submitted data were not new.'
         assert response.content_type == 'application/json'
 
+        # The restricted tag cannot be renamed and no tag can be renamed to
+        # restricted, since forms, files and collections store whether they
+        # have the restricted tag in their restricted column.  The description
+        # of the restricted tag can be updated.
+        restricted_tag = h.generate_restricted_tag()
+        Session.add(restricted_tag)
+        Session.commit()
+        restricted_tag_id = restricted_tag.id
+        params = json.dumps({'name': u'unrestricted', 'description': u''})
+        response = self.app.put(url('tag', id=restricted_tag_id), params, self.json_headers,
+                                 self.extra_environ_admin, status=400)
+        resp = json.loads(response.body)
+        assert resp['errors'] == u'The names of the restricted and foreign word tags cannot be changed.'
+        assert Session.query(Tag).get(restricted_tag_id).name == u'restricted'
+        params = json.dumps({'name': u'restricted', 'description': u'Restricted data.'})
+        response = self.app.put(url('tag', id=restricted_tag_id), params, self.json_headers,
+                                 self.extra_environ_admin)
+        assert json.loads(response.body)['description'] == u'Restricted data.'
+        params = json.dumps({'name': u'foreign word', 'description': u''})
+        response = self.app.put(url('tag', id=tag_id), params, self.json_headers,
+                                 self.extra_environ_admin, status=400)
+        resp = json.loads(response.body)
+        assert resp['errors'] == u'The names of the restricted and foreign word tags cannot be changed.'
+
     @nottest
     def test_delete(self):
         """Tests that DELETE /tags/id deletes the tag with id=id."""
@@ -0,0 +1,167 @@
+# Copyright 2016 Joel Dunham
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+"""Tests of the in-process treebank search engine of ``lib/treebank.py``."""
+
+import os
+import shutil
+import logging
+import tempfile
+from unittest import TestCase
+from nose.tools import nottest
+import onlinelinguisticdatabase.model as model
+import onlinelinguisticdatabase.lib.treebank as treebank_module
+from onlinelinguisticdatabase.lib.treebank import Treebank, UnsupportedPatternError, \
+    get_treebank
+
+log = logging.getLogger(__name__)
+
+trees = [
+    u'(TOP-1 (S (NP-SBJ (DT the) (NN dog)) (VP (VBD barked))))',
+    u'(TOP-2 (S (NP-SBJ (PRP it)) (VP (VBZ is) (NP-PRD (DT a) (NN cat)))))',
+    u'(TOP-3 (NP (NN cat) (. .)))',
+    u'(TOP-4 (S (NP-SBJ (DT the) (NN dog))',     # malformed: skipped
+    u'(NOTOP (S (NP-SBJ (DT a))))'              # no TOP-<id> root: skipped
+]
+
+class TestTreebank(TestCase):
+
+    def setUp(self):
+        self.treebank = Treebank()
+        for tree in trees:
+            self.treebank.add_tree(tree)
+
+    def search(self, pattern):
+        return list(self.treebank.search(pattern))
+
+    @nottest
+    def test_node_specifications(self):
+        """Tests labels, quoted labels, the wildcard, regexes and basic categories."""
+        assert self.treebank.tree_count == 3
+        assert self.search(u'NP-SBJ') == [1, 2]
+        assert self.search(u'NP') == [3]
+        assert self.search(u'"."') == [3]
+        assert self.search(u'__') == [1, 2, 3]
+        assert self.search(u'/^VB/') == [1, 2]
+        assert self.search(u'/^vb/') == []
+        assert self.search(u'/^vb/i') == [1, 2]
+        assert self.search(u'@NP') == [1, 2, 3]
+        assert self.search(u'PP') == []
+        assert self.search(u'') == []
+        assert self.search(u'   ') == []
+
+    @nottest
+    def test_dominance(self):
+        """Tests the dominance relations <, >, << and >>."""
+        assert self.search(u'S < NP-SBJ') == [1, 2]
+        assert self.search(u'S < DT') == []
+        assert self.search(u'S << DT') == [1, 2]
+        assert self.search(u'DT > NP-SBJ') == [1]
+        assert self.search(u'DT > NP-PRD') == [2]
+        assert self.search(u'NN >> S') == [1, 2]
+        assert self.search(u'NN >> VP') == [2]
+        assert self.search(u'NN << cat') == [2, 3]
+
+    @nottest
+    def test_precedence(self):
+        """Tests the precedence relations ., ,, .. and ,,."""
+        assert self.search(u'DT . NN') == [1, 2]
+        assert self.search(u'NN . "."') == [3]
+        assert self.search(u'NP-SBJ . VP') == [1, 2]
+        assert self.search(u'DT . VP') == []
+        assert self.search(u'DT .. VBD') == [1]
+        assert self.search(u'VBZ , PRP') == [2]
+        assert self.search(u'VBZ , DT') == []
+        assert self.search(u'VP ,, NP-SBJ') == [1, 2]
+        assert self.search(u'NN ,, PRP') == [2]
+        # Precedence does not cross trees.
+        assert self.search(u'PRP ,, NN') == []
+
+    @nottest
+    def test_sisters(self):
+        """Tests the sister relation $."""
+        assert self.search(u'VP $ NP-SBJ') == [1, 2]
+        assert self.search(u'DT $ NN') == [1, 2]
+        assert self.search(u'NN $ "."') == [3]
+        assert self.search(u'NN $ NN') == []
+        assert self.search(u'S $ __') == []
+
+    @nottest
+    def test_negation(self):
+        """Tests negated relations."""
+        assert self.search(u'NP-SBJ !< DT') == [2]
+        assert self.search(u'NN !$ DT') == [3]
+        assert self.search(u'S !<< PRP') == [1]
+        assert self.search(u'NN !>> S') == [3]
+
+    @nottest
+    def test_alternation_and_grouping(self):
+        """Tests alternatives, the application of relations to the first node
+        and parenthesized sub-patterns.
+        """
+        assert self.search(u'VBD|VBZ') == [1, 2]
+        assert self.search(u'NP-SBJ|NP-PRD < DT') == [1, 2]
+        assert self.search(u'/^V/|"." > __') == [1, 2, 3]
+        # Every relation in a sequence applies to the first node ...
+        assert self.search(u'S < NP-SBJ < VP') == [1, 2]
+        assert self.search(u'S < NP-SBJ < DT') == []
+        assert self.search(u'NP-SBJ < DT . VP') == [1]
+        # ... unless the relations are grouped.
+        assert self.search(u'S < (NP-SBJ < DT)') == [1]
+        assert self.search(u'S < (NP-SBJ < PRP)') == [2]
+        assert self.search(u'S << (NP-PRD < (DT . NN))') == [2]
+        assert self.search(u'S < (NP-SBJ !< DT)') == [2]
+
+    @nottest
+    def test_unsupported_patterns(self):
+        """Tests that patterns outside of the supported subset are rejected."""
+        for pattern in (u'NP <1 DT', u'NP < ', u'!NP', u'NP ! DT', u'(S < NP',
+                        u'S < NP)', u'/(/', u'NP=n < DT', u'< NP'):
+            try:
+                self.treebank.search(pattern)
+            except UnsupportedPatternError:
+                pass
+            else:
+                raise AssertionError(u'%s should be unsupported' % pattern)
+
+    @nottest
+    def test_get_treebank(self):
+        """Tests that treebanks are cached and parsed outside of the cache lock."""
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'corpus_1.tbk')
+            with open(path, 'w') as f:
+                f.write(u'\n'.join(trees).encode('utf8'))
+            corpus_file = model.CorpusFile()
+            corpus_file.checksum = u'checksum'
+            from_file = Treebank.from_file
+            original_from_file = Treebank.__dict__['from_file']
+            parses = []
+            def from_file_unlocked(path):
+                # Other treebanks can be fetched from the cache during the parse.
+                assert treebank_module.treebank_cache_lock.acquire(False)
+                treebank_module.treebank_cache_lock.release()
+                parses.append(path)
+                return from_file(path)
+            Treebank.from_file = staticmethod(from_file_unlocked)
+            try:
+                treebank = get_treebank(corpus_file, path)
+                assert get_treebank(corpus_file, path) is treebank
+            finally:
+                Treebank.from_file = original_from_file
+            assert parses == [path]
+            assert list(treebank.search(u'S < NP-SBJ')) == [1, 2]
+            assert treebank_module.treebank_build_locks == {}
+        finally:
+            shutil.rmtree(directory)
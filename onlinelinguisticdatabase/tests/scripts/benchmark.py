@@ -0,0 +1,462 @@
+#!/usr/bin/python
+
+# Copyright 2016 Joel Dunham
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+"""This script benchmarks an OLD application using the "lorem ipsum" datasets
+in ``onlinelinguisticdatabase/tests/data/datasets``.
+
+The application is loaded in-process (via WebTest) with the settings of a
+config file (``test.ini`` by default) except that it uses a new SQLite database
+and store in a temporary directory, so the databases of the config file are
+not touched.  The script seeds the database with a dataset via requests and
+then times the following:
+
+- form create (with morpheme linking) and update requests;
+- form searches with like, regex and relational filters;
+- pagination at the first, middle and last pages;
+- corpus ``writetofile`` requests;
+- morphology script generation;
+- morpheme language model estimation (requires MITLM's estimate-ngram);
+- morphological parser parses with a cold and a warm cache (requires foma);
+- JSON serialization of all forms.
+
+The results are written as JSON.  If a baseline results file is supplied via
+``--compare``, the ratio of each mean to the baseline mean is also printed, so
+that the performance of commits can be compared.
+
+Usage:
+
+    $ cd old
+    $ python onlinelinguisticdatabase/tests/scripts/benchmark.py \\
+        -d 1000 -o benchmark_1000.json
+    $ git checkout other_commit
+    $ python onlinelinguisticdatabase/tests/scripts/benchmark.py \\
+        -d 1000 --compare benchmark_1000.json
+
+"""
+
+import os
+import sys
+import time
+import shutil
+import logging
+import argparse
+import datetime
+import platform
+import tempfile
+import subprocess
+import simplejson as json
+
+here = os.path.dirname(os.path.realpath(__file__))
+old_path = os.path.abspath(os.path.join(here, '..', '..', '..'))
+datasets_path = os.path.join(here, '..', 'data', 'datasets')
+
+log = logging.getLogger('benchmark')
+
+################################################################################
+# Timing
+################################################################################
+
+class Timings(object):
+    """Collects the durations of named operations."""
+
+    def __init__(self):
+        self.durations = {}
+        self.skipped = {}
+
+    def time(self, name, func, *args, **kwargs):
+        """Call ``func`` and record its duration under ``name``; return its
+        return value.
+        """
+        started = time.time()
+        result = func(*args, **kwargs)
+        self.add(name, time.time() - started)
+        return result
+
+    def add(self, name, duration):
+        self.durations.setdefault(name, []).append(duration)
+
+    def skip(self, name, reason):
+        log.info('Skipping %s: %s' % (name, reason))
+        self.skipped[name] = reason
+
+    def get_dict(self):
+        result = dict((name, {'skipped': reason})
+                      for name, reason in self.skipped.iteritems())
+        for name, durations in self.durations.iteritems():
+            durations = sorted(durations)
+            count = len(durations)
+            result[name] = {
+                'count': count,
+                'total': sum(durations),
+                'mean': sum(durations) / count,
+                'median': durations[count // 2],
+                'min': durations[0],
+                'max': durations[-1]
+            }
+        return result
+
+
+################################################################################
+# Application
+################################################################################
+
+def write_benchmark_config(config_path, directory):
+    """Write a config file that uses the config file at ``config_path`` with a
+    new SQLite database and store in ``directory``; return its path.
+    """
+    path = os.path.join(directory, 'benchmark.ini')
+    with open(path, 'w') as f:
+        f.write('\n'.join([
+            '[app:main]',
+            'use = config:%s' % config_path,
+            'sqlalchemy.url = sqlite:///%s' % os.path.join(directory, 'benchmark.db'),
+            'permanent_store = %s' % os.path.join(directory, 'store'),
+            'cache_dir = %s' % os.path.join(directory, 'data'),
+            'add_language_data = 0',
+            'empty_database = 0',
+            'create_reduced_size_file_copies = 0',
+            ''
+        ]))
+    return path
+
+def load_app(config_path):
+    """Set up the OLD described by ``config_path`` and return a WebTest app
+    that is logged in as the default administrator.
+    """
+    from paste.deploy import loadapp
+    from paste.script.appinstall import SetupCommand
+    import webtest
+    SetupCommand('setup-app').run([config_path])
+    app = webtest.TestApp(loadapp('config:%s' % config_path))
+    response = app.post('/login/authenticate', json.dumps(
+        {'username': u'admin', 'password': u'adminA_1'}), json_headers)
+    assert json.loads(response.body)['authenticated'], 'Unable to log in.'
+    return app
+
+json_headers = {'Content-Type': 'application/json'}
+
+def post(app, path, params, **kwargs):
+    return json.loads(app.post(path, json.dumps(params), json_headers, **kwargs).body)
+
+def put(app, path, params, **kwargs):
+    return json.loads(app.put(path, json.dumps(params), json_headers, **kwargs).body)
+
+def get(app, path, params=None, **kwargs):
+    return json.loads(app.get(path, params or {}, json_headers, **kwargs).body)
+
+def poll(app, path, attribute, original, timeout):
+    """Poll ``GET path`` until the value of ``attribute`` is no longer
+    ``original``; return the resource.
+    """
+    started = time.time()
+    while True:
+        resource = get(app, path)
+        if resource[attribute] != original:
+            return resource
+        if time.time() - started > timeout:
+            raise RuntimeError('Timed out waiting for %s of %s to change.' % (
+                attribute, path))
+        time.sleep(0.1)
+
+form_create_params = {
+    'transcription': u'',
+    'phonetic_transcription': u'',
+    'narrow_phonetic_transcription': u'',
+    'morpheme_break': u'',
+    'grammaticality': u'',
+    'morpheme_gloss': u'',
+    'translations': [],
+    'comments': u'',
+    'speaker_comments': u'',
+    'elicitation_method': u'',
+    'tags': [],
+    'syntactic_category': u'',
+    'speaker': u'',
+    'elicitor': u'',
+    'verifier': u'',
+    'source': u'',
+    'status': u'tested',
+    'date_elicited': u'',
+    'syntax': u'',
+    'semantics': u''
+}
+
+
+################################################################################
+# Benchmarks
+################################################################################
+
+def seed(app, timings, dataset_path):
+    """Create the syntactic categories and forms of a lorem ipsum dataset via
+    requests, timing the form creations; return the params of the forms
+    created, keyed by id.
+    """
+    categories = {}
+    forms = {}
+    with open(dataset_path) as f:
+        for line in f:
+            elements = filter(None, unicode(line, 'utf8').rstrip(u'\n').split(u'\t'))
+            if len(elements) == 2:
+                name, type_ = elements
+                response = app.post('/syntacticcategories', json.dumps(
+                    {'name': name, 'type': type_, 'description': u''}),
+                    json_headers, status=[200, 400])
+                if response.status_int == 200:
+                    categories[name] = json.loads(response.body)['id']
+            elif len(elements) in (5, 6):
+                transcription, morpheme_break, morpheme_gloss, translation, \
+                    category = elements[:5]
+                params = dict(form_create_params,
+                    transcription=transcription,
+                    morpheme_break=morpheme_break,
+                    morpheme_gloss=morpheme_gloss,
+                    translations=[{'transcription': translation,
+                                   'grammaticality': u''}],
+                    syntax=elements[5] if len(elements) == 6 else u'',
+                    syntactic_category=categories.get(category, u''))
+                form = timings.time('form_create', post, app, '/forms', params)
+                forms[form['id']] = params
+    return forms
+
+def benchmark_form_updates(app, timings, forms, sample):
+    for id_ in sorted(forms)[:sample]:
+        params = dict(forms[id_], comments=u'Updated by the benchmark.')
+        timings.time('form_update', put, app, '/forms/%d' % id_, params)
+
+searches = {
+    'search_like': ['Form', 'transcription', 'like', u'%or%'],
+    'search_regex': ['Form', 'morpheme_break', 'regex', u'^[a-z]+-[a-z]+'],
+    'search_relational': ['and', [
+        ['Form', 'syntactic_category', 'name', '=', u'S'],
+        ['Form', 'translations', 'transcription', 'like', u'%a%']]]
+}
+
+def benchmark_searches(app, timings, repeat):
+    for name, filter_ in sorted(searches.items()):
+        for i in range(repeat):
+            timings.time(name, post, app, '/forms/search',
+                         {'query': {'filter': filter_}})
+
+def benchmark_pagination(app, timings, forms_count, repeat, items_per_page=20):
+    last_page = max(1, (forms_count + items_per_page - 1) // items_per_page)
+    pages = {'paginate_first': 1,
+             'paginate_middle': max(1, last_page // 2),
+             'paginate_last': last_page}
+    for name, page in sorted(pages.items()):
+        for i in range(repeat):
+            timings.time(name, get, app, '/forms',
+                         {'page': page, 'items_per_page': items_per_page})
+
+def create_sentences_corpus(app):
+    form_search = post(app, '/formsearches', {
+        'name': u'Sentences', 'description': u'', 'searcher': u'',
+        'search': {'filter': ['Form', 'syntactic_category', 'name', '=', u'S']}})
+    return post(app, '/corpora', {'name': u'Sentences', 'description': u'',
+        'content': u'', 'form_search': form_search['id'], 'tags': []})
+
+def write_corpus_to_file(app, corpus_id, format_, timeout):
+    put(app, '/corpora/%d/writetofile' % corpus_id, {'format': format_})
+    started = time.time()
+    while True:
+        corpus = get(app, '/corpora/%d' % corpus_id)
+        if not [cf for cf in corpus['files']
+                if cf['write_status'] in (u'queued', u'writing', u'indexing')]:
+            return corpus
+        if time.time() - started > timeout:
+            raise RuntimeError('Timed out waiting for corpus %d to be written.' % corpus_id)
+        time.sleep(0.1)
+
+def benchmark_corpus_writetofile(app, timings, corpus_id, repeat, timeout):
+    for i in range(repeat):
+        for format_ in (u'treebank', u'transcriptions only'):
+            timings.time('corpus_writetofile', write_corpus_to_file, app,
+                         corpus_id, format_, timeout)
+
+def run_task(app, path, action, attribute, timeout):
+    """Request ``PUT path/action`` and poll ``GET path`` until the task that it
+    starts has terminated; return the resource.
+    """
+    original = get(app, path)[attribute]
+    put(app, '%s/%s' % (path, action), {})
+    return poll(app, path, attribute, original, timeout)
+
+def benchmark_morphology(app, timings, corpus_id, repeat, timeout):
+    morphology = post(app, '/morphologies', {
+        'name': u'Lorem ipsum morphology', 'description': u'',
+        'lexicon_corpus': corpus_id, 'rules_corpus': corpus_id,
+        'script_type': u'lexc', 'extract_morphemes_from_rules_corpus': True,
+        'rules': u'', 'rich_upper': True, 'rich_lower': False,
+        'include_unknowns': False})
+    path = '/morphologies/%d' % morphology['id']
+    for i in range(repeat):
+        timings.time('morphology_generate', run_task, app, path, 'generate',
+                     'generate_attempt', timeout)
+    return morphology
+
+def benchmark_language_model(app, timings, corpus_id, repeat, timeout):
+    lm = post(app, '/morphemelanguagemodels', {
+        'name': u'Lorem ipsum language model', 'description': u'',
+        'corpus': corpus_id, 'vocabulary_morphology': u'',
+        'toolkit': u'mitlm', 'order': 3, 'smoothing': u'', 'categorial': False})
+    path = '/morphemelanguagemodels/%d' % lm['id']
+    for i in range(repeat):
+        timings.time('lm_estimate', run_task, app, path, 'generate',
+                     'generate_attempt', timeout)
+    return lm
+
+def benchmark_parser(app, timings, morphology, lm, forms, repeat, timeout):
+    phonology = post(app, '/phonologies', {
+        'name': u'Lorem ipsum phonology', 'description': u'',
+        'script': u'define phonology ?* ;'})
+    run_task(app, '/morphologies/%d' % morphology['id'], 'generate_and_compile',
+             'compile_attempt', timeout)
+    parser = post(app, '/morphologicalparsers', {
+        'name': u'Lorem ipsum parser', 'description': u'',
+        'phonology': phonology['id'], 'morphology': morphology['id'],
+        'language_model': lm['id']})
+    path = '/morphologicalparsers/%d' % parser['id']
+    run_task(app, path, 'generate_and_compile', 'compile_attempt', timeout)
+    words = sorted(set(word for params in forms.values()
+                       for word in params['transcription'].split()))[:100]
+    timings.time('parser_parse_cold', put, app, '%s/parse' % path,
+                 {'transcriptions': words})
+    for i in range(repeat):
+        timings.time('parser_parse_warm', put, app, '%s/parse' % path,
+                     {'transcriptions': words})
+
+def benchmark_json_serialization(timings, repeat):
+    import onlinelinguisticdatabase.lib.helpers as h
+    from onlinelinguisticdatabase.model import Form
+    from onlinelinguisticdatabase.model.meta import Session
+    forms = h.eagerload_form(Session.query(Form)).all()
+    for i in range(repeat):
+        timings.time('json_serialization', json.dumps, forms, cls=h.JSONOLDEncoder)
+    Session.remove()
+
+
+################################################################################
+# Main
+################################################################################
+
+def get_commit():
+    try:
+        return subprocess.Popen(['git', 'rev-parse', 'HEAD'], cwd=old_path,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()[0].strip() or None
+    except OSError:
+        return None
+
+def run(config_path, dataset, repeat, sample, timeout):
+    """Run the benchmarks and return the results as a dict."""
+    import onlinelinguisticdatabase.lib.helpers as h
+    dataset_path = os.path.join(datasets_path, 'loremipsum_%d.txt' % dataset)
+    config_path = os.path.abspath(config_path)
+    directory = tempfile.mkdtemp()
+    timings = Timings()
+    cwd = os.getcwd()
+    try:
+        # websetup.py expects the config file to be in the current directory.
+        os.chdir(directory)
+        app = load_app(write_benchmark_config(config_path, directory))
+        log.info('Seeding the database with %s.' % dataset_path)
+        forms = seed(app, timings, dataset_path)
+        log.info('Benchmarking.')
+        benchmark_form_updates(app, timings, forms, sample)
+        benchmark_searches(app, timings, repeat)
+        benchmark_pagination(app, timings, len(forms), repeat)
+        corpus = create_sentences_corpus(app)
+        benchmark_corpus_writetofile(app, timings, corpus['id'], repeat, timeout)
+        morphology = benchmark_morphology(app, timings, corpus['id'], repeat, timeout)
+        lm = None
+        if h.command_line_program_installed('estimate-ngram'):
+            lm = benchmark_language_model(app, timings, corpus['id'], repeat, timeout)
+        else:
+            timings.skip('lm_estimate', u'estimate-ngram is not installed')
+        if not h.foma_installed(force_check=True):
+            for name in ('parser_parse_cold', 'parser_parse_warm'):
+                timings.skip(name, u'foma and flookup are not installed')
+        elif lm is None:
+            for name in ('parser_parse_cold', 'parser_parse_warm'):
+                timings.skip(name, u'estimate-ngram is not installed')
+        else:
+            benchmark_parser(app, timings, morphology, lm, forms, repeat, timeout)
+        benchmark_json_serialization(timings, repeat)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(directory, ignore_errors=True)
+    return {
+        'benchmark': {
+            'dataset': dataset,
+            'forms': len(forms),
+            'repeat': repeat,
+            'sample': sample,
+            'commit': get_commit(),
+            'datetime': datetime.datetime.utcnow().isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform()
+        },
+        'results': timings.get_dict()
+    }
+
+def compare(results, baseline):
+    """Return lines that give the ratio of each mean in ``results`` to that in
+    ``baseline``.
+    """
+    lines = []
+    for name, result in sorted(results['results'].items()):
+        baseline_result = baseline['results'].get(name, {})
+        if 'mean' in result and baseline_result.get('mean'):
+            lines.append('%-24s %10.4fs %10.4fs %8.2fx' % (name, result['mean'],
+                baseline_result['mean'], result['mean'] / baseline_result['mean']))
+        else:
+            lines.append('%-24s %s' % (name, result.get('skipped') or
+                                       baseline_result.get('skipped') or 'n/a'))
+    return lines
+
+def parse_arguments(arg_list):
+    parser = argparse.ArgumentParser(description='Benchmark the OLD using '
+                                     'the lorem ipsum datasets.')
+    parser.add_argument('-c', '--config', default=os.path.join(old_path, 'test.ini'),
+                        help='the config file whose settings are used (default: test.ini)')
+    parser.add_argument('-d', '--dataset', type=int, default=100,
+                        choices=(100, 1000, 10000),
+                        help='the number of sentences in the dataset (default: 100)')
+    parser.add_argument('-r', '--repeat', type=int, default=5,
+                        help='the number of times each operation is repeated (default: 5)')
+    parser.add_argument('-s', '--sample', type=int, default=50,
+                        help='the number of forms updated (default: 50)')
+    parser.add_argument('-t', '--timeout', type=float, default=600,
+                        help='the seconds to wait for a background task (default: 600)')
+    parser.add_argument('-o', '--output', help='the file to write the results to '
+                        '(default: standard output)')
+    parser.add_argument('--compare', help='a results file to compare the results to')
+    return parser.parse_args(arg_list)
+
+if __name__ == '__main__':
+    arguments = parse_arguments(sys.argv[1:])
+    sys.path.insert(0, old_path)
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    results = run(arguments.config, arguments.dataset, arguments.repeat,
+                  arguments.sample, arguments.timeout)
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if arguments.output:
+        with open(arguments.output, 'w') as f:
+            f.write(output)
+    else:
+        print output
+    if arguments.compare:
+        with open(arguments.compare) as f:
+            baseline = json.load(f)
+        print >> sys.stderr, '\n'.join(compare(results, baseline))